@@ -13,6 +13,7 @@ import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.rpkm
 import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+import rnaseqlib.rpkm.transcript_utils as transcript_utils
 import rnaseqlib.mapping
 import rnaseqlib.mapping.mapper_wrappers as mapper_wrappers
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
@@ -23,8 +24,12 @@ import rnaseqlib.RNABase as rna_base
 import rnaseqlib.clip
 import rnaseqlib.clip.clip_utils as clip_utils
 import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.fastx_utils as fastx_utils
 import rnaseqlib.bam
 import rnaseqlib.bam.bam_utils as bam_utils
+import rnaseqlib.bam.jxn_utils as jxn_utils
+import rnaseqlib.bam.insert_len_utils as insert_len_utils
+import rnaseqlib.bam.intron_retention_utils as intron_retention_utils
 import rnaseqlib.motif
 import rnaseqlib.motif.homer_utils as homer_utils
 import rnaseqlib.motif.meme_utils as meme_utils
@@ -73,6 +78,10 @@ class Sample:
         self.events_dir = None
         # RPKM tables for the sample
         self.rpkm_tables = defaultdict(lambda: None)
+        # Junction counts table for the sample
+        self.jxns_filename = None
+        # Insert length distribution file (for paired-end samples)
+        self.insert_len_filename = None
         # Record if a sample is grouped
         # If there's a mixture of single-end and paired-end data
         # then rawdata is a list containing only one sample
@@ -153,17 +162,44 @@ class Pipeline:
     def __init__(self,
                  settings_filename,
                  log_output_dir,
-                 curr_sample=None):
+                 curr_sample=None,
+                 preview_reads=None,
+                 preview_fraction=None,
+                 regions_filename=None):
         """
         Initialize pipeline.
+
+        If 'preview_reads' is given, run in preview mode: only the
+        first 'preview_reads' reads of each sample (or, if
+        'preview_fraction' is given, reads sampled by a hash of their
+        IDs) are mapped and QC'd, and the output goes to a 'preview'
+        subdirectory of the output directory.
+
+        If 'regions_filename' (a BED file) is given, all steps that
+        use the mapped reads are restricted to reads in these
+        regions, and the output goes to a 'regions/<BED name>'
+        subdirectory of the output directory. The reads are
+        preprocessed and mapped in the full run's directories, so
+        that runs on different regions reuse the full run's mapped
+        reads and only redo the steps downstream of mapping.
         """
         # If invoked to run on particular sample
         self.curr_sample = curr_sample
+        # Number of reads and fraction of reads to sample in
+        # preview mode
+        self.preview_reads = preview_reads
+        self.preview_fraction = preview_fraction
+        # BED file of regions to restrict mapped reads to
+        self.regions_filename = regions_filename
+        self.chrom_regions = None
         self.genome = None
         # Output directory for logging pipeline activity
         self.log_output_dir = log_output_dir
         # Output directory for actual pipeline output
         self.output_dir = None
+        # Output directory of the full run (without regions), where
+        # reads are preprocessed and mapped
+        self.reads_output_dir = None
         # Load settings file
         self.settings_filename = settings_filename
         # Load settings
@@ -186,6 +222,8 @@ class Pipeline:
         self.my_cluster = None
         # Pipeline output subdirectories
         self.pipeline_outdirs = {}
+        # Output subdirectories for preprocessed and mapped reads
+        self.reads_outdirs = {}
         # RPKM directory for teh pipeline
         self.rpkm_dir = None
         # QC objects for each sample in pipeline
@@ -195,6 +233,17 @@ class Pipeline:
         self.load_basic_settings()
         # Load the directory where pipeline output should go
         self.output_dir = utils.pathify(self.settings_info["data"]["outdir"])
+        if self.preview_reads is not None:
+            # Keep preview output separate from the full run
+            self.output_dir = os.path.join(self.output_dir, "preview")
+        self.reads_output_dir = self.output_dir
+        if self.regions_filename is not None:
+            # Keep region-restricted output separate from the full run
+            regions_label = \
+                os.path.basename(self.regions_filename).rsplit(".", 1)[0]
+            self.output_dir = os.path.join(self.output_dir,
+                                           "regions",
+                                           regions_label)
         # Create logger
         pipeline_log_name = "Pipeline"
         if self.curr_sample is not None:
@@ -238,11 +287,14 @@ class Pipeline:
         """
         Load pipeline RNA base.
         """
+        # The binary annotation index is opened, if it is built,
+        # when loading the RNA base
         self.rna_base = rna_base.RNABase(self.genome,
                                          None,
-                                         from_dir=self.init_dir)
-        # Load genes information: tables only, without parsing
-        # into gene objects
+                                         from_dir=self.init_dir,
+                                         events_dir=self.gff_events_dir)
+        # Load genes information: from the annotation index, or
+        # tables only, without parsing into gene objects
         self.rna_base.load_gene_tables(tables_only=True)
         
 
@@ -329,6 +381,8 @@ class Pipeline:
         self.toplevel_subdirs["analysis"] = ["rpkm",
                                              "insert_lens",
                                              "events",
+                                             "junctions",
+                                             "intron_retention",
                                              "seqs",
                                              "motifs",
                                              "bed",
@@ -341,11 +395,25 @@ class Pipeline:
             for subdir_name in self.toplevel_subdirs[dirname]:
                 subdir_path = os.path.join(dirpath, subdir_name)
                 utils.make_dir(subdir_path)
+        # Reads are preprocessed and mapped in the full run's
+        # directories (the same as the pipeline's, unless restricted
+        # to regions)
+        for dirname in ["rawdata", "mapping"]:
+            dirpath = os.path.join(self.reads_output_dir, dirname)
+            utils.make_dir(dirpath)
+            self.reads_outdirs[dirname] = dirpath
         # Variables storing commonly accessed directories
         self.rpkm_dir = os.path.join(self.pipeline_outdirs["analysis"],
                                      "rpkm")
         self.events_dir = os.path.join(self.pipeline_outdirs["analysis"],
                                        "events")
+        self.jxns_dir = os.path.join(self.pipeline_outdirs["analysis"],
+                                     "junctions")
+        self.insert_lens_dir = os.path.join(self.pipeline_outdirs["analysis"],
+                                            "insert_lens")
+        self.intron_retention_dir = \
+            os.path.join(self.pipeline_outdirs["analysis"],
+                         "intron_retention")
         self.seqs_dir = os.path.join(self.pipeline_outdirs["analysis"],
                                      "seqs")
         self.motifs_dir = os.path.join(self.pipeline_outdirs["analysis"],
@@ -544,7 +612,7 @@ class Pipeline:
             self.logger.info("Trimming polyAs..")
             trimmed_filename = \
                 ribo_utils.trim_polyA_ends(sample.rawdata.seq_filename,
-                                           self.pipeline_outdirs["rawdata"])
+                                           self.reads_outdirs["rawdata"])
             # Adjust the trimmed file to be the "reads" sequence file for this
             # sample
             sample.rawdata.reads_filename = trimmed_filename
@@ -555,13 +623,13 @@ class Pipeline:
             trimmed_filename = \
                 clip_utils.trim_clip_adaptors(sample.rawdata.seq_filename,
                                               self.adaptors_filename,
-                                              self.pipeline_outdirs["rawdata"],
+                                              self.reads_outdirs["rawdata"],
                                               self.logger)
             sample.rawdata.reads_filename = trimmed_filename
             # Create collapsed versions of sequence files
             sample.rawdata.collapsed_seq_filename = \
                 clip_utils.collapse_clip_reads(sample,
-                                               self.pipeline_outdirs["rawdata"],
+                                               self.reads_outdirs["rawdata"],
                                                self.logger)
             self.logger.info("Collapsed reads filename: %s" \
                              %(sample.rawdata.collapsed_seq_filename))
@@ -583,8 +651,61 @@ class Pipeline:
                 return sample
         return None
             
+
+    def get_preview_filename(self, seq_filename):
+        """
+        Return the filename of the preview subsample of a sequence
+        file: <basename>.preview.<ext> in the rawdata directory.
+        """
+        seq_basename = os.path.basename(seq_filename)
+        gz_ext = ""
+        if seq_basename.endswith(".gz"):
+            seq_basename = seq_basename[0:-len(".gz")]
+            gz_ext = ".gz"
+        if "." in seq_basename:
+            seq_basename, seq_ext = seq_basename.rsplit(".", 1)
+            seq_ext = ".%s" %(seq_ext)
+        else:
+            seq_ext = ""
+        return os.path.join(self.reads_outdirs["rawdata"],
+                            "%s.preview%s%s" %(seq_basename, seq_ext, gz_ext))
+
+
+    def preview_sample_reads(self, sample):
+        """
+        Subsample the raw reads of a sample for preview mode, before
+        any preprocessing. The subsampled reads replace the sample's
+        sequence files, so that only they are preprocessed and mapped.
+        """
+        if sample.paired:
+            sample_rawdata = sample.rawdata
+        else:
+            sample_rawdata = [sample.rawdata]
+        for rawdata in sample_rawdata:
+            preview_filename = self.get_preview_filename(rawdata.seq_filename)
+            if os.path.isfile(preview_filename):
+                self.logger.info("Found %s. Skipping.." %(preview_filename))
+            else:
+                self.logger.info("Sampling %d reads from %s into %s" \
+                                 %(self.preview_reads,
+                                   rawdata.seq_filename,
+                                   preview_filename))
+                num_sampled = \
+                    fastx_utils.subsample_fastx(rawdata.seq_filename,
+                                                preview_filename,
+                                                self.preview_reads,
+                                                fraction=self.preview_fraction)
+                self.logger.info("Sampled %d reads." %(num_sampled))
+            rawdata.seq_filename = preview_filename
+            rawdata.reads_filename = preview_filename
+        return sample
+
             
     def run_on_samples(self):
+        # Build the annotation index once, before the sample
+        # jobs that open it
+        self.rna_base.load_annotation_index(events_dir=self.gff_events_dir,
+                                            build=True)
         samples_job_ids = []
         for sample in self.samples:
             self.logger.info("Processing sample %s" %(sample))
@@ -595,6 +716,13 @@ class Pipeline:
                   sample.label,
                   self.settings_filename,
                   self.output_dir)
+            if self.preview_reads is not None:
+                sample_cmd += " --preview %d" %(self.preview_reads)
+                if self.preview_fraction is not None:
+                    sample_cmd += " --preview-fraction %s" \
+                        %(str(self.preview_fraction))
+            if self.regions_filename is not None:
+                sample_cmd += " --regions %s" %(self.regions_filename)
             self.logger.info("Executing: %s" %(sample_cmd))
             job_id = self.my_cluster.launch_job(sample_cmd, job_name)
             self.logger.info("Job launched with ID %s" %(job_id))
@@ -620,6 +748,10 @@ class Pipeline:
         self.my_cluster.wait_on_jobs(job_ids)
         # Compile all the QC results
         self.compile_qc_output()
+        if self.preview_reads is not None:
+            # Preview runs only produce QC
+            self.logger.info("Preview QC completed!")
+            return
         # Compile all the analysis results
         self.compile_analysis_output()
         # Signal completion
@@ -636,6 +768,11 @@ class Pipeline:
                 self.logger.info("Cannot find sample %s! Exiting.." \
                                  %(label))
                 sys.exit(1)
+            if self.preview_reads is not None:
+                # Subsample before preprocessing, so that only the
+                # sampled reads are preprocessed
+                self.logger.info("Sampling reads for preview")
+                sample = self.preview_sample_reads(sample)
             # Pre-process the data if needed
             self.logger.info("Preprocessing reads")
             sample = self.preprocess_reads(sample)
@@ -645,6 +782,10 @@ class Pipeline:
             # Perform QC
             self.logger.info("Running QC")
             sample = self.run_qc(sample)
+            if self.preview_reads is not None:
+                # Preview runs only produce QC and read cycle profiles
+                sample.qc.output_cycle_profile()
+                return
             # Run gene expression analysis
             self.logger.info("Running analysis")
             sample = self.run_analysis(sample)
@@ -660,6 +801,11 @@ class Pipeline:
 
         Also creates a BAM file containing only the uniquely mapped
         reads, which is used for downstream analyses (e.g. in QC).
+
+        Reads are mapped into the full run's mapping directory, so a
+        run restricted to regions reuses the full run's mapped reads
+        (mapping them only if the full run has not) and keeps only
+        its processed BAMs in its own directory.
         """
         self.logger.info("Mapping reads for sample: %s" %(sample.label))
         mapper = self.settings_info["mapping"]["mapper"]
@@ -671,7 +817,7 @@ class Pipeline:
             bowtie_path = self.settings_info["mapping"]["bowtie_path"]
             index_filename = self.settings_info["mapping"]["bowtie_index"]
             output_filename = "%s" \
-                %(os.path.join(self.pipeline_outdirs["mapping"],
+                %(os.path.join(self.reads_outdirs["mapping"],
                                sample.label))
             bowtie_options = self.settings_info["mapping"]["bowtie_options"]
             # Number of mismatches to use in mapping
@@ -690,7 +836,7 @@ class Pipeline:
         elif mapper == "tophat":
             tophat_path = self.settings_info["mapping"]["tophat_path"]
             sample_mapping_outdir = \
-                os.path.join(self.pipeline_outdirs["mapping"],
+                os.path.join(self.reads_outdirs["mapping"],
                              sample.label)
             self.logger.info("Creating: %s" %(sample_mapping_outdir))
             utils.make_dir(sample_mapping_outdir)
@@ -718,6 +864,9 @@ class Pipeline:
                          sample.label,
                          "processed_bams")
         utils.make_dir(sample.processed_bam_dir)
+        if self.regions_filename is not None:
+            # Restrict all downstream steps to reads in the regions
+            sample.bam_filename = self.get_regions_bam_reads(sample)
         # Get the uniquely mapping reads
         sample.unique_bam_filename = self.get_unique_reads(sample)
         # Get the ribo-subtracted mapping reads
@@ -830,6 +979,35 @@ class Pipeline:
         return expected_bam_filename
 
 
+    def get_regions_bam_reads(self, sample):
+        """
+        Get the reads in the pipeline's regions from the reads BAM
+        file, fetched using the BAM index, and put them in a new
+        sorted and indexed file.
+        """
+        self.logger.info("Getting reads in regions for %s" %(sample.label))
+        bam_basename = os.path.basename(sample.bam_filename)
+        regions_bam_filename = \
+            os.path.join(sample.processed_bam_dir,
+                         "%s.regions.bam" %(bam_basename.split(".bam")[0]))
+        self.logger.info("  - Output file: %s" %(regions_bam_filename))
+        if os.path.isfile(regions_bam_filename):
+            self.logger.info("Found %s. Skipping.." %(regions_bam_filename))
+            return regions_bam_filename
+        if self.chrom_regions is None:
+            self.logger.info("Loading regions from: %s" \
+                             %(self.regions_filename))
+            self.chrom_regions = \
+                bam_utils.load_bed_regions(self.regions_filename)
+        # Fetching by region requires a sorted, indexed BAM
+        sorted_bam_filename = self.sort_and_index_bam(sample.bam_filename)
+        num_reads = bam_utils.fetch_regions_bam(sorted_bam_filename,
+                                                self.chrom_regions,
+                                                regions_bam_filename)
+        self.logger.info("Found %d reads in regions." %(num_reads))
+        return regions_bam_filename
+
+
     def get_ribosub_bam_reads(self, sample, chr_ribo="chrRibo"):
         """
         Subtract the rRNA-mapping reads away from the BAM file
@@ -982,6 +1160,8 @@ class Pipeline:
         self.logger.info("Compiling analysis output for all samples...")
         # Compile RPKM results
         self.compile_rpkms_output()
+        # Compile junction counts
+        self.compile_jxns_output()
 
 
     def compile_rpkms_output(self):
@@ -1012,6 +1192,180 @@ class Pipeline:
                               index=False)
 
 
+    def compile_jxns_output(self):
+        """
+        Compile junction counts for all samples into a sparse
+        junction by sample matrix.
+        """
+        sample_labels = []
+        sample_jxn_records = []
+        for sample in self.samples:
+            jxns_filename = os.path.join(self.jxns_dir,
+                                         "%s.jxns.txt" %(sample.label))
+            if not os.path.isfile(jxns_filename):
+                continue
+            sample_labels.append(sample.label)
+            sample_jxn_records.append(jxn_utils.load_jxn_table(jxns_filename))
+        if len(sample_labels) == 0:
+            self.logger.info("No junction counts to compile.")
+            return
+        matrix_prefix = os.path.join(self.jxns_dir, "jxn_counts")
+        self.logger.info("Outputting junction counts matrix to: %s" \
+                         %(matrix_prefix))
+        jxn_utils.output_jxn_matrix(sample_labels,
+                                    sample_jxn_records,
+                                    matrix_prefix)
+
+
+    def output_jxns(self, sample):
+        """
+        Output junction counts for a sample, from the CIGAR
+        of its spliced alignments.
+        """
+        self.logger.info("Outputting junction counts for sample: %s" \
+                         %(sample.label))
+        sample.jxns_filename = os.path.join(self.jxns_dir,
+                                            "%s.jxns.txt" %(sample.label))
+        if os.path.isfile(sample.jxns_filename):
+            self.logger.info("Found %s. Skipping.." \
+                             %(sample.jxns_filename))
+            return sample
+        num_processors = self.settings_info["mapping"]["num_processors"]
+        jxn_records = \
+            jxn_utils.count_bam_jxns(sample.bam_filename,
+                                     num_processors=num_processors)
+        self.logger.info("  - Found %d junctions" %(len(jxn_records)))
+        jxn_utils.output_jxn_table(jxn_records, sample.jxns_filename)
+        return sample
+
+
+    def output_insert_lens(self, sample,
+                           table_name="ensGene"):
+        """
+        Output insert length distribution for a paired-end sample,
+        estimated from read pairs in constitutive exons.
+        """
+        self.logger.info("Outputting insert lengths for sample: %s" \
+                         %(sample.label))
+        if table_name not in self.rna_base.tables_to_const_exons:
+            self.logger.warning("No constitutive exons for %s. Cannot " \
+                                "compute insert lengths." %(table_name))
+            return sample
+        sample.insert_len_filename = \
+            os.path.join(self.insert_lens_dir,
+                         "%s.insert_len" %(sample.label))
+        if os.path.isfile(sample.insert_len_filename):
+            self.logger.info("Found %s. Skipping.." \
+                             %(sample.insert_len_filename))
+            return sample
+        const_exons = self.rna_base.tables_to_const_exons[table_name]
+        regions = insert_len_utils.get_const_exon_regions(const_exons)
+        insert_len_dist = \
+            insert_len_utils.compute_insert_lens(sample.bam_filename,
+                                                 regions)
+        if insert_len_dist is None:
+            self.logger.warning("No properly paired mates found in %s" \
+                                %(sample.bam_filename))
+            return sample
+        self.logger.info("  - mean=%.1f, sdev=%.1f, num_pairs=%d" \
+                         %(insert_len_dist["mean"],
+                           insert_len_dist["sdev"],
+                           insert_len_dist["num_pairs"]))
+        insert_len_utils.output_insert_lens(insert_len_dist,
+                                            sample.insert_len_filename)
+        return sample
+
+
+    def output_intron_retention(self, sample, table_name="ensGene"):
+        """
+        Output intron retention metrics for the gene table's introns
+        and for RI events (if a GFF events directory is given),
+        computed in one pass over the sample's unique reads.
+        """
+        self.logger.info("Outputting intron retention for sample: %s" \
+                         %(sample.label))
+        gene_table = self.rna_base.gene_tables[table_name]
+        # Introns to quantify, by label
+        introns_gffs = []
+        introns_gff_fname = os.path.join(gene_table.introns_dir,
+                                         "%s.introns.gff" %(table_name))
+        if os.path.isfile(introns_gff_fname):
+            introns_gffs.append(("%s.introns" %(table_name),
+                                 introns_gff_fname))
+        if self.gff_events_dir is not None:
+            gff_filenames = \
+                utils.get_gff_filenames_in_dir(self.gff_events_dir)
+            for gff_fname in gff_filenames:
+                gff_label = os.path.basename(utils.trim_gff_ext(gff_fname))
+                if gff_label.startswith("RI."):
+                    introns_gffs.append((gff_label, gff_fname))
+        all_introns = []
+        introns_ranges = []
+        for introns_label, gff_fname in introns_gffs:
+            ir_fname = os.path.join(self.intron_retention_dir,
+                                    "%s.%s.ir.txt" %(sample.label,
+                                                     introns_label))
+            if os.path.isfile(ir_fname):
+                self.logger.info("Found %s. Skipping.." %(ir_fname))
+                continue
+            if introns_label.startswith("RI"):
+                introns = intron_retention_utils.load_ri_introns(gff_fname)
+            else:
+                introns = intron_retention_utils.load_gff_introns(gff_fname)
+            self.logger.info("  - Loaded %d introns from %s" \
+                             %(len(introns), gff_fname))
+            introns_ranges.append((ir_fname, len(all_introns),
+                                   len(all_introns) + len(introns)))
+            all_introns.extend(introns)
+        if len(all_introns) == 0:
+            return sample
+        ir = \
+            intron_retention_utils.compute_intron_retention(sample.unique_bam_filename,
+                                                            all_introns)
+        for ir_fname, first, last in introns_ranges:
+            self.logger.info("Outputting intron retention to: %s" %(ir_fname))
+            curr_ir = dict((key, vals[first:last]) \
+                           for key, vals in ir.iteritems())
+            intron_retention_utils.output_intron_retention(all_introns[first:last],
+                                                           curr_ir,
+                                                           ir_fname)
+        return sample
+
+
+    def output_tpms(self, sample, table_name="ensGene"):
+        """
+        Output transcript-level read counts and TPMs, estimated
+        by EM over equivalence classes of uniquely mapping reads.
+        """
+        self.logger.info("Outputting transcript TPMs for sample: %s" \
+                         %(sample.label))
+        sample_rpkm_outdir = os.path.join(self.rpkm_dir, sample.label)
+        utils.make_dir(sample_rpkm_outdir)
+        tpm_filename = os.path.join(sample_rpkm_outdir,
+                                    "%s.tpm" %(table_name))
+        if os.path.isfile(tpm_filename):
+            self.logger.info("Found %s. Skipping.." %(tpm_filename))
+            return sample
+        # Use the mean insert length as fragment length for
+        # paired-end samples, and the read length otherwise
+        frag_len = self.settings_info["mapping"]["readlen"]
+        if sample.paired and (sample.insert_len_filename is not None) and \
+           os.path.isfile(sample.insert_len_filename):
+            frag_len = \
+                insert_len_utils.load_insert_len_mean(sample.insert_len_filename)
+        self.logger.info("  - Fragment length: %.1f" %(frag_len))
+        genes = self.rna_base.get_genes(table_name)
+        trans_index, trans_counts, tpms = \
+            transcript_utils.quantify_transcripts(sample.unique_bam_filename,
+                                                  genes,
+                                                  frag_len=frag_len)
+        self.logger.info("Outputting TPMs to: %s" %(tpm_filename))
+        transcript_utils.output_tpms(trans_index, trans_counts, tpms,
+                                     tpm_filename,
+                                     frag_len=frag_len)
+        return sample
+
+
     def output_rpkms(self, sample):
         """
         Output RPKMs.
@@ -1394,6 +1748,23 @@ class Pipeline:
         # Compute RPKMs
         self.output_rpkms(sample)
         ##
+        ## RNA-Seq specific analysis steps
+        ##
+        if sample.sample_type == "rnaseq":
+            # Count splice junctions
+            if self.settings_info["settings"]["count_jxns"]:
+                self.output_jxns(sample)
+            # Estimate insert lengths of paired-end samples
+            if sample.paired and \
+               self.settings_info["settings"]["compute_insert_lens"]:
+                self.output_insert_lens(sample)
+            # Quantify transcripts
+            if self.settings_info["settings"]["compute_tpms"]:
+                self.output_tpms(sample)
+            # Quantify intron retention
+            if self.settings_info["settings"]["compute_intron_retention"]:
+                self.output_intron_retention(sample)
+        ##
         ## Ribo-Seq specific analysis steps
         ##
         if sample.sample_type == "riboseq":
@@ -8,6 +8,7 @@ import csv
 import rnaseqlib
 import rnaseqlib.fastx_utils as fastx_utils
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
+import rnaseqlib.bam.saturation_utils as saturation_utils
 import rnaseqlib.utils as utils
 
 import numpy
@@ -53,7 +54,8 @@ class QualityControl:
                                 "3p_to_cds",
                                 "5p_to_cds",
                                 "3p_to_5p",
-                                "exon_intron_ratio"]
+                                "exon_intron_ratio",
+                                "genebody_3p_to_5p"]
         self.qc_header = ["num_reads", 
                           "num_mapped",
                           "num_ribosub_mapped",
@@ -77,6 +79,19 @@ class QualityControl:
         self.qc_loaded = False
         # use ensGene gene table for QC computations
         self.gene_table = self.pipeline.rna_base.gene_tables["ensGene"]
+        # Gene body coverage accumulator
+        self.genebody_cov = None
+        self.genebody_filename = os.path.join(self.sample_outdir,
+                                              "%s.genebody.txt" \
+                                              %(self.sample.label))
+        # Saturation curves filename
+        self.saturation_filename = os.path.join(self.sample_outdir,
+                                                "%s.saturation.txt" \
+                                                %(self.sample.label))
+        # Sequence cycle profile filename
+        self.cycle_profile_filename = \
+            os.path.join(self.sample_outdir,
+                         "%s.cycle_profile.txt" %(self.sample.label))
         # Load QC information if file corresponding to sample
         # already exists
         self.load_qc_from_file()
@@ -399,12 +414,19 @@ class QualityControl:
         bam_file = pysam.Samfile(qc_regions_bam, "rb")
         self.logger.info("Counting reads in: %s" %(qc_regions_bam))
         region_counts = defaultdict(int)
+        # Accumulate gene body coverage in the same pass
+        self.logger.info("Loading representative transcripts for " \
+                         "gene body coverage..")
+        self.genebody_cov = \
+            GeneBodyCoverage(self.gene_table.get_representative_transcripts())
+        self.genebody_cov.set_references(bam_file.references)
         ##
         ## Map transcripts to region types and hits
         ##
         self.region_counts_by_transcript = \
             defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
         for bam_read in bam_file:
+            self.genebody_cov.add_read(bam_read)
             # Read aligns to region of interest
             regions_field = None
             try:
@@ -477,8 +499,33 @@ class QualityControl:
         # Collect sum of all the QC regions
         self.qc_results["qc_regions_total"] = \
             self.qc_results["num_exons"] + self.qc_results["num_introns"]
+        # Output gene body coverage
+        self.logger.info("Outputting gene body coverage (%d transcripts) " \
+                         "to: %s" %(self.genebody_cov.num_transcripts,
+                                    self.genebody_filename))
+        self.genebody_cov.output_coverage(self.genebody_filename)
         
 
+    def compute_saturation(self):
+        """
+        Compute saturation curves: number of genes and junctions
+        detected at subsamples of the uniquely mapped reads.
+        """
+        if os.path.isfile(self.saturation_filename):
+            self.logger.info("Found %s. Skipping.." \
+                             %(self.saturation_filename))
+            return
+        self.logger.info("Computing saturation curves..")
+        gene_exons = saturation_utils.get_gene_exons(self.gene_table)
+        saturation = \
+            saturation_utils.compute_saturation(self.sample.unique_bam_filename,
+                                                gene_exons)
+        self.logger.info("Outputting saturation curves to: %s" \
+                         %(self.saturation_filename))
+        saturation_utils.output_saturation(saturation,
+                                           self.saturation_filename)
+
+
     def compute_basic_qc(self):
         """
         Compute basic QC stats like number of reads mapped.
@@ -707,6 +754,15 @@ class QualityControl:
         # return power(2, ratio_3p_to_5p)
         
 
+    def get_genebody_3p_to_5p(self):
+        """
+        Get ratio of 3' to 5' gene body coverage.
+        """
+        if self.genebody_cov is None:
+            return self.na_val
+        return self.genebody_cov.get_3p_to_5p()
+
+
     def compute_qc_stats(self):
         """
         Compute various statistics from the QC numbers we have.
@@ -729,7 +785,8 @@ class QualityControl:
                               ("3p_to_cds", self.get_3p_to_cds),
                               ("5p_to_cds", self.get_5p_to_cds),
                               ("3p_to_5p", self.get_3p_to_5p),
-                              ("exon_intron_ratio", self.get_exon_intron_ratio)]
+                              ("exon_intron_ratio", self.get_exon_intron_ratio),
+                              ("genebody_3p_to_5p", self.get_genebody_3p_to_5p)]
         for stat_name, stat_func in self.qc_stat_funcs:
             self.qc_results[stat_name] = stat_func()
         
@@ -750,6 +807,12 @@ class QualityControl:
             self.compute_basic_qc()
             # Number of reads in various regions
             self.compute_regions()
+            # Saturation of genes and junctions detected, if
+            # requested (never in preview mode, where reads are
+            # already subsampled)
+            if self.settings_info["settings"]["compute_saturation"] and \
+               (self.pipeline.preview_reads is None):
+                self.compute_saturation()
             # Compute statistics from these results
             self.compute_qc_stats()
         # Set that QC results were loaded
@@ -783,7 +846,7 @@ class QualityControl:
         Compute the average 'N' bases (unable to sequence)
         as a function of the position of the read.
         """
-        fastq_entries = fastx_utils.get_read_fastx(fastq_filename)
+        fastq_entries = fastx_utils.get_fastx_entries(fastq_filename)
         # Mapping from position in read to number of Ns
         num_n_bases = defaultdict(int)
         # Mapping from position in read to total number of
@@ -798,7 +861,8 @@ class QualityControl:
                 # Stop at requested number of entries if asked to
                 if num_entries >= first_n_seqs:
                     break
-            header1, seq, header2, qual = entry
+            # Sequence is second field of FASTA and FASTQ entries
+            seq = entry[1]
             seq_len = len(seq)
             for n in range(seq_len):
                 if seq[n] == "N":
@@ -808,13 +872,225 @@ class QualityControl:
             num_entries += 1
         # Compute percentage of N along each position
         percent_n = []
-        for base_pos in range(max(num_reads.keys())):
+        for base_pos in range(max(num_reads.keys()) + 1):
             curr_percent_n = \
                 float(num_n_bases[base_pos]) / num_reads[base_pos]
             percent_n.append(curr_percent_n)
         return percent_n
 
-        
+
+    def output_cycle_profile(self, first_n_seqs=None):
+        """
+        Output the sequence cycle profile (percent of 'N' bases
+        at each read position) of the sample's reads. For paired-end
+        samples, the profile of each mate is output.
+        """
+        if os.path.isfile(self.cycle_profile_filename):
+            self.logger.info("Found %s. Skipping.." \
+                             %(self.cycle_profile_filename))
+            return
+        if self.sample.paired:
+            sample_rawdata = self.sample.rawdata
+        else:
+            sample_rawdata = [self.sample.rawdata]
+        self.logger.info("Outputting sequence cycle profile to: %s" \
+                         %(self.cycle_profile_filename))
+        with open(self.cycle_profile_filename, "w") as profile_out:
+            profile_out.write("label\tposition\tpercent_n\n")
+            for rawdata in sample_rawdata:
+                percent_n = \
+                    self.get_seq_cycle_profile(rawdata.reads_filename,
+                                               first_n_seqs=first_n_seqs)
+                for base_pos, curr_percent_n in enumerate(percent_n):
+                    profile_out.write("%s\t%d\t%.4f\n" \
+                                      %(rawdata.label,
+                                        base_pos + 1,
+                                        curr_percent_n))
+
+
+class GeneBodyCoverage:
+    """
+    Accumulator of read coverage along the gene body.
+
+    Maps the start of each alignment to a normalized position
+    (5' to 3') along a set of representative transcripts and
+    counts reads in 'num_bins' bins of transcript position.
+    Transcripts that overlap each other are excluded, so that
+    each read position falls in at most one exon.
+    """
+    def __init__(self, transcripts,
+                 num_bins=100,
+                 min_transcript_len=500,
+                 chunk_size=500000):
+        self.num_bins = num_bins
+        self.min_transcript_len = min_transcript_len
+        self.chunk_size = chunk_size
+        self.na_val = "NA"
+        # Coverage counts by bin
+        self.bin_counts = numpy.zeros(num_bins, dtype=numpy.int64)
+        self.num_transcripts = 0
+        # Per chromosome exon arrays, sorted by start
+        self.chrom_exons = {}
+        self.load_transcripts(transcripts)
+        # Buffered read positions, by BAM reference ID
+        self.tid_to_chrom = None
+        self.read_tids = []
+        self.read_positions = []
+
+
+    def load_transcripts(self, transcripts):
+        """
+        Index the exons of the given transcripts, a list of
+        (transcript_id, chrom, strand, exon_starts, exon_ends)
+        tuples with 1-based exon coordinates.
+        """
+        transcripts_by_chrom = defaultdict(list)
+        for transcript in transcripts:
+            trans_id, chrom, strand, exon_starts, exon_ends = transcript
+            trans_len = sum(exon_ends) - sum(exon_starts) + len(exon_starts)
+            if trans_len < self.min_transcript_len:
+                continue
+            transcripts_by_chrom[chrom].append(transcript)
+        for chrom, chrom_transcripts in transcripts_by_chrom.iteritems():
+            chrom_transcripts.sort(key=lambda t: min(t[3]))
+            # Exclude transcripts that overlap another transcript
+            spans = numpy.array([[min(t[3]), max(t[4])] \
+                                 for t in chrom_transcripts])
+            max_prev_ends = numpy.maximum.accumulate(spans[:, 1])
+            overlaps_prev = numpy.zeros(len(spans), dtype=bool)
+            overlaps_prev[1:] = spans[1:, 0] <= max_prev_ends[:-1]
+            overlaps_next = numpy.zeros(len(spans), dtype=bool)
+            overlaps_next[:-1] = spans[1:, 0] <= spans[:-1, 1]
+            keep = ~(overlaps_prev | overlaps_next)
+            starts = []
+            ends = []
+            # Offset of the exon start in the transcript,
+            # counting from the 5' end
+            offsets = []
+            trans_lens = []
+            strands = []
+            for transcript, to_keep in zip(chrom_transcripts, keep):
+                if not to_keep:
+                    continue
+                trans_id, chrom, strand, exon_starts, exon_ends = transcript
+                exon_coords = sorted(zip(exon_starts, exon_ends))
+                exon_lens = [end - start + 1 for start, end in exon_coords]
+                trans_len = sum(exon_lens)
+                cum_lens = numpy.cumsum([0] + exon_lens[:-1])
+                for (start, end), cum_len in zip(exon_coords, cum_lens):
+                    starts.append(start)
+                    ends.append(end)
+                    offsets.append(cum_len)
+                    trans_lens.append(trans_len)
+                    strands.append(strand == "-")
+                self.num_transcripts += 1
+            if len(starts) == 0:
+                continue
+            self.chrom_exons[chrom] = \
+                {"starts": numpy.array(starts, dtype=numpy.int64),
+                 "ends": numpy.array(ends, dtype=numpy.int64),
+                 "offsets": numpy.array(offsets, dtype=numpy.int64),
+                 "trans_lens": numpy.array(trans_lens, dtype=numpy.int64),
+                 "is_minus": numpy.array(strands, dtype=bool)}
+
+
+    def set_references(self, references):
+        """
+        Set the chromosome names of the BAM reference IDs.
+        """
+        self.tid_to_chrom = list(references)
+
+
+    def add_read(self, bam_read):
+        """
+        Add an alignment to the coverage.
+        """
+        if bam_read.is_unmapped:
+            return
+        self.read_tids.append(bam_read.tid)
+        self.read_positions.append(bam_read.pos + 1)
+        if len(self.read_positions) >= self.chunk_size:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Add the buffered read positions to the bin counts.
+        """
+        if len(self.read_positions) == 0:
+            return
+        tids = numpy.array(self.read_tids, dtype=numpy.int64)
+        positions = numpy.array(self.read_positions, dtype=numpy.int64)
+        self.read_tids = []
+        self.read_positions = []
+        for tid in numpy.unique(tids):
+            chrom = self.tid_to_chrom[tid]
+            if chrom not in self.chrom_exons:
+                continue
+            exons = self.chrom_exons[chrom]
+            curr_positions = positions[tids == tid]
+            # Exon with the closest start at or before each read
+            exon_inds = numpy.searchsorted(exons["starts"],
+                                           curr_positions,
+                                           side="right") - 1
+            in_exon = exon_inds >= 0
+            in_exon[in_exon] = \
+                curr_positions[in_exon] <= exons["ends"][exon_inds[in_exon]]
+            exon_inds = exon_inds[in_exon]
+            curr_positions = curr_positions[in_exon]
+            # Position in the transcript, 5' to 3'
+            trans_pos = exons["offsets"][exon_inds] + \
+                (curr_positions - exons["starts"][exon_inds])
+            trans_lens = exons["trans_lens"][exon_inds]
+            is_minus = exons["is_minus"][exon_inds]
+            trans_pos[is_minus] = \
+                trans_lens[is_minus] - 1 - trans_pos[is_minus]
+            bins = (trans_pos * self.num_bins) // trans_lens
+            self.bin_counts += numpy.bincount(bins,
+                                              minlength=self.num_bins)
+
+
+    def get_coverage(self):
+        """
+        Return the normalized coverage in each bin (5' to 3'),
+        scaled so that the maximum bin is 1.
+        """
+        self.flush()
+        max_count = self.bin_counts.max()
+        if max_count == 0:
+            return numpy.zeros(self.num_bins)
+        return self.bin_counts / float(max_count)
+
+
+    def get_3p_to_5p(self, frac=0.2):
+        """
+        Return the ratio of coverage in the 3' most 'frac' of
+        the gene body to the coverage in the 5' most 'frac'.
+        """
+        self.flush()
+        num_end_bins = max(1, int(self.num_bins * frac))
+        cov_5p = self.bin_counts[0:num_end_bins].sum()
+        cov_3p = self.bin_counts[-num_end_bins:].sum()
+        if cov_5p == 0:
+            return self.na_val
+        return cov_3p / float(cov_5p)
+
+
+    def output_coverage(self, output_filename):
+        """
+        Output gene body coverage: reads and normalized
+        coverage per bin.
+        """
+        coverage = self.get_coverage()
+        with open(output_filename, "w") as cov_out:
+            cov_out.write("bin\tnum_reads\tcoverage\n")
+            for bin_num in range(self.num_bins):
+                cov_out.write("%d\t%d\t%.4f\n" \
+                              %(bin_num,
+                                self.bin_counts[bin_num],
+                                coverage[bin_num]))
+
+
 class QCStats:
     """
     Represntation of QC stats for a set of samples.
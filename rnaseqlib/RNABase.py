@@ -12,6 +12,7 @@ import rnaseqlib
 import rnaseqlib.init as init
 import rnaseqlib.utils as utils
 import rnaseqlib.tables as tables
+import rnaseqlib.genes.AnnotationIndex as AnnotationIndex
 from rnaseqlib.init import download_seqs
 
 
@@ -23,7 +24,8 @@ class RNABase:
     def __init__(self, genome, output_dir,
                  with_index=True,
                  from_dir=None,
-                 init_params={}):
+                 init_params={},
+                 events_dir=None):
         self.genome = genome
         self.with_index = with_index
         self.indices_dir = None
@@ -41,6 +43,8 @@ class RNABase:
         self.gene_tables = {}
         # Mapping from tables to const exons information
         self.tables_to_const_exons = {}
+        # Binary annotation index, if loaded
+        self.annotation_index = None
         self.output_dir = None
         if from_dir is None:
             self.output_dir = os.path.join(output_dir,
@@ -48,18 +52,24 @@ class RNABase:
         else:
             self.output_dir = from_dir
             # Load the RNABase from a given directory
-            self.load_base(from_dir)
+            self.load_base(from_dir, events_dir=events_dir)
             
 
-    def load_base(self, input_dir):
+    def load_base(self, input_dir, events_dir=None):
         """
         Loading RNABase from directory.
+
+        The annotation index is opened first, if it is built, so
+        that genes and constitutive exons are loaded from it
+        rather than parsed from the tables ('events_dir' is the
+        events GFF directory the index is built with).
         """
         print "Loading RNA base from: %s" %(input_dir)
         if not os.path.isdir(input_dir):
             print "Error: Cannot find RNA base directory: %s" %(input_dir)
             sys.exit(1)
         self.ucsc_tables_dir = os.path.join(input_dir, "ucsc")
+        self.load_annotation_index(events_dir=events_dir)
         self.load_rpkm_info()
         self.load_qc_info()
 
@@ -80,15 +90,20 @@ class RNABase:
 
     def load_gene_tables(self, tables_only=False):
         """
-        Load gene information.
+        Load gene information: from the annotation index if it
+        is loaded and indexes the table, otherwise from the table.
         """
         # Load all UCSC headers
         headers = tables.load_ucsc_table_headers(self.output_dir)
         # Load all gene tables
         for table_name in self.gene_table_names:
+            annotation_index = None
+            if table_name == "ensGene":
+                annotation_index = self.annotation_index
             table = tables.GeneTable(self.ucsc_tables_dir,
                                      table_name,
-                                     tables_only=tables_only)
+                                     tables_only=tables_only,
+                                     annotation_index=annotation_index)
             self.gene_tables[table_name] = table
         return table
 
@@ -99,12 +114,120 @@ class RNABase:
         """
         const_exons_dir = self.get_const_exons_dir()
         for table_name in self.rpkm_table_names:
-            const_exons = tables.ConstExons(table_name,
-                                            from_dir=const_exons_dir)
+            const_exons = \
+                tables.ConstExons(table_name,
+                                  from_dir=const_exons_dir,
+                                  annotation_index=self.annotation_index)
             if const_exons.found:
                 self.tables_to_const_exons[table_name] = const_exons
 
 
+    def get_annotation_index_dir(self):
+        return os.path.join(self.output_dir, "annotation_index")
+
+
+    def get_annotation_sources(self, events_dir=None):
+        """
+        Return the files the annotation index is built from: a
+        mapping from source names to (filename, interval set,
+        GFF record type). Sources that are not interval sets
+        have None for set and record type.
+        """
+        ucsc_tables_dir = os.path.join(self.output_dir, "ucsc")
+        const_exons_dir = os.path.join(ucsc_tables_dir,
+                                       "exons",
+                                       "const_exons")
+        sources = {}
+        sources["ensGene"] = (os.path.join(ucsc_tables_dir, "ensGene.txt"),
+                              None, None)
+        # Tables that gene names and descriptions come from
+        for table_name in ["kgXref", "knownToEnsembl", "ensemblToGeneName"]:
+            sources[table_name] = \
+                (os.path.join(ucsc_tables_dir, "%s.txt" %(table_name)),
+                 None, None)
+        sources["ensGene.introns"] = \
+            (os.path.join(ucsc_tables_dir, "introns", "ensGene.introns.gff"),
+             "introns", "intron")
+        for table_name in self.rpkm_table_names:
+            sources["%s.const_exons" %(table_name)] = \
+                (os.path.join(const_exons_dir,
+                              "%s.const_exons.gff" %(table_name)),
+                 "const_exons.%s" %(table_name), "exon")
+        if events_dir is not None:
+            for gff_fname in utils.get_gff_filenames_in_dir(events_dir):
+                event_type = os.path.basename(utils.trim_gff_ext(gff_fname))
+                sources["events.%s" %(event_type)] = \
+                    (gff_fname, "events.%s" %(event_type), "gene")
+        return sources
+
+
+    def build_annotation_index(self, events_dir=None):
+        """
+        Build the binary annotation index (see
+        AnnotationIndex.build_index) from the gene tables,
+        their introns and constitutive exons, and optionally
+        the events GFFs in events_dir.
+        """
+        sources = self.get_annotation_sources(events_dir=events_dir)
+        ensGene_table = tables.GeneTable(os.path.join(self.output_dir, "ucsc"),
+                                         "ensGene",
+                                         tables_only=True)
+        gene_store = ensGene_table.get_genes(as_store=True)
+        source_fnames = {}
+        gff_interval_sets = {}
+        for source_name, (source_fname, set_name, rec_type) in \
+            sources.iteritems():
+            if not os.path.isfile(source_fname):
+                print "WARNING: Cannot find %s, not indexing it." \
+                    %(source_fname)
+                continue
+            source_fnames[source_name] = source_fname
+            if set_name is not None:
+                gff_interval_sets[set_name] = (source_fname, rec_type)
+        AnnotationIndex.build_index(self.get_annotation_index_dir(),
+                                    gene_store,
+                                    source_fnames,
+                                    gff_interval_sets=gff_interval_sets,
+                                    gene_names=ensGene_table.genes_to_names,
+                                    gene_descs=ensGene_table.genes_to_desc)
+
+
+    def load_annotation_index(self, events_dir=None, build=False):
+        """
+        Open the annotation index by memory mapping it, if it is
+        current with respect to its sources. If 'build' is True,
+        a missing or stale index is (re)built first.
+
+        Returns the index, or None if it could not be opened.
+        """
+        index_dir = self.get_annotation_index_dir()
+        sources = self.get_annotation_sources(events_dir=events_dir)
+        source_fnames = dict((source_name, source[0]) \
+                             for source_name, source in sources.iteritems() \
+                             if os.path.isfile(source[0]))
+        if not AnnotationIndex.is_index_current(index_dir, source_fnames):
+            if not build:
+                print "Annotation index in %s is missing or out of date." \
+                    %(index_dir)
+                return None
+            self.build_annotation_index(events_dir=events_dir)
+        self.annotation_index = AnnotationIndex.AnnotationIndex(index_dir)
+        return self.annotation_index
+
+
+    def get_genes(self, table_name="ensGene"):
+        """
+        Return the genes of a gene table: from the annotation
+        index if it is loaded and indexes the table, otherwise
+        parsed from the table.
+        """
+        if self.annotation_index is not None and table_name == "ensGene":
+            return self.annotation_index.genes
+        if table_name not in self.gene_tables:
+            self.load_gene_tables(tables_only=True)
+        return self.gene_tables[table_name].get_genes()
+
+
     def load_qc_info(self):
         """
         Load all information needed to compute QC.
@@ -132,7 +255,10 @@ class RNABase:
         print "Fetching tables.."
         # Download and process UCSC tables
         tables.download_ucsc_tables(self.genome,
-                                    self.output_dir)
+                                    self.output_dir,
+                                    num_processors=\
+                                      self.init_params.get("num_processors", 1),
+                                    ucsc_url=self.init_params.get("ucsc_url"))
         tables.process_ucsc_tables(self.genome,
                                    self.output_dir,
                                    init_params=self.init_params)
@@ -211,4 +337,5 @@ class RNABase:
         print "Initializing RNA base..."
         self.download_seqs()
         self.download_tables()
+        self.build_annotation_index()
         self.build_indices()
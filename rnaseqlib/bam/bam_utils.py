@@ -11,6 +11,7 @@ import pysam
 
 import rnaseqlib
 import rnaseqlib.fastx_utils as fastx_utils
+import rnaseqlib.sort_utils as sort_utils
 
 
 
@@ -43,17 +44,20 @@ def bam_to_bed(bam_fname, bed_fname,
       - extend_read_to_len: extend each read interval to be
         at least this many nucleotides long.
     """
-    # Convert BAM -> BED, sort BED and extend reads if asked
-    bamToBed_cmd = "bamToBed -i %s -cigar | sortBed -i - " \
-        %(bam_fname)
+    # Convert BAM -> BED, sort BED (with an external sort)
+    # and extend reads if asked
+    bed_proc = subprocess.Popen(["bamToBed", "-i", bam_fname, "-cigar"],
+                                stdout=subprocess.PIPE)
+    bed_lines = bed_proc.stdout
     # If asked to skip junctions, remove them from BED
     if skip_junctions:
-        bamToBed_cmd += " | awk \'$7 !~ \"N\" { print $0 }\'"
-    bed_proc = subprocess.Popen(bamToBed_cmd, shell=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+        bed_lines = (line for line in bed_lines \
+                     if "N" not in line.split("\t")[6])
+    tmp_dir = os.path.dirname(os.path.abspath(bed_fname))
+    sorted_lines = sort_utils.iter_sorted_lines(bed_lines,
+                                                tmp_dir=tmp_dir)
     with open(bed_fname, "w") as bed_out:
-        for line in iter(bed_proc.stdout.readline, ""):
+        for line in sorted_lines:
             fields = line.strip().split("\t")
             start, end = int(fields[1]), int(fields[2])
             interval_len = end - start + 1
@@ -65,6 +69,7 @@ def bam_to_bed(bam_fname, bed_fname,
             fields[1], fields[2] = str(start), str(end)
             processed_line = "%s\n" %("\t".join(fields))
             bed_out.write(processed_line)
+    bed_proc.wait()
             
 
 ##
@@ -125,3 +130,73 @@ def bam_to_fastx(logger, in_file, out_file,
 
 
 
+
+
+##
+## Utilities for restricting BAM files to regions
+##
+def load_bed_regions(bed_filename):
+    """
+    Load regions from a BED file, merging overlapping or
+    adjacent regions on each chromosome.
+
+    Returns a mapping from chromosome to a sorted list of
+    (start, end) tuples in 0-based, end-exclusive coordinates.
+    """
+    chrom_regions = {}
+    with open(bed_filename) as bed_in:
+        for line in bed_in:
+            if line.startswith("#") or line.startswith("track") or \
+               line.startswith("browser") or line.strip() == "":
+                continue
+            fields = line.strip().split("\t")
+            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            if chrom not in chrom_regions:
+                chrom_regions[chrom] = []
+            chrom_regions[chrom].append((start, end))
+    for chrom, regions in chrom_regions.iteritems():
+        regions.sort()
+        merged_regions = [regions[0]]
+        for start, end in regions[1:]:
+            prev_start, prev_end = merged_regions[-1]
+            if start <= prev_end:
+                merged_regions[-1] = (prev_start, max(prev_end, end))
+            else:
+                merged_regions.append((start, end))
+        chrom_regions[chrom] = merged_regions
+    return chrom_regions
+
+
+def fetch_regions_bam(bam_filename, chrom_regions, output_filename):
+    """
+    Output the alignments of a sorted, indexed BAM file that
+    overlap the given regions (see load_bed_regions) to a new
+    BAM file, using the BAM index to fetch only these regions.
+
+    Alignments that overlap several regions are output once,
+    and the output is sorted and indexed.
+
+    Returns the number of alignments output.
+    """
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    regions_bam = pysam.Samfile(output_filename, "wb", template=bam_file)
+    num_reads = 0
+    # Visit chromosomes in the order of the BAM header so
+    # that the output stays sorted
+    for chrom in bam_file.references:
+        if chrom not in chrom_regions:
+            continue
+        prev_end = None
+        for start, end in chrom_regions[chrom]:
+            for read in bam_file.fetch(chrom, start, end):
+                # Skip alignments already output for the
+                # previous region
+                if prev_end is not None and read.pos < prev_end:
+                    continue
+                regions_bam.write(read)
+                num_reads += 1
+            prev_end = end
+    regions_bam.close()
+    bam_file.close()
+    pysam.index(output_filename)
+    return num_reads
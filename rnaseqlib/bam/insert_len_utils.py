@@ -0,0 +1,187 @@
+##
+## Utilities for estimating the insert length distribution
+## of paired-end reads from their alignments to constitutive
+## exons.
+##
+import os
+import sys
+import time
+import random
+
+import numpy as np
+
+import pysam
+
+import rnaseqlib
+
+BAM_CMATCH = 0
+
+
+def parse_exon_label(exon_label):
+    """
+    Parse an exon label of the form chrom:start-end:strand.
+    Returns chrom, start, end, or None if the label cannot
+    be parsed.
+    """
+    fields = exon_label.split(":")
+    if len(fields) != 3:
+        return None
+    coords = fields[1].split("-")
+    if len(coords) != 2:
+        return None
+    return fields[0], int(coords[0]), int(coords[1])
+
+
+def get_const_exon_regions(const_exons, min_exon_len=500):
+    """
+    Return the regions of constitutive exons that are at least
+    'min_exon_len' long from a ConstExons object, as a sorted
+    list of (chrom, start, end) tuples.
+    """
+    regions = set()
+    for exon_label, exon_len in const_exons.exon_lens.iteritems():
+        if exon_len < min_exon_len:
+            continue
+        region = parse_exon_label(exon_label)
+        if region is None:
+            continue
+        regions.add(region)
+    return sorted(regions)
+
+
+def get_region_insert_lens(bam_file, chrom, start, end,
+                           max_pairs=None):
+    """
+    Return the insert lengths of properly paired read pairs
+    whose mates both fall, unspliced, within the given region
+    (1-based, inclusive coordinates).
+
+    Each pair is counted once, from its leftmost mate.
+    """
+    insert_lens = []
+    if chrom not in bam_file.references:
+        return insert_lens
+    for read in bam_file.fetch(chrom, start - 1, end):
+        if (not read.is_proper_pair) or read.is_secondary:
+            continue
+        # Count each pair from its leftmost mate only
+        if read.tlen <= 0:
+            continue
+        if read.pos < start - 1:
+            continue
+        # Both mates must be within the region
+        if read.pos + read.tlen > end:
+            continue
+        # Mate must not be spliced: a single match
+        cigar = read.cigar
+        if len(cigar) != 1 or cigar[0][0] != BAM_CMATCH:
+            continue
+        insert_lens.append(read.tlen)
+        if max_pairs is not None and len(insert_lens) >= max_pairs:
+            break
+    return insert_lens
+
+
+def compute_insert_len_stats(insert_lens):
+    """
+    Return insert length statistics: mean, standard deviation,
+    dispersion (sdev / sqrt(mean)) and number of pairs.
+    """
+    insert_lens = np.asarray(insert_lens)
+    mu = insert_lens.mean()
+    sdev = insert_lens.std()
+    dispersion = sdev / np.sqrt(float(mu))
+    return mu, sdev, dispersion, len(insert_lens)
+
+
+def compute_insert_lens(bam_filename, regions,
+                        max_pairs=100000,
+                        sd_max=2,
+                        seed=0):
+    """
+    Estimate the insert length distribution of an indexed
+    paired-end BAM file from read pairs in the given regions
+    (typically constitutive exons, see get_const_exon_regions).
+
+    Regions are visited in a random (seeded) order until
+    'max_pairs' read pairs have been sampled. Insert lengths
+    more than 'sd_max' standard deviations from the mean are
+    excluded, as in MISO's pe_utils.
+
+    Returns a dictionary with the 'mean', 'sdev', 'dispersion',
+    'num_pairs', the 'hist' of insert lengths (counts indexed by
+    insert length) and the insert lengths by region
+    ('region_insert_lens'), or None if no pairs were found.
+    """
+    regions = list(regions)
+    random.Random(seed).shuffle(regions)
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    region_insert_lens = {}
+    num_pairs = 0
+    for chrom, start, end in regions:
+        curr_lens = \
+            get_region_insert_lens(bam_file, chrom, start, end,
+                                   max_pairs=max_pairs - num_pairs)
+        if len(curr_lens) == 0:
+            continue
+        region_insert_lens[(chrom, start, end)] = np.array(curr_lens)
+        num_pairs += len(curr_lens)
+        if num_pairs >= max_pairs:
+            break
+    bam_file.close()
+    if num_pairs == 0:
+        return None
+    # Exclude outlying insert lengths
+    all_lens = np.concatenate(region_insert_lens.values())
+    mu, sdev, dispersion, num_pairs = compute_insert_len_stats(all_lens)
+    min_cutoff = mu - (sd_max * sdev)
+    max_cutoff = mu + (sd_max * sdev)
+    for region, insert_lens in region_insert_lens.items():
+        region_insert_lens[region] = \
+            insert_lens[(insert_lens >= min_cutoff) & \
+                        (insert_lens <= max_cutoff)]
+    filtered_lens = np.concatenate(region_insert_lens.values())
+    mu, sdev, dispersion, num_pairs = \
+        compute_insert_len_stats(filtered_lens)
+    return {"mean": mu,
+            "sdev": sdev,
+            "dispersion": dispersion,
+            "num_pairs": num_pairs,
+            "hist": np.bincount(filtered_lens),
+            "region_insert_lens": region_insert_lens}
+
+
+def output_insert_lens(insert_len_dist, output_filename):
+    """
+    Output an insert length distribution in MISO's .insert_len
+    format: a header with the distribution parameters followed
+    by the insert lengths of each region.
+    """
+    with open(output_filename, "w") as insert_len_out:
+        insert_len_out.write("#mean=%.1f,sdev=%.1f,dispersion=%.1f," \
+                             "num_pairs=%d\n" \
+                             %(insert_len_dist["mean"],
+                               insert_len_dist["sdev"],
+                               insert_len_dist["dispersion"],
+                               insert_len_dist["num_pairs"]))
+        insert_len_out.write("#region\tinsert_len\n")
+        region_insert_lens = insert_len_dist["region_insert_lens"]
+        for region in sorted(region_insert_lens.keys()):
+            insert_lens = region_insert_lens[region]
+            if len(insert_lens) == 0:
+                continue
+            chrom, start, end = region
+            insert_len_out.write("%s:%d-%d\t%s\n" \
+                                 %(chrom, start, end,
+                                   ",".join(map(str, insert_lens))))
+
+
+def load_insert_len_mean(insert_len_filename):
+    """
+    Return the mean insert length from the header of an
+    .insert_len file (see output_insert_lens).
+    """
+    with open(insert_len_filename) as insert_len_in:
+        header = insert_len_in.readline().strip().lstrip("#")
+    params = dict(field.split("=") for field in header.split(","))
+    return float(params["mean"])
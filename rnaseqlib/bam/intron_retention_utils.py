@@ -0,0 +1,277 @@
+##
+## Utilities for quantifying intron retention from read
+## coverage of introns and their flanking exons.
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.bam.jxn_utils as jxn_utils
+import rnaseqlib.rpkm.transcript_utils as transcript_utils
+import rnaseqlib.miso.psi_screen_utils as psi_screen_utils
+
+IR_TABLE_HEADER = ["intron_id", "chrom", "start", "end", "strand",
+                   "intron_median_cov", "flank_median_cov",
+                   "cov_ratio", "jxn_reads"]
+
+
+def load_ri_introns(gff_filename):
+    """
+    Load the retained introns of RI events from an events GFF3
+    file (as made by defineEvents.RI).
+
+    Returns a list of introns as (intron_id, chrom, strand, start,
+    end, up_start, up_end, dn_start, dn_end) tuples, where 'up' and
+    'dn' are the flanking exons (in genomic order), all with 1-based
+    coordinates.
+    """
+    introns = []
+    for event in psi_screen_utils.load_two_isoform_events(gff_filename):
+        # The spliced isoform is the one with two exons
+        spliced_exons = None
+        for exon_coords in event["exons"]:
+            if len(exon_coords) == 2:
+                spliced_exons = sorted(exon_coords)
+        if spliced_exons is None:
+            continue
+        up_exon, dn_exon = spliced_exons
+        introns.append((event["event_id"], event["chrom"], event["strand"],
+                        up_exon[1] + 1, dn_exon[0] - 1,
+                        up_exon[0], up_exon[1],
+                        dn_exon[0], dn_exon[1]))
+    return introns
+
+
+def load_gff_introns(gff_filename, flank_len=50):
+    """
+    Load introns from a GFF file of intron records (e.g. the
+    introns output by GeneTable.output_introns). The flanking
+    exons are taken to be the 'flank_len' bases on either side
+    of each intron.
+
+    Returns introns in the format of load_ri_introns.
+    """
+    introns = []
+    with open(gff_filename) as gff_in:
+        for line in gff_in:
+            if line.startswith("#"):
+                continue
+            fields = line.strip().split("\t")
+            if len(fields) < 9 or fields[2] != "intron":
+                continue
+            attributes = utils.parse_attributes(fields[8])
+            start, end = int(fields[3]), int(fields[4])
+            introns.append((attributes["ID"], fields[0], fields[6],
+                            start, end,
+                            max(start - flank_len, 1), start - 1,
+                            end + 1, end + flank_len))
+    return introns
+
+
+def get_chrom_coverage(bam_file, chrom):
+    """
+    Return the coverage and junction counts of reads on a
+    chromosome.
+
+    Coverage is given by the sorted starts and sorted ends of
+    the reads' aligned blocks (1-based, inclusive), from which the
+    coverage at any set of positions can be computed (see
+    get_coverage_at). Junctions are given as sorted keys (see
+    get_jxn_keys) and their read counts.
+    """
+    block_starts = []
+    block_ends = []
+    jxn_starts = []
+    jxn_ends = []
+    for read in bam_file.fetch(chrom):
+        if read.is_unmapped or read.is_secondary:
+            continue
+        for start, end in transcript_utils.get_read_blocks(read):
+            block_starts.append(start)
+            block_ends.append(end)
+        for start, end, overhang in jxn_utils.get_read_jxns(read):
+            jxn_starts.append(start)
+            jxn_ends.append(end)
+    block_starts = np.sort(np.array(block_starts, dtype=np.int64))
+    block_ends = np.sort(np.array(block_ends, dtype=np.int64))
+    jxn_keys, jxn_counts = \
+        np.unique(get_jxn_keys(np.array(jxn_starts, dtype=np.int64),
+                               np.array(jxn_ends, dtype=np.int64)),
+                  return_counts=True)
+    return block_starts, block_ends, jxn_keys, jxn_counts
+
+
+def get_jxn_keys(starts, ends):
+    """
+    Return integer keys for junctions from their coordinates.
+    """
+    return (starts << 32) + ends
+
+
+def get_coverage_at(block_starts, block_ends, positions):
+    """
+    Return read coverage at the given positions: the number of
+    blocks starting at or before each position minus the number
+    of blocks ending before it.
+    """
+    return np.searchsorted(block_starts, positions, side="right") - \
+           np.searchsorted(block_ends, positions, side="left")
+
+
+def get_segment_medians(block_starts, block_ends,
+                        part_segs, part_starts, part_ends, num_segs):
+    """
+    Return the median coverage of segments made of one or more
+    parts. Part i covers positions part_starts[i] to part_ends[i]
+    (inclusive) of segment part_segs[i].
+
+    The coverage of all positions of all segments is computed at
+    once and sorted by segment and coverage, from which the
+    medians are read off. Segments without positions get NaN.
+    """
+    part_lens = np.maximum(part_ends - part_starts + 1, 0)
+    total_len = part_lens.sum()
+    medians = np.empty(num_segs)
+    medians[:] = np.nan
+    if total_len == 0:
+        return medians
+    # Positions of all parts, concatenated
+    part_offsets = np.cumsum(part_lens) - part_lens
+    positions = np.repeat(part_starts - part_offsets, part_lens) + \
+                np.arange(total_len)
+    pos_segs = np.repeat(part_segs, part_lens)
+    coverage = get_coverage_at(block_starts, block_ends, positions)
+    sorted_coverage = coverage[np.lexsort((coverage, pos_segs))]
+    seg_lens = np.bincount(pos_segs, minlength=num_segs)
+    seg_offsets = np.cumsum(seg_lens) - seg_lens
+    has_positions = seg_lens > 0
+    low_inds = (seg_offsets + (seg_lens - 1) // 2)[has_positions]
+    high_inds = (seg_offsets + seg_lens // 2)[has_positions]
+    medians[has_positions] = \
+        (sorted_coverage[low_inds] + sorted_coverage[high_inds]) / 2.
+    return medians
+
+
+def get_intron_batches(intron_lens, max_batch_bases):
+    """
+    Split introns into consecutive batches with at most
+    'max_batch_bases' bases (or a single intron) each.
+
+    Returns a list of (first, last + 1) intron indices.
+    """
+    batches = []
+    batch_start = 0
+    batch_bases = 0
+    for intron_num, intron_len in enumerate(intron_lens):
+        if batch_bases + intron_len > max_batch_bases and \
+           intron_num > batch_start:
+            batches.append((batch_start, intron_num))
+            batch_start = intron_num
+            batch_bases = 0
+        batch_bases += intron_len
+    if batch_start < len(intron_lens):
+        batches.append((batch_start, len(intron_lens)))
+    return batches
+
+
+def compute_intron_retention(bam_filename, introns,
+                             max_batch_bases=10000000):
+    """
+    Compute intron retention metrics for introns (see
+    load_ri_introns) from an indexed BAM file.
+
+    For each intron, computes the median coverage of the intron,
+    the median coverage of its flanking exons, their ratio and
+    the number of reads spliced across the intron. Metrics are
+    computed for all introns of a chromosome at once, in batches
+    of at most 'max_batch_bases' intronic bases to bound memory.
+
+    Returns a dictionary of arrays indexed like the introns.
+    """
+    num_introns = len(introns)
+    ir = {"intron_median_cov": np.empty(num_introns),
+          "flank_median_cov": np.empty(num_introns),
+          "jxn_reads": np.zeros(num_introns, dtype=np.int64)}
+    ir["intron_median_cov"][:] = np.nan
+    ir["flank_median_cov"][:] = np.nan
+    introns_by_chrom = {}
+    for intron_num, intron in enumerate(introns):
+        chrom = intron[1]
+        if chrom not in introns_by_chrom:
+            introns_by_chrom[chrom] = []
+        introns_by_chrom[chrom].append(intron_num)
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    for chrom, chrom_intron_nums in introns_by_chrom.iteritems():
+        if chrom not in bam_file.references:
+            continue
+        block_starts, block_ends, jxn_keys, jxn_counts = \
+            get_chrom_coverage(bam_file, chrom)
+        chrom_intron_nums = np.array(chrom_intron_nums)
+        coords = np.array([introns[n][3:9] for n in chrom_intron_nums],
+                          dtype=np.int64)
+        starts, ends = coords[:, 0], coords[:, 1]
+        # Reads spliced exactly across each intron
+        intron_keys = get_jxn_keys(starts, ends)
+        key_inds = np.minimum(np.searchsorted(jxn_keys, intron_keys),
+                              max(len(jxn_keys) - 1, 0))
+        if len(jxn_keys) > 0:
+            has_jxn = (jxn_keys[key_inds] == intron_keys)
+            ir["jxn_reads"][chrom_intron_nums[has_jxn]] = \
+                jxn_counts[key_inds[has_jxn]]
+        for first, last in get_intron_batches(ends - starts + 1,
+                                              max_batch_bases):
+            batch_coords = coords[first:last]
+            batch_nums = chrom_intron_nums[first:last]
+            num_batch = last - first
+            seg_nums = np.arange(num_batch)
+            ir["intron_median_cov"][batch_nums] = \
+                get_segment_medians(block_starts, block_ends,
+                                    seg_nums,
+                                    batch_coords[:, 0],
+                                    batch_coords[:, 1],
+                                    num_batch)
+            # Flanking exons: two parts per segment
+            ir["flank_median_cov"][batch_nums] = \
+                get_segment_medians(block_starts, block_ends,
+                                    np.concatenate([seg_nums, seg_nums]),
+                                    np.concatenate([batch_coords[:, 2],
+                                                    batch_coords[:, 4]]),
+                                    np.concatenate([batch_coords[:, 3],
+                                                    batch_coords[:, 5]]),
+                                    num_batch)
+    bam_file.close()
+    flank_cov = ir["flank_median_cov"]
+    ir["cov_ratio"] = np.empty(num_introns)
+    ir["cov_ratio"][:] = np.nan
+    has_flank_cov = np.nan_to_num(flank_cov) > 0
+    ir["cov_ratio"][has_flank_cov] = \
+        ir["intron_median_cov"][has_flank_cov] / flank_cov[has_flank_cov]
+    return ir
+
+
+def output_intron_retention(introns, ir, output_filename,
+                            na_val="NA"):
+    """
+    Output intron retention metrics as a tab-delimited table.
+    """
+    with open(output_filename, "w") as ir_out:
+        ir_out.write("%s\n" %("\t".join(IR_TABLE_HEADER)))
+        for intron_num, intron in enumerate(introns):
+            intron_id, chrom, strand, start, end = intron[0:5]
+            cov_vals = []
+            for cov_key in ("intron_median_cov", "flank_median_cov",
+                            "cov_ratio"):
+                cov_val = ir[cov_key][intron_num]
+                if np.isnan(cov_val):
+                    cov_vals.append(na_val)
+                else:
+                    cov_vals.append("%.3f" %(cov_val))
+            fields = [intron_id, chrom, str(start), str(end), strand] + \
+                     cov_vals + [str(ir["jxn_reads"][intron_num])]
+            ir_out.write("%s\n" %("\t".join(fields)))
@@ -0,0 +1,267 @@
+##
+## Utilities for counting splice junctions from spliced
+## alignments (e.g. TopHat BAMs)
+##
+import os
+import sys
+import time
+import multiprocessing
+
+import pysam
+
+import rnaseqlib
+
+# CIGAR operations
+BAM_CMATCH = 0
+BAM_CINS = 1
+BAM_CDEL = 2
+BAM_CREF_SKIP = 3
+BAM_CEQUAL = 7
+BAM_CDIFF = 8
+
+# Operations that consume reference bases and are
+# part of an aligned block
+ALIGNED_OPS = set([BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF])
+
+JXN_TABLE_HEADER = ["chrom", "start", "end", "strand",
+                    "unique_count", "multi_count",
+                    "max_overhang", "mean_overhang"]
+
+
+def get_read_jxns(read):
+    """
+    Return the junctions spanned by an alignment, as a list
+    of (start, end, overhang) tuples, where 'start' and 'end'
+    are the 1-based first and last intron bases and 'overhang'
+    is the shorter of the read's aligned anchors on either side
+    of the junction.
+    """
+    cigar = read.cigar
+    if cigar is None:
+        return []
+    # Reference position and aligned bases of each block
+    # between junctions
+    ref_pos = read.pos
+    block_lens = [0]
+    jxn_coords = []
+    for op, op_len in cigar:
+        if op == BAM_CREF_SKIP:
+            jxn_coords.append((ref_pos + 1, ref_pos + op_len))
+            block_lens.append(0)
+            ref_pos += op_len
+        elif op in ALIGNED_OPS:
+            block_lens[-1] += op_len
+            ref_pos += op_len
+        elif op == BAM_CDEL:
+            ref_pos += op_len
+    if len(jxn_coords) == 0:
+        return []
+    read_jxns = []
+    total_len = sum(block_lens)
+    left_len = 0
+    for jxn_num, (start, end) in enumerate(jxn_coords):
+        left_len += block_lens[jxn_num]
+        overhang = min(left_len, total_len - left_len)
+        read_jxns.append((start, end, overhang))
+    return read_jxns
+
+
+def get_read_strand(read):
+    """
+    Return the strand of the junctions spanned by an alignment,
+    from the XS tag set by spliced aligners like TopHat, or '.'
+    if it is unknown.
+    """
+    for tag, value in read.tags:
+        if tag == "XS":
+            return value
+    return "."
+
+
+def get_read_num_hits(read):
+    """
+    Return the number of reported alignments for a read (NH tag),
+    or 1 if not given.
+    """
+    for tag, value in read.tags:
+        if tag == "NH":
+            return value
+    return 1
+
+
+def count_jxns_in_reads(reads):
+    """
+    Count junctions spanned by the given alignments.
+
+    Returns a mapping from (start, end, strand) to a list
+    of [unique_count, multi_count, max_overhang, overhang_sum].
+    """
+    jxn_counts = {}
+    for read in reads:
+        if read.is_unmapped:
+            continue
+        read_jxns = get_read_jxns(read)
+        if len(read_jxns) == 0:
+            continue
+        strand = get_read_strand(read)
+        is_unique = (get_read_num_hits(read) == 1)
+        for start, end, overhang in read_jxns:
+            jxn = (start, end, strand)
+            if jxn not in jxn_counts:
+                jxn_counts[jxn] = [0, 0, 0, 0]
+            counts = jxn_counts[jxn]
+            if is_unique:
+                counts[0] += 1
+            else:
+                counts[1] += 1
+            if overhang > counts[2]:
+                counts[2] = overhang
+            counts[3] += overhang
+    return jxn_counts
+
+
+def count_jxns_on_chrom(chrom_args):
+    """
+    Count junctions on a chromosome of an indexed BAM file.
+    Run by worker processes.
+
+    Returns the chromosome and a sorted list of its junction
+    records (see JXN_TABLE_HEADER).
+    """
+    bam_filename, chrom = chrom_args
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    jxn_counts = count_jxns_in_reads(bam_file.fetch(chrom))
+    bam_file.close()
+    jxn_records = []
+    for jxn in sorted(jxn_counts.keys()):
+        start, end, strand = jxn
+        unique_count, multi_count, max_overhang, overhang_sum = \
+            jxn_counts[jxn]
+        mean_overhang = \
+            overhang_sum / float(unique_count + multi_count)
+        jxn_records.append((chrom, start, end, strand,
+                            unique_count, multi_count,
+                            max_overhang, mean_overhang))
+    return chrom, jxn_records
+
+
+def count_bam_jxns(bam_filename, num_processors=1):
+    """
+    Count junctions in an indexed BAM file, walking the CIGAR
+    'N' operations of each alignment. Chromosomes are counted in
+    parallel when num_processors > 1.
+
+    Returns a list of junction records (see JXN_TABLE_HEADER)
+    in the order of the BAM header's chromosomes.
+    """
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    chroms = list(bam_file.references)
+    bam_file.close()
+    chrom_args = [(bam_filename, chrom) for chrom in chroms]
+    if num_processors > 1:
+        pool = multiprocessing.Pool(processes=num_processors)
+        try:
+            chrom_results = pool.map(count_jxns_on_chrom, chrom_args,
+                                     chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        chrom_results = map(count_jxns_on_chrom, chrom_args)
+    jxn_records = []
+    for chrom, chrom_records in chrom_results:
+        jxn_records.extend(chrom_records)
+    return jxn_records
+
+
+def output_jxn_table(jxn_records, output_filename):
+    """
+    Output junction records as a tab-delimited table.
+    """
+    with open(output_filename, "w") as jxns_out:
+        jxns_out.write("%s\n" %("\t".join(JXN_TABLE_HEADER)))
+        for record in jxn_records:
+            chrom, start, end, strand, unique_count, multi_count, \
+                max_overhang, mean_overhang = record
+            jxns_out.write("%s\t%d\t%d\t%s\t%d\t%d\t%d\t%.2f\n" \
+                           %(chrom, start, end, strand,
+                             unique_count, multi_count,
+                             max_overhang, mean_overhang))
+
+
+def load_jxn_table(jxn_table_filename):
+    """
+    Load junction table. Returns a list of junction records.
+    """
+    jxn_records = []
+    with open(jxn_table_filename) as jxns_in:
+        header = jxns_in.readline()
+        for line in jxns_in:
+            fields = line.strip().split("\t")
+            jxn_records.append((fields[0],
+                                int(fields[1]),
+                                int(fields[2]),
+                                fields[3],
+                                int(fields[4]),
+                                int(fields[5]),
+                                int(fields[6]),
+                                float(fields[7])))
+    return jxn_records
+
+
+def jxn_to_str(chrom, start, end, strand):
+    """
+    Return string ID of a junction.
+    """
+    return "%s:%d-%d:%s" %(chrom, start, end, strand)
+
+
+def output_jxn_matrix(sample_labels, sample_jxn_records, output_prefix,
+                      count_type="unique"):
+    """
+    Output a sparse junction by sample counts matrix for a set of
+    samples, in MatrixMarket coordinate format.
+
+    Writes:
+      - output_prefix.mtx: the counts matrix
+      - output_prefix.jxns.txt: junction IDs, one per row
+      - output_prefix.samples.txt: sample labels, one per column
+
+    'count_type' is 'unique', 'multi' or 'total'.
+    """
+    if count_type not in ("unique", "multi", "total"):
+        raise Exception, "Unknown count type %s" %(count_type)
+    # Junction IDs in the order they're first seen
+    jxn_to_row = {}
+    jxn_ids = []
+    entries = []
+    for col_num, jxn_records in enumerate(sample_jxn_records):
+        for record in jxn_records:
+            chrom, start, end, strand, unique_count, multi_count = \
+                record[0:6]
+            if count_type == "unique":
+                count = unique_count
+            elif count_type == "multi":
+                count = multi_count
+            else:
+                count = unique_count + multi_count
+            if count == 0:
+                continue
+            jxn_id = jxn_to_str(chrom, start, end, strand)
+            if jxn_id not in jxn_to_row:
+                jxn_to_row[jxn_id] = len(jxn_ids)
+                jxn_ids.append(jxn_id)
+            entries.append((jxn_to_row[jxn_id] + 1, col_num + 1, count))
+    with open("%s.mtx" %(output_prefix), "w") as matrix_out:
+        matrix_out.write("%%MatrixMarket matrix coordinate integer general\n")
+        matrix_out.write("%d %d %d\n" %(len(jxn_ids),
+                                        len(sample_labels),
+                                        len(entries)))
+        for entry in entries:
+            matrix_out.write("%d %d %d\n" %entry)
+    with open("%s.jxns.txt" %(output_prefix), "w") as jxns_out:
+        for jxn_id in jxn_ids:
+            jxns_out.write("%s\n" %(jxn_id))
+    with open("%s.samples.txt" %(output_prefix), "w") as samples_out:
+        for label in sample_labels:
+            samples_out.write("%s\n" %(label))
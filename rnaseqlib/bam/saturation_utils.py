@@ -0,0 +1,247 @@
+##
+## Utilities for computing sequencing saturation curves:
+## number of genes and junctions detected as a function
+## of sequencing depth.
+##
+import zlib
+
+import numpy as np
+
+import pysam
+
+import rnaseqlib.bam.jxn_utils as jxn_utils
+
+
+def get_read_subsample_bin(read_name, num_levels):
+    """
+    Return the subsampling bin of a read, from a deterministic
+    hash of its name, as an integer in [0, num_levels).
+
+    A read belongs to subsample level l (1-based) if its bin
+    is less than l, so mates of a pair (which share a name)
+    are always sampled together.
+    """
+    read_frac = (zlib.crc32(read_name) & 0xffffffff) / float(2**32)
+    return int(read_frac * num_levels)
+
+
+def get_gene_exons(gene_table):
+    """
+    Return the exons of all transcripts of each gene in a gene
+    table, as a list of (gene_id, chrom, exon_starts, exon_ends)
+    with 1-based exon coordinates.
+    """
+    if gene_table.gene_store is not None:
+        return get_store_gene_exons(gene_table.gene_store)
+    gene_exons = []
+    for gene_id in gene_table.genes_list:
+        exon_starts = []
+        exon_ends = []
+        chrom = None
+        for trans_entry in gene_table.table_by_gene[gene_id]:
+            chrom = trans_entry["chrom"]
+            exon_starts.extend([int(start) + 1 \
+                                for start in trans_entry["exonStarts"].rstrip(",").split(",")])
+            exon_ends.extend([int(end) \
+                              for end in trans_entry["exonEnds"].rstrip(",").split(",")])
+        gene_exons.append((gene_id, chrom, exon_starts, exon_ends))
+    return gene_exons
+
+
+def get_store_gene_exons(gene_store):
+    """
+    Return the exons of all transcripts of each gene in a
+    GeneStore.GeneStore (see get_gene_exons).
+    """
+    gene_exons = []
+    for gene_num, gene_id in enumerate(gene_store.gene_ids.tolist()):
+        first_trans = gene_store.gene_offsets[gene_num]
+        last_trans = gene_store.gene_offsets[gene_num + 1]
+        first_exon = gene_store.exon_offsets[first_trans]
+        last_exon = gene_store.exon_offsets[last_trans]
+        # Chromosome of the gene's last transcript
+        chrom = str(gene_store.chroms[last_trans - 1])
+        gene_exons.append((gene_id, chrom,
+                           gene_store.exon_starts[first_exon:last_exon].tolist(),
+                           gene_store.exon_ends[first_exon:last_exon].tolist()))
+    return gene_exons
+
+
+def get_gene_segments(gene_exons):
+    """
+    Split the exons of genes into non-overlapping segments per
+    chromosome, each assigned to the one gene whose exons cover it
+    or to -1 if the segment is covered by exons of several genes.
+
+    Returns a mapping from chromosome to a tuple of arrays
+    (segment starts, segment ends, gene indices), sorted by start.
+    """
+    exons_by_chrom = {}
+    for gene_num, gene_info in enumerate(gene_exons):
+        gene_id, chrom, exon_starts, exon_ends = gene_info
+        if chrom not in exons_by_chrom:
+            exons_by_chrom[chrom] = []
+        for start, end in zip(exon_starts, exon_ends):
+            exons_by_chrom[chrom].append((start, end, gene_num))
+    chrom_segments = {}
+    for chrom, exons in exons_by_chrom.iteritems():
+        # Sweep over exon boundaries, keeping track of the
+        # genes whose exons cover the current position
+        boundaries = []
+        for start, end, gene_num in exons:
+            boundaries.append((start, 1, gene_num))
+            boundaries.append((end + 1, -1, gene_num))
+        boundaries.sort()
+        seg_starts = []
+        seg_ends = []
+        seg_genes = []
+        gene_depths = {}
+        prev_pos = None
+        for pos, change, gene_num in boundaries:
+            if prev_pos is not None and pos > prev_pos and \
+               len(gene_depths) > 0:
+                seg_starts.append(prev_pos)
+                seg_ends.append(pos - 1)
+                if len(gene_depths) == 1:
+                    seg_genes.append(gene_depths.keys()[0])
+                else:
+                    seg_genes.append(-1)
+            depth = gene_depths.get(gene_num, 0) + change
+            if depth == 0:
+                del gene_depths[gene_num]
+            else:
+                gene_depths[gene_num] = depth
+            prev_pos = pos
+        chrom_segments[chrom] = (np.array(seg_starts, dtype=np.int64),
+                                 np.array(seg_ends, dtype=np.int64),
+                                 np.array(seg_genes, dtype=np.int64))
+    return chrom_segments
+
+
+def assign_reads_to_genes(positions, segments):
+    """
+    Return the gene index of each read position given the gene
+    segments of its chromosome, or -1 if it is not in a gene's
+    exons (or is in exons of several genes).
+    """
+    seg_starts, seg_ends, seg_genes = segments
+    seg_inds = np.searchsorted(seg_starts, positions, side="right") - 1
+    gene_inds = -np.ones(len(positions), dtype=np.int64)
+    in_seg = seg_inds >= 0
+    in_seg[in_seg] = positions[in_seg] <= seg_ends[seg_inds[in_seg]]
+    gene_inds[in_seg] = seg_genes[seg_inds[in_seg]]
+    return gene_inds
+
+
+def add_gene_bin_counts(gene_bin_counts, references, chrom_segments,
+                        read_tids, read_positions, read_bins):
+    """
+    Add buffered reads, given by their BAM reference IDs, 1-based
+    positions and subsample bins, to the (genes x bins) counts.
+    """
+    if len(read_positions) == 0:
+        return gene_bin_counts
+    num_genes, num_levels = gene_bin_counts.shape
+    tids = np.array(read_tids, dtype=np.int64)
+    positions = np.array(read_positions, dtype=np.int64)
+    bins = np.array(read_bins, dtype=np.int64)
+    for tid in np.unique(tids):
+        chrom = references[tid]
+        if chrom not in chrom_segments:
+            continue
+        in_chrom = (tids == tid)
+        gene_inds = assign_reads_to_genes(positions[in_chrom],
+                                          chrom_segments[chrom])
+        curr_bins = bins[in_chrom]
+        in_gene = gene_inds >= 0
+        counts = np.bincount(gene_inds[in_gene] * num_levels + \
+                             curr_bins[in_gene],
+                             minlength=num_genes * num_levels)
+        gene_bin_counts += counts.reshape((num_genes, num_levels))
+    return gene_bin_counts
+
+
+def compute_saturation(bam_filename, gene_exons,
+                       num_levels=10,
+                       min_reads=1,
+                       chunk_size=500000):
+    """
+    Compute saturation curves for a BAM file in a single pass.
+
+    Each read is assigned a deterministic subsample bin by hashing
+    its name. Read counts per gene and per junction are accumulated
+    by bin, so that the counts at each of the 'num_levels'
+    subsampling levels (1/num_levels, 2/num_levels, ..., 1 of the
+    reads) are cumulative sums over the bins.
+
+    A gene or junction is detected at a level if it has at least
+    'min_reads' reads in that subsample.
+
+    Returns a list of dictionaries, one per level, with the
+    'fraction' of reads sampled, 'num_reads', 'num_genes' and
+    'num_jxns'.
+    """
+    chrom_segments = get_gene_segments(gene_exons)
+    num_genes = len(gene_exons)
+    gene_bin_counts = np.zeros((num_genes, num_levels), dtype=np.int64)
+    read_bin_counts = np.zeros(num_levels, dtype=np.int64)
+    # Junction IDs and per-junction counts by bin
+    jxn_ids = {}
+    jxn_bin_counts = []
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    references = bam_file.references
+    # Buffered read positions for gene assignment
+    read_tids = []
+    read_positions = []
+    read_bins = []
+    for read in bam_file:
+        if read.is_unmapped:
+            continue
+        read_bin = get_read_subsample_bin(read.qname, num_levels)
+        read_bin_counts[read_bin] += 1
+        read_tids.append(read.tid)
+        read_positions.append(read.pos + 1)
+        read_bins.append(read_bin)
+        if len(read_positions) >= chunk_size:
+            add_gene_bin_counts(gene_bin_counts, references, chrom_segments,
+                                read_tids, read_positions, read_bins)
+            read_tids, read_positions, read_bins = [], [], []
+        for start, end, overhang in jxn_utils.get_read_jxns(read):
+            jxn = (read.tid, start, end)
+            if jxn not in jxn_ids:
+                jxn_ids[jxn] = len(jxn_bin_counts)
+                jxn_bin_counts.append([0] * num_levels)
+            jxn_bin_counts[jxn_ids[jxn]][read_bin] += 1
+    add_gene_bin_counts(gene_bin_counts, references, chrom_segments,
+                        read_tids, read_positions, read_bins)
+    bam_file.close()
+    jxn_bin_counts = np.array(jxn_bin_counts, dtype=np.int64)
+    if len(jxn_bin_counts) == 0:
+        jxn_bin_counts = np.zeros((0, num_levels), dtype=np.int64)
+    # Cumulative counts at each subsampling level
+    level_reads = np.cumsum(read_bin_counts)
+    level_genes = \
+        (np.cumsum(gene_bin_counts, axis=1) >= min_reads).sum(axis=0)
+    level_jxns = \
+        (np.cumsum(jxn_bin_counts, axis=1) >= min_reads).sum(axis=0)
+    saturation = []
+    for level in range(num_levels):
+        saturation.append({"fraction": (level + 1) / float(num_levels),
+                           "num_reads": level_reads[level],
+                           "num_genes": level_genes[level],
+                           "num_jxns": level_jxns[level]})
+    return saturation
+
+
+def output_saturation(saturation, output_filename):
+    """
+    Output saturation curves as a tab-delimited table.
+    """
+    with open(output_filename, "w") as saturation_out:
+        saturation_out.write("fraction\tnum_reads\tnum_genes\tnum_jxns\n")
+        for level in saturation:
+            saturation_out.write("%.2f\t%d\t%d\t%d\n" \
+                                 %(level["fraction"],
+                                   level["num_reads"],
+                                   level["num_genes"],
+                                   level["num_jxns"]))
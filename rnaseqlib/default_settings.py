@@ -114,8 +114,38 @@ def set_default_settings(settings_info):
             %(data_type)
         sys.exit(1)
     # Set general default settings
+    # Number of processors to use for parallelized steps
+    settings_info = set_settings_value(settings_info,
+                                       "mapping",
+                                       "num_processors",
+                                       1)
     if "prefilter_miso" not in settings_info["settings"]:
         # By default, set it so that MISO events are not
         # prefiltered
         settings_info["settings"]["prefilter_miso"] = False
+    # Count splice junctions from the mapped reads: off by default
+    settings_info = set_settings_value(settings_info,
+                                       "settings",
+                                       "count_jxns",
+                                       False)
+    # Estimate insert lengths of paired-end samples: off by default
+    settings_info = set_settings_value(settings_info,
+                                       "settings",
+                                       "compute_insert_lens",
+                                       False)
+    # Compute library saturation curves in QC: off by default
+    settings_info = set_settings_value(settings_info,
+                                       "settings",
+                                       "compute_saturation",
+                                       False)
+    # Quantify transcripts by EM: off by default
+    settings_info = set_settings_value(settings_info,
+                                       "settings",
+                                       "compute_tpms",
+                                       False)
+    # Quantify intron retention from coverage: off by default
+    settings_info = set_settings_value(settings_info,
+                                       "settings",
+                                       "compute_intron_retention",
+                                       False)
     return settings_info
@@ -12,26 +12,38 @@ import rnaseqlib.Pipeline as rna_pipeline
 import rnaseqlib.RNABase as rna_base
 
 def run_pipeline(settings_filename,
-                 output_dir):
+                 output_dir,
+                 preview_reads=None,
+                 preview_fraction=None,
+                 regions_filename=None):
     """
     Run pipeline on all samples given settings file.
     """
     # Create pipeline instance
     pipeline = rna_pipeline.Pipeline(settings_filename,
-                                     output_dir)
+                                     output_dir,
+                                     preview_reads=preview_reads,
+                                     preview_fraction=preview_fraction,
+                                     regions_filename=regions_filename)
     # Run pipeline
     pipeline.run()
 
     
 def run_on_sample(sample_label,
                   settings_filename,
-                  output_dir):
+                  output_dir,
+                  preview_reads=None,
+                  preview_fraction=None,
+                  regions_filename=None):
     """
     Run pipeline on one particular sample.
     """
     pipeline = rna_pipeline.Pipeline(settings_filename,
                                      output_dir,
-                                     curr_sample=sample_label)
+                                     curr_sample=sample_label,
+                                     preview_reads=preview_reads,
+                                     preview_fraction=preview_fraction,
+                                     regions_filename=regions_filename)
     pipeline.run_on_sample(sample_label)
 
 
@@ -46,11 +58,8 @@ def check_requirements():
                          # Bedtools
                          "intersectBed",
                          "subtractBed",
-                         "sortBed",
                          "mergeBed",
                          "tagBam",
-                         # Related utils
-                         "gtf2gff3.pl",
                          # Unix utils
                          "gunzip",
                          "wget",
@@ -65,8 +74,6 @@ def check_requirements():
                   "to your path if already installed." %(program)
             if program == "genePredToGtf":
                 genePredToGtf_msg()
-            elif program == "gtf2gff3.pl":
-                gtf2gff3_msg()
             print "  - Proceeding anyway..."
             found_all = False
     if found_all:
@@ -76,11 +83,6 @@ def check_requirements():
         sys.exit(1)
 
 
-def gtf2gff3_msg():
-    print "To get gtf2gff3.pl, see: "
-    print "http://cpansearch.perl.org/src/LDS/GBrowse-2.12/bin/gtf2gff3.pl"
-    
-        
 def genePredToGtf_msg():
     print "To install genePredToGtf, download the executable for your OS " \
           "from: "
@@ -125,6 +127,25 @@ def main():
     parser.add_option("--output-dir", dest="output_dir", nargs=1,
                       default=None,
                       help="Output directory.")
+    parser.add_option("--preview", dest="preview", nargs=1,
+                      default=None, type="int",
+                      help="Preview mode: map and QC only the first N " \
+                      "reads of each sample, writing a preliminary QC " \
+                      "table to the \'preview\' subdirectory of the output " \
+                      "directory. Takes as input N.")
+    parser.add_option("--preview-fraction", dest="preview_fraction",
+                      nargs=1, default=None, type="float",
+                      help="With --preview, sample reads by a hash of " \
+                      "their IDs, taking up to N reads from this fraction " \
+                      "(number between 0 and 1) of the reads rather than " \
+                      "the first N reads.")
+    parser.add_option("--regions", dest="regions", nargs=1,
+                      default=None,
+                      help="BED file of regions. If given, all steps that " \
+                      "use the mapped reads (unique reads, QC, clusters, " \
+                      "coverage, etc.) are restricted to reads in these " \
+                      "regions, and output goes to the \'regions\' " \
+                      "subdirectory of the output directory.")
     ##
     ## Options related to --init
     ##
@@ -139,6 +160,14 @@ def main():
                       help="Number of \'wiggle\' bases by which an exon can " \
                       "differ in order to be considered constitutive. By " \
                       "default set to 10. [OBSOLETE]")
+    parser.add_option("--num-processors", dest="num_processors",
+                      nargs=1, default=1, type="int",
+                      help="Number of processors to use when downloading " \
+                      "and converting gene tables during --init. Default is 1.")
+    parser.add_option("--ucsc-url", dest="ucsc_url", nargs=1, default=None,
+                      help="goldenPath URL to download UCSC tables from " \
+                      "during --init (e.g. a mirror). Default is " \
+                      "http://hgdownload.cse.ucsc.edu/goldenPath")
     (options, args) = parser.parse_args()
 
     greeting()
@@ -152,6 +181,10 @@ def main():
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
 
+    regions_filename = None
+    if options.regions is not None:
+        regions_filename = utils.pathify(options.regions)
+
     settings_filename = None
     if options.run:
         if options.settings == None:
@@ -161,7 +194,10 @@ def main():
             sys.exit(1)
         settings_filename = utils.pathify(options.settings)
         run_pipeline(settings_filename,
-                     output_dir)
+                     output_dir,
+                     preview_reads=options.preview,
+                     preview_fraction=options.preview_fraction,
+                     regions_filename=regions_filename)
 
     if options.run_on_sample is not None:
         if options.settings == None:
@@ -172,14 +208,19 @@ def main():
         settings_filename = utils.pathify(options.settings)
         sample_label = options.run_on_sample
         run_on_sample(sample_label, settings_filename,
-                      output_dir)
+                      output_dir,
+                      preview_reads=options.preview,
+                      preview_fraction=options.preview_fraction,
+                      regions_filename=regions_filename)
 
     if options.initialize is not None:
         # Parse initialization-related settings
         frac_constitutive = float(options.frac_constitutive)
         constitutive_exon_diff = int(options.constitutive_exon_diff)
         init_params = {"frac_constitutive": frac_constitutive,
-                       "constitutive_exon_diff": constitutive_exon_diff}
+                       "constitutive_exon_diff": constitutive_exon_diff,
+                       "num_processors": options.num_processors,
+                       "ucsc_url": options.ucsc_url}
         genome = options.initialize
         initialize_pipeline(genome,
                             output_dir,
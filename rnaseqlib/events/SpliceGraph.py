@@ -9,6 +9,8 @@ import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.events.parseTables as parseTables
 
+import numpy as np
+
 import gffutils
 
 import collections
@@ -114,10 +116,28 @@ class Donors(SpliceEdges):
     
 
 
+def get_intron_len(donor, acceptor):
+    """
+    Calculate length of intron between donor unit
+    and acceptor unit.
+    """
+    if donor.strand == "+":
+        intron_len = (acceptor.start_coord - 1) - \
+                     (donor.end_coord + 1) + 1
+    else:
+        # Minus strand -- reconsider length given that
+        # donor is "first" in transcript space compared to
+        # acceptor, and that start > end
+        intron_len = (donor.end_coord - 1) - \
+                     (acceptor.start_coord + 1) + 1
+    return intron_len
+
+
 def define_RI(sg,
               gff_out,
               min_intron_len=10,
-              multi_iso=False):
+              multi_iso=False,
+              chrom=None):
     """
     Define retained introns.
 
@@ -132,51 +152,18 @@ def define_RI(sg,
     Parameters:
     -----------
 
-    sg : SpliceGraph
+    sg : SpliceGraph or SpliceSiteGraph
     min_intron_len : minimum intron length
+    chrom : if given, only define retained introns on chrom
     """
     print "Defining retained introns (RI)"
-    def get_intron_len(donor, acceptor):
-        """
-        Calculate intron length.
-        """
-        if donor.strand == "+":
-            intron_len = (acceptor.start_coord - 1) - \
-                         (donor.end_coord + 1) + 1
-        else:
-            # Minus strand -- reconsider length given that
-            # donor is "first" in transcript space compared to
-            # acceptor, and that start > end
-            intron_len = (donor.end_coord - 1) - \
-                         (acceptor.start_coord + 1) + 1
-        return intron_len
     if multi_iso:
         raise Exception, "Multiple isoforms not supported."
-    # Keep track of observed retained introns
-    retained_introns = {}
-    for strand in sg.acceptors_to_donors:
-        for acceptor in sg.acceptors_to_donors[strand].edges:
-            # If any of the donor units to this acceptor
-            # have the acceptor end as their end coordinate, it's a retained
-            # intron event
-            donors = sg.acceptors_to_donors[strand].edges[acceptor]
-            for donor in donors:
-                # If there's a node that has this acceptor end as its end coordinate
-                # and the donor's start as the start coordinate, then it's a
-                # retained intron
-                intron_as_exon = Unit(donor.start, acceptor.end)
-                if sg.has_node(intron_as_exon):
-                    # Get length of intron
-                    intron_len = get_intron_len(donor, acceptor)
-                    if intron_len < min_intron_len:
-                        continue
-                    ri = (donor.coords_str, acceptor.coords_str)
-                    if ri in retained_introns:
-                        # Skip introns that we've seen already
-                        continue
-                    # Output retained intron to gff file
-                    output_RI(gff_out, donor, acceptor, intron_len)
-                    retained_introns[ri] = True
+    for donor, acceptor, intron_len in \
+        sg.iter_retained_introns(min_intron_len=min_intron_len,
+                                 chrom=chrom):
+        # Output retained intron to gff file
+        output_RI(gff_out, donor, acceptor, intron_len)
 
 
 def output_RI(gff_out, donor, acceptor, intron_len,
@@ -344,10 +331,11 @@ class SpliceGraph:
     """
     Represent the possible splicing graph transitions.
     """
-    def __init__(self, table_fnames):
+    def __init__(self, table_fnames, tables=None):
         self.table_fnames = table_fnames
-        # Mapping from table name to table
-        self.tables = {}
+        # Mapping from table name to table (can be given
+        # already parsed, to share one parse of the tables)
+        self.tables = tables
         self.acceptors_to_donors = {"+": Acceptors(strand="+"),
                                     "-": Acceptors(strand="-")}
         self.donors_to_acceptors = {"+": Donors(strand="+"),
@@ -394,10 +382,10 @@ class SpliceGraph:
         """
         Load tables.
         """
+        if self.tables is not None:
+            return
         print "Loading tables..."
-        for table_fname in self.table_fnames:
-            table_label = os.path.basename(table_fname)
-            self.tables[table_label] = parseTables.readTable(table_fname)
+        self.tables = parseTables.readTables(self.table_fnames)
                     
 
     def populate_graph(self):
@@ -442,6 +430,40 @@ class SpliceGraph:
         print "Populating graph took %.2f seconds" %(t2 - t1)
 
 
+    def iter_retained_introns(self, min_intron_len=10, chrom=None):
+        """
+        Iterate over retained introns, yielding the donor unit,
+        the acceptor unit and the intron length. If chrom is given,
+        only retained introns on chrom are considered.
+        """
+        # Keep track of observed retained introns
+        retained_introns = {}
+        for strand in self.acceptors_to_donors:
+            for acceptor in self.acceptors_to_donors[strand].edges:
+                if (chrom is not None) and (acceptor.chrom != chrom):
+                    continue
+                # If any of the donor units to this acceptor
+                # have the acceptor end as their end coordinate, it's a retained
+                # intron event
+                donors = self.acceptors_to_donors[strand].edges[acceptor]
+                for donor in donors:
+                    # If there's a node that has this acceptor end as its end
+                    # coordinate and the donor's start as the start coordinate,
+                    # then it's a retained intron
+                    intron_as_exon = Unit(donor.start, acceptor.end)
+                    if not self.has_node(intron_as_exon):
+                        continue
+                    intron_len = get_intron_len(donor, acceptor)
+                    if intron_len < min_intron_len:
+                        continue
+                    ri = (donor.coords_str, acceptor.coords_str)
+                    if ri in retained_introns:
+                        # Skip introns that we've seen already
+                        continue
+                    retained_introns[ri] = True
+                    yield donor, acceptor, intron_len
+
+
     def __str__(self):
         F = "\n".join(["%s->%s" %(donor, self.donors["+"].edges[donor]) \
                       for donor in self.donors["+"].edges])
@@ -455,6 +477,343 @@ class SpliceGraph:
         pass
 
 
+##
+## Integer-indexed splice graph
+##
+# Splice site relations, as named in the event definitions:
+#
+#   DtoA_F: donor -> downstream acceptor (intron)
+#   AtoD_F: acceptor -> donor of the same exon
+#   DtoA_R: donor -> acceptor of the same exon
+#   AtoD_R: acceptor -> upstream donor (intron)
+#
+SPLICE_RELATIONS = ["DtoA_F", "AtoD_F", "DtoA_R", "AtoD_R"]
+
+STRANDS = ["+", "-"]
+
+
+def make_csr(sources, sinks, num_nodes):
+    """
+    Collapse (source, sink) node pairs into CSR adjacency
+    arrays. Returns indptr, indices and counts, where the
+    neighbors of node i are indices[indptr[i]:indptr[i+1]],
+    sorted by node ID, and counts gives how many times each
+    edge was seen.
+    """
+    pair_keys = np.sort(sources.astype(np.int64) * num_nodes + sinks)
+    if len(pair_keys) == 0:
+        return (np.zeros(num_nodes + 1, dtype=np.int64),
+                np.zeros(0, dtype=np.int32),
+                np.zeros(0, dtype=np.int32))
+    is_first = np.ones(len(pair_keys), dtype=bool)
+    is_first[1:] = (pair_keys[1:] != pair_keys[:-1])
+    first_inds = np.nonzero(is_first)[0]
+    counts = np.diff(np.append(first_inds, len(pair_keys)))
+    uniq_keys = pair_keys[first_inds]
+    uniq_sources = uniq_keys // num_nodes
+    indices = (uniq_keys % num_nodes).astype(np.int32)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(uniq_sources, minlength=num_nodes))
+    return indptr, indices, counts.astype(np.int32)
+
+
+class SiteEdges:
+    """
+    Edges of one splice site relation, stored as CSR
+    adjacency arrays over splice site IDs.
+    """
+    def __init__(self, indptr, indices, counts):
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        # List versions of the arrays, used for fast lookups
+        # when enumerating events
+        self.lists = None
+
+
+    def get_lists(self):
+        """
+        Return indptr, indices and counts as lists.
+        """
+        if self.lists is None:
+            self.lists = (self.indptr.tolist(),
+                          self.indices.tolist(),
+                          self.counts.tolist())
+        return self.lists
+
+
+    def degree(self, site):
+        """
+        Number of distinct sites the site is connected to.
+        """
+        indptr = self.get_lists()[0]
+        return indptr[site + 1] - indptr[site]
+
+
+    def neighbors(self, site):
+        """
+        Sites connected to the given site, sorted by ID (and
+        therefore by coordinate.)
+        """
+        indptr, indices, counts = self.get_lists()
+        return indices[indptr[site]:indptr[site + 1]]
+
+
+    def neighbor_counts(self, site):
+        """
+        Number of times each of the site's edges was seen,
+        in the order of neighbors().
+        """
+        indptr, indices, counts = self.get_lists()
+        return counts[indptr[site]:indptr[site + 1]]
+
+
+    def __contains__(self, site):
+        """
+        Return True if the site has at least one edge.
+        """
+        return self.degree(site) > 0
+
+
+    def sources(self, first_site=0, last_site=None):
+        """
+        Return IDs of sites that have at least one edge, optionally
+        restricted to IDs in the range [first_site, last_site).
+        """
+        if last_site is None:
+            last_site = len(self.indptr) - 1
+        degrees = np.diff(self.indptr[first_site:last_site + 1])
+        return (np.nonzero(degrees)[0] + first_site).tolist()
+
+
+class SpliceSiteGraph:
+    """
+    Integer-indexed splice graph.
+
+    Splice sites are stored once in a site table (chrom ID,
+    coordinate, strand) sorted by chrom, strand and coordinate,
+    so that site IDs are contiguous per chrom/strand. Each splice
+    site relation (see SPLICE_RELATIONS) is stored as CSR
+    adjacency arrays over site IDs. Exons are stored as pairs of
+    (acceptor, donor) site IDs, with CSR adjacency from each exon
+    to the exons spliced downstream of it.
+    """
+    def __init__(self, table_fnames, tables=None):
+        self.table_fnames = table_fnames
+        # Mapping from table name to table (can be given
+        # already parsed, to share one parse of the tables)
+        self.tables = tables
+        # Site table
+        self.chroms = []
+        self.chrom_to_id = {}
+        self.site_keys = None
+        self.site_chroms = None
+        self.site_strands = None
+        self.site_coords = None
+        # Mapping from splice site relation to its edges
+        self.edges = {}
+        # Exon table: (acceptor site, donor site) per exon
+        self.exon_acceptors = None
+        self.exon_donors = None
+        self.exon_edges = None
+        self.load_tables()
+        self.populate_graph()
+        # The parsed tables are not needed once the graph is built
+        self.tables = None
+
+
+    def load_tables(self):
+        """
+        Load tables.
+        """
+        if self.tables is not None:
+            return
+        print "Loading tables..."
+        self.tables = parseTables.readTables(self.table_fnames)
+
+
+    def populate_graph(self):
+        """
+        Build the site table, the splice site relations and the
+        exon adjacency from the parsed tables.
+        """
+        print "Populating splice site graph..."
+        t1 = time.time()
+        self.chroms = sorted(set([item[0] for table_name in self.tables \
+                                  for item in self.tables[table_name]]))
+        self.chrom_to_id = dict([(chrom, chrom_id) \
+                                 for chrom_id, chrom in enumerate(self.chroms)])
+        # Flat per-exon arrays, with exons of each transcript
+        # in order of transcription
+        groups = []
+        acceptor_coords = []
+        donor_coords = []
+        has_next = []
+        for table_name in self.tables:
+            print "Adding splice sites from table %s" %(table_name)
+            for item in self.tables[table_name]:
+                chrom, startvals, endvals, strand, gene = item
+                starts, ends = parseTables.parseExonCoords(startvals, endvals)
+                num_exons = len(starts)
+                if num_exons < 2:
+                    # Unspliced transcript
+                    continue
+                if strand == "-":
+                    # Walk minus strand transcripts from their end
+                    # (in order of transcription), where exon ends
+                    # are acceptors and exon starts are donors
+                    starts, ends = ends[::-1], starts[::-1]
+                group = self.chrom_to_id[chrom] * 2 + STRANDS.index(strand)
+                groups.extend([group] * num_exons)
+                acceptor_coords.extend(starts)
+                donor_coords.extend(ends)
+                has_next.extend([True] * (num_exons - 1) + [False])
+        groups = np.array(groups, dtype=np.int64)
+        acceptor_keys = \
+            (groups << 32) + np.array(acceptor_coords, dtype=np.int64)
+        donor_keys = \
+            (groups << 32) + np.array(donor_coords, dtype=np.int64)
+        # Assign integer IDs to splice sites
+        self.site_keys, site_ids = \
+            np.unique(np.concatenate([acceptor_keys, donor_keys]),
+                      return_inverse=True)
+        num_sites = len(self.site_keys)
+        num_exon_rows = len(acceptor_keys)
+        acceptors = site_ids[:num_exon_rows]
+        donors = site_ids[num_exon_rows:]
+        site_groups = self.site_keys >> 32
+        self.site_chroms = (site_groups // 2).astype(np.int32)
+        self.site_strands = (site_groups % 2).astype(np.int8)
+        self.site_coords = \
+            (self.site_keys & 0xFFFFFFFF).astype(np.int32)
+        # Splice site relations
+        curr = np.nonzero(np.array(has_next, dtype=bool))[0]
+        nxt = curr + 1
+        relation_pairs = \
+            {"DtoA_F": (donors[curr], acceptors[nxt]),
+             "AtoD_F": (acceptors[nxt], donors[nxt]),
+             "DtoA_R": (donors[curr], acceptors[curr]),
+             "AtoD_R": (acceptors[nxt], donors[curr])}
+        for relation in SPLICE_RELATIONS:
+            sources, sinks = relation_pairs[relation]
+            self.edges[relation] = \
+                SiteEdges(*make_csr(sources, sinks, num_sites))
+        # Exons and exon to exon edges
+        exon_keys, exon_ids = \
+            np.unique(acceptors.astype(np.int64) * num_sites + donors,
+                      return_inverse=True)
+        self.exon_acceptors = (exon_keys // num_sites).astype(np.int32)
+        self.exon_donors = (exon_keys % num_sites).astype(np.int32)
+        self.exon_edges = \
+            SiteEdges(*make_csr(exon_ids[curr], exon_ids[nxt],
+                                len(exon_keys)))
+        t2 = time.time()
+        print "Populating splice site graph took %.2f seconds" %(t2 - t1)
+
+
+    @property
+    def num_sites(self):
+        return len(self.site_keys)
+
+
+    def site_str(self, site):
+        """
+        Return 'chrom:coord:strand' string for a site ID.
+        """
+        return "%s:%d:%s" %(self.chroms[self.site_chroms[site]],
+                            self.site_coords[site],
+                            STRANDS[self.site_strands[site]])
+
+
+    def chrom_site_range(self, chrom):
+        """
+        Return range [first, last) of the IDs of sites on chrom.
+        """
+        group = self.chrom_to_id[chrom] * 2
+        first, last = np.searchsorted(self.site_keys,
+                                      [group << 32, (group + 2) << 32])
+        return int(first), int(last)
+
+
+    def sources(self, relation, chrom=None):
+        """
+        Return IDs of sites that have at least one edge in
+        the given relation, optionally only those on chrom.
+        """
+        if chrom is None:
+            return self.edges[relation].sources()
+        first, last = self.chrom_site_range(chrom)
+        return self.edges[relation].sources(first, last)
+
+
+    def site_info(self, site):
+        """
+        Return chrom, coordinate and strand of a site ID.
+        """
+        return (self.chroms[self.site_chroms[site]],
+                int(self.site_coords[site]),
+                STRANDS[self.site_strands[site]])
+
+
+    def exon_unit(self, exon):
+        """
+        Return exon as a Unit.
+        """
+        acceptor = self.exon_acceptors[exon]
+        donor = self.exon_donors[exon]
+        chrom = self.chroms[self.site_chroms[acceptor]]
+        strand = STRANDS[self.site_strands[acceptor]]
+        return Unit((chrom, str(self.site_coords[acceptor]), strand),
+                    (chrom, str(self.site_coords[donor]), strand))
+
+
+    def iter_retained_introns(self, min_intron_len=10, chrom=None):
+        """
+        Iterate over retained introns, yielding the donor unit,
+        the acceptor unit and the intron length. If chrom is given,
+        only retained introns on chrom are considered.
+
+        An upstream exon spliced to a downstream exon defines a
+        retained intron if some exon starts at the upstream exon's
+        acceptor and ends at the downstream exon's donor.
+        """
+        num_sites = self.num_sites
+        exon_keys = \
+            self.exon_acceptors.astype(np.int64) * num_sites + self.exon_donors
+        up_exons = np.repeat(np.arange(len(exon_keys)),
+                             np.diff(self.exon_edges.indptr))
+        dn_exons = self.exon_edges.indices
+        if chrom is not None:
+            first, last = self.chrom_site_range(chrom)
+            up_acceptors = self.exon_acceptors[up_exons]
+            on_chrom = (up_acceptors >= first) & (up_acceptors < last)
+            up_exons = up_exons[on_chrom]
+            dn_exons = dn_exons[on_chrom]
+        ri_keys = self.exon_acceptors[up_exons].astype(np.int64) * num_sites + \
+                  self.exon_donors[dn_exons]
+        # Exon keys are sorted, so look up intron-as-exon keys
+        # by binary search
+        key_inds = np.searchsorted(exon_keys, ri_keys)
+        key_inds[key_inds == len(exon_keys)] = 0
+        is_ri = (exon_keys[key_inds] == ri_keys)
+        for up_exon, dn_exon in zip(up_exons[is_ri], dn_exons[is_ri]):
+            donor = self.exon_unit(up_exon)
+            acceptor = self.exon_unit(dn_exon)
+            intron_len = get_intron_len(donor, acceptor)
+            if intron_len < min_intron_len:
+                continue
+            yield donor, acceptor, intron_len
+
+
+    def __str__(self):
+        return "SpliceSiteGraph(%d sites, %d exons)" \
+               %(self.num_sites, len(self.exon_acceptors))
+
+
+    def __repr__(self):
+        return self.__str__()
+
+
 
 def main():
     table_fname = \
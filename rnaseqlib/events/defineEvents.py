@@ -2,6 +2,9 @@
 ## Define alternative splicing events
 ##
 import os, sys, operator, string
+import shutil
+import tempfile
+import multiprocessing
 import parseTables
 
 import rnaseqlib
@@ -17,122 +20,107 @@ LETTERS = string.uppercase
 def prepareSplicegraph(*args):
     """
     Prepare splicegraph for use in defining events.
-    Reads in all tables given in *args and populates some dictionaries
-    of splice sites.
-    Returns the splice site dictionaries.
+    Reads in all tables given in *args once into an integer-indexed
+    splice graph of splice sites.
+    Returns the splice graph.
     """
-    DtoA_F = {}
-    AtoD_F = {}
-    DtoA_R = {}
-    AtoD_R = {}
+    return splicegraph.SpliceSiteGraph(args)
 
-    for i in range(len(args)): 
-        print "Reading table", args[i]
-        DtoA_F, AtoD_F, DtoA_R, AtoD_R = \
-            parseTables.populateSplicegraph(args[i],
-                                            DtoA_F, AtoD_F, DtoA_R, AtoD_R)
-    DtoA_F, AtoD_F, DtoA_R, AtoD_R = \
-        parseTables.cleanSplicegraph(DtoA_F, AtoD_F, DtoA_R, AtoD_R)
 
-    return DtoA_F, AtoD_F, DtoA_R, AtoD_R
+def choose_flanking_coords(up_counts, dn_counts, strand, flanking):
+    """
+    Choose coordinates of the upstream and downstream flanking
+    sites of an event according to the flanking rule:
+
+      - shortest
+      - longest
+      - commonshortest
+      - commonlongest
+
+    'up_counts' and 'dn_counts' map candidate coordinates of the
+    upstream and downstream flanking sites to how often they occur.
+    Returns the upstream and downstream coordinates as strings.
+    """
+    if flanking in ['commonshortest', 'commonlongest']:
+        # Only consider the most common flanking sites
+        max_up = max(up_counts.values())
+        max_dn = max(dn_counts.values())
+        up_coords = [x for x in up_counts if up_counts[x] == max_up]
+        dn_coords = [x for x in dn_counts if dn_counts[x] == max_dn]
+    elif flanking in ['shortest', 'longest']:
+        up_coords = list(up_counts)
+        dn_coords = list(dn_counts)
+    else:
+        raise Exception, "Unknown flanking rule %s" %(flanking)
+    # Whether to take the upstream site with the smallest coordinate
+    # and the downstream site with the largest (on the plus strand)
+    take_outer = flanking in ['longest', 'commonshortest']
+    if strand == '-':
+        take_outer = not take_outer
+    if take_outer:
+        return str(min(up_coords)), str(max(dn_coords))
+    return str(max(up_coords)), str(min(dn_coords))
 
 
 # Define alt. 3' splice sites
 # A3SS are events where a donor is spliced to >1 acceptor, and the acceptors
 # share a downstream donor site in the same exon.
 #
-# Output a gff3.
-def A3SS(DtoA_F, AtoD_F, DtoA_R, AtoD_R, gff3_f,
+# Output a gff3 (only of events on chrom, if given.)
+def A3SS(sg, gff3_f,
          flanking='commonshortest',
-         multi_iso=False):
+         multi_iso=False,
+         chrom=None):
     print "Generating alternative 3\' splice sites (A3SS)"
     if os.path.isfile(gff3_f):
         print "  - Found file, skipping..."
         return
     out = open(gff3_f, 'w')
+    DtoA_F = sg.edges["DtoA_F"]
+    AtoD_F = sg.edges["AtoD_F"]
+    DtoA_R = sg.edges["DtoA_R"]
+    coords = sg.site_coords.tolist()
  
-    for donor in DtoA_F:
+    for donor in sg.sources("DtoA_F", chrom=chrom):
         # Check to see whether this donor splice site has more than one acceptor
         # site.
-        if len(DtoA_F[donor]) > 1:  # if it does, then see if any of them share a downstream 5'ss.
-            acceptors = list(DtoA_F[donor])
+        if DtoA_F.degree(donor) > 1:  # if it does, then see if any of them share a downstream 5'ss.
+            acceptors = DtoA_F.neighbors(donor)
             nextDonorCounts = {}
             nextDonorToAcceptors = {}   # downstream donor -> list of preious acceptors
             for acceptor in acceptors:
-                for x in list(AtoD_F[acceptor].elements()):
-                    try:
-                        nextDonorCounts[x] += 1
-                    except:
-                        nextDonorCounts[x] = 1
-                for x in list(AtoD_F[acceptor]):
-                    try:
-                        nextDonorToAcceptors[x].append(acceptor)
-                    except:
-                        nextDonorToAcceptors[x] = [acceptor]
-
-            acceptorlistnameToDonor = {}
+                for x, count in zip(AtoD_F.neighbors(acceptor),
+                                    AtoD_F.neighbor_counts(acceptor)):
+                    nextDonorCounts[x] = nextDonorCounts.get(x, 0) + count
+                    nextDonorToAcceptors.setdefault(x, []).append(acceptor)
+
+            acceptorlistToDonor = {}
 
             # Find all possible downstream donor sites for this set of alt. acceptor sites
             for nextDonor in nextDonorToAcceptors:
                 acceptorlist = nextDonorToAcceptors[nextDonor]
                 if len(acceptorlist) > 1:
-                    acceptorlist = [[x, int(x.split(":")[1])] for x in acceptorlist]
-                    acceptorlist.sort(key=operator.itemgetter(1))
-                    acceptorlistname = ";".join([x[0] for x in acceptorlist])
-                    try:
-                        acceptorlistnameToDonor[acceptorlistname].append(nextDonor)
-                    except:
-                        acceptorlistnameToDonor[acceptorlistname] = [nextDonor]
-
-            if len(acceptorlistnameToDonor) > 0:
-                chrom, coord, strand = donor.split(":")
-                donorCoord = donor.split(":")[1]
+                    # Site IDs are sorted by coordinate
+                    acceptorlist = tuple(sorted(acceptorlist))
+                    acceptorlistToDonor.setdefault(acceptorlist, []).append(nextDonor)
+
+            if len(acceptorlistToDonor) > 0:
+                chrom, coord, strand = sg.site_info(donor)
+                donorCoord = str(coord)
+                # Get the previous acceptor sites and their frequencies
+                prevAcceptorCounts = \
+                    dict(zip([coords[x] for x in DtoA_R.neighbors(donor)],
+                             DtoA_R.neighbor_counts(donor)))
               
-                for acceptorlistname in acceptorlistnameToDonor:
-                    acceptorCoords = [x.split(":")[1] for x in acceptorlistname.split(";")]
-
-                    # Get the previous acceptor sites and their frequencies
-                    prevAcceptorCounts = DtoA_R[donor]
-                    prevAcceptors = [int(x.split(":")[1]) for x in list(DtoA_R[donor])]
+                for acceptorlist in acceptorlistToDonor:
+                    acceptorCoords = [str(coords[x]) for x in acceptorlist]
                     nextDonorDict = {}
-                    for nextDonor in acceptorlistnameToDonor[acceptorlistname]:
-                        nextDonorDict[int(nextDonor.split(":")[1])] = \
+                    for nextDonor in acceptorlistToDonor[acceptorlist]:
+                        nextDonorDict[coords[nextDonor]] = \
                             nextDonorCounts[nextDonor]
-                    nextDonors = nextDonorDict.keys()
-
-                    if flanking == 'shortest': 
-                        if strand == '+': 
-                            prevAcceptorCoord = str(sorted(prevAcceptors)[-1])
-                            nextDonorCoord = str(sorted(nextDonors)[0])
-                        else:
-                            prevAcceptorCoord = str(sorted(prevAcceptors)[0])
-                            nextDonorCoord = str(sorted(nextDonors)[-1])
-                    elif flanking == 'longest':
-                        if strand == '+': 
-                            prevAcceptorCoord = str(sorted(prevAcceptors)[0])
-                            nextDonorCoord = str(sorted(nextDonors)[-1])
-                        else:
-                            prevAcceptorCoord = str(sorted(prevAcceptors)[-1])
-                            nextDonorCoord = str(sorted(nextDonors)[0])
-                    elif flanking in ['commonshortest', 'commonlongest']:
-                        prevAcceptorOptions = [int(x.split(":")[1]) for x in prevAcceptorCounts \
-                            if prevAcceptorCounts[x] == max(prevAcceptorCounts.values())]
-                        nextDonorOptions = [x for x in nextDonorDict \
-                            if nextDonorDict[x] == max(nextDonorDict.values())]
-                        if flanking == 'commonshortest':
-                            if strand == '+':
-                                prevAcceptorCoord = str(sorted(prevAcceptorOptions)[0])
-                                nextDonorCoord = str(sorted(nextDonorOptions)[-1])
-                            else: 
-                                prevAcceptorCoord = str(sorted(prevAcceptorOptions)[-1])
-                                nextDonorCoord = str(sorted(nextDonorOptions)[0])
-                        else:
-                            if strand == '+':
-                                prevAcceptorCoord = str(sorted(prevAcceptorOptions)[-1])
-                                nextDonorCoord = str(sorted(nextDonorOptions)[0])
-                            else: 
-                                prevAcceptorCoord = str(sorted(prevAcceptorOptions)[0])
-                                nextDonorCoord = str(sorted(nextDonorOptions)[-1])
+                    prevAcceptorCoord, nextDonorCoord = \
+                        choose_flanking_coords(prevAcceptorCounts, nextDonorDict,
+                                               strand, flanking)
 
                     # Output output 2-iso or multiple isoforms
                     if multi_iso:
@@ -243,100 +231,63 @@ def A3SS(DtoA_F, AtoD_F, DtoA_R, AtoD_R, gff3_f,
 # A3SS are events where >1 donor is spliced to an acceptor, and the donors share an
 # upstream acceptor site in the same exon.
 #
-# Output a gff3.
-def A5SS(DtoA_F, AtoD_F, DtoA_R, AtoD_R, gff3_f,
+# Output a gff3 (only of events on chrom, if given.)
+def A5SS(sg, gff3_f,
          flanking='commonshortest',
-         multi_iso=False):
+         multi_iso=False,
+         chrom=None):
     print "Generating alternative 5\' splice sites (A5SS)"
     if os.path.isfile(gff3_f):
         print "  - Found file, skipping..."
         return
     out = open(gff3_f, 'w')
+    AtoD_F = sg.edges["AtoD_F"]
+    DtoA_R = sg.edges["DtoA_R"]
+    AtoD_R = sg.edges["AtoD_R"]
+    coords = sg.site_coords.tolist()
  
-    for acceptor in AtoD_R:
+    for acceptor in sg.sources("AtoD_R", chrom=chrom):
         # Check to see whether this acceptor splice site has more than one donor 
         # site.
-        if len(AtoD_R[acceptor]) > 1:   # if it does, then see if any of them share an upstream 3'ss.
-            donors = list(AtoD_R[acceptor])     # these are the alt 5'ss 
-            prevAcceptorCounts = {}             # coordinate -> counts
+        if AtoD_R.degree(acceptor) > 1:   # if it does, then see if any of them share an upstream 3'ss.
+            donors = AtoD_R.neighbors(acceptor)     # these are the alt 5'ss 
+            prevAcceptorCounts = {}             # splice site -> counts
             prevAcceptorToDonors = {}           # splice site -> list of donors
 
             # Iterate through each alt donor and get their upstream acceptors
             for donor in donors:
-                for x in list(DtoA_R[donor].elements()):
-                    try:
-                        prevAcceptorCounts[x] += 1
-                    except:
-                        prevAcceptorCounts[x] = 1
-                for x in list(DtoA_R[donor]):
-                    try:
-                        prevAcceptorToDonors[x].append(donor)
-                    except:
-                        prevAcceptorToDonors[x] = [donor]
-
-            donorlistnameToAcceptor = {}
+                for x, count in zip(DtoA_R.neighbors(donor),
+                                    DtoA_R.neighbor_counts(donor)):
+                    prevAcceptorCounts[x] = prevAcceptorCounts.get(x, 0) + count
+                    prevAcceptorToDonors.setdefault(x, []).append(donor)
+
+            donorlistToAcceptor = {}
 
             # Find all possible acceptor sites for this list of alt. donor sites
             for prevAcceptor in prevAcceptorToDonors:
                 donorlist = prevAcceptorToDonors[prevAcceptor]
                 if len(donorlist) > 1:                  # this is an alt. 5'ss event
-                    donorlist = [[x, int(x.split(":")[1])] for x in donorlist]
-                    donorlist.sort(key=operator.itemgetter(1))
-                    donorlistname = ";".join([x[0] for x in donorlist])
-                    try:
-                        donorlistnameToAcceptor[donorlistname].append(prevAcceptor)
-                    except:
-                        donorlistnameToAcceptor[donorlistname] = [prevAcceptor]
+                    # Site IDs are sorted by coordinate
+                    donorlist = tuple(sorted(donorlist))
+                    donorlistToAcceptor.setdefault(donorlist, []).append(prevAcceptor)
             
-            if len(donorlistnameToAcceptor) > 0: 
-                chrom, coord, strand = acceptor.split(":")
-                acceptorCoord = acceptor.split(":")[1]
-
-                for donorlistname in donorlistnameToAcceptor:
-                    donorCoords = [x.split(":")[1] for x in donorlistname.split(";")] 
-
-                    # Get the next donor sites and their frequencies
-                    nextDonorCounts = AtoD_F[acceptor]
-                    nextDonors = [int(x.split(":")[1]) for x in list(AtoD_F[acceptor])]
+            if len(donorlistToAcceptor) > 0: 
+                chrom, coord, strand = sg.site_info(acceptor)
+                acceptorCoord = str(coord)
+                # Get the next donor sites and their frequencies
+                nextDonorCounts = \
+                    dict(zip([coords[x] for x in AtoD_F.neighbors(acceptor)],
+                             AtoD_F.neighbor_counts(acceptor)))
+
+                for donorlist in donorlistToAcceptor:
+                    donorCoords = [str(coords[x]) for x in donorlist]
                     prevAcceptorDict = {}
-                    for prevAcceptor in donorlistnameToAcceptor[donorlistname]:
-                        prevAcceptorDict[int(prevAcceptor.split(":")[1])] = \
+                    for prevAcceptor in donorlistToAcceptor[donorlist]:
+                        prevAcceptorDict[coords[prevAcceptor]] = \
                             prevAcceptorCounts[prevAcceptor]
-                    prevAcceptors = prevAcceptorDict.keys()
-
-                    if flanking == 'shortest': 
-                        if strand == '+': 
-                            prevAcceptorCoord = str(sorted(prevAcceptors)[-1])
-                            nextDonorCoord = str(sorted(nextDonors)[0])
-                        else:
-                            prevAcceptorCoord = str(sorted(prevAcceptors)[0])
-                            nextDonorCoord = str(sorted(nextDonors)[-1])
-                    elif flanking == 'longest':
-                        if strand == '+': 
-                            prevAcceptorCoord = str(sorted(prevAcceptors)[0])
-                            nextDonorCoord = str(sorted(nextDonors)[-1])
-                        else:
-                            prevAcceptorCoord = str(sorted(prevAcceptors)[-1])
-                            nextDonorCoord = str(sorted(nextDonors)[0])
-                    elif flanking in ['commonshortest', 'commonlongest']:
-                        prevAcceptorOptions = [x for x in prevAcceptorDict \
-                            if prevAcceptorDict[x] == max(prevAcceptorDict.values())]
-                        nextDonorOptions = [int(x.split(":")[1]) for x in nextDonorCounts \
-                            if nextDonorCounts[x] == max(nextDonorCounts.values())]
-                        if flanking == 'commonshortest':
-                            if strand == '+':
-                                prevAcceptorCoord = str(sorted(prevAcceptorOptions)[0])
-                                nextDonorCoord = str(sorted(nextDonorOptions)[-1])
-                            else: 
-                                prevAcceptorCoord = str(sorted(prevAcceptorOptions)[-1])
-                                nextDonorCoord = str(sorted(nextDonorOptions)[0])
-                        else:
-                            if strand == '+':
-                                prevAcceptorCoord = str(sorted(prevAcceptorOptions)[-1])
-                                nextDonorCoord = str(sorted(nextDonorOptions)[0])
-                            else: 
-                                prevAcceptorCoord = str(sorted(prevAcceptorOptions)[0])
-                                nextDonorCoord = str(sorted(nextDonorOptions)[-1])
+                    prevAcceptorCoord, nextDonorCoord = \
+                        choose_flanking_coords(prevAcceptorDict, nextDonorCounts,
+                                               strand, flanking)
 
                     # Output multiple isoforms if necessary
                     if multi_iso:
@@ -447,71 +398,50 @@ def A5SS(DtoA_F, AtoD_F, DtoA_R, AtoD_R, gff3_f,
 # Define skipped exons.
 #
 # Arguments are:
-# splice site dictionaries, followed by output file and a keyword to denote method of
+# splice graph, followed by output file and a keyword to denote method of
 # selecting flanking exon coordinates:
 # shortest
 # longest
 # commonshortest
 # commonlongest 
 #
-def SE(DtoA_F, AtoD_F, DtoA_R, AtoD_R, gff3_f,
-       flanking='commonshortest'):
+# If chrom is given, only events on chrom are defined.
+#
+def SE(sg, gff3_f,
+       flanking='commonshortest',
+       chrom=None):
     print "Generating skipped exons (SE)"
     if os.path.isfile(gff3_f):
         "  - Found file, skipping..."
         return
     out = open(gff3_f, 'w')
+    DtoA_F = sg.edges["DtoA_F"]
+    AtoD_F = sg.edges["AtoD_F"]
+    DtoA_R = sg.edges["DtoA_R"]
+    AtoD_R = sg.edges["AtoD_R"]
+    coords = sg.site_coords.tolist()
  
-    for acceptor in AtoD_R:                             # this acceptor is the SE acceptor
-        chrom, coord, strand = acceptor.split(":") 
-        donors = list(AtoD_F[acceptor])                 # these are possible 5'ss of the SE
+    for acceptor in sg.sources("AtoD_R", chrom=chrom): # this acceptor is the SE acceptor
+        chrom, coord, strand = sg.site_info(acceptor)
+        donors = AtoD_F.neighbors(acceptor)             # these are possible 5'ss of the SE
+        upDonors = AtoD_R.neighbors(acceptor)           # these are 5'ss that splice to SE 
         for donor in donors:                            # consider each SE
-            upDonors = list(AtoD_R[acceptor])           # these are 5'ss that splice to SE 
             if donor in DtoA_F:
-                dnAcceptors = list(DtoA_F[donor])       # these are 3'ss that SE splices to
+                dnAcceptors = DtoA_F.neighbors(donor)   # these are 3'ss that SE splices to
                 for upDonor in upDonors:
+                    upDonorAcceptors = set(DtoA_F.neighbors(upDonor))
                     for dnAcceptor in dnAcceptors:
-                        if dnAcceptor in list(DtoA_F[upDonor]):   # this is an SE
-                            ss1list = map(int, [x.split(":")[1] for x in list(DtoA_R[upDonor].elements())])
-                            ss2 = upDonor.split(":")[1]
-                            ss3 = acceptor.split(":")[1]
-                            ss4 = donor.split(":")[1]
-                            ss5 = dnAcceptor.split(":")[1]
-                            ss6list = map(int, [x.split(":")[1] for x in list(AtoD_F[dnAcceptor].elements())])
-  
-                            if flanking == 'shortest': 
-                                if strand == '+': 
-                                    ss1 = str(sorted(ss1list)[-1])
-                                    ss6 = str(sorted(ss6list)[0])
-                                else:
-                                    ss1 = str(sorted(ss1list)[0])
-                                    ss6 = str(sorted(ss6list)[-1])
-                            elif flanking == 'longest':
-                                if strand == '+': 
-                                    ss1 = str(sorted(ss1list)[0])
-                                    ss6 = str(sorted(ss6list)[-1])
-                                else:
-                                    ss1 = str(sorted(ss1list)[-1])
-                                    ss6 = str(sorted(ss6list)[0])
-                            elif flanking in ['commonshortest', 'commonlongest']:
-                                ss1cts = map(ss1list.count, ss1list)
-                                ss1options = [ss1list[x] for x in range(len(ss1cts)) if ss1cts[x] == max(ss1cts)]
-                                ss6cts = map(ss6list.count, ss6list)
-                                ss6options = [ss6list[x] for x in range(len(ss6cts)) if ss6cts[x] == max(ss6cts)]
-                                if flanking == 'commonshortest':
-                                    if strand == '+':
-                                        ss1 = str(sorted(ss1options)[0])
-                                        ss6 = str(sorted(ss6options)[-1])
-                                    else: 
-                                        ss1 = str(sorted(ss1options)[-1])
-                                        ss6 = str(sorted(ss6options)[0])
-                                else:
-                                    if strand == '+':
-                                        ss1 = str(sorted(ss1options)[-1])
-                                        ss6 = str(sorted(ss6options)[0])
-                                    else: 
-                                        ss1 = str(sorted(ss1options)[0])
-                                        ss6 = str(sorted(ss6options)[-1])
+                        if dnAcceptor in upDonorAcceptors:   # this is an SE
+                            ss1counts = dict(zip([coords[x] for x in DtoA_R.neighbors(upDonor)],
+                                                 DtoA_R.neighbor_counts(upDonor)))
+                            ss2 = str(coords[upDonor])
+                            ss3 = str(coords[acceptor])
+                            ss4 = str(coords[donor])
+                            ss5 = str(coords[dnAcceptor])
+                            ss6counts = dict(zip([coords[x] for x in AtoD_F.neighbors(dnAcceptor)],
+                                                 AtoD_F.neighbor_counts(dnAcceptor)))
+                            ss1, ss6 = choose_flanking_coords(ss1counts, ss6counts,
+                                                              strand, flanking)
 
                             # Iterate through each possible set of flanking exons
                             # for i in range(len(ss1list)):
@@ -562,215 +492,187 @@ def SE(DtoA_F, AtoD_F, DtoA_R, AtoD_R, gff3_f,
     out.close()
 
 
-def MXE(DtoA_F, AtoD_F, DtoA_R, AtoD_R, gff3_f,
-        flanking='commonshortest'):
+def MXE(sg, gff3_f,
+        flanking='commonshortest',
+        chrom=None):
     """
     Define mutually exclusive exons.
 
     Arguments are:
-    splice site dictionaries, followed by output file and a keyword to denote method of
+    splice graph, followed by output file and a keyword to denote method of
     selecting flanking exon coordinates:
     
       - shortest
       - longest
       - commonshortest
       - commonlongest
+
+    If chrom is given, only events on chrom are defined.
     """
     print "Generating mutually exclusive exons (MXE)"
     if os.path.isfile(gff3_f):
         "  - Found file, skipping..."
         return
     out = open(gff3_f, 'w')
-
-    visited = {} 
-    for mxe1acceptor in AtoD_R:                             # this acceptor is the acceptor for the MXE1
-        visited[mxe1acceptor] = 0
-        chrom, coord, strand = mxe1acceptor.split(":") 
-        mxe1donors = [x for x in list(AtoD_F[mxe1acceptor]) if x in DtoA_F]
+    DtoA_F = sg.edges["DtoA_F"]
+    AtoD_F = sg.edges["AtoD_F"]
+    DtoA_R = sg.edges["DtoA_R"]
+    AtoD_R = sg.edges["AtoD_R"]
+    coords = sg.site_coords.tolist()
+
+    visited = set()
+    for mxe1acceptor in sg.sources("AtoD_R", chrom=chrom):  # this acceptor is the acceptor for the MXE1
+        visited.add(mxe1acceptor)
+        chrom, coord, strand = sg.site_info(mxe1acceptor)
+        mxe1donors = [x for x in AtoD_F.neighbors(mxe1acceptor) if x in DtoA_F]
                                                             # these are donors for MXE1
+        upDonors = AtoD_R.neighbors(mxe1acceptor)           # these are the upstream 5'ss that splice to MXE1 
         for mxe1donor in mxe1donors:                        
-            upDonors = list(AtoD_R[mxe1acceptor])           # these are the upstream 5'ss that splice to MXE1 
-            dnAcceptorsFrom1 = list(DtoA_F[mxe1donor])      # these are possible downstream acceptors from MXE1 
+            dnAcceptorsFrom1 = set(DtoA_F.neighbors(mxe1donor))
+                                                            # these are possible downstream acceptors from MXE1 
             for upDonor in upDonors:
-                mxe2acceptors = [x for x in list(DtoA_F[upDonor]) if x not in visited] 
+                mxe2acceptors = [x for x in DtoA_F.neighbors(upDonor) if x not in visited] 
                                                             # these are potential 3'ss for MXE2
                 for mxe2acceptor in mxe2acceptors: 
-                    mxe2donors = [x for x in list(AtoD_F[mxe2acceptor]) if x in DtoA_F]
+                    mxe2donors = [x for x in AtoD_F.neighbors(mxe2acceptor) if x in DtoA_F]
                                                             # these are potential 5'ss for MXE2
                     # proper MXEs will share a common downstream acceptor, from MXE1 donor and MXE2 donor
                     # and also be non-overlapping
                     for mxe2donor in mxe2donors:
-
-                        dnAcceptorsFrom2 = list(DtoA_F[mxe2donor])
+                        dnAcceptors = [x for x in DtoA_F.neighbors(mxe2donor) \
+                                       if x in dnAcceptorsFrom1]
                                                             # these are possible downstream acceptors from MXE2
-                        dnAcceptors = set.intersection(set(dnAcceptorsFrom1), set(dnAcceptorsFrom2))
-                        if len(dnAcceptors) > 0:
-                            for dnAcceptor in dnAcceptors:
+                        for dnAcceptor in dnAcceptors:
 
-                                # Put MXEs in strand order
-                                acceptorcoords = map(int, [mxe1acceptor.split(":")[1], mxe2acceptor.split(":")[1]])
-                                donorcoords = map(int, [mxe1donor.split(":")[1], mxe2donor.split(":")[1]])
-                                if strand == '+':
-                                    if acceptorcoords[1] < acceptorcoords[0]:
-                                        acceptorcoords = acceptorcoords[::-1]     # sort by coordinate
-                                        donorcoords = donorcoords[::-1]
+                            # Put MXEs in strand order
+                            acceptorcoords = [coords[mxe1acceptor], coords[mxe2acceptor]]
+                            donorcoords = [coords[mxe1donor], coords[mxe2donor]]
+                            if strand == '+':
+                                if acceptorcoords[1] < acceptorcoords[0]:
+                                    acceptorcoords = acceptorcoords[::-1]     # sort by coordinate
+                                    donorcoords = donorcoords[::-1]
+                            else:
+                                if acceptorcoords[0] < acceptorcoords[1]:     # sort by coordinate
+                                    acceptorcoords = acceptorcoords[::-1]
+                                    donorcoords = donorcoords[::-1]
+
+                            # Make sure MXEs are non-overlapping
+                            if (strand == '+' and donorcoords[0] < acceptorcoords[1]) or \
+                                (strand == '-' and acceptorcoords[1] < donorcoords[0]):
+
+                                # Output these MXEs
+                                ss1counts = dict(zip([coords[x] for x in DtoA_R.neighbors(upDonor)],
+                                                     DtoA_R.neighbor_counts(upDonor)))
+                                ss2 = str(coords[upDonor])
+                                ss3 = str(acceptorcoords[0])
+                                ss4 = str(donorcoords[0])
+                                ss5 = str(acceptorcoords[1])
+                                ss6 = str(donorcoords[1])
+                                ss7 = str(coords[dnAcceptor])
+                                ss8counts = dict(zip([coords[x] for x in AtoD_F.neighbors(dnAcceptor)],
+                                                     AtoD_F.neighbor_counts(dnAcceptor)))
+                                ss1, ss8 = choose_flanking_coords(ss1counts, ss8counts,
+                                                                  strand, flanking)
+
+                                # Iterate through each possible set of flanking exons
+                                # for i in range(len(ss1list)):
+                                #    for j in range(len(ss6list)):
+                                if strand == '+': 
+                                    upexon = ":".join([chrom, ss1, ss2, strand])
+                                    mxe1 = ":".join([chrom, ss3, ss4, strand])
+                                    mxe2 = ":".join([chrom, ss5, ss6, strand])
+                                    dnexon = ":".join([chrom, ss7, ss8, strand])
+                                    name = "@".join([upexon, mxe1, mxe2, dnexon])
+                                    out.write("\t".join([chrom, 'MXE', 'gene', ss1, ss8,\
+                                        '.', strand, '.', "ID=" + name + ";Name=" + name]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'mRNA', ss1, ss8,\
+                                        '.', strand, '.', "ID=" + name + ".A;Parent=" + name]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'mRNA', ss1, ss8,\
+                                        '.', strand, '.', "ID=" + name + ".B;Parent=" + name]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss1, ss2,\
+                                        '.', strand, '.', "ID=" + name + ".A.up;Parent=" + name + ".A"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss3, ss4,\
+                                        '.', strand, '.', "ID=" + name + ".A.mxe1;Parent=" + name + ".A"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss7, ss8,\
+                                        '.', strand, '.', "ID=" + name + ".A.dn;Parent=" + name + ".A"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss1, ss2,\
+                                        '.', strand, '.', "ID=" + name + ".B.up;Parent=" + name + ".B"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss5, ss6,\
+                                        '.', strand, '.', "ID=" + name + ".B.mxe2;Parent=" + name + ".B"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss7, ss8,\
+                                        '.', strand, '.', "ID=" + name + ".B.dn;Parent=" + name + ".B"]) + "\n")
+                                    
                                 else:
-                                    if acceptorcoords[0] < acceptorcoords[1]:     # sort by coordinate
-                                        acceptorcoords = acceptorcoords[::-1]
-                                        donorcoords = donorcoords[::-1]
-
-                                # Make sure MXEs are non-overlapping
-                                if (strand == '+' and donorcoords[0] < acceptorcoords[1]) or \
-                                    (strand == '-' and acceptorcoords[1] < donorcoords[0]):
-
-                                    # Output these MXEs
-                                    ss1list = map(int, [x.split(":")[1] for x in list(DtoA_R[upDonor].elements())])
-                                    ss2 = upDonor.split(":")[1]
-                                    ss3 = str(acceptorcoords[0])
-                                    ss4 = str(donorcoords[0])
-                                    ss5 = str(acceptorcoords[1])
-                                    ss6 = str(donorcoords[1])
-                                    ss7 = dnAcceptor.split(":")[1]
-                                    ss8list = map(int, [x.split(":")[1] for x in list(AtoD_F[dnAcceptor].elements())])
-
-                                    if flanking == 'shortest': 
-                                        if strand == '+': 
-                                            ss1 = str(sorted(ss1list)[-1])
-                                            ss8 = str(sorted(ss8list)[0])
-                                        else:
-                                            ss1 = str(sorted(ss1list)[0])
-                                            ss8 = str(sorted(ss8list)[-1])
-                                    elif flanking == 'longest':
-                                        if strand == '+': 
-                                            ss1 = str(sorted(ss1list)[0])
-                                            ss8 = str(sorted(ss8list)[-1])
-                                        else:
-                                            ss1 = str(sorted(ss1list)[-1])
-                                            ss8 = str(sorted(ss8list)[0])
-                                    elif flanking in ['commonshortest', 'commonlongest']:
-                                        ss1cts = map(ss1list.count, ss1list)
-                                        ss1options = [ss1list[x] for x in range(len(ss1cts)) \
-                                            if ss1cts[x] == max(ss1cts)]
-                                        ss8cts = map(ss8list.count, ss8list)
-                                        ss8options = [ss8list[x] for x in range(len(ss8cts)) \
-                                            if ss8cts[x] == max(ss8cts)]
-                                        if flanking == 'commonshortest':
-                                            if strand == '+':
-                                                ss1 = str(sorted(ss1options)[0])
-                                                ss8 = str(sorted(ss8options)[-1])
-                                            else: 
-                                                ss1 = str(sorted(ss1options)[-1])
-                                                ss8 = str(sorted(ss8options)[0])
-                                        else:
-                                            if strand == '+':
-                                                ss1 = str(sorted(ss1options)[-1])
-                                                ss8 = str(sorted(ss8options)[0])
-                                            else: 
-                                                ss1 = str(sorted(ss1options)[0])
-                                                ss8 = str(sorted(ss8options)[-1])
-
-                                        # Iterate through each possible set of flanking exons
-                                        # for i in range(len(ss1list)):
-                                        #    for j in range(len(ss6list)):
-                                        if strand == '+': 
-                                            upexon = ":".join([chrom, ss1, ss2, strand])
-                                            mxe1 = ":".join([chrom, ss3, ss4, strand])
-                                            mxe2 = ":".join([chrom, ss5, ss6, strand])
-                                            dnexon = ":".join([chrom, ss7, ss8, strand])
-                                            name = "@".join([upexon, mxe1, mxe2, dnexon])
-                                            out.write("\t".join([chrom, 'MXE', 'gene', ss1, ss8,\
-                                                '.', strand, '.', "ID=" + name + ";Name=" + name]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'mRNA', ss1, ss8,\
-                                                '.', strand, '.', "ID=" + name + ".A;Parent=" + name]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'mRNA', ss1, ss8,\
-                                                '.', strand, '.', "ID=" + name + ".B;Parent=" + name]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss1, ss2,\
-                                                '.', strand, '.', "ID=" + name + ".A.up;Parent=" + name + ".A"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss3, ss4,\
-                                                '.', strand, '.', "ID=" + name + ".A.mxe1;Parent=" + name + ".A"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss7, ss8,\
-                                                '.', strand, '.', "ID=" + name + ".A.dn;Parent=" + name + ".A"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss1, ss2,\
-                                                '.', strand, '.', "ID=" + name + ".B.up;Parent=" + name + ".B"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss5, ss6,\
-                                                '.', strand, '.', "ID=" + name + ".B.mxe2;Parent=" + name + ".B"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss7, ss8,\
-                                                '.', strand, '.', "ID=" + name + ".B.dn;Parent=" + name + ".B"]) + "\n")
-                                            
-                                        else:
-                                            upexon = ":".join([chrom, ss2, ss1, strand])
-                                            mxe1 = ":".join([chrom, ss4, ss3, strand])
-                                            mxe2 = ":".join([chrom, ss6, ss5, strand])
-                                            dnexon = ":".join([chrom, ss8, ss7, strand])
-                                            name = "@".join([upexon, mxe1, mxe2, dnexon])
-                                            out.write("\t".join([chrom, 'MXE', 'gene', ss8, ss1,\
-                                                '.', strand, '.', "ID=" + name + ";Name=" + name]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'mRNA', ss8, ss1,\
-                                                '.', strand, '.', "ID=" + name + ".A;Parent=" + name]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'mRNA', ss8, ss1,\
-                                                '.', strand, '.', "ID=" + name + ".B;Parent=" + name]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss2, ss1,\
-                                                '.', strand, '.', "ID=" + name + ".A.up;Parent=" + name + ".A"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss4, ss3,\
-                                                '.', strand, '.', "ID=" + name + ".A.mxe1;Parent=" + name + ".A"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss8, ss7,\
-                                                '.', strand, '.', "ID=" + name + ".A.dn;Parent=" + name + ".A"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss2, ss1,\
-                                                '.', strand, '.', "ID=" + name + ".B.up;Parent=" + name + ".B"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss6, ss5,\
-                                                '.', strand, '.', "ID=" + name + ".B.mxe2;Parent=" + name + ".B"]) + "\n")
-                                            out.write("\t".join([chrom, 'MXE', 'exon', ss8, ss7,\
-                                                '.', strand, '.', "ID=" + name + ".B.dn;Parent=" + name + ".B"]) + "\n")
+                                    upexon = ":".join([chrom, ss2, ss1, strand])
+                                    mxe1 = ":".join([chrom, ss4, ss3, strand])
+                                    mxe2 = ":".join([chrom, ss6, ss5, strand])
+                                    dnexon = ":".join([chrom, ss8, ss7, strand])
+                                    name = "@".join([upexon, mxe1, mxe2, dnexon])
+                                    out.write("\t".join([chrom, 'MXE', 'gene', ss8, ss1,\
+                                        '.', strand, '.', "ID=" + name + ";Name=" + name]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'mRNA', ss8, ss1,\
+                                        '.', strand, '.', "ID=" + name + ".A;Parent=" + name]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'mRNA', ss8, ss1,\
+                                        '.', strand, '.', "ID=" + name + ".B;Parent=" + name]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss2, ss1,\
+                                        '.', strand, '.', "ID=" + name + ".A.up;Parent=" + name + ".A"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss4, ss3,\
+                                        '.', strand, '.', "ID=" + name + ".A.mxe1;Parent=" + name + ".A"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss8, ss7,\
+                                        '.', strand, '.', "ID=" + name + ".A.dn;Parent=" + name + ".A"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss2, ss1,\
+                                        '.', strand, '.', "ID=" + name + ".B.up;Parent=" + name + ".B"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss6, ss5,\
+                                        '.', strand, '.', "ID=" + name + ".B.mxe2;Parent=" + name + ".B"]) + "\n")
+                                    out.write("\t".join([chrom, 'MXE', 'exon', ss8, ss7,\
+                                        '.', strand, '.', "ID=" + name + ".B.dn;Parent=" + name + ".B"]) + "\n")
     out.close()
 
 
 
 
-def RI(DtoA_F, AtoD_F, DtoA_R, AtoD_R, gff3_f,
-       multi_iso=False):
+def RI(sg, gff3_f,
+       multi_iso=False,
+       chrom=None):
     """
     Define retained introns.
 
     Arguments are:
-    splice site dictionaries, followed by output file and a
-    keyword to denote method of selecting flanking exon
-    coordinates:
-    
-      - shortest
-      - longest
-      - commonshortest
-      - commonlongest 
+    splice graph, followed by output file and whether
+    to output multiple isoforms. If chrom is given, only
+    events on chrom are defined.
     """
     print "Generating retained introns (RI)"
 #    if os.path.isfile(gff3_f):
 #        print "  - Found file, skipping..."
 #        return
     out = open(gff3_f, 'w')
-
-    print "ATOD_F: ", AtoD_F
-
-    for acceptor in AtoD_F:                                 # iterate through acceptors
-        chrom, acceptorcoord, strand = acceptor.split(":")
-        donors = [x for x in list(AtoD_F[acceptor]) if x in DtoA_R]
+    AtoD_F = sg.edges["AtoD_F"]
+    DtoA_R = sg.edges["DtoA_R"]
+    AtoD_R = sg.edges["AtoD_R"]
+    coords = sg.site_coords.tolist()
+
+    for acceptor in sg.sources("AtoD_F", chrom=chrom):     # iterate through acceptors
+        chrom, acceptorcoord, strand = sg.site_info(acceptor)
+        donors = [x for x in AtoD_F.neighbors(acceptor) if x in DtoA_R]
                                                            # get the 5'ss in same exon for these acceptors
 
         if len(donors) > 1:
             for donor in donors:                           # iterate through these 5'ss
                 rilist = []
-                riAcceptors = [x for x in list(DtoA_R[donor]) if x in AtoD_R]
-                print "riAcceptors: ", riAcceptors
+                riAcceptors = [x for x in DtoA_R.neighbors(donor) if x in AtoD_R]
                                                            # get the upstream 3'ss for this 5'ss
                 for riAcceptor in riAcceptors:             # iterate through these 3'ss and get their 5'ss
-                    riDonors = [x for x in list(AtoD_R[riAcceptor]) if x in DtoA_R]
+                    riDonors = [x for x in AtoD_R.neighbors(riAcceptor) if x in DtoA_R]
                     for riDonor in riDonors:               # if the 3'ss upstream of these 5'ss is the upstream
-                        upAcceptors = list(DtoA_R[riDonor])# acceptor, this is a retained intron 
+                        upAcceptors = DtoA_R.neighbors(riDonor)  # acceptor, this is a retained intron 
                         if acceptor in upAcceptors:
                             rilist.append([riDonor, riAcceptor])
                 if len(rilist) > 0:
-                    ss1 = acceptor.split(":")[1]
-                    donorlist = list(set([x[0].split(":")[1] for x in rilist]))
-                    acceptorlist = list(set([x[1].split(":")[1] for x in rilist]))
-                    ss4 = donor.split(":")[1]
+                    ss1 = str(acceptorcoord)
+                    donorlist = [str(x) for x in sorted(set([coords[x[0]] for x in rilist]))]
+                    acceptorlist = [str(x) for x in sorted(set([coords[x[1]] for x in rilist]))]
+                    ss4 = str(coords[donor])
 
                     if multi_iso:
                         if strand == '+':
@@ -876,62 +778,166 @@ def load_ucsc_tables(tables_dir,
     return table_fnames
 
 
-def output_SE(sg, table_fnames, output_fname, flanking):
-    DtoA_F, AtoD_F, DtoA_R, AtoD_R = sg
-    SE(DtoA_F, AtoD_F, DtoA_R, AtoD_R, output_fname,
-       flanking=flanking)
+def output_SE(sg, table_fnames, output_fname, flanking,
+              chrom=None):
+    SE(sg, output_fname,
+       flanking=flanking,
+       chrom=chrom)
 
 
-def output_MXE(sg, table_fnames, output_fname, flanking):
-    DtoA_F, AtoD_F, DtoA_R, AtoD_R = sg
-    MXE(DtoA_F, AtoD_F, DtoA_R, AtoD_R, output_fname,
-        flanking=flanking)
+def output_MXE(sg, table_fnames, output_fname, flanking,
+               chrom=None):
+    MXE(sg, output_fname,
+        flanking=flanking,
+        chrom=chrom)
 
 
 def output_A3SS(sg, table_fnames, output_fname, flanking,
-                multi_iso=False):
-    DtoA_F, AtoD_F, DtoA_R, AtoD_R = sg    
-    A3SS(DtoA_F, AtoD_F, DtoA_R, AtoD_R, output_fname,
+                multi_iso=False,
+                chrom=None):
+    A3SS(sg, output_fname,
          flanking=flanking,
-         multi_iso=multi_iso)
+         multi_iso=multi_iso,
+         chrom=chrom)
 
 
 def output_A5SS(sg, table_fnames, output_fname, flanking,
-                multi_iso=False):
-    DtoA_F, AtoD_F, DtoA_R, AtoD_R = sg    
-    A5SS(DtoA_F, AtoD_F, DtoA_R, AtoD_R, output_fname,
+                multi_iso=False,
+                chrom=None):
+    A5SS(sg, output_fname,
          flanking=flanking,
-         multi_iso=multi_iso)
+         multi_iso=multi_iso,
+         chrom=chrom)
 
 
 def output_RI(sg, table_fnames, output_fname,
-              flanking=None):
+              flanking=None,
+              chrom=None):
     """
     Output RI annotation.
     """
     print "Outputting retained introns..."
     gff_out = gffutils.gffwriter.GFFWriter(output_fname)
-    # Define RI with the SpliceGraph object
-    splicegraph.define_RI(sg, gff_out)
+    # Define RI with the splice graph object
+    splicegraph.define_RI(sg, gff_out, chrom=chrom)
     gff_out.close()
 
 
+# Mapping from event type to the function that creates it
+EVENT_TYPE_TO_FUNC = \
+    [("SE", output_SE),
+     ("MXE", output_MXE),
+     ("A3SS", output_A3SS),
+     ("A5SS", output_A5SS),
+     ("RI", output_RI)]
+
+# Splice graph used by worker processes. Set before the workers
+# are forked so that they share it rather than receive a pickled copy.
+WORKER_SPLICE_GRAPH = None
+
+
+def output_events_on_chrom(event_args):
+    """
+    Output events of one type on one chromosome to a GFF fragment.
+    Run by worker processes in parallel mode.
+    """
+    event_type, chrom, fragment_fname, flanking = event_args
+    event_func = dict(EVENT_TYPE_TO_FUNC)[event_type]
+    event_func(WORKER_SPLICE_GRAPH, None, fragment_fname,
+               flanking=flanking,
+               chrom=chrom)
+    return fragment_fname
+
+
+def merge_gff_fragments(fragment_fnames, output_fname):
+    """
+    Concatenate GFF fragments, in the given order, into a single
+    GFF file. Only the header of the first fragment is kept.
+    """
+    gff_out = open(output_fname, "w")
+    for fragment_num, fragment_fname in enumerate(fragment_fnames):
+        for line in open(fragment_fname):
+            if line.startswith("#") and fragment_num > 0:
+                continue
+            gff_out.write(line)
+    gff_out.close()
+
+
+def defineAllSplicingParallel(sg, annotation_fnames,
+                              flanking='commonshortest',
+                              num_processors=2):
+    """
+    Define events of all types in parallel, using worker processes
+    that each define the events of one type on one chromosome.
+
+    'annotation_fnames' is a list of (event type, output filename)
+    pairs. Per-chromosome GFF fragments are merged into each output
+    file in order of chromosome name, so the output doesn't depend
+    on the order in which the workers finish.
+    """
+    global WORKER_SPLICE_GRAPH
+    fragments_dir = \
+        tempfile.mkdtemp(prefix="fragments.",
+                         dir=os.path.dirname(annotation_fnames[0][1]))
+    # Chromosomes with the most splice sites first, so that
+    # they don't end up being processed last
+    chrom_num_sites = {}
+    for chrom in sg.chroms:
+        first_site, last_site = sg.chrom_site_range(chrom)
+        chrom_num_sites[chrom] = last_site - first_site
+    chroms_by_size = sorted(sg.chroms,
+                            key=lambda chrom: chrom_num_sites[chrom],
+                            reverse=True)
+    event_args = []
+    fragment_fnames = {}
+    for event_type, output_fname in annotation_fnames:
+        fragment_fnames[event_type] = \
+            dict([(chrom, os.path.join(fragments_dir,
+                                       "%s.%s.gff3" %(event_type, chrom))) \
+                  for chrom in sg.chroms])
+        for chrom in chroms_by_size:
+            event_args.append((event_type, chrom,
+                               fragment_fnames[event_type][chrom],
+                               flanking))
+    print "Defining events on %d chromosomes with %d processes" \
+          %(len(sg.chroms), num_processors)
+    WORKER_SPLICE_GRAPH = sg
+    pool = multiprocessing.Pool(processes=num_processors)
+    try:
+        pool.map(output_events_on_chrom, event_args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        WORKER_SPLICE_GRAPH = None
+    for event_type, output_fname in annotation_fnames:
+        print "Merging %s events into %s" %(event_type, output_fname)
+        merge_gff_fragments([fragment_fnames[event_type][chrom] \
+                             for chrom in sg.chroms],
+                            output_fname)
+    shutil.rmtree(fragments_dir)
+
+
 def defineAllSplicing(tabledir, gff3dir,
                       flanking='commonshortest',
                       multi_iso=False,
                       genome_label=None,
-                      sanitize=False):
+                      sanitize=False,
+                      num_processors=1):
 #                      event_types=["SE", "RI", "MXE", "A3SS", "A5SS"]):
     """
     A wrapper to define all splicing events: SE, MXE, RI, A3SS, A5SS
     RI does not use the "flanking criteria".
+
+    If num_processors > 1, event types and chromosomes are
+    processed in parallel.
     """
     if isinstance(multi_iso, str):
         multi_iso = eval(multi_iso)
 
     table_fnames = load_ucsc_tables(tabledir)
-    sg = splicegraph.SpliceGraph(table_fnames)
-    DtoA_F, AtoD_F, DtoA_R, AtoD_R = prepareSplicegraph(*table_fnames)
+    # Parse the tables once into a splice graph shared by
+    # all event types
+    sg = splicegraph.SpliceSiteGraph(table_fnames)
 
     # Encode the flanking exons rule in output directory
     gff3dir = os.path.join(gff3dir, flanking)
@@ -943,37 +949,30 @@ def defineAllSplicing(tabledir, gff3dir,
         genome_label = ""
 
     annotation_fnames = []
-    # Mapping from event type to the function that creates it
-    event_type_to_func = \
-        [("SE", output_SE),
-         ("MXE", output_MXE),
-         ("A3SS", output_A3SS),
-         ("A5SS", output_A5SS),
-         ("RI", output_RI)]
-
-    for event_type, event_func in event_type_to_func:
+    for event_type, event_func in EVENT_TYPE_TO_FUNC:
         output_fname = \
             os.path.join(gff3dir, "%s.%s.gff3" %(event_type,
                                                  genome_label))
-        if event_type == "RI":
-            sg_data = sg
-        else:
-            sg_data = DtoA_F, AtoD_F, DtoA_R, AtoD_R
-        event_func(sg_data, table_fnames, output_fname, flanking=flanking)
-        annotation_fnames.append(output_fname)
+        if num_processors == 1:
+            event_func(sg, table_fnames, output_fname, flanking=flanking)
+        annotation_fnames.append((event_type, output_fname))
+
+    if num_processors > 1:
+        # Skip event types whose annotation was already made
+        parallel_fnames = []
+        for event_type, output_fname in annotation_fnames:
+            if os.path.isfile(output_fname):
+                print "Found %s, skipping..." %(output_fname)
+                continue
+            parallel_fnames.append((event_type, output_fname))
+        if len(parallel_fnames) > 0:
+            defineAllSplicingParallel(sg, parallel_fnames,
+                                      flanking=flanking,
+                                      num_processors=num_processors)
 
     # If asked, sanitize the annotation in place
     if sanitize:
-        for annotation_fname in annotation_fnames:
+        for event_type, annotation_fname in annotation_fnames:
             print "Sanitizing %s" %(annotation_fname)
             helpers.sanitize_gff_file(annotation_fname,
                                       in_place=True)
-
-
-
-
-
-
-
-
-
@@ -63,6 +63,33 @@ def readTable(table_f):
     return data
 
 
+def readTables(table_fnames):
+    """
+    Read in all the given tables once. Returns a mapping from
+    table label (basename of table file) to its parsed records,
+    so that the same parse can be shared by all splice graph
+    representations.
+    """
+    tables = collections.OrderedDict()
+    for table_fname in table_fnames:
+        print "Reading table", table_fname
+        table_label = os.path.basename(table_fname)
+        tables[table_label] = readTable(table_fname)
+    return tables
+
+
+def parseExonCoords(startvals, endvals):
+    """
+    Parse the comma-separated exonStarts/exonEnds fields
+    of a table record into lists of integers.
+
+    Adds +1 to starts since downloaded UCSC tables are 0-based start!
+    """
+    starts = [int(x) + 1 for x in startvals.split(",")[:-1]]
+    ends = [int(x) for x in endvals.split(",")[:-1]]
+    return starts, ends
+
+
 # Get splice graph.
 def populateSplicegraph(table_f, ss5_ss3_F, ss3_ss5_F, ss5_ss3_R, ss3_ss5_R):
     data = readTable(table_f)
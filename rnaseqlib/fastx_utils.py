@@ -12,6 +12,7 @@ import rnaseqlib.fasta_utils as fasta_utils
 import rnaseqlib.fastq_utils as fastq_utils
 
 import gzip
+import zlib
 
 def write_open_fastx(fastx_filename):
     """
@@ -156,3 +157,48 @@ def fastx_collapse_fastq(fastq_filename, output_dir, logger):
     return collapsed_seq_filename
                                           
     
+
+
+def get_read_pair_id(header):
+    """
+    Return the ID of a read from its FASTQ/FASTA header, shared
+    by both mates of a pair: the header up to the first whitespace,
+    without a leading '>' or '@' or a trailing /1 or /2.
+    """
+    read_id = header.split()[0].lstrip(">@")
+    if read_id.endswith("/1") or read_id.endswith("/2"):
+        read_id = read_id[:-2]
+    return read_id
+
+
+def subsample_fastx(fastx_filename, output_filename, num_reads,
+                    fraction=None):
+    """
+    Output a subsample of the reads of a FASTQ/FASTA file.
+
+    Takes the first 'num_reads' reads. If 'fraction' is given,
+    only reads whose ID hashes to a value below 'fraction' are
+    taken, so that the same mates are sampled from the two files
+    of a paired-end sample.
+
+    Returns the number of reads written.
+    """
+    fastx_type = get_fastx_type(fastx_filename)
+    fastx_entries = get_fastx_entries(fastx_filename)
+    fastx_out = write_open_fastx(output_filename)
+    num_written = 0
+    for entry in fastx_entries:
+        if num_written >= num_reads:
+            break
+        if fraction is not None:
+            read_id = get_read_pair_id(entry[0])
+            read_frac = (zlib.crc32(read_id) & 0xffffffff) / float(2**32)
+            if read_frac >= fraction:
+                continue
+        if fastx_type == "fasta":
+            fasta_utils.write_fasta(fastx_out, [entry])
+        else:
+            fastq_utils.write_fastq(fastx_out, entry)
+        num_written += 1
+    fastx_out.close()
+    return num_written
@@ -0,0 +1,306 @@
+##
+## Versioned binary index of a genome's annotation
+##
+## Gene models (as a GeneStore), gene names and descriptions, and
+## interval sets (exons, CDS, UTRs, introns, constitutive exons
+## and events) are saved as
+## .npy arrays in one directory, built once per genome. Jobs open
+## the index by memory mapping its arrays, so that worker processes
+## on one node share them through the page cache.
+##
+import os
+import sys
+import time
+import json
+import shutil
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.genes.GeneStore as GeneStore
+
+# Version of the index format; indices of other versions are rebuilt
+INDEX_VERSION = 2
+
+MANIFEST_FILENAME = "manifest.json"
+
+# Fields of interval set arrays
+INTERVAL_FIELDS = ["id", "chrom", "start", "end", "strand", "gene"]
+
+# Attributes naming the gene of a GFF record, in order of preference
+GFF_GENE_ATTRIBUTES = ["gene_id", "ensg_id", "Parent"]
+
+# Arrays of gene information, aligned with the genes of the store
+GENE_INFO_ARRAYS = ["gene_names", "gene_descs"]
+
+
+class AnnotationIndex:
+    """
+    An annotation index opened from its directory.
+
+    'genes' is a GeneStore.GeneStore, 'gene_names' and 'gene_descs'
+    are arrays of the names and descriptions of its genes, and
+    'intervals' maps interval set names to structured arrays with
+    fields INTERVAL_FIELDS, sorted by chromosome and start. The
+    'gene' field is the index of the interval's gene in the store,
+    or -1 if it has none.
+    """
+    def __init__(self, index_dir, mmap_mode="r"):
+        self.index_dir = index_dir
+        self.manifest = load_manifest(index_dir)
+        if self.manifest is None:
+            raise Exception, "Cannot find annotation index in %s" \
+                %(index_dir)
+        if self.manifest["version"] != INDEX_VERSION:
+            raise Exception, "Annotation index %s has version %s, " \
+                "expected %s" %(index_dir, self.manifest["version"],
+                                INDEX_VERSION)
+        self.genes = \
+            GeneStore.GeneStore.load(os.path.join(index_dir, "genes"),
+                                     mmap_mode=mmap_mode)
+        for array_name in GENE_INFO_ARRAYS:
+            setattr(self, array_name,
+                    np.load(os.path.join(index_dir, "%s.npy" %(array_name)),
+                            mmap_mode=mmap_mode))
+        self.intervals = {}
+        for set_name in self.manifest["interval_sets"]:
+            self.intervals[set_name] = \
+                np.load(get_intervals_filename(index_dir, set_name),
+                        mmap_mode=mmap_mode)
+
+
+    def get_intervals(self, set_name, chrom=None):
+        """
+        Return an interval set, optionally only its intervals on
+        a chromosome.
+        """
+        if set_name not in self.intervals:
+            raise Exception, "No interval set %s in annotation index %s" \
+                %(set_name, self.index_dir)
+        intervals = self.intervals[set_name]
+        if chrom is None:
+            return intervals
+        first_ind = np.searchsorted(intervals["chrom"], chrom, side="left")
+        last_ind = np.searchsorted(intervals["chrom"], chrom, side="right")
+        return intervals[first_ind:last_ind]
+
+
+    def __repr__(self):
+        return "AnnotationIndex(dir=%s, genes=%d, interval_sets=%s)" \
+            %(self.index_dir,
+              len(self.genes),
+              ",".join(sorted(self.intervals.keys())))
+
+
+def get_intervals_filename(index_dir, set_name):
+    return os.path.join(index_dir, "%s.intervals.npy" %(set_name))
+
+
+def load_manifest(index_dir):
+    """
+    Load the manifest of an index, or return None if the index
+    has none (e.g. it was never built or not built completely).
+    """
+    manifest_fname = os.path.join(index_dir, MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_fname):
+        return None
+    with open(manifest_fname) as manifest_in:
+        return json.load(manifest_in)
+
+
+def get_source_stamps(source_fnames):
+    """
+    Return stamps (size and modification time) of the source files
+    an index is built from, by source name. Missing sources get
+    None. Modification times are kept at full (sub-second)
+    resolution.
+    """
+    stamps = {}
+    for source_name, source_fname in source_fnames.iteritems():
+        if source_fname is None or not os.path.isfile(source_fname):
+            stamps[source_name] = None
+            continue
+        source_stat = os.stat(source_fname)
+        stamps[source_name] = [source_stat.st_size,
+                               source_stat.st_mtime]
+    return stamps
+
+
+def is_index_current(index_dir, source_fnames):
+    """
+    Return True if the index in index_dir has the current version
+    and was built from (at least) the given source files as they
+    are now.
+    """
+    manifest = load_manifest(index_dir)
+    if manifest is None or manifest["version"] != INDEX_VERSION:
+        return False
+    source_stamps = get_source_stamps(source_fnames)
+    for source_name, stamp in source_stamps.iteritems():
+        if manifest["sources"].get(source_name) != stamp:
+            return False
+    return True
+
+
+def make_intervals(ids, chroms, starts, ends, strands, gene_nums):
+    """
+    Make an interval set: a structured array with fields
+    INTERVAL_FIELDS, sorted by chromosome, start and end.
+    """
+    ids = np.asarray(ids, dtype="S")
+    chroms = np.asarray(chroms, dtype="S")
+    strands = np.asarray(strands, dtype="S1")
+    dtype = [("id", "S%d" %(max(ids.itemsize, 1))),
+             ("chrom", "S%d" %(max(chroms.itemsize, 1))),
+             ("start", np.int64),
+             ("end", np.int64),
+             ("strand", "S1"),
+             ("gene", np.int64)]
+    intervals = np.empty(len(ids), dtype=dtype)
+    intervals["id"] = ids
+    intervals["chrom"] = chroms
+    intervals["start"] = starts
+    intervals["end"] = ends
+    intervals["strand"] = strands
+    intervals["gene"] = gene_nums
+    order = np.lexsort((intervals["end"], intervals["start"],
+                        intervals["chrom"]))
+    return intervals[order]
+
+
+def get_gene_store_intervals(gene_store, min_cds_len=10):
+    """
+    Return the exon, CDS, 5' UTR and 3' UTR intervals of all
+    transcripts of a GeneStore.GeneStore, by set name. Intervals
+    are named by their transcript.
+    """
+    trans_genes = np.repeat(np.arange(gene_store.num_genes),
+                            np.diff(gene_store.gene_offsets))
+    exon_trans = np.repeat(np.arange(gene_store.num_transcripts),
+                           np.diff(gene_store.exon_offsets))
+    regions = gene_store.get_transcript_regions(min_cds_len=min_cds_len)
+    regions["exons"] = (exon_trans,
+                        gene_store.exon_starts,
+                        gene_store.exon_ends)
+    interval_sets = {}
+    for set_name, (trans_inds, starts, ends) in regions.iteritems():
+        interval_sets[set_name] = \
+            make_intervals(gene_store.trans_ids[trans_inds],
+                           gene_store.chroms[trans_inds],
+                           starts,
+                           ends,
+                           gene_store.strands[trans_inds],
+                           trans_genes[trans_inds])
+    return interval_sets
+
+
+def load_gff_intervals(gff_filename, rec_type, gene_nums={}):
+    """
+    Load the records of a given type from a GFF file as an
+    interval set, named by their ID. Records are assigned to
+    genes through their gene attributes (GFF_GENE_ATTRIBUTES)
+    and 'gene_nums', a mapping from gene IDs to gene indices.
+    """
+    ids = []
+    chroms = []
+    starts = []
+    ends = []
+    strands = []
+    rec_genes = []
+    with open(gff_filename) as gff_in:
+        for line in gff_in:
+            if line.startswith("#"):
+                continue
+            fields = line.strip().split("\t")
+            if len(fields) < 9 or fields[2] != rec_type:
+                continue
+            attributes = utils.parse_attributes(fields[8])
+            gene_num = -1
+            for gene_attr in GFF_GENE_ATTRIBUTES:
+                if attributes.get(gene_attr) in gene_nums:
+                    gene_num = gene_nums[attributes[gene_attr]]
+                    break
+            ids.append(attributes.get("ID", ""))
+            chroms.append(fields[0])
+            starts.append(int(fields[3]))
+            ends.append(int(fields[4]))
+            strands.append(fields[6])
+            rec_genes.append(gene_num)
+    return make_intervals(ids, chroms,
+                          np.array(starts, dtype=np.int64),
+                          np.array(ends, dtype=np.int64),
+                          strands,
+                          np.array(rec_genes, dtype=np.int64))
+
+
+def get_gene_info_array(gene_store, gene_info, na_val="NA"):
+    """
+    Return an array of information about the genes of a store
+    (e.g. their names) from a mapping from gene IDs to strings.
+    Genes that are missing or have no value get 'na_val'.
+    """
+    values = []
+    for gene_id in gene_store.gene_ids.tolist():
+        value = gene_info.get(gene_id, na_val)
+        if not isinstance(value, basestring):
+            value = na_val
+        values.append(value)
+    return np.array(values, dtype=str)
+
+
+def build_index(index_dir, gene_store, source_fnames,
+                gff_interval_sets={},
+                gene_names={},
+                gene_descs={}):
+    """
+    Build an annotation index into index_dir.
+
+    - gene_store: GeneStore.GeneStore of the genome's gene models
+    - gene_names, gene_descs: mappings from gene IDs to gene
+      names and descriptions
+    - source_fnames: mapping from source names to the files the
+      index is built from, whose stamps are recorded so that a
+      stale index can be detected (see is_index_current)
+    - gff_interval_sets: mapping from interval set names to
+      (gff_filename, rec_type) pairs of GFF records to index
+
+    The index is built in a temporary directory and moved into
+    place once complete, so that jobs never open a partly built
+    index. Returns the index directory.
+    """
+    print "Building annotation index in %s" %(index_dir)
+    t1 = time.time()
+    build_dir = "%s.build.%d" %(index_dir, os.getpid())
+    if os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    utils.make_dir(build_dir)
+    gene_store.save(os.path.join(build_dir, "genes"))
+    np.save(os.path.join(build_dir, "gene_names.npy"),
+            get_gene_info_array(gene_store, gene_names))
+    np.save(os.path.join(build_dir, "gene_descs.npy"),
+            get_gene_info_array(gene_store, gene_descs))
+    interval_sets = get_gene_store_intervals(gene_store)
+    for set_name, (gff_filename, rec_type) in gff_interval_sets.iteritems():
+        print "  - Indexing %s records of %s" %(rec_type, gff_filename)
+        interval_sets[set_name] = load_gff_intervals(gff_filename, rec_type,
+                                                     gene_store.gene_nums)
+    for set_name, intervals in interval_sets.iteritems():
+        np.save(get_intervals_filename(build_dir, set_name), intervals)
+    manifest = {"version": INDEX_VERSION,
+                "sources": get_source_stamps(source_fnames),
+                "interval_sets": sorted(interval_sets.keys())}
+    # The manifest is written last: an index without one is
+    # incomplete
+    with open(os.path.join(build_dir, MANIFEST_FILENAME), "w") as manifest_out:
+        json.dump(manifest, manifest_out, indent=1)
+    old_dir = None
+    if os.path.isdir(index_dir):
+        old_dir = "%s.old.%d" %(index_dir, os.getpid())
+        os.rename(index_dir, old_dir)
+    os.rename(build_dir, index_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    t2 = time.time()
+    print "Building annotation index took %.2f secs" %(t2 - t1)
+    return index_dir
@@ -17,6 +17,7 @@ import misopy
 import misopy.gff_utils as gff_utils
 
 import operator
+import itertools
 from collections import namedtuple
 
 class Gene:
@@ -169,58 +170,11 @@ class Gene:
         base_diff: base difference allowed when considering an exon
         to be 'included' in transcript
         """
-        num_trans = len(transcripts)
-        # Iterate through each exon and determine what fraction
-        # of the transcripts it appears in.
-        exons = self.get_parts(cds_only=cds_only)
-        # Fraction of transcripts that each exon occurs in
-        exons_fracs = []
-        frac_str = "NA"
-        if len(exons) == 0:
-            return exons, frac_str
-        for exon in exons:
-            # Calculate if the exon is in or out of each
-            # transcript
-            exon_status = array([trans.has_part(exon,
-                                                base_diff=base_diff,
-                                                cds_only=cds_only) \
-                                 for trans in transcripts])
-            # Compute the fraction of transcripts in which the exon
-            # occurs.
-            in_transcripts_frac = \
-                len(where(exon_status == True)[0]) / float(num_trans)
-            exons_fracs.append(in_transcripts_frac)
-        ## Get the exons that are most approximately constitutive, i.e.
-        ## occur in high fraction of transcripts
-        exons_dict = \
-            dict([(exon, frac) for exon, frac in zip(exons, exons_fracs)])
-        # Sort exons by how constitutive they are
-        sorted_exons = \
-            sorted(exons_dict.iteritems(), key=operator.itemgetter(1),
-                   reverse=True)
-        # Get maximally constitutive exons first
-        max_frac = max(exons_fracs)
-        const_exons = \
-            [e[0] for e in sorted_exons if e[1] == max_frac]
-        # Fraction of transcripts chosen exons appear in 
-        fracs = len(const_exons) * [max_frac]
-        # Compute sum of lengths of exons
-        sum_lens = np.sum([exon.len for exon in const_exons])
-        if sum_lens < min_exon_space:
-            print "NOTE: sum of constitutive exon lengths for %s is only %d" \
-                  %(self.label, sum_lens)
-            # Try to get next exon in list if there are any
-            if len(sorted_exons) >= 2:
-                next_exon, next_exon_frac = sorted_exons[1]
-                print "Fetching next exon which appears in %.2f fraction " \
-                      "of transcripts" %(next_exon_frac)
-                const_exons.append(next_exon)
-                fracs.append(next_exon_frac)
-                sum_lens += next_exon.len
-        # Return constitutive exons and a string describing the fraction of
-        # transcripts they appear in
-        frac_str = ",".join(["%.2f" %(f) for f in fracs])
-        return const_exons, frac_str
+        return get_const_exons_of_transcript_sets([transcripts],
+                                                  cds_only=cds_only,
+                                                  base_diff=base_diff,
+                                                  min_exon_space=min_exon_space,
+                                                  labels=[self.label])[0]
 
 
 #     def old_compute_const_exons(self,
@@ -336,11 +290,16 @@ class Transcript:
     __slots__ = ['parts', 'chrom', 'strand', 'label',
                  'cds_start', 'cds_end', 'cds_coords',
                  'cds_parts', 'parent']
+    # Attributes that CDS/UTR parts are derived from: setting
+    # any of them clears the memoized derived parts
+    DERIVED_FROM = ('parts', 'cds_start', 'cds_end')
     def __init__(self, parts, chrom, strand,
                  label=None,
                  cds_start=None,
                  cds_end=None,
                  parent=None):
+        # Memoized CDS/UTR parts by (part type, min_cds_len)
+        self.derived_parts = {}
         self.gene = None
         self.chrom = chrom
         self.strand = strand
@@ -361,6 +320,20 @@ class Transcript:
             self.has_cds = True
             
         
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        if name in Transcript.DERIVED_FROM:
+            self.__dict__['derived_parts'] = {}
+
+
+    def clear_derived_parts(self):
+        """
+        Clear memoized CDS/UTR parts. Needed only if the transcript's
+        parts are modified in place rather than reassigned.
+        """
+        self.derived_parts = {}
+
+        
     def __repr__(self):
         parts_str = ",".join(p.__str__() for p in self.parts)
         return "Transcript(%s, %s, %s, label=%s, parent=%s, has_cds=%s)" \
@@ -415,12 +388,87 @@ class Transcript:
 
         If the CDS length is less than 'min_cds_len' nucleotides,
         skip it altogether.
+
+        The parts are memoized (see get_derived_parts).
         """
-        self.cds_parts = []
-        cds_len = self.cds_end - self.cds_start + 1
+        self.cds_parts = self.get_derived_parts("cds", min_cds_len)
+        return self.cds_parts
+
+
+    def get_5p_utr_parts(self, min_cds_len=10):
+        """
+        Return the parts of the transcript in its 5' UTR, or no
+        parts if it has no CDS (see get_cds_parts).
+        """
+        return self.get_derived_parts("5p_utr", min_cds_len)
+
+
+    def get_3p_utr_parts(self, min_cds_len=10):
+        """
+        Return the parts of the transcript in its 3' UTR, or no
+        parts if it has no CDS (see get_cds_parts).
+        """
+        return self.get_derived_parts("3p_utr", min_cds_len)
+
+
+    def get_derived_parts(self, part_type, min_cds_len=10):
+        """
+        Return the CDS ('cds') or UTR ('5p_utr', '3p_utr') parts of
+        the transcript, computing them only on first request.
+        """
+        key = (part_type, min_cds_len)
+        if key not in self.derived_parts:
+            if part_type == "cds":
+                self.derived_parts[key] = self.compute_cds_parts(min_cds_len)
+            else:
+                self.derived_parts[key] = \
+                    self.compute_utr_parts(part_type, min_cds_len)
+        return self.derived_parts[key]
+
+
+    def compute_utr_parts(self, part_type, min_cds_len=10):
+        """
+        Compute the parts of the transcript in the 5' UTR
+        ('5p_utr') or 3' UTR ('3p_utr'): the parts of exons before
+        the CDS start or after the CDS end, taking strand into
+        account.
+        """
+        utr_parts = []
+        if (self.cds_start is None) or \
+           (self.cds_end - self.cds_start + 1 < min_cds_len):
+            return tuple(utr_parts)
+        # UTR before the CDS in genomic coordinates
+        left_utr = (part_type == "5p_utr") == (self.strand != "-")
+        for part in self.parts:
+            if left_utr and (part.start < self.cds_start):
+                utr_start, utr_end = part.start, min(part.end,
+                                                     self.cds_start - 1)
+            elif (not left_utr) and (part.end > self.cds_end):
+                utr_start, utr_end = max(part.start, self.cds_end + 1), \
+                                     part.end
+            else:
+                continue
+            utr_part = Part(utr_start, utr_end,
+                            chrom=part.chrom,
+                            strand=part.strand,
+                            parent=part.parent)
+            utr_part.label = "%s.%s:%s-%s:%s" %(part_type,
+                                                utr_part.chrom,
+                                                str(utr_part.start),
+                                                str(utr_part.end),
+                                                part.strand)
+            utr_parts.append(utr_part)
+        return tuple(utr_parts)
+
+
+    def compute_cds_parts(self, min_cds_len=10):
+        """
+        Compute the parts that are in the CDS (see get_cds_parts).
+        """
+        cds_parts = []
         if (self.cds_start is None) or \
-           (cds_len < min_cds_len):
-            return self.cds_parts
+           (self.cds_end - self.cds_start + 1 < min_cds_len):
+            return tuple(cds_parts)
         # Compute the parts that are in the CDS
         for part in self.parts:
             # Skip parts that end before the CDS or
@@ -442,7 +490,7 @@ class Transcript:
                                                      str(cds_part.start),
                                                      str(cds_part.end),
                                                      part.strand)
-                self.cds_parts = [cds_part]
+                cds_parts = [cds_part]
                 break
             elif (part.start <= self.cds_start) and \
                  (part.end > self.cds_start):
@@ -474,9 +522,9 @@ class Transcript:
                                                  str(cds_part.end),
                                                  part.strand)
             if cds_part is not None:
-                self.cds_parts.append(cds_part)
-        self.cds_parts = tuple(self.cds_parts)
-        return self.cds_parts
+                cds_parts.append(cds_part)
+        cds_parts = tuple(cds_parts)
+        return cds_parts
         
     
 class Part:
@@ -532,6 +580,277 @@ def output_parts_as_gff(gff_out, parts, chrom, strand,
         gff_out.write(gff_rec)
 
 
+##
+## CDS/UTR intervals of many transcripts
+##
+TRANSCRIPT_REGIONS = ["cds", "5p_utr", "3p_utr"]
+
+def get_transcripts_exon_arrays(transcripts):
+    """
+    Flatten the exons of transcripts into arrays, for
+    get_transcript_regions.
+
+    Returns (exon_starts, exon_ends, exon_offsets, cds_starts,
+    cds_ends, strands), where the exons of transcript i are at
+    exon_offsets[i]:exon_offsets[i + 1]. Transcripts without CDS
+    coordinates get an empty CDS.
+    """
+    exon_starts = []
+    exon_ends = []
+    num_exons = []
+    cds_starts = []
+    cds_ends = []
+    strands = []
+    for transcript in transcripts:
+        for part in transcript.parts:
+            exon_starts.append(part.start)
+            exon_ends.append(part.end)
+        num_exons.append(len(transcript.parts))
+        if transcript.cds_start is None:
+            cds_starts.append(1)
+            cds_ends.append(0)
+        else:
+            cds_starts.append(transcript.cds_start)
+            cds_ends.append(transcript.cds_end)
+        strands.append(transcript.strand)
+    exon_offsets = np.zeros(len(num_exons) + 1, dtype=np.int64)
+    np.cumsum(num_exons, out=exon_offsets[1:])
+    return (np.array(exon_starts, dtype=np.int64),
+            np.array(exon_ends, dtype=np.int64),
+            exon_offsets,
+            np.array(cds_starts, dtype=np.int64),
+            np.array(cds_ends, dtype=np.int64),
+            np.array(strands, dtype=str))
+
+
+def get_transcript_regions(exon_starts, exon_ends, exon_offsets,
+                           cds_starts, cds_ends, strands,
+                           min_cds_len=10):
+    """
+    Derive the CDS, 5' UTR and 3' UTR intervals of all transcripts
+    at once from their exons (see get_transcripts_exon_arrays or
+    GeneStore.GeneStore), with the same rules as
+    Transcript.get_cds_parts and Transcript.get_5p_utr_parts /
+    get_3p_utr_parts.
+
+    Returns a dictionary mapping each region ('cds', '5p_utr',
+    '3p_utr') to arrays (trans_inds, starts, ends) of its intervals,
+    ordered by transcript and then by exon.
+    """
+    num_exons = np.diff(exon_offsets)
+    exon_trans = np.repeat(np.arange(len(num_exons)), num_exons)
+    exon_cds_starts = cds_starts[exon_trans]
+    exon_cds_ends = cds_ends[exon_trans]
+    # Transcripts with too short a CDS have no CDS or UTRs
+    is_coding = ((cds_ends - cds_starts + 1) >= min_cds_len)[exon_trans]
+    is_minus = (strands == "-")[exon_trans]
+    in_cds = is_coding & (exon_ends > exon_cds_starts) & \
+             (exon_starts < exon_cds_ends)
+    in_left_utr = is_coding & (exon_starts < exon_cds_starts)
+    in_right_utr = is_coding & (exon_ends > exon_cds_ends)
+    left_utr_ends = np.minimum(exon_ends, exon_cds_starts - 1)
+    right_utr_starts = np.maximum(exon_starts, exon_cds_ends + 1)
+    regions = {}
+    regions["cds"] = (exon_trans[in_cds],
+                      np.maximum(exon_starts, exon_cds_starts)[in_cds],
+                      np.minimum(exon_ends, exon_cds_ends)[in_cds])
+    for region, left_strand_minus in (("5p_utr", False),
+                                      ("3p_utr", True)):
+        # The 5' UTR is left of the CDS on the plus strand
+        # and right of it on the minus strand
+        in_left = in_left_utr & (is_minus == left_strand_minus)
+        in_right = in_right_utr & (is_minus != left_strand_minus)
+        in_region = in_left | in_right
+        regions[region] = \
+            (exon_trans[in_region],
+             np.where(in_left, exon_starts, right_utr_starts)[in_region],
+             np.where(in_left, left_utr_ends, exon_ends)[in_region])
+    return regions
+
+
+##
+## Constitutive exons
+##
+def compute_const_exons_by_gene(genes,
+                                base_diff=6,
+                                cds_only=False,
+                                frac_const=.7,
+                                min_exon_space=40):
+    """
+    Compute constitutive exons of many genes at once (see
+    Gene.compute_const_exons for the parameters). 'genes' can
+    be GeneModel.Gene objects or GeneStore views.
+
+    Returns a list of (const_exons, frac_str) for the genes, and
+    also sets each gene's 'const_exons'.
+    """
+    results = [None] * len(genes)
+    multi_trans_genes = []
+    transcript_sets = []
+    for gene_num, gene in enumerate(genes):
+        if cds_only:
+            transcripts = gene.get_cds_transcripts()
+        else:
+            transcripts = gene.transcripts
+        # If we have only one transcript then all
+        # exons are constitutive
+        if len(transcripts) == 1:
+            if cds_only:
+                const_exons = transcripts[0].get_cds_parts()
+            else:
+                const_exons = transcripts[0].parts
+            results[gene_num] = (const_exons,
+                                 ",".join(len(const_exons) * ["1"]))
+        else:
+            multi_trans_genes.append(gene_num)
+            transcript_sets.append(transcripts)
+    multi_results = \
+        get_const_exons_of_transcript_sets(transcript_sets,
+                                           cds_only=cds_only,
+                                           base_diff=base_diff,
+                                           min_exon_space=min_exon_space,
+                                           labels=[genes[gene_num].label \
+                                                   for gene_num in multi_trans_genes])
+    for gene_num, result in itertools.izip(multi_trans_genes, multi_results):
+        results[gene_num] = result
+    for gene, result in itertools.izip(genes, results):
+        gene.const_exons = result[0]
+    return results
+
+
+def get_const_exons_of_transcript_sets(transcript_sets,
+                                       cds_only=False,
+                                       base_diff=6,
+                                       min_exon_space=40,
+                                       labels=None):
+    """
+    Get the (approximately) constitutive exons of each of a list of
+    sets of transcripts, all at once.
+
+    The distinct exons of each set are found by sorting the
+    (set, start, end) coordinates of all parts. An exon occurs in
+    a transcript if one of the transcript's parts has start and end
+    within 'base_diff' of the exon's, and the (transcript, exon)
+    pairs for which this holds are found by binary search on the
+    sorted exon starts. This gives, for each set, the nonzero
+    entries of its transcripts x exons occurrence matrix, whose
+    column sums are the number of transcripts each exon occurs in.
+
+    The exons occurring in the highest fraction of a set's
+    transcripts are its constitutive exons. If their total length
+    is less than 'min_exon_space', the next most constitutive exon
+    is added.
+
+    Returns a list of (const_exons, frac_str) for the sets, where
+    const_exons are in the order of their first occurrence in
+    the transcripts and frac_str gives the fraction of transcripts
+    each occurs in.
+    """
+    num_sets = len(transcript_sets)
+    if labels is None:
+        labels = [None] * num_sets
+    # Flatten the parts of all transcripts
+    part_objs = []
+    part_sets = []
+    part_trans = []
+    part_starts = []
+    part_ends = []
+    set_num_trans = np.zeros(num_sets, dtype=np.int64)
+    trans_num = 0
+    for set_num, transcripts in enumerate(transcript_sets):
+        set_num_trans[set_num] = len(transcripts)
+        for trans in transcripts:
+            if cds_only:
+                trans_parts = trans.get_cds_parts()
+            else:
+                trans_parts = trans.parts
+            for part in trans_parts:
+                part_objs.append(part)
+                part_sets.append(set_num)
+                part_trans.append(trans_num)
+                part_starts.append(part.start)
+                part_ends.append(part.end)
+            trans_num += 1
+    results = [([], "NA")] * num_sets
+    if len(part_objs) == 0:
+        return results
+    part_sets = np.array(part_sets, dtype=np.int64)
+    part_trans = np.array(part_trans, dtype=np.int64)
+    part_starts = np.array(part_starts, dtype=np.int64)
+    part_ends = np.array(part_ends, dtype=np.int64)
+    # Distinct exons of each set, sorted by (set, start, end), and
+    # the first part giving each exon
+    part_order = np.lexsort((np.arange(len(part_objs)), part_ends,
+                             part_starts, part_sets))
+    sorted_sets = part_sets[part_order]
+    sorted_starts = part_starts[part_order]
+    sorted_ends = part_ends[part_order]
+    is_first = np.ones(len(part_order), dtype=bool)
+    is_first[1:] = (np.diff(sorted_sets) != 0) | \
+                   (np.diff(sorted_starts) != 0) | \
+                   (np.diff(sorted_ends) != 0)
+    exon_first_parts = part_order[is_first]
+    exon_sets = sorted_sets[is_first]
+    exon_starts = sorted_starts[is_first]
+    exon_ends = sorted_ends[is_first]
+    num_exons = len(exon_first_parts)
+    # Candidate exons of each part: exons of the same set whose
+    # start is within 'base_diff' of the part's start
+    exon_keys = (exon_sets << 32) + exon_starts
+    low_inds = \
+        np.searchsorted(exon_keys,
+                        (part_sets << 32) + np.maximum(part_starts - base_diff, 0),
+                        side="left")
+    high_inds = np.searchsorted(exon_keys,
+                                (part_sets << 32) + part_starts + base_diff,
+                                side="right")
+    num_cands = high_inds - low_inds
+    cand_offsets = np.cumsum(num_cands) - num_cands
+    cand_exons = np.repeat(low_inds - cand_offsets, num_cands) + \
+                 np.arange(num_cands.sum())
+    cand_parts = np.repeat(np.arange(len(part_objs)), num_cands)
+    matches = np.abs(exon_ends[cand_exons] - part_ends[cand_parts]) <= base_diff
+    # Distinct (transcript, exon) occurrences
+    occurrences = np.unique(part_trans[cand_parts[matches]] * num_exons + \
+                            cand_exons[matches])
+    exon_num_trans = np.bincount(occurrences % num_exons, minlength=num_exons)
+    exon_fracs = exon_num_trans / set_num_trans[exon_sets].astype(float)
+    # Exons of each set are contiguous
+    set_exon_counts = np.bincount(exon_sets, minlength=num_sets)
+    set_exon_offsets = np.zeros(num_sets + 1, dtype=np.int64)
+    np.cumsum(set_exon_counts, out=set_exon_offsets[1:])
+    has_exons = set_exon_counts > 0
+    max_fracs = np.zeros(num_sets)
+    max_fracs[has_exons] = \
+        np.maximum.reduceat(exon_fracs, set_exon_offsets[:-1][has_exons])
+    is_const = (exon_fracs == max_fracs[exon_sets])
+    exon_lens = exon_ends - exon_starts + 1
+    for set_num in np.nonzero(has_exons)[0]:
+        first_exon = set_exon_offsets[set_num]
+        last_exon = set_exon_offsets[set_num + 1]
+        set_exons = np.arange(first_exon, last_exon)
+        # Order exons by first occurrence
+        set_exons = set_exons[np.argsort(exon_first_parts[first_exon:last_exon])]
+        const_exons = set_exons[is_const[set_exons]]
+        selected = list(const_exons)
+        sum_lens = exon_lens[const_exons].sum()
+        if sum_lens < min_exon_space:
+            print "NOTE: sum of constitutive exon lengths for %s is only %d" \
+                  %(labels[set_num], sum_lens)
+            # Add the next most constitutive exon, if any
+            other_exons = set_exons[~is_const[set_exons]]
+            if len(other_exons) > 0:
+                next_exon = \
+                    other_exons[np.argmax(exon_fracs[other_exons])]
+                print "Fetching next exon which appears in %.2f fraction " \
+                      "of transcripts" %(exon_fracs[next_exon])
+                selected.append(next_exon)
+        results[set_num] = \
+            ([part_objs[exon_first_parts[exon]] for exon in selected],
+             ",".join(["%.2f" %(exon_fracs[exon]) for exon in selected]))
+    return results
+
+
 ##
 ## Coordinate utilities
 ##
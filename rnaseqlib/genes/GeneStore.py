@@ -0,0 +1,554 @@
+##
+## Array-backed store of gene models
+##
+## Exons of all transcripts are kept in flat arrays (struct of
+## arrays) with transcript and gene offsets into them. Genes,
+## transcripts and parts are exposed through lightweight views
+## with the attributes of GeneModel.Gene, Transcript and Part.
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.genes.GeneModel as GeneModel
+
+# Arrays making up a store, saved as one .npy file each
+STORE_ARRAYS = ["gene_ids",
+                "gene_symbols",
+                "gene_offsets",
+                "trans_ids",
+                "chroms",
+                "strands",
+                "cds_starts",
+                "cds_ends",
+                "exon_offsets",
+                "exon_starts",
+                "exon_ends"]
+
+
+class GeneStore:
+    """
+    Gene models stored as arrays.
+
+    Transcripts are grouped by gene: the transcripts of gene i are
+    gene_offsets[i]:gene_offsets[i + 1], and the exons of transcript
+    j are exon_offsets[j]:exon_offsets[j + 1]. All coordinates
+    are 1-based.
+
+    Behaves like a dictionary mapping gene IDs to GeneView objects,
+    which are made on access.
+    """
+    def __init__(self, arrays):
+        for array_name in STORE_ARRAYS:
+            setattr(self, array_name, arrays[array_name])
+        self.num_genes = len(self.gene_ids)
+        self.num_transcripts = len(self.trans_ids)
+        # Mapping from gene IDs to gene indices
+        self.gene_nums = dict((gene_id, gene_num) \
+                              for gene_num, gene_id in \
+                              enumerate(self.gene_ids.tolist()))
+
+
+    @classmethod
+    def from_table_arrays(cls, table_arrays, gene_symbols=None,
+                          na_val="NA"):
+        """
+        Make a store from a table parsed into arrays (see
+        tables.parse_ucsc_table_arrays).
+
+        Genes are ordered by their first transcript in the table,
+        and transcripts of a gene keep their table order.
+        'gene_symbols' is an optional mapping from gene IDs to
+        gene symbols.
+        """
+        table_gene_ids = table_arrays["gene_ids"]
+        uniq_gene_ids, first_inds, trans_genes = \
+            np.unique(table_gene_ids, return_index=True, return_inverse=True)
+        # Rank genes by their first appearance in the table
+        gene_order = np.argsort(first_inds, kind="mergesort")
+        gene_ranks = np.empty(len(gene_order), dtype=np.int64)
+        gene_ranks[gene_order] = np.arange(len(gene_order))
+        trans_genes = gene_ranks[trans_genes]
+        trans_order = np.argsort(trans_genes, kind="mergesort")
+        gene_ids = uniq_gene_ids[gene_order]
+        gene_offsets = np.zeros(len(gene_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(trans_genes, minlength=len(gene_ids)),
+                  out=gene_offsets[1:])
+        # Reorder exons to follow the order of their transcripts
+        table_offsets = table_arrays["exon_offsets"]
+        exon_lens = np.diff(table_offsets)[trans_order]
+        exon_offsets = np.zeros(len(trans_order) + 1, dtype=np.int64)
+        np.cumsum(exon_lens, out=exon_offsets[1:])
+        exon_inds = \
+            np.repeat(table_offsets[:-1][trans_order] - exon_offsets[:-1],
+                      exon_lens) + np.arange(exon_offsets[-1])
+        if gene_symbols is None:
+            gene_symbols = {}
+        arrays = \
+            {"gene_ids": gene_ids,
+             "gene_symbols": \
+                 np.array([gene_symbols.get(gene_id, na_val) \
+                           for gene_id in gene_ids.tolist()], dtype=str),
+             "gene_offsets": gene_offsets,
+             "exon_offsets": exon_offsets,
+             "exon_starts": table_arrays["exon_starts"][exon_inds],
+             "exon_ends": table_arrays["exon_ends"][exon_inds]}
+        for array_name in ["trans_ids", "chroms", "strands",
+                           "cds_starts", "cds_ends"]:
+            arrays[array_name] = table_arrays[array_name][trans_order]
+        return cls(arrays)
+
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode="r"):
+        """
+        Load a store saved by save(). By default the arrays are
+        memory mapped read-only, so that processes loading the same
+        store share its memory.
+        """
+        arrays = {}
+        for array_name in STORE_ARRAYS:
+            array_fname = os.path.join(store_dir, "%s.npy" %(array_name))
+            if not os.path.isfile(array_fname):
+                raise Exception, "Cannot find gene store array %s" \
+                    %(array_fname)
+            arrays[array_name] = np.load(array_fname, mmap_mode=mmap_mode)
+        return cls(arrays)
+
+
+    def save(self, store_dir):
+        """
+        Save the store's arrays into a directory.
+        """
+        utils.make_dir(store_dir)
+        for array_name in STORE_ARRAYS:
+            np.save(os.path.join(store_dir, "%s.npy" %(array_name)),
+                    getattr(self, array_name))
+        return store_dir
+
+
+    def get_transcript_regions(self, min_cds_len=10):
+        """
+        Return the CDS, 5' UTR and 3' UTR intervals of all
+        transcripts as arrays (see GeneModel.get_transcript_regions).
+        Transcript indices refer to the store's transcript arrays.
+        """
+        return GeneModel.get_transcript_regions(self.exon_starts,
+                                                self.exon_ends,
+                                                self.exon_offsets,
+                                                self.cds_starts,
+                                                self.cds_ends,
+                                                self.strands,
+                                                min_cds_len=min_cds_len)
+
+
+    def __len__(self):
+        return self.num_genes
+
+
+    def __contains__(self, gene_id):
+        return gene_id in self.gene_nums
+
+
+    def __getitem__(self, gene_id):
+        return GeneView(self, self.gene_nums[gene_id])
+
+
+    def __iter__(self):
+        return self.iterkeys()
+
+
+    def get(self, gene_id, default=None):
+        if gene_id not in self.gene_nums:
+            return default
+        return self[gene_id]
+
+
+    def keys(self):
+        return self.gene_ids.tolist()
+
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+
+    def itervalues(self):
+        for gene_num in xrange(self.num_genes):
+            yield GeneView(self, gene_num)
+
+
+    def iteritems(self):
+        for gene_num, gene_id in enumerate(self.keys()):
+            yield gene_id, GeneView(self, gene_num)
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def __repr__(self):
+        return "GeneStore(%d genes, %d transcripts, %d exons)" \
+            %(self.num_genes, self.num_transcripts, len(self.exon_starts))
+
+
+class PartView(object):
+    """
+    Part of a transcript, with the attributes of GeneModel.Part.
+    """
+    __slots__ = ["start", "end", "chrom", "strand", "parent",
+                 "label_prefix"]
+    def __init__(self, start, end, chrom, strand, parent,
+                 label_prefix=""):
+        self.start = start
+        self.end = end
+        self.chrom = chrom
+        self.strand = strand
+        self.parent = parent
+        self.label_prefix = label_prefix
+
+
+    @property
+    def label(self):
+        return "%s%s:%s-%s:%s" %(self.label_prefix,
+                                 self.chrom,
+                                 self.start,
+                                 self.end,
+                                 self.strand)
+
+
+    @property
+    def len(self):
+        return self.end - self.start + 1
+
+
+    def __repr__(self):
+        return "Part(%s, %s)" %(str(self.start),
+                                str(self.end))
+
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class TranscriptView(object):
+    """
+    Transcript in a GeneStore, with the attributes of
+    GeneModel.Transcript.
+    """
+    __slots__ = ["store", "trans_num"]
+    def __init__(self, store, trans_num):
+        self.store = store
+        self.trans_num = trans_num
+
+
+    @property
+    def label(self):
+        return str(self.store.trans_ids[self.trans_num])
+
+
+    @property
+    def parent(self):
+        gene_num = np.searchsorted(self.store.gene_offsets, self.trans_num,
+                                   side="right") - 1
+        return str(self.store.gene_ids[gene_num])
+
+
+    @property
+    def chrom(self):
+        return str(self.store.chroms[self.trans_num])
+
+
+    @property
+    def strand(self):
+        return str(self.store.strands[self.trans_num])
+
+
+    @property
+    def cds_start(self):
+        return int(self.store.cds_starts[self.trans_num])
+
+
+    @property
+    def cds_end(self):
+        return int(self.store.cds_ends[self.trans_num])
+
+
+    @property
+    def cds_coords(self):
+        return (self.cds_start, self.cds_end)
+
+
+    def get_exon_coords(self):
+        """
+        Return arrays of the start and end coordinates
+        of the transcript's exons.
+        """
+        first_exon = self.store.exon_offsets[self.trans_num]
+        last_exon = self.store.exon_offsets[self.trans_num + 1]
+        return (self.store.exon_starts[first_exon:last_exon],
+                self.store.exon_ends[first_exon:last_exon])
+
+
+    @property
+    def start(self):
+        return int(self.store.exon_starts[self.store.exon_offsets[self.trans_num]])
+
+
+    @property
+    def end(self):
+        return int(self.store.exon_ends[self.store.exon_offsets[self.trans_num + 1] - 1])
+
+
+    @property
+    def parts(self):
+        exon_starts, exon_ends = self.get_exon_coords()
+        chrom, strand, label = self.chrom, self.strand, self.label
+        return [PartView(start, end, chrom, strand, label) \
+                for start, end in zip(exon_starts.tolist(),
+                                      exon_ends.tolist())]
+
+
+    def get_cds_coords(self, min_cds_len=10):
+        """
+        Return arrays of the start and end coordinates of the
+        transcript's exons trimmed to the CDS, as in
+        GeneModel.Transcript.get_cds_parts.
+        """
+        cds_start, cds_end = self.cds_coords
+        exon_starts, exon_ends = self.get_exon_coords()
+        if (cds_end - cds_start + 1) < min_cds_len:
+            return exon_starts[0:0], exon_ends[0:0]
+        in_cds = (exon_ends > cds_start) & (exon_starts < cds_end)
+        return (np.maximum(exon_starts[in_cds], cds_start),
+                np.minimum(exon_ends[in_cds], cds_end))
+
+
+    def get_cds_parts(self, min_cds_len=10):
+        """
+        Return the parts of the transcript in the CDS.
+        """
+        cds_starts, cds_ends = self.get_cds_coords(min_cds_len=min_cds_len)
+        chrom, strand, label = self.chrom, self.strand, self.label
+        return tuple(PartView(start, end, chrom, strand, label,
+                              label_prefix="cds.") \
+                     for start, end in zip(cds_starts.tolist(),
+                                           cds_ends.tolist()))
+
+
+    @property
+    def cds_parts(self):
+        return self.get_cds_parts()
+
+
+    def get_utr_parts(self, part_type, min_cds_len=10):
+        """
+        Return the parts of the transcript in its 5' UTR ('5p_utr')
+        or 3' UTR ('3p_utr').
+        """
+        exon_starts, exon_ends = self.get_exon_coords()
+        regions = \
+            GeneModel.get_transcript_regions(exon_starts, exon_ends,
+                                             np.array([0, len(exon_starts)]),
+                                             np.array([self.cds_start]),
+                                             np.array([self.cds_end]),
+                                             np.array([self.strand]),
+                                             min_cds_len=min_cds_len)
+        trans_inds, utr_starts, utr_ends = regions[part_type]
+        chrom, strand, label = self.chrom, self.strand, self.label
+        return tuple(PartView(start, end, chrom, strand, label,
+                              label_prefix="%s." %(part_type)) \
+                     for start, end in zip(utr_starts.tolist(),
+                                           utr_ends.tolist()))
+
+
+    def get_5p_utr_parts(self, min_cds_len=10):
+        return self.get_utr_parts("5p_utr", min_cds_len=min_cds_len)
+
+
+    def get_3p_utr_parts(self, min_cds_len=10):
+        return self.get_utr_parts("3p_utr", min_cds_len=min_cds_len)
+
+
+    @property
+    def has_cds(self):
+        return len(self.get_cds_coords()[0]) > 0
+
+
+    def has_part(self, part,
+                 cds_only=False,
+                 base_diff=0):
+        """
+        Return True if the part exists in the transcript, allowing
+        its start and end to differ by up to 'base_diff' bases.
+        """
+        if cds_only:
+            exon_starts, exon_ends = self.get_cds_coords()
+        else:
+            exon_starts, exon_ends = self.get_exon_coords()
+        return bool(((np.abs(exon_starts - part.start) <= base_diff) & \
+                     (np.abs(exon_ends - part.end) <= base_diff)).any())
+
+
+    def to_transcript(self):
+        """
+        Return the transcript as a GeneModel.Transcript.
+        """
+        parts = [GeneModel.Part(part.start, part.end, part.chrom,
+                                part.strand, parent=part.parent) \
+                 for part in self.parts]
+        return GeneModel.Transcript(parts, self.chrom, self.strand,
+                                    label=self.label,
+                                    cds_start=self.cds_start,
+                                    cds_end=self.cds_end,
+                                    parent=self.parent)
+
+
+    def __repr__(self):
+        parts_str = ",".join(p.__str__() for p in self.parts)
+        return "Transcript(%s, %s, %s, label=%s, parent=%s, has_cds=%s)" \
+            %(parts_str,
+              self.chrom,
+              self.strand,
+              self.label,
+              self.parent,
+              str(self.has_cds))
+
+
+class GeneView(object):
+    """
+    Gene in a GeneStore, with the attributes of GeneModel.Gene.
+    """
+    __slots__ = ["store", "gene_num", "const_exons"]
+    def __init__(self, store, gene_num):
+        self.store = store
+        self.gene_num = gene_num
+        self.const_exons = []
+
+
+    @property
+    def label(self):
+        return str(self.store.gene_ids[self.gene_num])
+
+
+    @property
+    def gene_symbol(self):
+        return str(self.store.gene_symbols[self.gene_num])
+
+
+    def get_trans_nums(self):
+        """
+        Return the range of transcript indices of the gene.
+        """
+        return xrange(self.store.gene_offsets[self.gene_num],
+                      self.store.gene_offsets[self.gene_num + 1])
+
+
+    @property
+    def transcripts(self):
+        return [TranscriptView(self.store, trans_num) \
+                for trans_num in self.get_trans_nums()]
+
+
+    @property
+    def chrom(self):
+        return str(self.store.chroms[self.store.gene_offsets[self.gene_num]])
+
+
+    @property
+    def strand(self):
+        return str(self.store.strands[self.store.gene_offsets[self.gene_num]])
+
+
+    @property
+    def parts(self):
+        parts = []
+        for transcript in self.transcripts:
+            parts.extend(transcript.parts)
+        return parts
+
+
+    @property
+    def cds_parts(self):
+        cds_parts = []
+        for transcript in self.transcripts:
+            cds_parts.extend(transcript.cds_parts)
+        return cds_parts
+
+
+    @property
+    def has_cds(self):
+        # As in GeneModel.Gene, a gene has a CDS if any of its
+        # transcripts has CDS coordinates, which all transcripts
+        # of a table do
+        return len(self.get_trans_nums()) > 0
+
+
+    def get_inclusive_trans_coords(self):
+        """
+        Return the lowest start and highest end coordinates
+        across the gene's transcripts.
+        """
+        exon_offsets = self.store.exon_offsets
+        first_exon = exon_offsets[self.store.gene_offsets[self.gene_num]]
+        last_exon = exon_offsets[self.store.gene_offsets[self.gene_num + 1]]
+        return [int(self.store.exon_starts[first_exon:last_exon].min()),
+                int(self.store.exon_ends[first_exon:last_exon].max())]
+
+
+    def get_cds_transcripts(self):
+        """
+        Return only transcripts with CDS regions.
+        """
+        return [transcript for transcript in self.transcripts \
+                if transcript.has_cds]
+
+
+    def get_parts(self, cds_only=False):
+        """
+        Get all distinct parts from all transcripts.
+        """
+        seen_parts = {}
+        parts = []
+        for trans in self.transcripts:
+            if cds_only:
+                trans_parts = trans.get_cds_parts()
+            else:
+                trans_parts = trans.parts
+            for exon in trans_parts:
+                if (exon.start, exon.end) in seen_parts:
+                    continue
+                parts.append(exon)
+                seen_parts[(exon.start, exon.end)] = True
+        return parts
+
+
+    def compute_const_exons(self, **kwargs):
+        """
+        Get constitutive exons (see GeneModel.Gene.compute_const_exons).
+        """
+        return GeneModel.compute_const_exons_by_gene([self], **kwargs)[0]
+
+
+    def to_gene(self):
+        """
+        Return the gene as a GeneModel.Gene.
+        """
+        transcripts = [transcript.to_transcript() \
+                       for transcript in self.transcripts]
+        return GeneModel.Gene(transcripts, self.chrom, self.strand,
+                              label=self.label,
+                              gene_symbol=self.gene_symbol)
+
+
+    def __repr__(self):
+        return "GeneModel(%s, %s, %s)" %(self.label,
+                                         self.chrom,
+                                         self.strand)
@@ -0,0 +1,481 @@
+##
+## Random access to the records of a GFF3 file through a sidecar
+## index
+##
+## The index records the byte offset, ID, coordinates and
+## top-level ancestor of every record, so that records can be
+## looked up by ID or by region without loading the whole file.
+## It is saved next to the GFF (as <gff>.gffidx.npz) and rebuilt
+## when the GFF changes.
+##
+import os
+import sys
+import time
+import urllib
+
+import numpy as np
+
+import misopy
+import misopy.gff_utils as gff_utils
+import misopy.Gene as gene_utils
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.interval_utils as interval_utils
+
+INDEX_EXT = ".gffidx.npz"
+
+# Arrays making up an index
+INDEX_ARRAYS = ["stamp",
+                "offsets",
+                "ids",
+                "types",
+                "chroms",
+                "starts",
+                "ends",
+                "strands",
+                "roots"]
+
+
+def parse_gff_line(line):
+    """
+    Parse a GFF3 line into a misopy.gff_utils.GFF record (as
+    misopy.gff_utils.Reader does).
+    """
+    fields = line.rstrip("\r\n").split("\t")
+    if len(fields) != 9:
+        raise Exception, "Invalid number of fields (should be 9):\n%s" \
+            %(line)
+    attributes = {}
+    for pair_string in fields[8].split(";"):
+        if "=" not in pair_string:
+            continue
+        tag, value = pair_string.split("=", 1)
+        attributes[urllib.unquote(tag)] = map(urllib.unquote,
+                                              value.split(","))
+    return gff_utils.GFF(seqid=urllib.unquote(fields[0]),
+                         source=urllib.unquote(fields[1]),
+                         type=urllib.unquote(fields[2]),
+                         start=int(fields[3]),
+                         end=int(fields[4]),
+                         score=gff_utils.parse_maybe_empty(fields[5], float),
+                         strand=gff_utils.parse_maybe_empty(fields[6]),
+                         phase=gff_utils.parse_maybe_empty(fields[7], int),
+                         attributes=attributes)
+
+
+def make_gene_info(gene_rec, child_recs):
+    """
+    Make the gene object and hierarchy of a gene from its record
+    and its descendants' records, as returned for each gene by
+    misopy.Gene.load_genes_from_gff. Returns None if no gene can
+    be made from the records.
+    """
+    gene_id = gene_rec.get_id()
+    gff_db = gff_utils.GFFDatabase()
+    gff_db.genes.append(gene_rec)
+    for record in child_recs:
+        if record.type == "mRNA" or record.type == "transcript":
+            gff_db.mRNAs.append(record)
+            gff_db.mRNAs_by_gene[record.get_parent()].append(record)
+        elif record.type == "exon":
+            gff_db.exons.append(record)
+            gff_db.exons_by_mRNA[record.get_parent()].append(record)
+        elif record.type == "CDS":
+            gff_db.cdss.append(record)
+            gff_db.cdss_by_exon[record.get_parent()].append(record)
+    gene_records, gene_hierarchy = gff_db.get_genes_records([gene_id])
+    if gene_id not in gene_hierarchy:
+        return None
+    gene_hierarchy[gene_id]["gene"] = gene_rec
+    gene_obj = gene_utils.make_gene_from_gff_records(gene_id,
+                                                     gene_hierarchy[gene_id],
+                                                     gene_records)
+    if gene_obj is None:
+        return None
+    return {"gene_object": gene_obj,
+            "hierarchy": gene_hierarchy}
+
+
+def get_gff_stamp(gff_filename):
+    """
+    Return the stamp (size and modification time) of a GFF file,
+    used to tell whether its index is current. The modification
+    time is kept at full (sub-second) resolution, so that a GFF
+    rewritten within a second of indexing is not taken as current.
+    """
+    gff_stat = os.stat(gff_filename)
+    return np.array([gff_stat.st_size, gff_stat.st_mtime],
+                    dtype=np.float64)
+
+
+def build_gff_index(gff_filename):
+    """
+    Index the records of a GFF3 file in one pass. Returns a
+    dictionary of INDEX_ARRAYS.
+
+    The root of a record is the index of its top-level ancestor,
+    found through Parent attributes (the first parent of records
+    with several); top-level records are their own roots.
+    """
+    offsets = []
+    ids = []
+    types = []
+    chroms = []
+    starts = []
+    ends = []
+    strands = []
+    parents = []
+    with open(gff_filename) as gff_in:
+        offset = 0
+        for line in iter(gff_in.readline, ""):
+            line_offset = offset
+            offset += len(line)
+            if line.startswith("#") or line.strip() == "":
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) != 9:
+                continue
+            attributes = utils.parse_attributes(fields[8])
+            start, end = int(fields[3]), int(fields[4])
+            offsets.append(line_offset)
+            ids.append(attributes.get("ID", ""))
+            types.append(fields[2])
+            chroms.append(fields[0])
+            starts.append(min(start, end))
+            ends.append(max(start, end))
+            strands.append(fields[6])
+            parents.append(attributes.get("Parent", "").split(",")[0])
+    # Resolve the root of each record through its parents
+    id_to_num = {}
+    for rec_num, rec_id in enumerate(ids):
+        if rec_id != "" and rec_id not in id_to_num:
+            id_to_num[rec_id] = rec_num
+    parent_nums = [id_to_num.get(parent, -1) for parent in parents]
+    roots = [-1] * len(ids)
+    for rec_num in xrange(len(ids)):
+        # Walk up to the first record with a known root
+        path = []
+        curr_num = rec_num
+        while roots[curr_num] == -1:
+            path.append(curr_num)
+            parent_num = parent_nums[curr_num]
+            if parent_num == -1 or parent_num in path:
+                roots[curr_num] = curr_num
+                path.pop()
+                break
+            curr_num = parent_num
+        for path_num in path:
+            roots[path_num] = roots[curr_num]
+    return {"stamp": get_gff_stamp(gff_filename),
+            "offsets": np.array(offsets, dtype=np.int64),
+            "ids": np.array(ids, dtype="S"),
+            "types": np.array(types, dtype="S"),
+            "chroms": np.array(chroms, dtype="S"),
+            "starts": np.array(starts, dtype=np.int64),
+            "ends": np.array(ends, dtype=np.int64),
+            "strands": np.array(strands, dtype="S1"),
+            "roots": np.array(roots, dtype=np.int64)}
+
+
+def load_gff_index(index_filename, gff_filename):
+    """
+    Load a GFF index saved by output_gff_index, or return None
+    if it is missing or out of date.
+    """
+    if not os.path.isfile(index_filename):
+        return None
+    index_data = np.load(index_filename)
+    try:
+        if not np.array_equal(index_data["stamp"],
+                              get_gff_stamp(gff_filename)):
+            return None
+        return dict((array_name, index_data[array_name]) \
+                    for array_name in INDEX_ARRAYS)
+    finally:
+        index_data.close()
+
+
+def output_gff_index(index_arrays, index_filename):
+    """
+    Save a GFF index. The index is written to a temporary file
+    and moved into place, so that readers never see a partial
+    index. Returns False if the index could not be written (e.g.
+    the GFF's directory is read-only).
+    """
+    tmp_filename = "%s.%d.tmp.npz" %(index_filename[0:-len(".npz")],
+                                     os.getpid())
+    try:
+        np.savez(tmp_filename, **index_arrays)
+        os.rename(tmp_filename, index_filename)
+    except (IOError, OSError):
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+        return False
+    return True
+
+
+class IndexedGFF:
+    """
+    A GFF3 file with a sidecar index, for looking up records by
+    ID or by region, and for iterating through top-level records
+    with their descendants.
+
+    Records are returned as misopy.gff_utils.GFF objects.
+    """
+    def __init__(self, gff_filename, use_index_file=True):
+        self.gff_filename = gff_filename
+        if not os.path.isfile(gff_filename):
+            raise Exception, "Cannot find GFF file %s" %(gff_filename)
+        self.index_filename = "%s%s" %(gff_filename, INDEX_EXT)
+        index_arrays = None
+        if use_index_file:
+            index_arrays = load_gff_index(self.index_filename, gff_filename)
+        if index_arrays is None:
+            t1 = time.time()
+            index_arrays = build_gff_index(gff_filename)
+            if use_index_file:
+                output_gff_index(index_arrays, self.index_filename)
+            t2 = time.time()
+            print "Indexed GFF %s in %.2f secs" %(gff_filename, t2 - t1)
+        for array_name in INDEX_ARRAYS:
+            setattr(self, array_name, index_arrays[array_name])
+        self.num_records = len(self.offsets)
+        # Records sorted by ID, for lookups by ID
+        self.id_order = np.argsort(self.ids, kind="mergesort")
+        self.sorted_ids = self.ids[self.id_order]
+        # Records of each top-level record (itself first, then its
+        # descendants in file order)
+        self.top_nums = np.nonzero(self.roots == np.arange(self.num_records))[0]
+        self.child_order = np.lexsort((np.arange(self.num_records),
+                                       self.roots))
+        self.child_offsets = \
+            np.searchsorted(self.roots[self.child_order], self.top_nums)
+        self.child_offsets = np.append(self.child_offsets, self.num_records)
+        # Records sorted by chromosome and start, with the running
+        # maximum of their ends within each chromosome, for region
+        # lookups. Coordinates are offset by chromosome (see
+        # interval_utils.get_keyed_coords) so that regions on all
+        # chromosomes can be searched at once.
+        self.chrom_names = np.unique(self.chroms)
+        self.region_order = np.lexsort((self.starts, self.chroms))
+        region_codes = np.searchsorted(self.chrom_names,
+                                       self.chroms[self.region_order])
+        self.key_base = 1
+        if self.num_records > 0:
+            self.key_base = max(self.starts.max(), self.ends.max()) + 1
+        self.region_key_starts = \
+            interval_utils.get_keyed_coords(region_codes,
+                                            self.starts[self.region_order],
+                                            self.key_base)
+        # Keyed ends increase with chromosome, so the running maximum
+        # never carries over from a previous chromosome
+        self.region_key_max_ends = np.maximum.accumulate(\
+            interval_utils.get_keyed_coords(region_codes,
+                                            self.ends[self.region_order],
+                                            self.key_base))
+        self.gff_file = None
+
+
+    def read_record(self, rec_num):
+        """
+        Read a record from the GFF file by its index.
+        """
+        if self.gff_file is None:
+            self.gff_file = open(self.gff_filename)
+        self.gff_file.seek(self.offsets[rec_num])
+        return parse_gff_line(self.gff_file.readline())
+
+
+    def close(self):
+        if self.gff_file is not None:
+            self.gff_file.close()
+            self.gff_file = None
+
+
+    def get_record_num(self, record_id):
+        """
+        Return the index of the record with the given ID, or
+        None if there is none.
+        """
+        ind = np.searchsorted(self.sorted_ids, record_id)
+        if ind == len(self.sorted_ids) or self.sorted_ids[ind] != record_id:
+            return None
+        return self.id_order[ind]
+
+
+    def get_record(self, record_id):
+        """
+        Return the record with the given ID, or None if there
+        is none.
+        """
+        rec_num = self.get_record_num(record_id)
+        if rec_num is None:
+            return None
+        return self.read_record(rec_num)
+
+
+    def get_record_tree(self, record_id):
+        """
+        Return the top-level record with the given ID and a list of
+        its descendants (in file order), or None if there is none.
+        """
+        rec_num = self.get_record_num(record_id)
+        if rec_num is None or self.roots[rec_num] != rec_num:
+            return None
+        top_ind = np.searchsorted(self.top_nums, rec_num)
+        return self.read_record_tree(top_ind)
+
+
+    def read_record_tree(self, top_ind):
+        """
+        Read the top_ind-th top-level record and its descendants.
+        """
+        tree_nums = self.child_order[self.child_offsets[top_ind]:\
+                                     self.child_offsets[top_ind + 1]]
+        tree_recs = [self.read_record(rec_num) for rec_num in tree_nums]
+        return tree_recs[0], tree_recs[1:]
+
+
+    def get_record_nums_in_regions(self, chroms, starts, ends,
+                                   strands=None,
+                                   record_types=None):
+        """
+        Find the records that overlap each of a set of regions
+        (1-based, inclusive coordinates), optionally only those on
+        the region's strand and of given types.
+
+        - chroms, starts, ends: region coordinates
+        - strands: strand of each region, or None for either strand
+          (for all regions, or per region)
+
+        Returns (region_inds, rec_nums) arrays pairing regions with
+        the records overlapping them, ordered by region and record
+        start.
+
+        The records that may overlap a region are found by binary
+        search: those before the first record whose running maximum
+        end reaches the region's start all end before it, and those
+        starting after the region's end follow it.
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        num_regions = len(starts)
+        if num_regions == 0 or self.num_records == 0:
+            return empty, empty
+        chroms = np.asarray(chroms, dtype="S")
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        # Regions on chromosomes with no records match nothing
+        chrom_codes = np.searchsorted(self.chrom_names, chroms)
+        known_chroms = \
+            (self.chrom_names[np.minimum(chrom_codes,
+                                         len(self.chrom_names) - 1)] == chroms)
+        chrom_codes = np.minimum(chrom_codes, len(self.chrom_names) - 1)
+        # Clip coordinates to the chromosome's range of keys
+        key_starts = \
+            interval_utils.get_keyed_coords(chrom_codes,
+                                            np.clip(starts, 0,
+                                                    self.key_base - 1),
+                                            self.key_base)
+        key_ends = \
+            interval_utils.get_keyed_coords(chrom_codes,
+                                            np.clip(ends, 0,
+                                                    self.key_base - 1),
+                                            self.key_base)
+        first_inds = np.searchsorted(self.region_key_max_ends, key_starts,
+                                     side="left")
+        last_inds = np.searchsorted(self.region_key_starts, key_ends,
+                                    side="right")
+        num_candidates = np.where(known_chroms,
+                                  np.maximum(last_inds - first_inds, 0), 0)
+        region_inds = np.repeat(np.arange(num_regions), num_candidates)
+        candidate_offsets = np.cumsum(num_candidates) - num_candidates
+        candidate_nums = np.arange(num_candidates.sum()) - \
+                         np.repeat(candidate_offsets, num_candidates)
+        rec_nums = self.region_order[np.repeat(first_inds, num_candidates) + \
+                                     candidate_nums]
+        overlaps = self.ends[rec_nums] >= starts[region_inds]
+        if strands is not None:
+            if isinstance(strands, basestring):
+                strands = [strands] * num_regions
+            # Regions without a strand (None) match either strand
+            region_strands = np.array([strand or "" for strand in strands],
+                                      dtype="S1")[region_inds]
+            overlaps &= (region_strands == "") | \
+                        (region_strands == self.strands[rec_nums])
+        if record_types is not None:
+            overlaps &= np.in1d(self.types[rec_nums], record_types)
+        return region_inds[overlaps], rec_nums[overlaps]
+
+
+    def get_records_in_regions(self, chroms, starts, ends,
+                               strands=None,
+                               record_types=None):
+        """
+        Return the records that overlap each of a set of regions
+        (see get_record_nums_in_regions), as a list of lists of
+        records, one per region.
+        """
+        region_inds, rec_nums = \
+            self.get_record_nums_in_regions(chroms, starts, ends,
+                                            strands=strands,
+                                            record_types=record_types)
+        region_recs = [[] for region_ind in xrange(len(starts))]
+        for region_ind, rec_num in zip(region_inds.tolist(),
+                                       rec_nums.tolist()):
+            region_recs[region_ind].append(self.read_record(rec_num))
+        return region_recs
+
+
+    def get_records_in_region(self, chrom, start, end,
+                              strand=None,
+                              record_types=None):
+        """
+        Return the records that overlap a region (1-based, inclusive
+        coordinates), optionally only those on a strand and of given
+        types, in order of start coordinate.
+        """
+        return self.get_records_in_regions([chrom], [start], [end],
+                                           strands=[strand],
+                                           record_types=record_types)[0]
+
+
+    def iter_record_trees(self):
+        """
+        Iterate through top-level records and their descendants
+        (see get_record_tree), in file order.
+        """
+        for top_ind in xrange(len(self.top_nums)):
+            yield self.read_record_tree(top_ind)
+
+
+    def iter_genes(self):
+        """
+        Iterate through the genes of the GFF as (gene_id, gene_info)
+        pairs, in file order, where gene_info is as returned for each
+        gene by misopy.Gene.load_genes_from_gff. Only one gene's
+        records are held in memory at a time.
+        """
+        for top_rec, child_recs in self.iter_record_trees():
+            if top_rec.type != "gene":
+                continue
+            gene_info = make_gene_info(top_rec, child_recs)
+            if gene_info is None:
+                print "Cannot make gene out of %s" %(top_rec.get_id())
+                continue
+            yield top_rec.get_id(), gene_info
+
+
+    def __iter__(self):
+        return self.iter_record_trees()
+
+
+    def __len__(self):
+        return len(self.top_nums)
+
+
+    def __repr__(self):
+        return "IndexedGFF(%s, records=%d, top_level=%d)" \
+            %(self.gff_filename,
+              self.num_records,
+              len(self.top_nums))
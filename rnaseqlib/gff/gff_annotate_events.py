@@ -7,14 +7,16 @@
 ## with gene information. Specifically, it adds Ensembl gene IDs, RefSeq
 ## IDs, and gene symbols to the attributes field of the events GFF.
 ##
-## This is done by converting by the UCSC table txStart/txEnd sites to
-## a GFF internally and intersecting the event gene GFF coordinates with
-## these txStart/txEnd coordinates (using pybedtools). The results of
-## the intersection are converted.
+## This is done by sweeping through the event gene coordinates and the
+## table's txStart/txEnd coordinates, both sorted by chromosome, strand
+## and start, and matching each event gene to the table genes that
+## contain it on the same strand. The events GFF is then rewritten in
+## one streaming pass, annotating its gene records.
 ##
 import os
 import sys
 import time
+import heapq
 
 import pandas
 
@@ -23,21 +25,25 @@ import rnaseqlib.utils as utils
 
 from collections import defaultdict
 
-import gffutils
-import gffutils.gffwriter as gffwriter
-import pybedtools
+# Gene information attributes added to event genes
+GENE_INFO_ATTRIBUTES = ["ensg_id", "refseq_id", "gsymbol"]
 
 
-def get_table_as_bedtool(table_fname):
+def load_table_genes(table_fname):
     """
-    Load UCSC table as BedTool where txStart/txEnd
-    as coordinates.
+    Load the genes of a UCSC table, using txStart/txEnd as
+    coordinates.
 
     The UCSC tables (when downloaded) have a 0-based
     start coordinate, so need to add 1 to start.
 
     Uses the kgXref.combined ensGene table produced by
-    
+    rnaseqlib --init.
+
+    Returns a list of (chrom, strand, start, end, gene_num, gene_info)
+    tuples sorted by chromosome, strand and start, where gene_num is
+    the gene's row in the table and gene_info maps GENE_INFO_ATTRIBUTES
+    to the gene's values ('NA' if missing).
     """
     if "kgXref.combined" not in os.path.basename(table_fname):
         print "WARNING: Are you sure %s is a combined ensGene table?" \
@@ -48,87 +54,170 @@ def get_table_as_bedtool(table_fname):
         gene_symbol_col = "value"
     else:
         gene_symbol_col = "geneSymbol"
-    def get_bedtool_iter():
-        for gene_num, gene_entry in table.iterrows():
-            chrom = gene_entry["chrom"]
-            start = int(gene_entry["txStart"]) + 1
-            end = int(gene_entry["txEnd"])
-            strand = gene_entry["strand"]
-            # Annotation fields
-            name2 = gene_entry["name2"]
-            if pandas.isnull(name2):
-                name2 = "NA"
-            refseq_id = gene_entry["refseq"]
-            if pandas.isnull(refseq_id):
-                refseq_id = "NA"
-            gene_symbol = gene_entry[gene_symbol_col]
-            if pandas.isnull(gene_symbol):
-                gene_symbol = "NA"
-            attributes = \
-                "ID=%s;ensg_id=%s;refseq_id=%s;gsymbol=%s;" \
-                %(name2,
-                  name2,
-                  refseq_id,
-                  gene_symbol)
-            # Convert table to BedTool
-            gff_entry = [chrom,
-                         "genes_table",
-                         "gene",
-                         str(start),
-                         str(end),
-                         ".",
-                         strand,
-                         ".",
-                         attributes]
-            gff_interval = \
-                pybedtools.create_interval_from_list(gff_entry)
-            yield gff_interval
-    table_bedtool = pybedtools.BedTool(get_bedtool_iter())
-    return table_bedtool
-
-
-def get_coords_to_gene_info(coord_intervals, table_bed):
-    """
-    Given an iterator of BedTool Intervals 'coord_intervals'
-    and a BedTool containing table coordinates 'table_bed'
-    return a mapping from events to genes.
-
-    Map event genes to their IDs. If event_geneX
-    is an entry of coords_intervals, generate:
-    
+    table_genes = []
+    for gene_num, (chrom, tx_start, tx_end, strand,
+                   name2, refseq_id, gene_symbol) in \
+        enumerate(zip(table["chrom"], table["txStart"], table["txEnd"],
+                      table["strand"], table["name2"], table["refseq"],
+                      table[gene_symbol_col])):
+        gene_info = {}
+        for attr_name, attr_val in (("ensg_id", name2),
+                                    ("refseq_id", refseq_id),
+                                    ("gsymbol", gene_symbol)):
+            if pandas.isnull(attr_val):
+                attr_val = "NA"
+            gene_info[attr_name] = str(attr_val)
+        table_genes.append((chrom, strand, int(tx_start) + 1, int(tx_end),
+                            gene_num, gene_info))
+    table_genes.sort(key=lambda gene: gene[0:4])
+    return table_genes
+
+
+def load_event_genes(gff_fname):
+    """
+    Load the gene records of an events GFF. Returns a list of
+    (chrom, strand, start, end, event_id) tuples sorted by chromosome,
+    strand and start.
+    """
+    event_genes = []
+    with open(gff_fname) as gff_in:
+        for line in gff_in:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 9 or fields[2] != "gene":
+                continue
+            event_id = utils.parse_attributes(fields[8])["ID"]
+            event_genes.append((fields[0], fields[6],
+                                int(fields[3]), int(fields[4]),
+                                event_id))
+    event_genes.sort()
+    return event_genes
+
+
+def get_event_genes_to_info(event_genes, table_genes):
+    """
+    Map event genes to the information of the table genes that
+    contain them on the same strand (see load_event_genes and
+    load_table_genes), in one sweep through both:
+
        event_gene1 -> refseq  -> value
                    -> ensgene -> value
        event_gene2 -> refseq  -> ...
        ...
+
+    Table genes that start before the current event gene are kept
+    in a heap by their end, and dropped once they end before it
+    starts, since they cannot contain it or any later event gene.
+    Values are listed in order of the table genes in the table.
     """
-    # Mapping from event intervals (i.e. the genes in 'coord_intervals')
-    # and the gene information
     event_genes_to_info = defaultdict(lambda: defaultdict(list))
-    # Intersect event genes with gene txStart/txEnd
-    intersected_bed = \
-        coord_intervals.intersect(table_bed, wb=True, s=True, f=1)
-    for entry in intersected_bed:
-        event_gene_attrs = utils.parse_attributes(entry.fields[8])
-        event_gene_str = event_gene_attrs["ID"]
-        gene_info_field = entry.fields[-1]
-        # Strip semicolon of ID attributes
-        if gene_info_field.endswith(";"):
-            gene_info_field = gene_info_field[0:-1]
-        # Convert attributes into dictionary
-        gene_info = utils.parse_attributes(gene_info_field)
-        ensgene_id = gene_info["ensg_id"]
-        refseq_id = gene_info["refseq_id"]
-        gene_symbol = gene_info["gsymbol"]
-        # Skip null entries
-        if not is_null_id(ensgene_id):
-            event_genes_to_info[event_gene_str]["ensg_id"].append(ensgene_id)
-        if not is_null_id(refseq_id):
-            event_genes_to_info[event_gene_str]["refseq_id"].append(refseq_id)
-        if not is_null_id(gene_symbol):
-            event_genes_to_info[event_gene_str]["gsymbol"].append(gene_symbol)
+    num_table_genes = len(table_genes)
+    table_ind = 0
+    curr_key = None
+    active_genes = []
+    for chrom, strand, start, end, event_id in event_genes:
+        if (chrom, strand) != curr_key:
+            curr_key = (chrom, strand)
+            active_genes = []
+            # Skip table genes on chromosomes/strands with no events
+            while table_ind < num_table_genes and \
+                  table_genes[table_ind][0:2] < curr_key:
+                table_ind += 1
+        # Add table genes starting at or before the event gene
+        while table_ind < num_table_genes and \
+              table_genes[table_ind][0:2] == curr_key and \
+              table_genes[table_ind][2] <= start:
+            table_gene = table_genes[table_ind]
+            heapq.heappush(active_genes, (table_gene[3], table_gene[4],
+                                          table_ind))
+            table_ind += 1
+        # Drop table genes ending before the event gene
+        while len(active_genes) > 0 and active_genes[0][0] < start:
+            heapq.heappop(active_genes)
+        containing_genes = sorted([(gene_num, gene_ind) \
+                                   for gene_end, gene_num, gene_ind \
+                                   in active_genes if gene_end >= end])
+        for gene_num, gene_ind in containing_genes:
+            gene_info = table_genes[gene_ind][5]
+            for attr_name in GENE_INFO_ATTRIBUTES:
+                # Skip null entries
+                if not is_null_id(gene_info[attr_name]):
+                    event_genes_to_info[event_id][attr_name].append(\
+                        gene_info[attr_name])
     return event_genes_to_info
 
 
+def set_attributes(attr_field, new_attributes):
+    """
+    Set attributes in a GFF attributes field, keeping the order of
+    existing attributes and appending new ones. 'new_attributes' is
+    a list of (key, value) pairs.
+    """
+    attr_pairs = []
+    for attr in attr_field.strip().strip(";").split(";"):
+        if "=" not in attr:
+            continue
+        attr_pairs.append(attr.split("=", 1))
+    new_values = dict(new_attributes)
+    output_pairs = []
+    for key, val in attr_pairs:
+        if key in new_values:
+            val = new_values.pop(key)
+        output_pairs.append((key, val))
+    for key, val in new_attributes:
+        if key in new_values:
+            output_pairs.append((key, val))
+    return ";".join(["%s=%s" %(key, val) for key, val in output_pairs])
+
+
+def get_event_gene_info(attributes, event_info):
+    """
+    Return the (key, value) gene information attributes of an event
+    gene, from its existing attributes and the information of the
+    table genes that contain it, if any. Existing ensg_id, refseq_id
+    and gsymbol attributes are kept when no table gene contains the
+    event gene (they used to be reset to 'NA').
+    """
+    gene_info = []
+    for attr_name in GENE_INFO_ATTRIBUTES:
+        # Use existing IDs if present
+        attr_val = attributes.get(attr_name, "NA")
+        if event_info is not None:
+            attr_vals = utils.unique_list(event_info[attr_name])
+            if len(attr_vals) > 0 and attr_vals[0] != "NA":
+                attr_val = ",".join(attr_vals)
+        gene_info.append((attr_name, attr_val))
+    return gene_info
+
+
+def output_annotated_gff(gff_fname, event_genes_to_info, output_fname):
+    """
+    Output an events GFF with the gene information of its event
+    genes added, streaming through its records. The output is
+    written to a temporary file and moved into place, so that
+    output_fname may be the input GFF.
+    """
+    tmp_output_fname = "%s.annotated.tmp" %(output_fname)
+    with open(gff_fname) as gff_in:
+        with open(tmp_output_fname, "w") as gff_out:
+            for line in gff_in:
+                fields = line.rstrip("\r\n").split("\t")
+                if line.startswith("#") or len(fields) < 9 or \
+                   fields[2] != "gene":
+                    gff_out.write(line)
+                    continue
+                attributes = utils.parse_attributes(fields[8])
+                event_info = event_genes_to_info.get(attributes["ID"])
+                fields[8] = \
+                    set_attributes(fields[8],
+                                   get_event_gene_info(attributes,
+                                                       event_info))
+                gff_out.write("%s\n" %("\t".join(fields)))
+    os.rename(tmp_output_fname, output_fname)
+    return output_fname
+
+
 def annotate_gff_with_genes(args):
     """
     Annotate GFF with genes table.
@@ -139,73 +228,20 @@ def annotate_gff_with_genes(args):
     table_fname = utils.pathify(args.table_filename)
     if not os.path.isfile(table_fname):
         raise Exception, "Cannot find %s" %(table_fname)
-    table_bed = get_table_as_bedtool(table_fname)
-    # Get BedTool for events, containing only the gene entries
-    all_events_bed = pybedtools.BedTool(gff_fname)
-    event_genes = \
-        all_events_bed.filter(lambda entry: entry.fields[2] == "gene")
+    t1 = time.time()
+    table_genes = load_table_genes(table_fname)
+    # Get the gene entries of events
+    event_genes = load_event_genes(gff_fname)
     print "Determining overlap between events and genes..."
     # Get mapping from events to gene information
     event_genes_to_info = \
-      get_coords_to_gene_info(event_genes, table_bed)
-
+      get_event_genes_to_info(event_genes, table_genes)
     # Incorporate the gene information into the GFF and output it
-    # it using gffutils
-    print "Loading events into GFF database..."
-    events_db = gffutils.create_db(gff_fname, ":memory:",
-                                   verbose=False)
     output_fname = gff_fname 
-    events_out = gffwriter.GFFWriter(output_fname,
-                                     in_place=True)
     print " - Outputting annotated GFF to: %s" %(output_fname)
-    def new_recs():
-        for gene_recs in list(events_db.iter_by_parent_childs()):
-            gene_rec = gene_recs[0]
-            event_id = gene_rec.id
-            # Use existing IDs if present
-            if "ensgene_id" in gene_rec.attributes:
-                ensgene_id = gene_rec.attributes["ensg_id"][0]
-            else:
-                ensgene_id = "NA"
-            if "refseq_id" in gene_rec.attributes:
-                refseq_id = gene_rec.attributes["refseq_id"][0]
-            else:
-                refseq_id = "NA"
-            if "gene_symbol" in gene_rec.attributes:
-                gene_symbol = gene_rec.attributes["gsymbol"][0]
-            else:
-                gene_symbol = "NA"
-            if event_id in event_genes_to_info:
-                event_info = event_genes_to_info[event_id]
-                ensgene_ids = \
-                    utils.unique_list(event_info["ensg_id"])
-                if len(ensgene_ids) > 0 and ensgene_ids[0] != "NA":
-                    ensgene_id = ",".join(ensgene_ids)
-                refseq_ids = \
-                    utils.unique_list(event_info["refseq_id"])
-                if len(refseq_ids) > 0 and refseq_ids[0] != "NA":
-                    refseq_id = ",".join(refseq_ids)
-                gene_symbols = \
-                    utils.unique_list(event_info["gsymbol"])
-                if len(gene_symbols) > 0 and gene_symbols[0] != "NA":
-                    gene_symbol = ",".join(gene_symbols)
-            gene_rec.attributes["ensg_id"] = [ensgene_id]
-            gene_rec.attributes["refseq_id"] = [refseq_id]
-            gene_rec.attributes["gsymbol"] = [gene_symbol]
-            # Yield all the gene's records
-            for g in gene_recs:
-                yield g
-    t1 = time.time()
-    print "Creating annotated GFF database..."
-    annotated_db = gffutils.create_db(new_recs(), ":memory:",
-                                      verbose=False)
+    output_annotated_gff(gff_fname, event_genes_to_info, output_fname)
     t2 = time.time()
-    print "Creation took %.2f secs" %(t2 - t1)
-    # Write to file
-    print "Writing annotated GFF to file..."
-    for gene_rec in annotated_db.all_features(featuretype="gene"):
-        events_out.write_gene_recs(annotated_db, gene_rec.id)
-    events_out.close()
+    print "Annotation took %.2f secs" %(t2 - t1)
 
 
 def is_null_id(gene_id):
@@ -32,7 +32,8 @@ def make_annotation(args):
                                  flanking=args.flanking_rule,
                                  multi_iso=args.multi_iso,
                                  genome_label=args.genome_label,
-                                 sanitize=args.sanitize)
+                                 sanitize=args.sanitize,
+                                 num_processors=args.num_processors)
     t2 = time.time()
     print "Took %.2f minutes to make the annotation." \
           %((t2 - t1)/60.)
@@ -57,6 +58,10 @@ def main():
     parser.add_argument("--sanitize", default=False, action="store_true",
                         help="If passed, sanitize the annotation. "
                         "Off by default.")
+    parser.add_argument("--num-processors", default=1, type=int,
+                        help="Number of processes to use. If greater than "
+                        "1, event types and chromosomes are processed in "
+                        "parallel. 1 by default.")
     args = parser.parse_args()
     make_annotation(args)
           
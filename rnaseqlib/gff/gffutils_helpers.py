@@ -31,6 +31,8 @@ import misopy
 import misopy.gff_utils as miso_gff_utils
 import misopy.Gene as gene_utils
 
+import rnaseqlib.gff.IndexedGFF as IndexedGFF
+
 
 def genome_to_ucsc_table(genome):
     """
@@ -398,9 +400,6 @@ def fetch_seq_from_gff(gff_fname, fasta_fname, output_dir,
        c, d: positive ints, position relative to 3' splice site of SE
              c < d
     """
-    # Load GFF genes
-    gff_db = miso_gff_utils.GFFDatabase(from_filename=gff_fname,
-                                        reverse_recs=True)
     file_basename = re.sub("\.gff3?", "",
                            os.path.basename(gff_fname))
     output_basename = "%s.event_seqs" %(file_basename)
@@ -425,81 +424,84 @@ def fetch_seq_from_gff(gff_fname, fasta_fname, output_dir,
     print "Outputting sequences to: %s" %(fasta_output_fname)
     if os.path.isfile(fasta_output_fname):
         print "  - Overwriting existing file"
-    genes = gene_utils.load_genes_from_gff(gff_fname)
+    # Stream through the GFF's genes one at a time
+    indexed_gff = IndexedGFF.IndexedGFF(gff_fname)
     gff_out_file = open(gff_output_fname, "w")
     gff_out = miso_gff_utils.Writer(gff_out_file)
-    for gene_id in genes:
-        gene_info = genes[gene_id]
-        gene_tree = gene_info["hierarchy"]
-        gene_obj = gene_info["gene_object"]
-        # GFF records to write for the current gene
-        recs_to_write = []
-        # For mRNA entries, extract the flanking introns of the
-        # alternative exon if asked
-        event_recs = get_event_recs_from_gene(gene_obj, gene_tree)
-        long_mRNA_id = event_recs["long_mRNA"].get_id()
-        if event_recs is None:
-            continue
-        # Write out up, se, and dn exons
-        recs_to_write.extend([event_recs["up_exon"]["record"],
-                              event_recs["se_exon"]["record"],
-                              event_recs["dn_exon"]["record"]])
-        if with_flanking_introns:
-            introns_coords = \
-                get_flanking_introns_coords(gene_obj)
-            if introns_coords == None:
-                raise Exception, "Cannot find flanking introns coordinates."
-                sys.exit(1)
-            # Fetch upstream intron sequence
-            up_intron_start, up_intron_end = \
-                introns_coords["up_intron"]
-            up_intron_len = up_intron_end - up_intron_start + 1
-            # Fetch downstream intron sequence
-            dn_intron_start, dn_intron_end = \
-                introns_coords["dn_intron"]
-            dn_intron_len = dn_intron_end - dn_intron_start + 1
-            # If given custom coordinates, use them instead of entire up/down
-            # flanking intronic coordinates.
-            se_exon_rec = event_recs["se_exon"]["record"]
-            if flanking_introns_coords is not None:
-                # (start,end) of upstream intron sequence
-                a, b = \
-                    int(flanking_introns_coords[0]), int(flanking_introns_coords[1])
-                c, d = \
-                    int(flanking_introns_coords[2]), int(flanking_introns_coords[3])
-                a, b, c, d = error_check_intronic_coords(a, b, c, d,
-                                                         up_intron_len, dn_intron_len)
-                # Coordinates relative to 5' splice site of sequence to be fetched
-                # The start of upstream intron sequence is negative from the 5' ss
-                up_intron_start = se_exon_rec.start + a
-                up_intron_end = se_exon_rec.start + b
-                dn_intron_start = se_exon_rec.end + c
-                dn_intron_end = se_exon_rec.end + d
-            # Make GFF records for up/dn intronic sequences
-            chrom = se_exon_rec.seqid
-            source = se_exon_rec.source
-            rec_type = "intron"
-            strand = se_exon_rec.strand
-            up_intron_str = "%s.up_intron" %(long_mRNA_id)
-            up_intron_rec = \
-                miso_gff_utils.GFF(chrom, source, "intron",
-                              up_intron_start, up_intron_end,
-                              strand=strand,
-                              attributes={"ID": [up_intron_str],
-                                          "Parent": [gene_obj.label]})
-            dn_intron_str = "%s.dn_intron" %(long_mRNA_id)
-            dn_intron_rec = \
-                miso_gff_utils.GFF(chrom, source, "intron",
-                                   dn_intron_start, dn_intron_end,
-                                   strand=strand,
-                                   attributes={"ID": [dn_intron_str],
-                                               "Parent": [gene_obj.label]})
-            recs_to_write.append(up_intron_rec)
-            recs_to_write.append(dn_intron_rec)
-        # Write out records to GFF
-        for rec in recs_to_write:
-            gff_out.write(rec)
-    gff_out_file.close()
+    try:
+        for gene_id, gene_info in indexed_gff.iter_genes():
+            gene_tree = gene_info["hierarchy"]
+            gene_obj = gene_info["gene_object"]
+            # GFF records to write for the current gene
+            recs_to_write = []
+            # For mRNA entries, extract the flanking introns of the
+            # alternative exon if asked
+            event_recs = get_event_recs_from_gene(gene_obj, gene_tree)
+            long_mRNA_id = event_recs["long_mRNA"].get_id()
+            if event_recs is None:
+                continue
+            # Write out up, se, and dn exons
+            recs_to_write.extend([event_recs["up_exon"]["record"],
+                                  event_recs["se_exon"]["record"],
+                                  event_recs["dn_exon"]["record"]])
+            if with_flanking_introns:
+                introns_coords = \
+                    get_flanking_introns_coords(gene_obj)
+                if introns_coords == None:
+                    raise Exception, "Cannot find flanking introns coordinates."
+                    sys.exit(1)
+                # Fetch upstream intron sequence
+                up_intron_start, up_intron_end = \
+                    introns_coords["up_intron"]
+                up_intron_len = up_intron_end - up_intron_start + 1
+                # Fetch downstream intron sequence
+                dn_intron_start, dn_intron_end = \
+                    introns_coords["dn_intron"]
+                dn_intron_len = dn_intron_end - dn_intron_start + 1
+                # If given custom coordinates, use them instead of entire up/down
+                # flanking intronic coordinates.
+                se_exon_rec = event_recs["se_exon"]["record"]
+                if flanking_introns_coords is not None:
+                    # (start,end) of upstream intron sequence
+                    a, b = \
+                        int(flanking_introns_coords[0]), int(flanking_introns_coords[1])
+                    c, d = \
+                        int(flanking_introns_coords[2]), int(flanking_introns_coords[3])
+                    a, b, c, d = error_check_intronic_coords(a, b, c, d,
+                                                             up_intron_len, dn_intron_len)
+                    # Coordinates relative to 5' splice site of sequence to be fetched
+                    # The start of upstream intron sequence is negative from the 5' ss
+                    up_intron_start = se_exon_rec.start + a
+                    up_intron_end = se_exon_rec.start + b
+                    dn_intron_start = se_exon_rec.end + c
+                    dn_intron_end = se_exon_rec.end + d
+                # Make GFF records for up/dn intronic sequences
+                chrom = se_exon_rec.seqid
+                source = se_exon_rec.source
+                rec_type = "intron"
+                strand = se_exon_rec.strand
+                up_intron_str = "%s.up_intron" %(long_mRNA_id)
+                up_intron_rec = \
+                    miso_gff_utils.GFF(chrom, source, "intron",
+                                  up_intron_start, up_intron_end,
+                                  strand=strand,
+                                  attributes={"ID": [up_intron_str],
+                                              "Parent": [gene_obj.label]})
+                dn_intron_str = "%s.dn_intron" %(long_mRNA_id)
+                dn_intron_rec = \
+                    miso_gff_utils.GFF(chrom, source, "intron",
+                                       dn_intron_start, dn_intron_end,
+                                       strand=strand,
+                                       attributes={"ID": [dn_intron_str],
+                                                   "Parent": [gene_obj.label]})
+                recs_to_write.append(up_intron_rec)
+                recs_to_write.append(dn_intron_rec)
+            # Write out records to GFF
+            for rec in recs_to_write:
+                gff_out.write(rec)
+    finally:
+        indexed_gff.close()
+        gff_out_file.close()
     # Output FASTA sequences
     output_fasta_seqs_from_gff(gff_output_fname,
                                fasta_fname,
@@ -832,53 +834,53 @@ def add_introns_to_gff(gff_filename, output_dir):
         print "Found file %s, skipping.." %(output_filename)
         return output_filename
     gff_out = miso_gff_utils.Writer(open(output_filename, "w"))
-    gff_db = miso_gff_utils.GFFDatabase(from_filename=gff_filename,
-                                        reverse_recs=True)
     t1 = time.time()
-    genes = gene_utils.load_genes_from_gff(gff_filename)
-    for gene_id in genes:
-        gene_info = genes[gene_id]
-        gene_tree = gene_info["hierarchy"]
-        gene_obj = gene_info["gene_object"]
-        gene_rec = gene_tree[gene_id]["gene"]
-        # Write the GFF record
-        gff_out.write(gene_rec)
-        # Write out the mRNAs, their exons, and then
-        # input the introns
-        for mRNA in gene_obj.isoforms:
-            mRNA_id = mRNA.label
-            curr_mRNA = gene_tree[gene_id]["mRNAs"][mRNA_id]
-            gff_out.write(curr_mRNA["record"])
-            # Write out the exons
-            curr_exons = gene_tree[gene_id]["mRNAs"][mRNA_id]["exons"]
-            for exon in curr_exons:
-                gff_out.write(curr_exons[exon]["record"])
-        # Now output the introns
-        for isoform in gene_obj.isoforms:
-            intron_coords = []
-            for first_exon, second_exon in zip(isoform.parts,
-                                               isoform.parts[1::1]):
-                # Intron start coordinate is the coordinate right after
-                # the end of the first exon, intron end coordinate is the
-                # coordinate just before the beginning of the second exon
-                intron_start = first_exon.end + 1
-                intron_end = second_exon.start - 1
-                if intron_start >= intron_end:
-                    continue
-                intron_coords.append((intron_start, intron_end))
-                # Create record for this intron
-                intron_id = "%s:%d-%d:%s.intron" \
-                    %(gene_obj.chrom,
-                      intron_start,
-                      intron_end,
-                      gene_obj.strand)
-                intron_rec = \
-                    miso_gff_utils.GFF(gene_obj.chrom, gene_rec.source, "intron",
-                                       intron_start, intron_end,
-                                       strand=gene_obj.strand,
-                                       attributes={"ID": [intron_id],
-                                                   "Parent": [isoform.label]})
-                gff_out.write(intron_rec)
+    indexed_gff = IndexedGFF.IndexedGFF(gff_filename)
+    try:
+        for gene_id, gene_info in indexed_gff.iter_genes():
+            gene_tree = gene_info["hierarchy"]
+            gene_obj = gene_info["gene_object"]
+            gene_rec = gene_tree[gene_id]["gene"]
+            # Write the GFF record
+            gff_out.write(gene_rec)
+            # Write out the mRNAs, their exons, and then
+            # input the introns
+            for mRNA in gene_obj.isoforms:
+                mRNA_id = mRNA.label
+                curr_mRNA = gene_tree[gene_id]["mRNAs"][mRNA_id]
+                gff_out.write(curr_mRNA["record"])
+                # Write out the exons
+                curr_exons = gene_tree[gene_id]["mRNAs"][mRNA_id]["exons"]
+                for exon in curr_exons:
+                    gff_out.write(curr_exons[exon]["record"])
+            # Now output the introns
+            for isoform in gene_obj.isoforms:
+                intron_coords = []
+                for first_exon, second_exon in zip(isoform.parts,
+                                                   isoform.parts[1::1]):
+                    # Intron start coordinate is the coordinate right after
+                    # the end of the first exon, intron end coordinate is the
+                    # coordinate just before the beginning of the second exon
+                    intron_start = first_exon.end + 1
+                    intron_end = second_exon.start - 1
+                    if intron_start >= intron_end:
+                        continue
+                    intron_coords.append((intron_start, intron_end))
+                    # Create record for this intron
+                    intron_id = "%s:%d-%d:%s.intron" \
+                        %(gene_obj.chrom,
+                          intron_start,
+                          intron_end,
+                          gene_obj.strand)
+                    intron_rec = \
+                        miso_gff_utils.GFF(gene_obj.chrom, gene_rec.source, "intron",
+                                           intron_start, intron_end,
+                                           strand=gene_obj.strand,
+                                           attributes={"ID": [intron_id],
+                                                       "Parent": [isoform.label]})
+                    gff_out.write(intron_rec)
+    finally:
+        indexed_gff.close()
     t2 = time.time()
     print "Addition took %.2f minutes." %((t2 - t1)/60.)
 
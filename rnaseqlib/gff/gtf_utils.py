@@ -0,0 +1,336 @@
+##
+## Conversion of GTF (e.g. from genePredToGtf) to GFF3
+##
+## Records are grouped by transcript_id (and genes by gene_id)
+## and output as a gene/mRNA/exon/CDS/UTR hierarchy. The GTF is
+## split by chromosome in one streaming pass, and chromosomes
+## are converted in parallel.
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from collections import OrderedDict
+
+import rnaseqlib
+
+# GTF record types of the coding region of a transcript
+CODING_REC_TYPES = ["CDS", "start_codon", "stop_codon"]
+
+
+def parse_gtf_attributes(attr_field):
+    """
+    Parse the attributes field of a GTF line
+    (e.g. 'gene_id "g1"; transcript_id "t1";') into a dictionary.
+    """
+    attributes = {}
+    for attr in attr_field.strip().split(";"):
+        attr = attr.strip()
+        if attr == "":
+            continue
+        key_val = attr.split(None, 1)
+        if len(key_val) != 2:
+            continue
+        attributes[key_val[0]] = key_val[1].strip('"')
+    return attributes
+
+
+def split_gtf_by_chrom(gtf_filename, split_dir):
+    """
+    Split a GTF file into one file per chromosome in split_dir.
+
+    Returns a list of (chrom, filename) pairs in order of
+    first appearance of the chromosomes.
+    """
+    chrom_files = OrderedDict()
+    try:
+        with open(gtf_filename) as gtf_in:
+            for line in gtf_in:
+                if line.startswith("#") or line.strip() == "":
+                    continue
+                chrom = line.split("\t", 1)[0]
+                if chrom not in chrom_files:
+                    chrom_fname = os.path.join(split_dir,
+                                               "%d.gtf" %(len(chrom_files)))
+                    chrom_files[chrom] = open(chrom_fname, "w")
+                chrom_files[chrom].write(line)
+    finally:
+        for chrom_file in chrom_files.itervalues():
+            chrom_file.close()
+    return [(chrom, chrom_file.name) \
+            for chrom, chrom_file in chrom_files.iteritems()]
+
+
+def load_gtf_transcripts(gtf_lines):
+    """
+    Group GTF records by gene and transcript.
+
+    Returns an ordered mapping from gene IDs to ordered mappings
+    from transcript IDs to transcripts: dictionaries with the
+    transcript's 'chrom', 'source', 'strand', 'attributes',
+    'records', a mapping from record types to lists of (start, end)
+    coordinates, and 'cds_frames', a list of (start, end, frame)
+    of its CDS records. Genes and transcripts are in order of
+    appearance.
+    """
+    genes = OrderedDict()
+    for line in gtf_lines:
+        if line.startswith("#"):
+            continue
+        fields = line.rstrip("\r\n").split("\t")
+        if len(fields) < 9:
+            continue
+        attributes = parse_gtf_attributes(fields[8])
+        if "transcript_id" not in attributes:
+            continue
+        trans_id = attributes["transcript_id"]
+        gene_id = attributes.get("gene_id", trans_id)
+        if gene_id not in genes:
+            genes[gene_id] = OrderedDict()
+        gene_transcripts = genes[gene_id]
+        if trans_id not in gene_transcripts:
+            gene_transcripts[trans_id] = {"chrom": fields[0],
+                                          "source": fields[1],
+                                          "strand": fields[6],
+                                          "attributes": attributes,
+                                          "records": {},
+                                          "cds_frames": []}
+        records = gene_transcripts[trans_id]["records"]
+        rec_type = fields[2]
+        if rec_type not in records:
+            records[rec_type] = []
+        start, end = int(fields[3]), int(fields[4])
+        records[rec_type].append((min(start, end), max(start, end)))
+        if rec_type == "CDS":
+            frame = fields[7]
+            if frame not in ("0", "1", "2"):
+                frame = "0"
+            gene_transcripts[trans_id]["cds_frames"].append(\
+                (min(start, end), max(start, end), int(frame)))
+    return genes
+
+
+def get_transcript_parts(transcript):
+    """
+    Return the exons, CDS parts and 5'/3' UTR parts of a
+    transcript as lists of (start, end) coordinates, each in
+    5' to 3' order.
+
+    The coding region spans the transcript's CDS, start codon and
+    stop codon records (GFF3 CDS parts include the stop codon).
+    Transcripts without exon records take their exons from their
+    CDS records.
+    """
+    records = transcript["records"]
+    exons = sorted(records.get("exon", []))
+    coding_coords = []
+    for rec_type in CODING_REC_TYPES:
+        coding_coords.extend(records.get(rec_type, []))
+    if len(exons) == 0:
+        exons = sorted(coding_coords)
+    cds_parts = []
+    left_utrs = []
+    right_utrs = []
+    if len(coding_coords) > 0:
+        cds_start = min(start for start, end in coding_coords)
+        cds_end = max(end for start, end in coding_coords)
+        for start, end in exons:
+            if start < cds_start:
+                left_utrs.append((start, min(end, cds_start - 1)))
+            if end > cds_end:
+                right_utrs.append((max(start, cds_end + 1), end))
+            if end >= cds_start and start <= cds_end:
+                cds_parts.append((max(start, cds_start), min(end, cds_end)))
+    if transcript["strand"] == "-":
+        exons.reverse()
+        cds_parts.reverse()
+        left_utrs.reverse()
+        right_utrs.reverse()
+        return exons, cds_parts, right_utrs, left_utrs
+    return exons, cds_parts, left_utrs, right_utrs
+
+
+def get_first_cds_frame(transcript):
+    """
+    Return the GTF frame of the 5'-most CDS record of a transcript,
+    or 0 if it has no CDS records. The frame is non-zero when the
+    CDS is incomplete at its 5' end.
+    """
+    cds_frames = transcript["cds_frames"]
+    if len(cds_frames) == 0:
+        return 0
+    if transcript["strand"] == "-":
+        return max(cds_frames, key=lambda cds_frame: cds_frame[1])[2]
+    return min(cds_frames)[2]
+
+
+def get_cds_phases(cds_parts, first_frame=0):
+    """
+    Return the GFF3 phases of CDS parts given in 5' to 3' order:
+    the number of bases to skip at the part's 5' end to reach
+    the next codon. 'first_frame' is the phase of the first part
+    (see get_first_cds_frame), as in gtf2gff3.pl.
+    """
+    phases = []
+    cds_len = -first_frame
+    for start, end in cds_parts:
+        phases.append((3 - (cds_len % 3)) % 3)
+        cds_len += end - start + 1
+    return phases
+
+
+def make_gff3_line(chrom, source, rec_type, start, end, strand,
+                   attributes, phase="."):
+    """
+    Return a GFF3 line. Attributes are a list of (key, value)
+    pairs.
+    """
+    attr_field = ";".join(["%s=%s" %(key, val) for key, val in attributes])
+    return "%s\n" %("\t".join([chrom, source, rec_type,
+                               str(start), str(end), ".",
+                               strand, str(phase), attr_field]))
+
+
+def get_gene_gff3_lines(gene_id, transcripts):
+    """
+    Return the GFF3 lines of a gene with its transcripts (see
+    load_gtf_transcripts), as a gene record followed by an mRNA
+    record and its exon, CDS and UTR records per transcript.
+    """
+    trans_lines = []
+    gene_start = None
+    gene_end = None
+    # Gene IDs must differ from transcript IDs in GFF3, which is
+    # not the case in e.g. knownGene GTFs
+    gene_rec_id = gene_id
+    if gene_id in transcripts:
+        gene_rec_id = "%s.gene" %(gene_id)
+    first_transcript = None
+    for trans_id, transcript in transcripts.iteritems():
+        exons, cds_parts, utrs_5p, utrs_3p = get_transcript_parts(transcript)
+        if len(exons) == 0:
+            continue
+        if first_transcript is None:
+            first_transcript = transcript
+        chrom = transcript["chrom"]
+        source = transcript["source"]
+        strand = transcript["strand"]
+        trans_start = min(start for start, end in exons)
+        trans_end = max(end for start, end in exons)
+        if gene_start is None or trans_start < gene_start:
+            gene_start = trans_start
+        if gene_end is None or trans_end > gene_end:
+            gene_end = trans_end
+        trans_lines.append(make_gff3_line(chrom, source, "mRNA",
+                                          trans_start, trans_end, strand,
+                                          [("ID", trans_id),
+                                           ("Name", trans_id),
+                                           ("Parent", gene_rec_id)]))
+        for exon_num, (start, end) in enumerate(exons):
+            trans_lines.append(make_gff3_line(chrom, source, "exon",
+                                              start, end, strand,
+                                              [("ID", "%s.exon%d" \
+                                                %(trans_id, exon_num + 1)),
+                                               ("Parent", trans_id)]))
+        phases = get_cds_phases(cds_parts,
+                                first_frame=get_first_cds_frame(transcript))
+        for cds_num, (start, end) in enumerate(cds_parts):
+            trans_lines.append(make_gff3_line(chrom, source, "CDS",
+                                              start, end, strand,
+                                              [("ID", "%s.cds%d" \
+                                                %(trans_id, cds_num + 1)),
+                                               ("Parent", trans_id)],
+                                              phase=phases[cds_num]))
+        for utr_type, utr_label, utrs in \
+            (("five_prime_UTR", "utr5p", utrs_5p),
+             ("three_prime_UTR", "utr3p", utrs_3p)):
+            for utr_num, (start, end) in enumerate(utrs):
+                trans_lines.append(make_gff3_line(chrom, source, utr_type,
+                                                  start, end, strand,
+                                                  [("ID", "%s.%s%d" \
+                                                    %(trans_id, utr_label,
+                                                      utr_num + 1)),
+                                                   ("Parent", trans_id)]))
+    if first_transcript is None:
+        return []
+    gene_attributes = [("ID", gene_rec_id),
+                       ("Name", first_transcript["attributes"].get("gene_name",
+                                                                   gene_id)),
+                       ("gene_id", gene_id)]
+    gene_line = make_gff3_line(first_transcript["chrom"],
+                               first_transcript["source"],
+                               "gene", gene_start, gene_end,
+                               first_transcript["strand"],
+                               gene_attributes)
+    return [gene_line] + trans_lines
+
+
+def convert_gtf_chrom(args):
+    """
+    Convert the GTF records of one chromosome to a GFF3 file.
+    Takes a (gtf_filename, gff3_filename) pair, for use with
+    multiprocessing.
+    """
+    gtf_filename, gff3_filename = args
+    with open(gtf_filename) as gtf_in:
+        genes = load_gtf_transcripts(gtf_in)
+    # Output genes in order of their start coordinates
+    gene_lines = []
+    for gene_id, transcripts in genes.iteritems():
+        lines = get_gene_gff3_lines(gene_id, transcripts)
+        if len(lines) > 0:
+            gene_lines.append((int(lines[0].split("\t")[3]), lines))
+    gene_lines.sort(key=lambda start_lines: start_lines[0])
+    with open(gff3_filename, "w") as gff3_out:
+        for gene_start, lines in gene_lines:
+            gff3_out.writelines(lines)
+    return gff3_filename
+
+
+def gtf_to_gff3(gtf_filename, gff3_filename,
+                num_processors=1,
+                tmp_dir=None):
+    """
+    Convert a GTF file to GFF3.
+
+    The GTF is split by chromosome into temporary files (in
+    'tmp_dir', by default the output directory), which are
+    converted in parallel when num_processors > 1 and
+    concatenated in order of first appearance of the chromosomes.
+    Only one chromosome's records are held in memory per process.
+    """
+    print "Converting GTF %s to GFF3" %(gtf_filename)
+    print "  - Output file: %s" %(gff3_filename)
+    t1 = time.time()
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(gff3_filename))
+    split_dir = tempfile.mkdtemp(prefix="gtf_to_gff3.", dir=tmp_dir)
+    try:
+        chrom_gtfs = split_gtf_by_chrom(gtf_filename, split_dir)
+        chrom_args = [(chrom_gtf, "%s.gff3" %(chrom_gtf)) \
+                      for chrom, chrom_gtf in chrom_gtfs]
+        if num_processors > 1:
+            pool = multiprocessing.Pool(processes=num_processors)
+            try:
+                chrom_gff3s = pool.map(convert_gtf_chrom, chrom_args,
+                                       chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            chrom_gff3s = map(convert_gtf_chrom, chrom_args)
+        tmp_gff3_filename = "%s.tmp" %(gff3_filename)
+        with open(tmp_gff3_filename, "w") as gff3_out:
+            gff3_out.write("##gff-version 3\n")
+            for chrom_gff3 in chrom_gff3s:
+                with open(chrom_gff3) as chrom_in:
+                    shutil.copyfileobj(chrom_in, gff3_out)
+        os.rename(tmp_gff3_filename, gff3_filename)
+    finally:
+        shutil.rmtree(split_dir, ignore_errors=True)
+    t2 = time.time()
+    print "Conversion took %.2f secs" %(t2 - t1)
+    return gff3_filename
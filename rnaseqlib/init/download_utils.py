@@ -7,10 +7,24 @@ import sys
 import time
 
 import shutil
+import socket
+import httplib
 import urllib2
 import posixpath
 
+from multiprocessing.pool import ThreadPool
+
 import rnaseqlib
+import rnaseqlib.utils as utils
+
+# Extension of partially downloaded files
+PARTIAL_EXT = ".part"
+
+DOWNLOAD_BLOCK_SIZE = 2**20
+
+# Errors after which a download can be resumed
+DOWNLOAD_ERRORS = (urllib2.URLError, httplib.HTTPException,
+                   socket.error, IOError)
 
 
 def wget(url):
@@ -24,34 +38,165 @@ def wget(url):
     print "  Downloading took %.2f minutes." %((t2 - t1)/60.)
 
 
+def fetch_url(url, partial_filename, resume=True):
+    """
+    Fetch a URL into a partially downloaded file. If 'resume' is
+    True and the file exists, only the rest of the URL is requested
+    and appended to it (the file is overwritten if the server does
+    not support ranges).
+
+    Returns True if the download completed with the size the
+    server reported, False if it was interrupted (so that it can
+    be resumed) and None if the URL cannot be fetched.
+    """
+    offset = 0
+    if resume and os.path.isfile(partial_filename):
+        offset = os.path.getsize(partial_filename)
+    request = urllib2.Request(url)
+    if offset > 0:
+        print "  - Resuming from byte %d" %(offset)
+        request.add_header("Range", "bytes=%d-" %(offset))
+    try:
+        url_in = urllib2.urlopen(request)
+    except urllib2.HTTPError, http_error:
+        if http_error.code == 416:
+            # Range not satisfiable: the partial file is no good
+            print "  - Cannot resume, restarting download"
+            os.remove(partial_filename)
+            return False
+        print "WARNING: Could not fetch %s (%s)" %(url, http_error)
+        return None
+    except DOWNLOAD_ERRORS, download_error:
+        print "WARNING: Could not connect to %s (%s)" %(url, download_error)
+        return False
+    if offset > 0 and url_in.getcode() != 206:
+        # The server sent the whole file
+        offset = 0
+    expected_size = url_in.info().getheader("Content-Length")
+    if expected_size is not None:
+        expected_size = offset + int(expected_size)
+    try:
+        with open(partial_filename, "ab" if offset > 0 else "wb") as url_out:
+            shutil.copyfileobj(url_in, url_out, DOWNLOAD_BLOCK_SIZE)
+    except DOWNLOAD_ERRORS, download_error:
+        print "WARNING: Download of %s interrupted (%s)" %(url,
+                                                          download_error)
+        return False
+    finally:
+        url_in.close()
+    if expected_size is not None:
+        downloaded_size = os.path.getsize(partial_filename)
+        if downloaded_size != expected_size:
+            print "WARNING: Got %d of %d bytes of %s" %(downloaded_size,
+                                                        expected_size,
+                                                        url)
+            if downloaded_size > expected_size:
+                os.remove(partial_filename)
+            return False
+    return True
+
+
 def download_url(url, output_dir,
                  binary=True,
                  basename=None,
-                 unless_exists=True):
+                 unless_exists=True,
+                 resume=True,
+                 md5sum=None,
+                 num_attempts=3):
     """
     Download a url and put it at the desired location.
+
+    The download goes to a partial file (with PARTIAL_EXT) that is
+    moved into place once complete, so an interrupted download is
+    resumed (if 'resume' is True) by the next attempt or the next
+    call. Downloads are checked against the size reported by the
+    server and, if given, the MD5 checksum 'md5sum'.
+
+    Returns the output filename, or None if the download failed.
     """
-    print "Downloading: %s" %(url)
-    t1 = time.time()
-    url_in = None
-    try:
-        url_in = urllib2.urlopen(url)
-    except urllib2.HTTPError:
-        print "WARNING: Could not fetch %s" %(url)
-        return None
     url_name = posixpath.basename(url)
     if basename != None:
         url_name = basename
     output_filename = os.path.join(output_dir, url_name)
     if unless_exists and os.path.isfile(output_filename):
-        print "  - File exists, skipping."
+        print "  - File %s exists, skipping." %(output_filename)
         return output_filename
-    if binary:
-        url_out = open(output_filename, "wb")
-    else:
-        url_out = open(output_filename, "w")
-    shutil.copyfileobj(url_in, url_out)
+    print "Downloading: %s" %(url)
+    t1 = time.time()
+    partial_filename = "%s%s" %(output_filename, PARTIAL_EXT)
+    fetch_status = False
+    for attempt_num in range(num_attempts):
+        fetch_status = fetch_url(url, partial_filename, resume=resume)
+        if fetch_status is not False:
+            break
+    if not fetch_status:
+        print "WARNING: Failed to download %s" %(url)
+        return None
+    if md5sum is not None:
+        file_md5sum = utils.get_file_checksum(partial_filename)
+        if file_md5sum != md5sum:
+            print "WARNING: Checksum of %s is %s, expected %s" \
+                %(url, file_md5sum, md5sum)
+            os.remove(partial_filename)
+            return None
+    os.rename(partial_filename, output_filename)
     t2 = time.time()
     print "  Downloading took %.2f minutes." %((t2 - t1)/60.)
     return output_filename
 
+
+def load_url_lines(url):
+    """
+    Return the lines of a (small) file at a URL, or None if it
+    cannot be fetched.
+    """
+    try:
+        url_in = urllib2.urlopen(url)
+    except DOWNLOAD_ERRORS:
+        return None
+    try:
+        return url_in.readlines()
+    except DOWNLOAD_ERRORS:
+        return None
+    finally:
+        url_in.close()
+
+
+def load_md5sums(url):
+    """
+    Load an md5sum.txt-style list of checksums from a URL, as a
+    mapping from filenames to MD5 checksums. Returns an empty
+    mapping if the list cannot be fetched.
+    """
+    md5sums = {}
+    try:
+        url_in = urllib2.urlopen(url)
+    except DOWNLOAD_ERRORS:
+        return md5sums
+    try:
+        for line in url_in:
+            fields = line.strip().split()
+            if len(fields) != 2:
+                continue
+            md5sums[posixpath.basename(fields[1].lstrip("*"))] = fields[0]
+    except DOWNLOAD_ERRORS:
+        return {}
+    finally:
+        url_in.close()
+    return md5sums
+
+
+def run_in_pool(func, args_list, num_processors=1):
+    """
+    Call func on each element of args_list with a pool of at most
+    'num_processors' threads (e.g. to download files in parallel).
+    Returns the results in order.
+    """
+    if num_processors <= 1 or len(args_list) <= 1:
+        return map(func, args_list)
+    pool = ThreadPool(processes=min(num_processors, len(args_list)))
+    try:
+        return pool.map(func, args_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,298 @@
+##
+## Vectorized operations on sets of genomic intervals stored
+## as numpy arrays: sorting, merging, subtracting and
+## complementing. Follows bedtools conventions: coordinates
+## are 0-based, half-open (start, end) as in BED.
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+
+
+def get_label_codes(*labels):
+    """
+    Return integer codes for combinations of labels (e.g.
+    chromosome and strand) of intervals, such that sorting by
+    code sorts by the labels in order.
+    """
+    codes = np.zeros(len(labels[0]), dtype=np.int64)
+    for label in labels:
+        uniq_labels, label_codes = np.unique(label, return_inverse=True)
+        codes = codes * len(uniq_labels) + label_codes
+    return codes
+
+
+def get_keyed_coords(keys, coords, key_base):
+    """
+    Return coordinates offset by their key, so that coordinates
+    of different keys can be compared and searched as one
+    sorted array.
+    """
+    return keys * key_base + coords
+
+
+def sort_intervals(chroms, starts, ends=None):
+    """
+    Return the indices that sort intervals by chromosome,
+    start and end (as sortBed).
+    """
+    if ends is None:
+        ends = starts
+    return np.lexsort((ends, starts, get_label_codes(chroms)))
+
+
+def merge_keyed_intervals(keys, starts, ends, distance=0):
+    """
+    Merge overlapping intervals with the same key (see
+    merge_intervals).
+
+    Returns the keys, starts and ends of merged intervals, in order
+    of key and start, and the index of the merged interval that
+    each input interval falls in.
+    """
+    num_intervals = len(starts)
+    if num_intervals == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    order = np.lexsort((starts, keys))
+    sorted_keys = keys[order]
+    sorted_starts = starts[order]
+    sorted_ends = ends[order]
+    # Running maximum of ends within each key: offset ends by key
+    # so that the maximum never carries over from a previous key
+    key_base = max(sorted_ends.max(), sorted_starts.max()) + distance + 1
+    running_ends = \
+        np.maximum.accumulate(get_keyed_coords(sorted_keys, sorted_ends,
+                                               key_base)) - \
+        sorted_keys * key_base
+    # A merged interval begins at a new key or at an interval
+    # starting beyond the reach of the previous ones
+    is_first = np.ones(num_intervals, dtype=bool)
+    is_first[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | \
+                   (sorted_starts[1:] > running_ends[:-1] + distance)
+    first_inds = np.nonzero(is_first)[0]
+    last_inds = np.append(first_inds[1:] - 1, num_intervals - 1)
+    interval_merged = np.empty(num_intervals, dtype=np.int64)
+    interval_merged[order] = np.cumsum(is_first) - 1
+    return (sorted_keys[first_inds],
+            sorted_starts[first_inds],
+            running_ends[last_inds],
+            interval_merged)
+
+
+def merge_intervals(chroms, starts, ends, strands=None, distance=0):
+    """
+    Merge overlapping intervals (as mergeBed). Intervals are
+    merged if they overlap, are book-ended or are at most
+    'distance' bases apart. If strands are given, only intervals
+    on the same strand are merged (as mergeBed -s).
+
+    Returns (first_inds, merged_starts, merged_ends, interval_merged)
+    where merged intervals are ordered by chromosome (and strand)
+    and start, first_inds are the indices of an input interval of
+    each merged interval (to look up its chromosome and strand),
+    and interval_merged gives the index of the merged interval that
+    each input interval falls in.
+    """
+    if strands is None:
+        keys = get_label_codes(chroms)
+    else:
+        keys = get_label_codes(chroms, strands)
+    merged_keys, merged_starts, merged_ends, interval_merged = \
+        merge_keyed_intervals(keys, starts, ends, distance=distance)
+    # An input interval of each merged interval
+    first_inds = np.zeros(len(merged_starts), dtype=np.int64)
+    first_inds[interval_merged[::-1]] = \
+        np.arange(len(starts) - 1, -1, -1)
+    # Order merged intervals by chromosome and start regardless
+    # of strand
+    merge_order = sort_intervals(np.asarray(chroms)[first_inds],
+                                 merged_starts, merged_ends)
+    new_merged = np.empty(len(merge_order), dtype=np.int64)
+    new_merged[merge_order] = np.arange(len(merge_order))
+    return (first_inds[merge_order],
+            merged_starts[merge_order],
+            merged_ends[merge_order],
+            new_merged[interval_merged])
+
+
+def subtract_keyed_intervals(keys, starts, ends,
+                             sub_keys, sub_starts, sub_ends):
+    """
+    Subtract intervals from intervals with the same key (see
+    subtract_intervals).
+
+    Returns the input interval indices, starts and ends of the
+    remaining pieces, ordered by input interval and start.
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if len(starts) == 0:
+        return empty, empty, empty
+    if len(sub_starts) == 0:
+        return np.arange(len(starts)), starts.copy(), ends.copy()
+    # Subtracted intervals, merged so that they are disjoint
+    merged_keys, merged_starts, merged_ends, interval_merged = \
+        merge_keyed_intervals(sub_keys, sub_starts, sub_ends)
+    key_base = max(ends.max(), merged_ends.max()) + 1
+    merged_key_starts = get_keyed_coords(merged_keys, merged_starts, key_base)
+    merged_key_ends = get_keyed_coords(merged_keys, merged_ends, key_base)
+    # Merged intervals overlapping each interval are first_sub:last_sub
+    first_sub = np.searchsorted(merged_key_ends,
+                                get_keyed_coords(keys, starts, key_base),
+                                side="right")
+    last_sub = np.searchsorted(merged_key_starts,
+                               get_keyed_coords(keys, ends, key_base),
+                               side="left")
+    num_subs = np.maximum(last_sub - first_sub, 0)
+    # An interval overlapping n subtracted intervals leaves up
+    # to n + 1 pieces: before, between and after them
+    num_pieces = num_subs + 1
+    piece_inds = np.repeat(np.arange(len(starts)), num_pieces)
+    piece_offsets = np.cumsum(num_pieces) - num_pieces
+    piece_nums = np.arange(num_pieces.sum()) - \
+                 np.repeat(piece_offsets, num_pieces)
+    piece_subs = np.repeat(first_sub, num_pieces) + piece_nums
+    is_first = (piece_nums == 0)
+    is_last = (piece_nums == num_subs[piece_inds])
+    # Pad merged coordinates so that out of range lookups are
+    # harmless; they are masked out below
+    padded_starts = np.append(merged_starts, 0)
+    padded_ends = np.append(merged_ends, 0)
+    piece_starts = np.where(is_first, starts[piece_inds],
+                            padded_ends[np.maximum(piece_subs - 1, 0)])
+    piece_ends = np.where(is_last, ends[piece_inds],
+                          padded_starts[np.minimum(piece_subs,
+                                                   len(merged_starts))])
+    piece_starts = np.maximum(piece_starts, starts[piece_inds])
+    piece_ends = np.minimum(piece_ends, ends[piece_inds])
+    keep = piece_ends > piece_starts
+    return piece_inds[keep], piece_starts[keep], piece_ends[keep]
+
+
+def subtract_intervals(chroms, starts, ends,
+                       sub_chroms, sub_starts, sub_ends,
+                       strands=None, sub_strands=None):
+    """
+    Subtract one set of intervals from another (as subtractBed):
+    return the parts of each interval not covered by any of the
+    subtracted intervals on its chromosome (and strand, if strands
+    are given).
+
+    Returns the interval indices, starts and ends of the remaining
+    pieces.
+    """
+    num_intervals = len(starts)
+    all_labels = [np.concatenate([np.asarray(chroms),
+                                  np.asarray(sub_chroms)])]
+    if strands is not None:
+        all_labels.append(np.concatenate([np.asarray(strands),
+                                          np.asarray(sub_strands)]))
+    all_keys = get_label_codes(*all_labels)
+    return subtract_keyed_intervals(all_keys[:num_intervals], starts, ends,
+                                    all_keys[num_intervals:],
+                                    sub_starts, sub_ends)
+
+
+def complement_intervals(groups, starts, ends,
+                         bound_starts, bound_ends):
+    """
+    Return the complement of intervals within the bounds of their
+    group, e.g. the intronic regions of genes from their exons and
+    gene bounds.
+
+    - groups: group index of each interval
+    - starts, ends: interval coordinates
+    - bound_starts, bound_ends: bounds of each group (indexed by
+      group index)
+
+    Returns the group indices, starts and ends of the complement
+    intervals, ordered by group and start.
+    """
+    return subtract_keyed_intervals(np.arange(len(bound_starts)),
+                                    bound_starts, bound_ends,
+                                    groups, starts, ends)
+
+
+def load_bed_intervals(bed_filename):
+    """
+    Load the intervals of a BED file (with at least 6 fields)
+    into arrays: chroms, starts, ends, names, scores and strands.
+    """
+    chroms = []
+    starts = []
+    ends = []
+    names = []
+    scores = []
+    strands = []
+    with open(bed_filename) as bed_in:
+        for line in bed_in:
+            if line.startswith("#") or line.startswith("track"):
+                continue
+            fields = line.strip().split("\t")
+            if len(fields) < 6:
+                continue
+            chroms.append(fields[0])
+            starts.append(int(fields[1]))
+            ends.append(int(fields[2]))
+            names.append(fields[3])
+            scores.append(float(fields[4]))
+            strands.append(fields[5])
+    return {"chroms": np.array(chroms, dtype="S"),
+            "starts": np.array(starts, dtype=np.int64),
+            "ends": np.array(ends, dtype=np.int64),
+            "names": np.array(names, dtype="S"),
+            "scores": np.array(scores),
+            "strands": np.array(strands, dtype="S")}
+
+
+def format_score(score):
+    """
+    Format a BED score, as an integer if it is one.
+    """
+    if score == int(score):
+        return str(int(score))
+    return "%.3f" %(score)
+
+
+def merge_bed_file(input_filename, output_filename,
+                   stranded=True,
+                   distance=0,
+                   names_delim=","):
+    """
+    Merge the intervals of a BED file and output them as a sorted
+    BED file (as 'sortBed | mergeBed -nms -s -scores sum'). The
+    names of merged intervals are the distinct names of their
+    intervals, delimited by 'names_delim', and their scores are
+    the sums of their intervals' scores.
+    """
+    bed = load_bed_intervals(input_filename)
+    strands = None
+    if stranded:
+        strands = bed["strands"]
+    first_inds, merged_starts, merged_ends, interval_merged = \
+        merge_intervals(bed["chroms"], bed["starts"], bed["ends"],
+                        strands=strands,
+                        distance=distance)
+    num_merged = len(merged_starts)
+    merged_scores = np.bincount(interval_merged, weights=bed["scores"],
+                                minlength=num_merged)
+    # Distinct names of each merged interval, in order of appearance
+    merged_names = [[] for merged_num in xrange(num_merged)]
+    for merged_num, name in zip(interval_merged.tolist(),
+                                bed["names"].tolist()):
+        if name not in merged_names[merged_num]:
+            merged_names[merged_num].append(name)
+    with open(output_filename, "w") as bed_out:
+        for merged_num, first_ind in enumerate(first_inds.tolist()):
+            bed_out.write("%s\t%d\t%d\t%s\t%s\t%s\n" \
+                          %(bed["chroms"][first_ind],
+                            merged_starts[merged_num],
+                            merged_ends[merged_num],
+                            names_delim.join(merged_names[merged_num]),
+                            format_score(merged_scores[merged_num]),
+                            bed["strands"][first_ind]))
+    return output_filename
@@ -14,6 +14,8 @@ from collections import defaultdict
 import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.coords_utils as coords_utils
+import rnaseqlib.interval_utils as interval_utils
+import rnaseqlib.sort_utils as sort_utils
 
 import pybedtools
 
@@ -209,12 +211,35 @@ def get_reads_matching_regions(bam_filename,
     if not os.path.isfile(bed_filename):
         logger.critical("BED file %s does not exist." %(bed_filename))
         return None
-    bedtools_cmd = \
-      "bamToBed -i %(bam_filename)s -split | sortBed -i - | " \
-      "intersectBed -a %(bed_filename)s -b - -sorted -f %(frac_overlap)s -wo | " \
-      "groupBy -g 1-4 -c 9 -o collapse > %(output_filename)s" %(args)
-    logger.info("Executing: %s" %(bedtools_cmd))
-    ret_val = os.system(bedtools_cmd)
+    # Sort the reads as BED with an external sort
+    reads_bed_filename = "%s.reads.bed" %(output_filename)
+    args["reads_bed_filename"] = reads_bed_filename
+    bamToBed_proc = subprocess.Popen(["bamToBed", "-i", bam_filename,
+                                      "-split"],
+                                     stdout=subprocess.PIPE)
+    tmp_dir = os.path.dirname(os.path.abspath(output_filename))
+    try:
+        with open(reads_bed_filename, "w") as reads_bed_out:
+            reads_bed_out.writelines(\
+                sort_utils.iter_sorted_lines(bamToBed_proc.stdout,
+                                             tmp_dir=tmp_dir))
+        bamToBed_proc.communicate()
+        if bamToBed_proc.returncode != 0:
+            logger.critical("bamToBed call failed on %s." %(bam_filename))
+            raise Exception, "bamToBed failed on %s." %(bam_filename)
+        bedtools_cmd = \
+          "intersectBed -a %(bed_filename)s -b %(reads_bed_filename)s " \
+          "-sorted -f %(frac_overlap)s -wo | " \
+          "groupBy -g 1-4 -c 9 -o collapse > %(output_filename)s" %(args)
+        logger.info("Executing: %s" %(bedtools_cmd))
+        ret_val = os.system(bedtools_cmd)
+    finally:
+        # Don't leave the reads BED behind if sorting or bedtools fail
+        if bamToBed_proc.poll() is None:
+            bamToBed_proc.kill()
+            bamToBed_proc.wait()
+        if os.path.isfile(reads_bed_filename):
+            os.remove(reads_bed_filename)
     if ret_val != 0:
         logger.critical("bedtools call failed.")
         return None
@@ -334,28 +359,18 @@ def count_reads_matching_intervals(bam_filename,
 def merge_bed(input_filename, output_filename,
               sort_input=True):
     """
-    Merge a BED file. Input filename can be a GFF or a
-    BED file.
+    Merge a BED file (as 'sortBed | mergeBed -nms -s -scores sum'),
+    in-process (see interval_utils.merge_bed_file). Names of merged
+    intervals are comma delimited.
     """
-    merge_cmd = ""
     if os.path.isfile(output_filename):
         print "%s exists. Skipping..." %(output_filename)
         return output_filename
-    if sort_input:
-        merge_cmd = \
-          "sortBed -i %s | mergeBed -i stdin -nms -s -scores sum | sortBed -i - " \
-            %(input_filename)
-        print "Executing: %s" %(merge_cmd)
-        output_file = open(output_filename, "w")
-        proc = subprocess.Popen(merge_cmd,
-                                stdout=subprocess.PIPE,
-                                shell=True)
-        sub_bed_delimiter(proc.stdout, output_file,
-                          from_delim=";",
-                          to_delim=",")
-        proc.communicate()
-    else:
+    if not sort_input:
         raise Exception, "Not implemented."
+    print "Merging %s" %(input_filename)
+    interval_utils.merge_bed_file(input_filename, output_filename,
+                                  stranded=True)
     return output_filename
 
 
@@ -388,36 +403,39 @@ def make_bed_line(chrom, start, end,
 
 def sort_bed(input_filename, output_filename,
              gff_to_bed=False,
-             attribute_to_use=None):
+             attribute_to_use=None,
+             max_mem_mb=sort_utils.DEFAULT_MAX_MEM_MB):
     """
-    Sort BED file with sortBed.
+    Sort BED (or GFF) file by chromosome and start, with an
+    external merge sort using at most about 'max_mem_mb'
+    megabytes (see sort_utils.iter_sorted_lines).
 
-    - If 'gff_to_bed' is given, assumes the output of sortBed
-      is in GFF format, and converts it on the fly to BED
+    - If 'gff_to_bed' is given, assumes the input is
+      in GFF format, and converts it on the fly to BED
     """
     print "Sorting BED %s" %(input_filename)
     if not os.path.isfile(input_filename):
         print "Error: %s does not exist." %(input_filename)
         return None
     if os.path.isfile(output_filename):
-        print "%s exists, skipping sortBed" %(output_filename)
+        print "%s exists, skipping sort" %(output_filename)
         return output_filename
-    input_file = open(input_filename, "r")
-    output_file = open(output_filename, "w")
     print "  - Output file: %s" %(output_filename)
+    file_format = sort_utils.get_file_format(input_filename)
     if gff_to_bed:
-        proc = subprocess.Popen(["sortBed", "-i"],
-                                stdin=input_file,
-                                stdout=subprocess.PIPE)
-        # Iterate through stdout
-        convert_gff_to_bed(proc.stdout, output_file,
-                           attribute_to_use=attribute_to_use)
-    else:
-        proc = subprocess.Popen(["sortBed", "-i"],
-                                stdin=input_file,
-                                stdout=output_file)
-    proc.communicate()
-    output_file.close()
+        file_format = "gff"
+    tmp_dir = os.path.dirname(os.path.abspath(output_filename))
+    with open(input_filename, "r") as input_file:
+        sorted_lines = sort_utils.iter_sorted_lines(input_file,
+                                                    file_format=file_format,
+                                                    max_mem_mb=max_mem_mb,
+                                                    tmp_dir=tmp_dir)
+        with open(output_filename, "w") as output_file:
+            if gff_to_bed:
+                convert_gff_to_bed(sorted_lines, output_file,
+                                   attribute_to_use=attribute_to_use)
+            else:
+                output_file.writelines(sorted_lines)
     print "  - Sorting completed."
     return output_filename
     
@@ -4,49 +4,262 @@
 import os
 import sys
 import time
+import gzip
+import multiprocessing
+
+import numpy as np
+import scipy.sparse
+
+import pysam
 
 import rnaseqlib
 
-def convertBowtieToJxns(inpath, outpath, jxns, jxnmod, compress=False):
-  
-    if isinstance(compress,str):
-        compress = eval(compress)
- 
-    if compress==True: 
-        out = gzip.open(outpath,'wb')
+
+def get_jxn_refs(samfile, ref_offsets=None):
+    """
+    Return, for each reference ID of the SAM/BAM file, the
+    junction number of the first junction on that reference,
+    or -1 if it is not a junction library reference.
+
+    By default the single reference with 'Jxn' in its name holds
+    junctions numbered from 0. 'ref_offsets' can map reference
+    names to the number of their first junction instead, and is
+    required when there are several junction references.
+    """
+    jxn_refs = []
+    for ref_name in samfile.references:
+        if ref_offsets is not None:
+            jxn_refs.append(ref_offsets.get(ref_name, -1))
+        elif 'Jxn' in ref_name:
+            jxn_refs.append(0)
+        else:
+            jxn_refs.append(-1)
+    if ref_offsets is None and jxn_refs.count(0) > 1:
+        raise Exception, "Several junction references in %s; pass " \
+                         "ref_offsets to number their junctions." \
+                         %(samfile.filename)
+    return np.array(jxn_refs, dtype=np.int64)
+
+
+def merge_coord_counts(coords, counts):
+    """
+    Sum the counts of equal junction library coordinates.
+
+    Returns the sorted unique coordinates and their counts.
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.uint32)
+    if len(coords) == 0:
+        return coords, counts
+    order = np.argsort(coords, kind="mergesort")
+    coords = coords[order]
+    is_first = np.ones(len(coords), dtype=bool)
+    is_first[1:] = (coords[1:] != coords[:-1])
+    first_inds = np.nonzero(is_first)[0]
+    return coords[first_inds], \
+           np.add.reduceat(counts[order], first_inds).astype(np.uint32)
+
+
+def add_jxn_positions(coord_counts, coords, num_jxns, jxnmod):
+    """
+    Add reads at the given (1-based) junction library coordinates
+    to the sparse junction coordinate counts 'coord_counts', a pair
+    of sorted unique coordinates and their counts.
+
+    Returns the updated coordinate counts.
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    # Coordinates past the last junction are not counted
+    coords = coords[coords // jxnmod < num_jxns]
+    if len(coords) == 0:
+        return coord_counts
+    uniq_coords, counts = \
+        merge_coord_counts(coords, np.ones(len(coords), dtype=np.uint32))
+    return merge_coord_counts(np.append(coord_counts[0], uniq_coords),
+                              np.append(coord_counts[1], counts))
+
+
+def get_jxn_count_matrix(coord_counts, num_jxns, jxnmod):
+    """
+    Return sparse junction coordinate counts as a sparse
+    (num_jxns x jxnmod) junction by position matrix.
+    """
+    coords, counts = coord_counts
+    return scipy.sparse.csr_matrix((counts, (coords // jxnmod,
+                                             coords % jxnmod)),
+                                   shape=(num_jxns, jxnmod),
+                                   dtype=np.uint32)
+
+
+def count_bowtie_jxn_coords(inpath, num_jxns, jxnmod,
+                            ref_offsets=None,
+                            chunk_size=1000000):
+    """
+    Count reads aligned to a junction library in a SAM/BAM file
+    by junction library coordinate.
+
+    Streams over the alignments, buffering at most 'chunk_size'
+    junction coordinates before adding them to the counts.
+
+    Returns the sorted coordinates with reads and their counts.
+    """
+    if inpath.endswith(".bam"):
+        samfile = pysam.Samfile(inpath, "rb")
     else:
-        out = open(outpath,'w')
+        samfile = pysam.Samfile(inpath, "r")
+    jxn_refs = get_jxn_refs(samfile, ref_offsets=ref_offsets).tolist()
+    coord_counts = (np.array([], dtype=np.int64),
+                    np.array([], dtype=np.uint32))
+    coords = []
+    for read in samfile:
+        if read.tid < 0:
+            # Unmapped read
+            continue
+        first_jxn = jxn_refs[read.tid]
+        if first_jxn < 0:
+            continue
+        # Junction library coordinates are 1-based
+        coords.append(first_jxn * jxnmod + read.pos + 1)
+        if len(coords) == chunk_size:
+            coord_counts = add_jxn_positions(coord_counts, coords,
+                                             num_jxns, jxnmod)
+            coords = []
+    coord_counts = add_jxn_positions(coord_counts, coords, num_jxns, jxnmod)
+    samfile.close()
+    return coord_counts
+
 
-    if inpath.endswith(".gz"):
-        infile = gzip.open(inpath)
+def count_bowtie_jxns(inpath, num_jxns, jxnmod,
+                      ref_offsets=None,
+                      chunk_size=1000000):
+    """
+    Count reads aligned to a junction library in a SAM/BAM file.
+
+    Returns a sparse (num_jxns x jxnmod) matrix with the number of
+    reads aligned to each position of each junction, where the
+    junction number and position of a read are its coordinate
+    divided by, and modulo, 'jxnmod'.
+    """
+    coord_counts = count_bowtie_jxn_coords(inpath, num_jxns, jxnmod,
+                                           ref_offsets=ref_offsets,
+                                           chunk_size=chunk_size)
+    return get_jxn_count_matrix(coord_counts, num_jxns, jxnmod)
+
+
+def count_bowtie_jxns_shard(shard_args):
+    """
+    Count junction reads in one input shard by coordinate. Run
+    by worker processes.
+    """
+    inpath, num_jxns, jxnmod, ref_offsets = shard_args
+    return count_bowtie_jxn_coords(inpath, num_jxns, jxnmod,
+                                   ref_offsets=ref_offsets)
+
+
+def count_bowtie_jxns_parallel(inpaths, num_jxns, jxnmod,
+                               ref_offsets=None,
+                               num_processors=1):
+    """
+    Count junction reads across several SAM/BAM shards (e.g. from
+    a chunked mapping run) and sum their counts. Shards are counted
+    in parallel when num_processors > 1, and each shard's counts
+    are summed in as soon as it is done.
+
+    Returns a sparse (num_jxns x jxnmod) junction by position
+    matrix, as in count_bowtie_jxns.
+    """
+    shard_args = [(inpath, num_jxns, jxnmod, ref_offsets) \
+                  for inpath in inpaths]
+    coord_counts = (np.array([], dtype=np.int64),
+                    np.array([], dtype=np.uint32))
+    pool = None
+    if num_processors > 1:
+        pool = multiprocessing.Pool(processes=num_processors)
+        shard_coord_counts = pool.imap_unordered(count_bowtie_jxns_shard,
+                                                 shard_args)
+    else:
+        shard_coord_counts = (count_bowtie_jxns_shard(args) \
+                              for args in shard_args)
+    try:
+        for shard_coords, shard_counts in shard_coord_counts:
+            coord_counts = \
+                merge_coord_counts(np.append(coord_counts[0], shard_coords),
+                                   np.append(coord_counts[1], shard_counts))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return get_jxn_count_matrix(coord_counts, num_jxns, jxnmod)
+
+
+def save_jxn_count_matrix(counts, jxns, outpath):
+    """
+    Save a sparse junction by position count matrix, along with
+    the junction names, as a binary (.npz) file of its nonzero
+    entries.
+    """
+    counts = scipy.sparse.coo_matrix(counts)
+    np.savez(outpath,
+             jxn_nums=counts.row,
+             positions=counts.col,
+             counts=counts.data,
+             shape=np.array(counts.shape),
+             jxns=np.array(jxns))
+
+
+def load_jxn_count_matrix(inpath):
+    """
+    Load a binary junction count matrix. Returns the junction
+    names and the sparse junction by position counts.
+    """
+    data = np.load(inpath)
+    counts = scipy.sparse.csr_matrix((data["counts"],
+                                      (data["jxn_nums"], data["positions"])),
+                                     shape=tuple(data["shape"]),
+                                     dtype=np.uint32)
+    return data["jxns"].tolist(), counts
+
+
+def write_jxn_counts(counts, jxns, outpath, compress=False):
+    """
+    Write sparse junction counts as text, one junction per line,
+    with the counts at each position as 'pos:count' separated by
+    ';'. Only junctions with reads are written.
+    """
+    counts = scipy.sparse.csr_matrix(counts)
+    counts.eliminate_zeros()
+    counts.sort_indices()
+    if compress:
+        out = gzip.open(outpath, 'wb')
     else:
-        infile = open(inpath)
-    
-    storedjxns = {}
+        out = open(outpath, 'w')
+    for jxnnum in xrange(counts.shape[0]):
+        row_start, row_end = counts.indptr[jxnnum], counts.indptr[jxnnum + 1]
+        if row_start == row_end:
+            continue
+        out.write(jxns[jxnnum] + "\t" + \
+                  ";".join(["%d:%d" %(pos, count) \
+                            for pos, count in \
+                            zip(counts.indices[row_start:row_end],
+                                counts.data[row_start:row_end])]) + "\n")
+    out.close()
+
+
+def convertBowtieToJxns(inpath, outpath, jxns, jxnmod, compress=False,
+                        matrix_outpath=None):
+    """
+    Convert Bowtie alignments (SAM/BAM) to a junction library into
+    counts of reads per junction position.
+
+    'jxns' lists the junction names by junction number. If
+    'matrix_outpath' is given, the counts are also saved as a
+    binary junction count matrix.
+    """
+    if isinstance(compress,str):
+        compress = eval(compress)
     print "Converting Bowtie to jxns: ", inpath, outpath
-    for line in infile:
-        if not line.startswith("@"):
-            if 'Jxn' in line:
-                vals = line.strip().split("\t")
-                name = vals[0]
-                coord = int(vals[3])
-                jxnnum = int(coord)/jxnmod
-                jxnpos = int(coord)%jxnmod
-                key = jxnnum/mod
-                jxn = jxns[key][jxnnum]
-                if jxn not in storedjxns:
-                    storedjxns[jxn] = {}
-                try:
-                    #storedjxns[jxn].append(name+":"+jxnpos)
-                    storedjxns[jxn][jxnpos] += 1
-                except:
-                    #storedjxns[jxn] = [name+":"+jxnpos]
-                    storedjxns[jxn][jxnpos] = 1
- 
-    for jxn in storedjxns:
-        #out.write(jxn+"\t"+"\t".join(storedjxns[jxn])+"\n")
-        data = [[x, storedjxns[jxn][x]] for x in storedjxns[jxn]]
-        data.sort(key=operator.itemgetter(0))
-        out.write(jxn+"\t"+";".join([":".join(map(str,x)) \
-            for x in data])+"\n")
-    out.close() 
+    counts = count_bowtie_jxns(inpath, len(jxns), jxnmod)
+    write_jxn_counts(counts, jxns, outpath, compress=compress)
+    if matrix_outpath is not None:
+        save_jxn_count_matrix(counts, jxns, matrix_outpath)
+    return counts
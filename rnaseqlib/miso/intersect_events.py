@@ -17,8 +17,12 @@ import misopy.gff_utils as gff_utils
 import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.tables as tables
+import rnaseqlib.gff.IndexedGFF as IndexedGFF
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
 
+# Indexed GFFs opened by get_indexed_gff, by filename
+INDEXED_GFFS = {}
+
 
 def gff_genes_from_events(gff_filename,
                           gene_field="gene"):
@@ -223,6 +227,20 @@ def parse_query_region(region):
     return parsed_region
         
         
+def get_indexed_gff(gff_filename):
+    """
+    Return an IndexedGFF.IndexedGFF for a GFF file, reusing the one
+    opened by a previous call unless the file has changed since.
+    """
+    indexed_gff = INDEXED_GFFS.get(gff_filename)
+    if (indexed_gff is None) or \
+       (not np.array_equal(indexed_gff.stamp,
+                           IndexedGFF.get_gff_stamp(gff_filename))):
+        indexed_gff = IndexedGFF.IndexedGFF(gff_filename)
+        INDEXED_GFFS[gff_filename] = indexed_gff
+    return indexed_gff
+
+
 def get_events_in_region(gff_filename, region,
                          record_types=["gene"]):
     """
@@ -231,42 +249,46 @@ def get_events_in_region(gff_filename, region,
 
     record_types is a list of GFF records to collect (e.g. gene, mRNA, ...)
     """
-    gff_db = gff_utils.GFFDatabase(from_filename=gff_filename,
-                                   reverse_recs=True)
     # Parse the query region
     parsed_region = parse_query_region(region)
     query_chrom, query_start, query_end, \
         query_strand = parsed_region
-    matched_records = []
-    num_recs = 0
-    for record in gff_db:
-        chrom = record.seqid
-        # Name
-        name = record.type
-        start, end = int(record.start), int(record.end)
-        strand = record.strand
-        # Skip GFF records that don't match our record types
-        if name not in record_types:
-            continue
-        num_recs += 1
-        # Check that there is intersection
-        if (query_chrom != chrom) or \
-            (not utils.intersect_coords(query_start, query_end,
-                                        start, end)):
-            # Skip if chromosomes don't match or if there's no intersection
-            continue
-        # If strand is supplied in query region, check that
-        # the strand matches 
-        if (query_strand is not None) and \
-            (strand != query_strand):
-            continue
-        # Must match
+    # Look up the region in the GFF's index rather than scanning
+    # all of its records
+    indexed_gff = get_indexed_gff(gff_filename)
+    matched_records = \
+        indexed_gff.get_records_in_region(query_chrom, query_start, query_end,
+                                          strand=query_strand,
+                                          record_types=record_types)
+    for record in matched_records:
         record_id = record.get_id()
         print "%s" %(record_id)
         print "  - ", record
-        matched_records.append(record)
-    print "Looked through %d records." %(num_recs)
+    print "Found %d matching records." %(len(matched_records))
     return matched_records
+
+
+def get_events_in_regions(gff_filename, regions,
+                          record_types=["gene"]):
+    """
+    Return the entries of record_types in a given GFF file that
+    intersect each of a list of regions (in the format of
+    get_events_in_region, e.g. chr1:100-200:+), as a list of lists
+    of records, one per region. All regions are intersected with
+    the GFF's index at once.
+    """
+    parsed_regions = [parse_query_region(region) for region in regions]
+    indexed_gff = get_indexed_gff(gff_filename)
+    region_recs = \
+        indexed_gff.get_records_in_regions([region[0] for region in parsed_regions],
+                                           [region[1] for region in parsed_regions],
+                                           [region[2] for region in parsed_regions],
+                                           strands=[region[3] \
+                                                    for region in parsed_regions],
+                                           record_types=record_types)
+    print "Found %d matching records in %d regions." \
+        %(sum(len(recs) for recs in region_recs), len(regions))
+    return region_recs
         
 
 def main():
@@ -14,10 +14,13 @@ import pandas
 
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.tables as tables
+import rnaseqlib.bam.insert_len_utils as insert_len_utils
 import rnaseqlib.miso.misowrap_settings as misowrap_settings
 import rnaseqlib.miso.PsiTable as pt
 import rnaseqlib.miso.MISOWrap as mw
 import rnaseqlib.miso.miso_utils as miso_utils
+import rnaseqlib.miso.psi_screen_utils as psi_screen_utils
 import rnaseqlib.cluster_utils.cluster as cluster
 import rnaseqlib.pandas_utils as pandas_utils
 
@@ -331,12 +334,19 @@ def filter_comparisons(settings,
 
 @arg("settings", help="misowrap settings filename.")
 @arg("logs-outdir", help="directory where to place logs.")
+@arg("--output-dir", help="Directory where to place insert length files. "
+     "Defaults to \'insert_lens_dir\' from settings.")
+@arg("--max-pairs", help="Maximum number of read pairs to sample per BAM.",
+     type=int)
+@arg("--min-exon-len", help="Minimum length of constitutive exons to use.",
+     type=int)
 @arg("--dry-run", help="Dry run. Do not execute any jobs or commands.")
-@arg("--use-cluster", help="Use cluster.")
 def compute_insert_lens(settings,
-                        output_dir,
-                        dry_run=False,
-                        use_cluster=True):
+                        logs_outdir,
+                        output_dir=None,
+                        max_pairs=100000,
+                        min_exon_len=500,
+                        dry_run=False):
     """
     Compute insert lengths for all samples.
     """
@@ -345,31 +355,139 @@ def compute_insert_lens(settings,
     misowrap_obj = mw.MISOWrap(settings_filename,
                                logs_outdir,
                                logger_label="insert_lens")
-    const_exons_gff = misowrap_obj.const_exons_gff
-    if not os.path.isfile(const_exons_gff):
-        print "Error: %s const exons GFF does not exist." \
-            %(const_exons_gff)
+    if output_dir is None:
+        output_dir = misowrap_obj.insert_lens_dir
+    if output_dir is None:
+        print "Error: need an output directory or \'insert_lens_dir\' " \
+              "in settings."
+        sys.exit(1)
+    output_dir = utils.pathify(output_dir)
+    utils.make_dir(output_dir)
+    # Use the constitutive exons index
+    const_exons = \
+        tables.ConstExons("ensGene",
+                          from_dir=os.path.dirname(misowrap_obj.const_exons_gff))
+    if not const_exons.found:
+        print "Error: cannot load constitutive exons from %s" \
+            %(os.path.dirname(misowrap_obj.const_exons_gff))
         sys.exit(1)
-    pe_utils_path = misowrap_obj.pe_utils_cmd 
-    insert_len_output_dir = os.path.join(output_dir, "insert_lens")
+    regions = insert_len_utils.get_const_exon_regions(const_exons,
+                                                      min_exon_len=min_exon_len)
     num_bams = len(misowrap_obj.bam_files)
-    
     print "Computing insert lengths for %d files" %(num_bams)
+    print "  - Using %d constitutive exons" %(len(regions))
     for bam_filename, sample_name in misowrap_obj.bam_files:
+        bam_filename = utils.pathify(bam_filename)
         print "Processing: %s" %(bam_filename)
-        insert_len_cmd = "%s --compute-insert-len %s %s --output-dir %s" \
-            %(pe_utils_path,
-              bam_filename,
-              const_exons_gff,
-              insert_len_output_dir)
-        print "Executing: %s" %(insert_len_cmd)
-        job_name = "%s_insert_len" %(sample_name)
-        if use_cluster:
-            misowrap_obj.my_cluster.launch_job(insert_len_cmd,
-                                               job_name,
-                                               ppn=1)
-        else:
-            os.system(insert_len_cmd)
+        insert_len_filename = \
+            os.path.join(output_dir,
+                         "%s.insert_len" %(os.path.basename(bam_filename)))
+        if dry_run:
+            continue
+        t1 = time.time()
+        insert_len_dist = \
+            insert_len_utils.compute_insert_lens(bam_filename,
+                                                 regions,
+                                                 max_pairs=max_pairs)
+        if insert_len_dist is None:
+            print "WARNING: no properly paired mates in %s. Skipping..." \
+                %(bam_filename)
+            continue
+        insert_len_utils.output_insert_lens(insert_len_dist,
+                                            insert_len_filename)
+        t2 = time.time()
+        print "  - mean=%.1f, sdev=%.1f, num_pairs=%d (%.2f secs)" \
+            %(insert_len_dist["mean"],
+              insert_len_dist["sdev"],
+              insert_len_dist["num_pairs"],
+              t2 - t1)
+
+
+@arg("settings", help="misowrap settings filename.")
+@arg("logs-outdir", help="Directory where to place logs.")
+@arg("events-gff-dir", help="Directory of events GFF3 files, as made by "
+     "gff_make_annotation.")
+@arg("--output-dir", help="Directory where to place screening output. "
+     "Defaults to \'screen\' in the MISO output directory.")
+@arg("--min-counts", help="Minimum number of inclusion and exclusion reads "
+     "for an event to be covered in a sample.", type=int)
+@arg("--min-delta-psi", help="Minimum difference in Psi between covered "
+     "samples for an event to pass screening.", type=float)
+@arg("--event-types", help="Event types to screen.", nargs='+', type=str)
+def screen_psi(settings,
+               logs_outdir,
+               events_gff_dir,
+               output_dir=None,
+               min_counts=20,
+               min_delta_psi=0.1,
+               event_types=None):
+    """
+    Screen events by Psi estimates computed from read counts,
+    without running MISO.
+
+    Outputs a MISO-style summary file for each sample and event
+    type (loadable by PsiTable), and a GFF3 file of the events that
+    pass the coverage and variability filter for each event type,
+    to run MISO on.
+    """
+    settings_filename = utils.pathify(settings)
+    misowrap_obj = mw.MISOWrap(settings_filename,
+                               logs_outdir,
+                               logger_label="screen")
+    if output_dir is None:
+        output_dir = os.path.join(misowrap_obj.miso_outdir, "screen")
+    output_dir = utils.pathify(output_dir)
+    utils.make_dir(output_dir)
+    events_gff_dir = utils.pathify(events_gff_dir)
+    gff_filenames = glob.glob(os.path.join(events_gff_dir, "*.gff3"))
+    if len(gff_filenames) == 0:
+        print "Error: no GFF3 files in %s" %(events_gff_dir)
+        sys.exit(1)
+    for gff_filename in gff_filenames:
+        event_type = os.path.basename(gff_filename).split(".")[0]
+        if event_types is not None and event_type not in event_types:
+            print "Skipping event type: %s" %(event_type)
+            continue
+        events = psi_screen_utils.load_two_isoform_events(gff_filename)
+        misowrap_obj.logger.info("Screening %d %s events from %s" \
+                                 %(len(events), event_type, gff_filename))
+        samples_event_psis = []
+        for bam_filename, sample_label in misowrap_obj.bam_files:
+            bam_filename = utils.pathify(bam_filename)
+            read_len = \
+                int(get_read_len(sample_label, misowrap_obj.read_len))
+            t1 = time.time()
+            event_psis = psi_screen_utils.screen_events(bam_filename,
+                                                        events,
+                                                        read_len)
+            samples_event_psis.append(event_psis)
+            summary_dir = os.path.join(output_dir,
+                                       sample_label,
+                                       event_type,
+                                       "summary")
+            utils.make_dir(summary_dir)
+            summary_filename = os.path.join(summary_dir,
+                                            "%s.miso_summary" %(event_type))
+            psi_screen_utils.output_screen_summary(events, event_psis,
+                                                   summary_filename)
+            t2 = time.time()
+            misowrap_obj.logger.info("  - %s: %s (%.2f secs)" \
+                                     %(sample_label, summary_filename,
+                                       t2 - t1))
+        screened_event_ids = \
+            psi_screen_utils.get_screened_events(events,
+                                                 samples_event_psis,
+                                                 min_counts=min_counts,
+                                                 min_delta_psi=min_delta_psi)
+        screened_gff_filename = \
+            os.path.join(output_dir,
+                         "%s.screened.gff3" %(event_type))
+        misowrap_obj.logger.info("%d of %d %s events passed screening: %s" \
+                                 %(len(screened_event_ids), len(events),
+                                   event_type, screened_gff_filename))
+        psi_screen_utils.output_events_gff(gff_filename,
+                                           screened_event_ids,
+                                           screened_gff_filename)
 
 
 @arg("settings", help="misowrap settings filename.")
@@ -494,6 +612,8 @@ def main():
         compare,
         filter_comparisons,
         combine_comparisons,
+        compute_insert_lens,
+        screen_psi,
     ])
     # from optparse import OptionParser
     # parser = OptionParser()
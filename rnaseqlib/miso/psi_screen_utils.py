@@ -0,0 +1,324 @@
+##
+## Fast screening of alternative events by Psi estimates from
+## read counts, to select the events worth running MISO on.
+##
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.rpkm.transcript_utils as transcript_utils
+
+SUMMARY_HEADER = ["event_name", "miso_posterior_mean", "ci_low", "ci_high",
+                  "isoforms", "counts", "assigned_counts", "chrom",
+                  "strand", "mRNA_starts", "mRNA_ends"]
+
+
+def load_two_isoform_events(gff_filename):
+    """
+    Load events with two isoforms from an events GFF3 file (as
+    made by gff_make_annotation).
+
+    Returns a list of events as dictionaries with the event's
+    'event_id', 'chrom', 'strand', 'mRNA_ids', 'mRNA_starts',
+    'mRNA_ends' and the 'exons' of each mRNA.
+    """
+    events = []
+    events_by_id = {}
+    mRNAs_to_events = {}
+    with open(gff_filename) as gff_in:
+        for line in gff_in:
+            if line.startswith("#"):
+                continue
+            fields = line.strip().split("\t")
+            if len(fields) < 9:
+                continue
+            chrom, rec_type = fields[0], fields[2]
+            start, end, strand = int(fields[3]), int(fields[4]), fields[6]
+            attributes = utils.parse_attributes(fields[8])
+            if rec_type == "gene":
+                event = {"event_id": attributes["ID"],
+                         "chrom": chrom,
+                         "strand": strand,
+                         "mRNA_ids": [],
+                         "mRNA_starts": [],
+                         "mRNA_ends": [],
+                         "exons": []}
+                events.append(event)
+                events_by_id[event["event_id"]] = event
+            elif rec_type == "mRNA":
+                event = events_by_id[attributes["Parent"]]
+                mRNAs_to_events[attributes["ID"]] = \
+                    (event, len(event["mRNA_ids"]))
+                event["mRNA_ids"].append(attributes["ID"])
+                event["mRNA_starts"].append(start)
+                event["mRNA_ends"].append(end)
+                event["exons"].append([])
+            elif rec_type == "exon":
+                event, mRNA_num = mRNAs_to_events[attributes["Parent"]]
+                event["exons"][mRNA_num].append((start, end))
+    return [event for event in events if len(event["mRNA_ids"]) == 2]
+
+
+def get_isoform_positions(exon_coords):
+    """
+    Return the genomic positions of an isoform's exons, in order.
+    """
+    return np.concatenate([np.arange(start, end + 1) \
+                           for start, end in sorted(exon_coords)])
+
+
+def get_num_unique_placements(iso_positions, other_positions, read_len):
+    """
+    Return the number of positions at which a read of length
+    'read_len' can be placed on an isoform such that it is not
+    compatible with the other isoform, given the genomic positions
+    of both isoforms (see get_isoform_positions).
+    """
+    num_placements = len(iso_positions) - read_len + 1
+    if num_placements <= 0:
+        return 0
+    # Index of each isoform position in the other isoform
+    other_inds = np.searchsorted(other_positions, iso_positions)
+    other_inds = np.minimum(other_inds, len(other_positions) - 1)
+    in_other = (other_positions[other_inds] == iso_positions)
+    # Number of positions not in the other isoform in each placement
+    not_in_other = np.concatenate([[0], np.cumsum(~in_other)])
+    placement_not_in_other = \
+        not_in_other[read_len:] - not_in_other[:num_placements]
+    # A placement is shared if all its positions are consecutive
+    # in the other isoform
+    placement_span = other_inds[read_len - 1:] - other_inds[:num_placements]
+    shared = (placement_not_in_other == 0) & (placement_span == read_len - 1)
+    return num_placements - shared.sum()
+
+
+def get_events_unique_lens(events, read_len):
+    """
+    Return the number of read placements unique to the first
+    and to the second isoform of each event, as two arrays.
+    """
+    inc_lens = np.zeros(len(events), dtype=np.int64)
+    exc_lens = np.zeros(len(events), dtype=np.int64)
+    for event_num, event in enumerate(events):
+        inc_positions = get_isoform_positions(event["exons"][0])
+        exc_positions = get_isoform_positions(event["exons"][1])
+        inc_lens[event_num] = \
+            get_num_unique_placements(inc_positions, exc_positions, read_len)
+        exc_lens[event_num] = \
+            get_num_unique_placements(exc_positions, inc_positions, read_len)
+    return inc_lens, exc_lens
+
+
+def count_event_reads(bam_filename, events):
+    """
+    Count the reads of a BAM file compatible with each isoform
+    of two-isoform events.
+
+    Reads are assigned to the isoforms they are compatible with
+    (see transcript_utils.TranscriptIndex), so both junction and
+    exon body reads are counted.
+
+    Returns an (events x 3) array of counts of reads compatible
+    with only the first isoform (inclusion), only the second
+    isoform (exclusion) and both isoforms.
+    """
+    num_events = len(events)
+    trans_records = []
+    for event in events:
+        for mRNA_id, exon_coords in zip(event["mRNA_ids"], event["exons"]):
+            trans_records.append((event["event_id"], mRNA_id,
+                                  event["chrom"], exon_coords))
+    trans_index = transcript_utils.TranscriptIndex(trans_records)
+    equiv_counts, num_unassigned = \
+        transcript_utils.count_equiv_classes(bam_filename, trans_index)
+    event_counts = np.zeros((num_events, 3), dtype=np.int64)
+    if len(equiv_counts) == 0:
+        return event_counts
+    equiv_classes = equiv_counts.keys()
+    class_counts = np.array([equiv_counts[c] for c in equiv_classes],
+                            dtype=np.int64)
+    class_sizes = np.array([len(c) for c in equiv_classes], dtype=np.int64)
+    # Flattened (class, isoform) pairs. Isoforms of event i
+    # have indices 2i and 2i + 1
+    pair_classes = np.repeat(np.arange(len(equiv_classes)), class_sizes)
+    pair_trans = np.concatenate([np.array(c, dtype=np.int64) \
+                                 for c in equiv_classes])
+    # Isoforms of each event a class is compatible with, as a
+    # bit mask: 1 for the first isoform only, 2 for the second
+    # only, 3 for both
+    class_events, pair_keys = \
+        np.unique(pair_classes * num_events + pair_trans // 2,
+                  return_inverse=True)
+    event_masks = np.bincount(pair_keys, weights=1 << (pair_trans % 2))
+    event_masks = event_masks.astype(np.int64)
+    np.add.at(event_counts,
+              (class_events % num_events, event_masks - 1),
+              class_counts[class_events // num_events])
+    return event_counts
+
+
+def inc_frac_to_psi(inc_frac, inc_lens, exc_lens):
+    """
+    Convert the fraction of inclusion reads to Psi, given the
+    number of read placements unique to each isoform.
+    """
+    inc_rate = inc_frac / inc_lens
+    exc_rate = (1. - inc_frac) / exc_lens
+    return inc_rate / (inc_rate + exc_rate)
+
+
+def compute_psi(inc_counts, exc_counts, inc_lens, exc_lens, z=1.96):
+    """
+    Estimate Psi for events from inclusion and exclusion read
+    counts, normalized by the number of read placements unique
+    to each isoform.
+
+    The confidence interval is a Wilson binomial interval on the
+    fraction of inclusion reads, converted to Psi.
+
+    Returns arrays of Psi and its confidence interval, with NaN
+    for events without inclusion or exclusion reads or unique
+    placements.
+    """
+    inc_counts = np.asarray(inc_counts, dtype=np.float64)
+    exc_counts = np.asarray(exc_counts, dtype=np.float64)
+    inc_lens = np.asarray(inc_lens, dtype=np.float64)
+    exc_lens = np.asarray(exc_lens, dtype=np.float64)
+    num_reads = inc_counts + exc_counts
+    valid = (num_reads > 0) & (inc_lens > 0) & (exc_lens > 0)
+    inc_counts[~valid] = 0.
+    num_reads[~valid] = 1.
+    inc_lens[~valid] = 1.
+    exc_lens[~valid] = 1.
+    inc_frac = inc_counts / num_reads
+    denom = 1. + (z**2 / num_reads)
+    center = (inc_frac + (z**2 / (2. * num_reads))) / denom
+    half_width = \
+        z * np.sqrt((inc_frac * (1. - inc_frac) / num_reads) + \
+                    (z**2 / (4. * num_reads**2))) / denom
+    psi = inc_frac_to_psi(inc_frac, inc_lens, exc_lens)
+    ci_low = inc_frac_to_psi(np.maximum(center - half_width, 0.),
+                             inc_lens, exc_lens)
+    ci_high = inc_frac_to_psi(np.minimum(center + half_width, 1.),
+                              inc_lens, exc_lens)
+    for vals in (psi, ci_low, ci_high):
+        vals[~valid] = np.nan
+    return psi, ci_low, ci_high
+
+
+def screen_events(bam_filename, events, read_len):
+    """
+    Compute read counts and Psi estimates for two-isoform events
+    from a BAM file.
+
+    Returns a dictionary of arrays: the 'counts' (see
+    count_event_reads), 'psi', 'ci_low' and 'ci_high'.
+    """
+    event_counts = count_event_reads(bam_filename, events)
+    inc_lens, exc_lens = get_events_unique_lens(events, read_len)
+    psi, ci_low, ci_high = compute_psi(event_counts[:, 0],
+                                       event_counts[:, 1],
+                                       inc_lens, exc_lens)
+    return {"counts": event_counts,
+            "psi": psi,
+            "ci_low": ci_low,
+            "ci_high": ci_high}
+
+
+def output_screen_summary(events, event_psis, output_filename,
+                          na_val="NA"):
+    """
+    Output event Psi estimates in the format of MISO summary
+    files, so that they can be loaded by PsiTable.
+
+    Counts are given per MISO read class: (1,0) for inclusion,
+    (0,1) for exclusion and (1,1) for reads compatible with both
+    isoforms. Assigned counts are the inclusion and exclusion reads.
+    """
+    event_counts = event_psis["counts"]
+    with open(output_filename, "w") as summary_out:
+        summary_out.write("%s\n" %("\t".join(SUMMARY_HEADER)))
+        for event_num, event in enumerate(events):
+            inc_count, exc_count, both_count = event_counts[event_num]
+            psi_vals = []
+            for psi_key in ("psi", "ci_low", "ci_high"):
+                psi_val = event_psis[psi_key][event_num]
+                if np.isnan(psi_val):
+                    psi_vals.append(na_val)
+                else:
+                    psi_vals.append("%.2f" %(psi_val))
+            counts_str = "(0,1):%d,(1,0):%d,(1,1):%d" \
+                %(exc_count, inc_count, both_count)
+            assigned_str = "0:%d,1:%d" %(inc_count, exc_count)
+            isoforms_str = ",".join(["\'%s\'" %(mRNA_id) \
+                                     for mRNA_id in event["mRNA_ids"]])
+            fields = [event["event_id"]] + psi_vals + \
+                     [isoforms_str,
+                      counts_str,
+                      assigned_str,
+                      event["chrom"],
+                      event["strand"],
+                      ",".join(map(str, event["mRNA_starts"])),
+                      ",".join(map(str, event["mRNA_ends"]))]
+            summary_out.write("%s\n" %("\t".join(fields)))
+
+
+def get_screened_events(events, samples_event_psis,
+                        min_counts=20,
+                        min_delta_psi=0.1):
+    """
+    Return the IDs of events that pass a coverage and variability
+    filter: events with at least 'min_counts' inclusion and
+    exclusion reads in at least one sample, and (if there are
+    several samples) a difference of at least 'min_delta_psi'
+    between the Psi estimates of covered samples.
+    """
+    num_events = len(events)
+    covered = np.zeros((len(samples_event_psis), num_events), dtype=bool)
+    psis = np.zeros((len(samples_event_psis), num_events))
+    for sample_num, event_psis in enumerate(samples_event_psis):
+        event_counts = event_psis["counts"]
+        covered[sample_num] = \
+            ((event_counts[:, 0] + event_counts[:, 1]) >= min_counts) & \
+            (~np.isnan(event_psis["psi"]))
+        psis[sample_num] = event_psis["psi"]
+    passed = covered.any(axis=0)
+    if len(samples_event_psis) > 1:
+        max_psis = np.where(covered, psis, -np.inf).max(axis=0)
+        min_psis = np.where(covered, psis, np.inf).min(axis=0)
+        passed &= (max_psis - min_psis) >= min_delta_psi
+    return [events[event_num]["event_id"] \
+            for event_num in np.nonzero(passed)[0]]
+
+
+def output_events_gff(gff_filename, event_ids, output_filename):
+    """
+    Output the records of the given events from an events GFF3
+    file to a new GFF3 file.
+    """
+    event_ids = set(event_ids)
+    mRNAs_to_events = {}
+    with open(gff_filename) as gff_in:
+        with open(output_filename, "w") as gff_out:
+            for line in gff_in:
+                if line.startswith("#"):
+                    gff_out.write(line)
+                    continue
+                fields = line.strip().split("\t")
+                if len(fields) < 9:
+                    continue
+                attributes = utils.parse_attributes(fields[8])
+                if fields[2] == "gene":
+                    event_id = attributes["ID"]
+                elif fields[2] == "mRNA":
+                    event_id = attributes["Parent"]
+                    mRNAs_to_events[attributes["ID"]] = event_id
+                else:
+                    event_id = mRNAs_to_events.get(attributes["Parent"])
+                if event_id in event_ids:
+                    gff_out.write(line)
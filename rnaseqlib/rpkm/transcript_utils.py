@@ -0,0 +1,353 @@
+##
+## Utilities for transcript-level quantification: reads are
+## assigned to the set of transcripts they are compatible with,
+## collapsed into equivalence classes and transcript abundances
+## are estimated by EM over the classes.
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.genes.GeneStore as GeneStore
+
+# CIGAR operations
+BAM_CMATCH = 0
+BAM_CINS = 1
+BAM_CDEL = 2
+BAM_CREF_SKIP = 3
+BAM_CEQUAL = 7
+BAM_CDIFF = 8
+
+TPM_TABLE_HEADER = ["transcript_id", "gene_id", "length",
+                    "eff_length", "est_counts", "tpm"]
+
+
+def get_gene_trans_records(genes):
+    """
+    Return transcript records for a TranscriptIndex from genes,
+    a mapping from gene IDs to GeneModel.Gene objects or a
+    GeneStore.GeneStore.
+    """
+    if isinstance(genes, GeneStore.GeneStore):
+        return get_store_trans_records(genes)
+    trans_records = []
+    for gene_id in sorted(genes.keys()):
+        gene = genes[gene_id]
+        for transcript in gene.transcripts:
+            exon_coords = [(part.start, part.end) for part in transcript.parts]
+            trans_records.append((gene_id, transcript.label,
+                                  transcript.chrom, exon_coords))
+    return trans_records
+
+
+def get_store_trans_records(gene_store):
+    """
+    Return transcript records for a TranscriptIndex from a
+    GeneStore.GeneStore, read off its arrays.
+    """
+    trans_records = []
+    gene_ids = gene_store.gene_ids.tolist()
+    trans_ids = gene_store.trans_ids.tolist()
+    chroms = gene_store.chroms.tolist()
+    gene_offsets = gene_store.gene_offsets.tolist()
+    exon_offsets = gene_store.exon_offsets.tolist()
+    exon_starts = gene_store.exon_starts.tolist()
+    exon_ends = gene_store.exon_ends.tolist()
+    for gene_num in np.argsort(gene_store.gene_ids, kind="mergesort"):
+        gene_id = gene_ids[gene_num]
+        for trans_num in xrange(gene_offsets[gene_num],
+                                gene_offsets[gene_num + 1]):
+            first_exon = exon_offsets[trans_num]
+            last_exon = exon_offsets[trans_num + 1]
+            exon_coords = zip(exon_starts[first_exon:last_exon],
+                              exon_ends[first_exon:last_exon])
+            trans_records.append((gene_id, trans_ids[trans_num],
+                                  chroms[trans_num], exon_coords))
+    return trans_records
+
+
+class TranscriptIndex:
+    """
+    Exons of a set of transcripts as arrays, for finding the
+    transcripts compatible with reads.
+
+    Takes a list of transcript records (gene_id, transcript_id,
+    chrom, exon_coords), where exon_coords is a list of (start, end)
+    tuples with 1-based coordinates.
+
+    Exons of each transcript are given consecutive exon indices
+    in order of their start coordinates, so that the exon
+    following exon i in its transcript is exon i + 1.
+    """
+    def __init__(self, trans_records):
+        # Transcripts and their genes, in order of transcript index
+        self.trans_ids = []
+        self.trans_genes = []
+        exon_chroms = []
+        exon_starts = []
+        exon_ends = []
+        exon_trans = []
+        for gene_id, trans_id, chrom, exon_coords in trans_records:
+            trans_num = len(self.trans_ids)
+            self.trans_ids.append(trans_id)
+            self.trans_genes.append(gene_id)
+            for start, end in sorted(exon_coords):
+                exon_chroms.append(chrom)
+                exon_starts.append(start)
+                exon_ends.append(end)
+                exon_trans.append(trans_num)
+        self.num_transcripts = len(self.trans_ids)
+        exon_chroms = np.array(exon_chroms)
+        # Pad exon arrays by one so that the "next exon" of
+        # the last exon can be looked up
+        self.exon_starts = np.append(np.array(exon_starts, dtype=np.int64), -1)
+        self.exon_ends = np.append(np.array(exon_ends, dtype=np.int64), -1)
+        self.exon_trans = np.append(np.array(exon_trans, dtype=np.int64), -1)
+        self.trans_lens = \
+            np.bincount(self.exon_trans[:-1],
+                        weights=self.exon_ends[:-1] - self.exon_starts[:-1] + 1,
+                        minlength=self.num_transcripts)
+        # Exon indices of each chromosome sorted by start, for
+        # finding the exons that contain a position
+        self.chrom_exons = {}
+        for chrom in np.unique(exon_chroms):
+            chrom_inds = np.nonzero(exon_chroms == chrom)[0]
+            chrom_inds = \
+                chrom_inds[np.argsort(self.exon_starts[chrom_inds],
+                                      kind="mergesort")]
+            exon_lens = self.exon_ends[chrom_inds] - \
+                        self.exon_starts[chrom_inds] + 1
+            self.chrom_exons[chrom] = (chrom_inds,
+                                       self.exon_starts[chrom_inds],
+                                       exon_lens.max())
+
+
+    def get_containing_exons(self, chrom, start, end):
+        """
+        Return the indices of exons that contain the given
+        interval (1-based, inclusive coordinates).
+        """
+        if chrom not in self.chrom_exons:
+            return np.zeros(0, dtype=np.int64)
+        chrom_inds, chrom_starts, max_exon_len = self.chrom_exons[chrom]
+        first_ind = np.searchsorted(chrom_starts, end - max_exon_len + 1,
+                                    side="left")
+        last_ind = np.searchsorted(chrom_starts, start, side="right")
+        exon_inds = chrom_inds[first_ind:last_ind]
+        return exon_inds[self.exon_ends[exon_inds] >= end]
+
+
+    def get_compatible_transcripts(self, chrom, read_blocks):
+        """
+        Return the indices of transcripts compatible with a read's
+        aligned blocks, a list of (start, end) tuples separated by
+        junctions (see get_read_blocks).
+
+        Each block must be contained in an exon of the transcript,
+        and blocks on either side of a junction must end and start
+        at the boundaries of consecutive exons of the transcript.
+        """
+        first_start, first_end = read_blocks[0]
+        exon_inds = self.get_containing_exons(chrom, first_start, first_end)
+        prev_end = first_end
+        for start, end in read_blocks[1:]:
+            if len(exon_inds) == 0:
+                break
+            next_inds = exon_inds + 1
+            compatible = \
+                (self.exon_trans[next_inds] == self.exon_trans[exon_inds]) & \
+                (self.exon_ends[exon_inds] == prev_end) & \
+                (self.exon_starts[next_inds] == start) & \
+                (self.exon_ends[next_inds] >= end)
+            exon_inds = next_inds[compatible]
+            prev_end = end
+        return self.exon_trans[exon_inds]
+
+
+    def get_eff_lens(self, frag_len):
+        """
+        Return the effective lengths of transcripts: the number of
+        positions a fragment of length 'frag_len' can start at,
+        and at least 1.
+        """
+        return np.maximum(self.trans_lens - frag_len + 1, 1)
+
+
+def get_read_blocks(read):
+    """
+    Return the blocks of a read separated by junctions, as a
+    list of (start, end) tuples in 1-based coordinates.
+    Deletions and insertions do not split blocks.
+    """
+    read_blocks = []
+    ref_pos = read.pos
+    block_start = None
+    for op, op_len in read.cigar:
+        if op in (BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF, BAM_CDEL):
+            if block_start is None:
+                block_start = ref_pos
+            ref_pos += op_len
+        elif op == BAM_CREF_SKIP:
+            if block_start is not None:
+                read_blocks.append((block_start + 1, ref_pos))
+                block_start = None
+            ref_pos += op_len
+    if block_start is not None:
+        read_blocks.append((block_start + 1, ref_pos))
+    return read_blocks
+
+
+def count_equiv_classes(bam_filename, trans_index):
+    """
+    Collapse the reads of a BAM file into equivalence classes:
+    sets of transcripts that reads are compatible with. The mates
+    of a read pair are compatible with the transcripts compatible
+    with both mates.
+
+    Secondary alignments are skipped, so a BAM of uniquely
+    mapping reads should be used.
+
+    Returns a mapping from equivalence classes (tuples of
+    transcript indices) to read counts, and the number of reads
+    that were compatible with no transcript.
+    """
+    equiv_counts = {}
+    num_unassigned = 0
+    # Compatible transcripts of mates seen so far
+    pending_mates = {}
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    references = bam_file.references
+    for read in bam_file:
+        if read.is_unmapped or read.is_secondary:
+            continue
+        read_blocks = get_read_blocks(read)
+        if len(read_blocks) == 0:
+            continue
+        trans_inds = \
+            trans_index.get_compatible_transcripts(references[read.tid],
+                                                   read_blocks)
+        if read.is_paired and (not read.mate_is_unmapped):
+            # Wait for the mate
+            if read.qname not in pending_mates:
+                pending_mates[read.qname] = trans_inds
+                continue
+            trans_inds = np.intersect1d(pending_mates.pop(read.qname),
+                                        trans_inds)
+        if len(trans_inds) == 0:
+            num_unassigned += 1
+            continue
+        equiv_class = tuple(np.unique(trans_inds))
+        equiv_counts[equiv_class] = equiv_counts.get(equiv_class, 0) + 1
+    bam_file.close()
+    # Mates whose pair was not found are counted singly
+    for trans_inds in pending_mates.itervalues():
+        if len(trans_inds) == 0:
+            num_unassigned += 1
+            continue
+        equiv_class = tuple(np.unique(trans_inds))
+        equiv_counts[equiv_class] = equiv_counts.get(equiv_class, 0) + 1
+    return equiv_counts, num_unassigned
+
+
+def run_em(equiv_counts, eff_lens,
+           max_iters=5000,
+           tol=1e-8):
+    """
+    Estimate the number of reads from each transcript from
+    equivalence class counts, by EM.
+
+    In each iteration, the reads of each class are split among its
+    transcripts in proportion to their abundance divided by their
+    effective length. The computation is vectorized over all
+    (class, transcript) pairs.
+
+    Returns the estimated read counts of each transcript.
+    """
+    num_transcripts = len(eff_lens)
+    num_classes = len(equiv_counts)
+    if num_classes == 0:
+        return np.zeros(num_transcripts)
+    equiv_classes = equiv_counts.keys()
+    class_counts = np.array([equiv_counts[c] for c in equiv_classes],
+                            dtype=np.float64)
+    class_sizes = np.array([len(c) for c in equiv_classes], dtype=np.int64)
+    # Flattened (class, transcript) pairs
+    pair_classes = np.repeat(np.arange(num_classes), class_sizes)
+    pair_trans = np.concatenate([np.array(c, dtype=np.int64) \
+                                 for c in equiv_classes])
+    pair_weights = 1. / eff_lens[pair_trans]
+    total_counts = class_counts.sum()
+    # Start from a uniform split of reads among transcripts
+    trans_counts = np.ones(num_transcripts) * (total_counts / num_transcripts)
+    for iter_num in range(max_iters):
+        pair_probs = trans_counts[pair_trans] * pair_weights
+        class_totals = np.bincount(pair_classes, weights=pair_probs,
+                                   minlength=num_classes)
+        pair_counts = class_counts[pair_classes] * pair_probs / \
+                      class_totals[pair_classes]
+        new_trans_counts = np.bincount(pair_trans, weights=pair_counts,
+                                       minlength=num_transcripts)
+        converged = \
+            (np.abs(new_trans_counts - trans_counts) <= \
+             tol * total_counts).all()
+        trans_counts = new_trans_counts
+        if converged:
+            break
+    return trans_counts
+
+
+def compute_tpms(trans_counts, eff_lens):
+    """
+    Return transcripts per million from estimated read counts
+    and effective lengths.
+    """
+    rates = trans_counts / eff_lens
+    if rates.sum() == 0:
+        return np.zeros(len(rates))
+    return 1e6 * rates / rates.sum()
+
+
+def quantify_transcripts(bam_filename, genes,
+                         frag_len=200):
+    """
+    Quantify transcripts of genes (a mapping from gene IDs to
+    GeneModel.Gene objects) from a BAM file of uniquely mapping
+    reads.
+
+    'frag_len' is the mean fragment length (the mean insert length
+    for paired-end reads, or the read length for single-end reads)
+    used in computing effective lengths.
+
+    Returns the TranscriptIndex, the estimated read counts and
+    TPMs of its transcripts.
+    """
+    trans_index = TranscriptIndex(get_gene_trans_records(genes))
+    equiv_counts, num_unassigned = \
+        count_equiv_classes(bam_filename, trans_index)
+    eff_lens = trans_index.get_eff_lens(frag_len)
+    trans_counts = run_em(equiv_counts, eff_lens)
+    tpms = compute_tpms(trans_counts, eff_lens)
+    return trans_index, trans_counts, tpms
+
+
+def output_tpms(trans_index, trans_counts, tpms, output_filename,
+                frag_len=200):
+    """
+    Output transcript read counts and TPMs as a tab-delimited table.
+    """
+    eff_lens = trans_index.get_eff_lens(frag_len)
+    with open(output_filename, "w") as tpms_out:
+        tpms_out.write("%s\n" %("\t".join(TPM_TABLE_HEADER)))
+        for trans_num, trans_id in enumerate(trans_index.trans_ids):
+            tpms_out.write("%s\t%s\t%d\t%d\t%.2f\t%.4f\n" \
+                           %(trans_id,
+                             trans_index.trans_genes[trans_num],
+                             trans_index.trans_lens[trans_num],
+                             eff_lens[trans_num],
+                             trans_counts[trans_num],
+                             tpms[trans_num]))
@@ -13,7 +13,12 @@ def load_settings(config_filename,
                               "paired_end_frag"],
                   # Boolean parameters
                   BOOL_PARAMS=["paired",
-                               "prefilter_miso"],
+                               "prefilter_miso",
+                               "count_jxns",
+                               "compute_insert_lens",
+                               "compute_saturation",
+                               "compute_tpms",
+                               "compute_intron_retention"],
                   STR_PARAMS=["indir",
                               "outdir",
                               "stranded",
@@ -0,0 +1,165 @@
+##
+## External merge sort of BED/GFF files by chromosome and
+## start (as sortBed), within a memory budget: chunks of the
+## input are sorted in memory, spilled to temporary files and
+## merged.
+##
+import os
+import sys
+import time
+import heapq
+import tempfile
+
+import rnaseqlib
+
+# Column of the start coordinate in each file format
+START_COLUMNS = {"bed": 1,
+                 "gff": 3}
+
+# Approximate memory used by a line in a chunk, besides its
+# characters: the string, its sort key and list entry
+LINE_OVERHEAD_BYTES = 200
+
+DEFAULT_MAX_MEM_MB = 1024
+
+
+def get_file_format(filename):
+    """
+    Guess the format of an intervals file from its extension:
+    'gff' for GFF/GTF files and 'bed' otherwise.
+    """
+    basename = filename
+    if basename.endswith(".gz"):
+        basename = basename[0:-3]
+    if os.path.splitext(basename)[1] in (".gff", ".gff3", ".gtf"):
+        return "gff"
+    return "bed"
+
+
+def is_header_line(line):
+    """
+    Return True if line is a header or comment line rather
+    than an interval.
+    """
+    return line.startswith("#") or line.startswith("track") or \
+           line.startswith("browser")
+
+
+def get_sort_key_func(file_format):
+    """
+    Return a function mapping an interval line to its sort key,
+    (chrom, start).
+    """
+    if file_format not in START_COLUMNS:
+        raise Exception, "Unknown file format %s" %(file_format)
+    start_col = START_COLUMNS[file_format]
+    def get_sort_key(line):
+        fields = line.split("\t", start_col + 1)
+        return (fields[0], int(fields[start_col]))
+    return get_sort_key
+
+
+def output_chunk(chunk, tmp_dir):
+    """
+    Write a sorted chunk of lines to a temporary file and
+    return its filename.
+    """
+    chunk_fd, chunk_fname = tempfile.mkstemp(prefix="sort_chunk.",
+                                             dir=tmp_dir)
+    with os.fdopen(chunk_fd, "w") as chunk_out:
+        chunk_out.writelines(chunk)
+    return chunk_fname
+
+
+def iter_keyed_lines(lines, get_sort_key, chunk_num):
+    """
+    Iterate through (key, chunk_num, line) tuples of sorted lines,
+    for merging chunks. The chunk number breaks ties between
+    chunks, so that the sort is stable.
+    """
+    for line in lines:
+        yield (get_sort_key(line), chunk_num, line)
+
+
+def iter_sorted_lines(lines,
+                      file_format="bed",
+                      max_mem_mb=DEFAULT_MAX_MEM_MB,
+                      tmp_dir=None):
+    """
+    Iterate through lines of a BED or GFF file sorted by chromosome
+    and start. Header lines come first, in their input order,
+    and blank lines are dropped.
+
+    Lines are read in chunks of at most about 'max_mem_mb'
+    megabytes, each sorted in memory. If the input fits in one
+    chunk it is sorted in memory; otherwise sorted chunks are
+    written to temporary files (in 'tmp_dir') and merged.
+    """
+    get_sort_key = get_sort_key_func(file_format)
+    max_mem_bytes = max_mem_mb * (1024 ** 2)
+    header_lines = []
+    chunk = []
+    chunk_bytes = 0
+    chunk_fnames = []
+    try:
+        for line in lines:
+            if line.strip() == "":
+                continue
+            if is_header_line(line):
+                header_lines.append(line)
+                continue
+            if not line.endswith("\n"):
+                line += "\n"
+            chunk.append(line)
+            chunk_bytes += len(line) + LINE_OVERHEAD_BYTES
+            if chunk_bytes >= max_mem_bytes:
+                chunk.sort(key=get_sort_key)
+                chunk_fnames.append(output_chunk(chunk, tmp_dir))
+                chunk = []
+                chunk_bytes = 0
+        chunk.sort(key=get_sort_key)
+        for line in header_lines:
+            yield line
+        if len(chunk_fnames) == 0:
+            for line in chunk:
+                yield line
+            return
+        # k-way merge of the spilled chunks and the last chunk
+        chunk_files = [open(chunk_fname) for chunk_fname in chunk_fnames]
+        keyed_chunks = [iter_keyed_lines(chunk_file, get_sort_key, chunk_num) \
+                        for chunk_num, chunk_file in enumerate(chunk_files)]
+        keyed_chunks.append(iter_keyed_lines(chunk, get_sort_key,
+                                             len(chunk_files)))
+        try:
+            for sort_key, chunk_num, line in heapq.merge(*keyed_chunks):
+                yield line
+        finally:
+            for chunk_file in chunk_files:
+                chunk_file.close()
+    finally:
+        for chunk_fname in chunk_fnames:
+            if os.path.isfile(chunk_fname):
+                os.remove(chunk_fname)
+
+
+def sort_file(input_filename, output_filename,
+              file_format=None,
+              max_mem_mb=DEFAULT_MAX_MEM_MB,
+              tmp_dir=None):
+    """
+    Sort a BED or GFF file by chromosome and start (see
+    iter_sorted_lines). The format is guessed from the input
+    filename if not given. Temporary files go in the output
+    file's directory by default.
+    """
+    if file_format is None:
+        file_format = get_file_format(input_filename)
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(output_filename))
+    with open(input_filename) as input_file:
+        with open(output_filename, "w") as output_file:
+            output_file.writelines(iter_sorted_lines(input_file,
+                                                     file_format=file_format,
+                                                     max_mem_mb=max_mem_mb,
+                                                     tmp_dir=tmp_dir))
+    return output_filename
@@ -10,6 +10,7 @@ import time
 import csv
 import subprocess
 import glob
+import gc
 
 import itertools
 import operator
@@ -18,11 +19,14 @@ import pandas
 
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.interval_utils as interval_utils
 import rnaseqlib.init as init
 import rnaseqlib.genes.exons as exons
 import rnaseqlib.gff
 import rnaseqlib.gff.gffutils_helpers as gffutils_helpers
+import rnaseqlib.gff.gtf_utils as gtf_utils
 import rnaseqlib.genes.GeneModel as GeneModel
+import rnaseqlib.genes.GeneStore as GeneStore
 
 from rnaseqlib.paths import *
 from rnaseqlib.init.genome_urls import *
@@ -53,9 +57,13 @@ UCSC_TABLE_LABELS = ["knownGene.txt.gz",
                      # tRNA tables
                      "tRNAs.txt.gz"]
 
+# Checksums of the files of a UCSC database directory, if available
+UCSC_MD5SUMS_FILENAME = "md5sum.txt"
+
 ##
 ## Default headers for UCSC tables (based on SQL schema)
-## Only used if the actual headers cannot be downloaded from mysql
+## Only used if the actual headers cannot be downloaded from the
+## table schemas (<table>.sql) of the UCSC database directory
 ## database
 ##
 UCSC_KGXREF_HEADER = \
@@ -175,11 +183,16 @@ def load_refGene_table_as_df(table_fname, header, sep="\t"):
 class GeneTable:
     """
     Parse gene table.
+
+    If 'annotation_index' is given (an AnnotationIndex.AnnotationIndex
+    of the table), gene models, names and descriptions are taken
+    from it instead of parsing the table.
     """
     def __init__(self, table_dir, source,
                  tables_only=False,
                  params={},
-                 headers=None):
+                 headers=None,
+                 annotation_index=None):
         self.table_dir = table_dir
         self.headers = headers
         self.exons_dir = os.path.join(self.table_dir, "exons")
@@ -193,6 +206,8 @@ class GeneTable:
         self.table = None
         self.genes = {}
         self.genes_list = []
+        # GeneStore of the genes, if loaded from an annotation index
+        self.gene_store = None
         self.na_val = "NA"
         self.params = params
         self.constitutive_exon_diff = 10
@@ -227,7 +242,10 @@ class GeneTable:
             self.headers["knownGene"] = UCSC_KNOWNGENE_HEADER
             self.headers["refGene"] = UCSC_REFGENE_HEADER
         # Load tables        
-        self.load_tables(tables_only=tables_only)
+        if annotation_index is not None:
+            self.load_annotation_index(annotation_index)
+        else:
+            self.load_tables(tables_only=tables_only)
         
 
     def init_dirs(self):
@@ -281,6 +299,24 @@ class GeneTable:
             self.load_refSeq_table(tables_only=tables_only)
 
         
+    def load_annotation_index(self, annotation_index):
+        """
+        Load genes from an annotation index rather than the table:
+        gene models as the index's GeneStore, and the names and
+        descriptions of genes.
+        """
+        print "Loading %s genes from annotation index %s" \
+            %(self.source, annotation_index.index_dir)
+        self.gene_store = annotation_index.genes
+        self.genes_list = self.gene_store.gene_ids.tolist()
+        self.genes_to_names.update(
+            itertools.izip(self.genes_list,
+                           annotation_index.gene_names.tolist()))
+        self.genes_to_desc.update(
+            itertools.izip(self.genes_list,
+                           annotation_index.gene_descs.tolist()))
+
+        
     def load_knownGene_table(self, tables_only=False):
         raise Exception, "Not implemented."
 
@@ -413,12 +449,16 @@ class GeneTable:
         # to avoid introducing into the table entries that have
         # kgXref info and a UCSC transcript name but *do not*
         # have an Ensembl transcript ID
-        self.table = pandas.merge(self.table, self.kgXref_table,
-                                  # use ensGene table keys 
-                                  how="left",
-                                  left_index=True,
-                                  left_on=["knownGene_name"],
-                                  right_on=["kgID"])
+        # The join is done by looking up each entry's UCSC transcript
+        # name in kgXref indexed by kgID, which is equivalent to a
+        # left merge but avoids building the merge's join indexer
+        kgXref_by_id = \
+            self.kgXref_table.drop_duplicates(subset=["kgID"]).set_index("kgID",
+                                                                         drop=False)
+        kgXref_cols = \
+            kgXref_by_id.reindex(self.table["knownGene_name"].values)
+        kgXref_cols.index = self.table.index
+        self.table = pandas.concat([self.table, kgXref_cols], axis=1)
         # Output combined table with kgXref
         self.output_ensGene_combined(self.table,
                                      "ensGene.kgXref.combined")
@@ -431,22 +471,19 @@ class GeneTable:
         ## and gene to description
         ##
         self.table_by_gene = defaultdict(list)
-        seen_genes = {}
-        for idx, series in self.table.iterrows():
-            gene_id = series["name2"]
-            gene_info = series.to_dict()
-            trans = gene_info["name"]
+        for gene_id, gene_info in itertools.izip(self.table["name2"].values,
+                                                 self.table.to_dict("records")):
             self.table_by_gene[gene_id].append(gene_info)
-            if gene_id in seen_genes:
-                continue
-            else:
-                self.genes_list.append(gene_id)
-                seen_genes[gene_id] = True
-                # Record mapping from gene to name via transcript
-                self.genes_to_names[gene_id] = gene_info[self.gene_symbol_field]
-                # Get Ensembl transcript's UCSC name and from that get
-                # the gene description
-                self.genes_to_desc[gene_id] = gene_info["description"]
+        # Gene names and descriptions are taken from the first
+        # transcript of each gene
+        first_entries = self.table.drop_duplicates(subset=["name2"])
+        self.genes_list.extend(first_entries["name2"].values)
+        self.genes_to_names.update(
+            itertools.izip(first_entries["name2"].values,
+                           first_entries[self.gene_symbol_field].values))
+        self.genes_to_desc.update(
+            itertools.izip(first_entries["name2"].values,
+                           first_entries["description"].values))
         # Parse table into actual gene objects if asked
         if not tables_only:
             self.genes = self.get_genes()
@@ -454,6 +491,69 @@ class GeneTable:
         self.output_lens_table("ensGene")
 
 
+    def get_representative_transcripts(self):
+        """
+        Return the representative transcript of each gene, taken
+        to be its longest mRNA.
+
+        Returns a list of (transcript_id, chrom, strand, exon_starts,
+        exon_ends) tuples, with 1-based exon coordinates.
+        """
+        rep_transcripts = []
+        if self.gene_store is not None:
+            return self.get_store_representative_transcripts()
+        if self.table_by_gene is None:
+            return rep_transcripts
+        for gene_id in self.genes_list:
+            rep_transcript = None
+            rep_len = -1
+            for trans_entry in self.table_by_gene[gene_id]:
+                exon_starts = \
+                    [int(start) + 1 \
+                     for start in trans_entry["exonStarts"].rstrip(",").split(",")]
+                exon_ends = \
+                    [int(end) \
+                     for end in trans_entry["exonEnds"].rstrip(",").split(",")]
+                trans_len = sum(exon_ends) - sum(exon_starts) + len(exon_starts)
+                if trans_len > rep_len:
+                    rep_len = trans_len
+                    rep_transcript = (trans_entry["name"],
+                                      trans_entry["chrom"],
+                                      trans_entry["strand"],
+                                      exon_starts,
+                                      exon_ends)
+            rep_transcripts.append(rep_transcript)
+        return rep_transcripts
+
+
+    def get_store_representative_transcripts(self):
+        """
+        Return the representative transcript of each gene of the
+        gene store (see get_representative_transcripts).
+        """
+        store = self.gene_store
+        exon_trans = np.repeat(np.arange(store.num_transcripts),
+                               np.diff(store.exon_offsets))
+        trans_lens = np.bincount(exon_trans,
+                                 weights=store.exon_ends - store.exon_starts + 1,
+                                 minlength=store.num_transcripts)
+        rep_transcripts = []
+        for gene_num in xrange(store.num_genes):
+            first_trans = store.gene_offsets[gene_num]
+            last_trans = store.gene_offsets[gene_num + 1]
+            # The first of the longest transcripts
+            trans_num = \
+                first_trans + np.argmax(trans_lens[first_trans:last_trans])
+            first_exon = store.exon_offsets[trans_num]
+            last_exon = store.exon_offsets[trans_num + 1]
+            rep_transcripts.append((str(store.trans_ids[trans_num]),
+                                    str(store.chroms[trans_num]),
+                                    str(store.strands[trans_num]),
+                                    store.exon_starts[first_exon:last_exon].tolist(),
+                                    store.exon_ends[first_exon:last_exon].tolist()))
+        return rep_transcripts
+
+
     def output_lens_table(self, table_basename):
         """
         Output the lengths table.
@@ -539,15 +639,20 @@ class GeneTable:
                   "for %s" %(self.source)
             
 
-    def get_genes(self):
+    def get_genes(self, as_store=False):
         """
         Load table into gene structures.
 
-        Return a generator.
+        If 'as_store' is True, return the genes as an array-backed
+        GeneStore.GeneStore rather than a dictionary of
+        GeneModel.Gene objects.
         """
         genes = None
         if self.source == "ensGene":
-            genes = self.get_ensGene_by_genes()
+            if as_store:
+                genes = self.get_ensGene_store()
+            else:
+                genes = self.get_ensGene_by_genes()
         else:
             raise Exception, "Not implemented."
         return genes
@@ -561,7 +666,17 @@ class GeneTable:
         return genes_by_id
             
 
-    def get_ensGene_by_genes(self, ensGene_filename=None):
+    def get_ensGene_by_genes(self, ensGene_filename=None,
+                             use_cache=True):
+        """
+        Load ensGene table into GeneModel.Gene objects, stored
+        in self.genes by gene ID.
+
+        The parsed table is cached as flat arrays in a binary
+        file in the table directory (see get_table_cache_filename),
+        keyed on the checksum of the table, so that later loads
+        of an unchanged table skip parsing it.
+        """
         print "Loading Ensembl table into genes..."
         # Main ensGene table
         if ensGene_filename is None:
@@ -571,49 +686,170 @@ class GeneTable:
             raise Exception, "Cannot find ensGene table %s" \
                 %(ensGene_filename)
         t1 = time.time()
-        table = dictread_groupby_col(open(ensGene_filename),
-                                     "name2",
-                                     delimiter="\t",
-                                     fieldnames=self.ensGene_header)
-        for gene_id, gene_entries in table.iteritems():
-            gene_symbol = self.na_val
-            all_transcripts = []
-            entries_copy = []
-            for entry in gene_entries:
-                entries_copy.append(entry)
-                chrom = entry["chrom"]
-                strand = entry["strand"]
-                # Convert start coordinates into 1-based coordinates
-                exon_starts = \
-                    (int(start) + 1 \
-                     for start in entry["exonStarts"].rstrip(",").split(","))
-                exon_ends = \
-                    (int(end) \
-                     for end in entry["exonEnds"].rstrip(",").split(","))
-                exon_coords = zip(exon_starts, exon_ends)
-                # Convert cds coordinates into 1-based as well
-                cds_start = int(entry["cdsStart"]) + 1
-                cds_end = int(entry["cdsEnd"])
-                transcript_id = entry["name"]
-                parts = [GeneModel.Part(exon[0], exon[1], chrom, strand,
-                                        parent=transcript_id) \
-                         for exon in exon_coords]
-                transcript = GeneModel.Transcript(parts, chrom, strand,
-                                                  label=transcript_id,
-                                                  cds_start=cds_start,
-                                                  cds_end=cds_end,
-                                                  parent=gene_id)
-                gene_symbol = self.trans_to_names[transcript_id]
-                all_transcripts.append(transcript)
-            gene_model = GeneModel.Gene(all_transcripts, chrom, strand,
-                                        label=gene_id,
-                                        gene_symbol=gene_symbol)
-            self.genes[gene_id] = gene_model
+        table_checksum = utils.get_file_checksum(ensGene_filename)
+        table_arrays = self.load_ensGene_arrays(ensGene_filename,
+                                                table_checksum,
+                                                use_cache=use_cache)
+        self.genes.update(self.get_genes_from_arrays(table_arrays))
         t2 = time.time()
         print "Loading took %.2f secs" %(t2 - t1)
         return self.genes
 
 
+    def load_ensGene_arrays(self, ensGene_filename, table_checksum,
+                            use_cache=True):
+        """
+        Return the ensGene table parsed into arrays (see
+        parse_ucsc_table_arrays), from the parsed table cache
+        if it matches the table's checksum.
+        """
+        cache_filename = self.get_table_cache_filename("ensGene")
+        table_arrays = None
+        if use_cache:
+            table_arrays = load_table_cache(cache_filename, table_checksum)
+        if table_arrays is not None:
+            print "  - Loaded parsed table from cache %s" %(cache_filename)
+        else:
+            table_arrays = parse_ucsc_table_arrays(ensGene_filename,
+                                                   self.headers["ensGene"],
+                                                   delimiter=self.delimiter)
+            if use_cache:
+                output_table_cache(table_arrays, cache_filename,
+                                   table_checksum)
+        return table_arrays
+
+
+    def get_ensGene_store(self, ensGene_filename=None):
+        """
+        Load ensGene table into an array-backed GeneStore.
+
+        The store is saved in the table directory, keyed on the
+        checksums of the table and of the kgXref table that gene
+        symbols come from (see get_ensGene_store_checksum), and
+        returned memory mapped, so that worker processes loading it
+        (see GeneStore.GeneStore.load) share its memory.
+        """
+        print "Loading Ensembl table into gene store..."
+        if ensGene_filename is None:
+            ensGene_filename = os.path.join(self.table_dir,
+                                            "ensGene.txt")
+        if not os.path.isfile(ensGene_filename):
+            raise Exception, "Cannot find ensGene table %s" \
+                %(ensGene_filename)
+        t1 = time.time()
+        store_dir = os.path.join(self.table_dir, "ensGene.store")
+        checksum_fname = os.path.join(store_dir, "checksum.txt")
+        table_checksum = utils.get_file_checksum(ensGene_filename)
+        gene_store_checksum = self.get_ensGene_store_checksum(table_checksum)
+        store_checksum = None
+        if os.path.isfile(checksum_fname):
+            store_checksum = open(checksum_fname).read().strip()
+        if store_checksum != gene_store_checksum:
+            table_arrays = self.load_ensGene_arrays(ensGene_filename,
+                                                    table_checksum)
+            gene_symbols = {}
+            for trans_id, gene_id in \
+                itertools.izip(table_arrays["trans_ids"].tolist(),
+                               table_arrays["gene_ids"].tolist()):
+                gene_symbols[gene_id] = self.trans_to_names[trans_id]
+            gene_store = \
+                GeneStore.GeneStore.from_table_arrays(table_arrays,
+                                                      gene_symbols=gene_symbols,
+                                                      na_val=self.na_val)
+            print "  - Saving gene store to %s" %(store_dir)
+            # Record the checksum only once the store is saved, so
+            # that a partly saved store is not mistaken for a
+            # complete one
+            if os.path.isfile(checksum_fname):
+                os.remove(checksum_fname)
+            gene_store.save(store_dir)
+            with open(checksum_fname, "w") as checksum_out:
+                checksum_out.write("%s\n" %(gene_store_checksum))
+        gene_store = GeneStore.GeneStore.load(store_dir)
+        t2 = time.time()
+        print "Loading took %.2f secs" %(t2 - t1)
+        return gene_store
+
+
+    def get_ensGene_store_checksum(self, table_checksum):
+        """
+        Return the checksum that the ensGene gene store is keyed
+        on: the checksum of the ensGene table combined with that
+        of the kgXref table, since the store's gene symbols are
+        taken from kgXref.
+        """
+        kgXref_filename = os.path.join(self.table_dir, "kgXref.txt")
+        kgXref_checksum = self.na_val
+        if os.path.isfile(kgXref_filename):
+            kgXref_checksum = utils.get_file_checksum(kgXref_filename)
+        return "%s,%s" %(table_checksum, kgXref_checksum)
+
+
+    def get_table_cache_filename(self, table_name):
+        """
+        Return the filename of the parsed table cache for a table.
+        """
+        return os.path.join(self.table_dir,
+                            "%s.parsed.npz" %(table_name))
+
+
+    def get_genes_from_arrays(self, table_arrays):
+        """
+        Make GeneModel.Gene objects from a table parsed into
+        arrays (see parse_ucsc_table_arrays).
+
+        Returns a dictionary mapping gene IDs to genes.
+        """
+        exon_starts = table_arrays["exon_starts"].tolist()
+        exon_ends = table_arrays["exon_ends"].tolist()
+        exon_offsets = table_arrays["exon_offsets"].tolist()
+        cds_starts = table_arrays["cds_starts"].tolist()
+        cds_ends = table_arrays["cds_ends"].tolist()
+        trans_ids = table_arrays["trans_ids"].tolist()
+        chroms = table_arrays["chroms"].tolist()
+        strands = table_arrays["strands"].tolist()
+        # Transcripts of each gene, in table order
+        trans_by_gene = defaultdict(list)
+        for trans_num, gene_id in enumerate(table_arrays["gene_ids"].tolist()):
+            trans_by_gene[gene_id].append(trans_num)
+        genes = {}
+        # None of the objects made here are garbage, so suspend
+        # garbage collection, whose repeated passes over the
+        # growing set of objects otherwise dominate the time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for gene_id, trans_nums in trans_by_gene.iteritems():
+                gene_symbol = self.na_val
+                all_transcripts = []
+                for trans_num in trans_nums:
+                    chrom = chroms[trans_num]
+                    strand = strands[trans_num]
+                    transcript_id = trans_ids[trans_num]
+                    first_exon = exon_offsets[trans_num]
+                    last_exon = exon_offsets[trans_num + 1]
+                    parts = [GeneModel.Part(start, end, chrom, strand,
+                                            parent=transcript_id) \
+                             for start, end in \
+                             itertools.izip(exon_starts[first_exon:last_exon],
+                                            exon_ends[first_exon:last_exon])]
+                    transcript = \
+                        GeneModel.Transcript(parts, chrom, strand,
+                                             label=transcript_id,
+                                             cds_start=cds_starts[trans_num],
+                                             cds_end=cds_ends[trans_num],
+                                             parent=gene_id)
+                    gene_symbol = self.trans_to_names[transcript_id]
+                    all_transcripts.append(transcript)
+                genes[gene_id] = GeneModel.Gene(all_transcripts, chrom, strand,
+                                                label=gene_id,
+                                                gene_symbol=gene_symbol)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return genes
+
+
     def load_ensGene_name_table(self, delimiter="\t"):
         """
         Load mapping from genes to names.
@@ -670,13 +906,18 @@ class GeneTable:
             genes_to_exons_header = ["gene_id", "exons"]
             if const_only:
                 genes_to_exons_header.append("frac_const")
-            for gene_id, gene in self.genes.iteritems():
+            gene_items = self.genes.items()
+            if const_only:
+                # Get only constitutive exons, for all genes at once
+                const_exons = \
+                    GeneModel.compute_const_exons_by_gene([gene for gene_id, gene \
+                                                           in gene_items],
+                                                          base_diff=self.constitutive_exon_diff,
+                                                          frac_const=self.frac_constitutive,
+                                                          cds_only=cds_only)
+            for gene_num, (gene_id, gene) in enumerate(gene_items):
                 if const_only:
-                    # Get only constitutive exons
-                    exons, frac_str = \
-                      gene.compute_const_exons(base_diff=self.constitutive_exon_diff,
-                                               frac_const=self.frac_constitutive,
-                                               cds_only=cds_only)
+                    exons, frac_str = const_exons[gene_num]
                 elif cds_only:
                     # Get all CDS exons
                     exons = gene.cds_parts
@@ -773,8 +1014,8 @@ class GeneTable:
         """
         Output the table's merged exons as a (sorted) BED file.
 
-        Used to determine the exonic content of a sample. Relies on
-        sortBed and mergeBed to do the heavy lifting.
+        Used to determine the exonic content of a sample. Exons
+        are merged in-process (see interval_utils.merge_bed_file).
 
         Only implemented for ensGene.txt; probably not
         necessary to work out for other tables since this is
@@ -831,9 +1072,9 @@ class GeneTable:
                                      delimiter="\t")
         merged_exons_by_gene = defaultdict(list)
         for entry in ensGene_bed:
-            # Gene names might appear multiple times due in mergeBed
-            # output in which case they are semi-colon delimited
-            gene_id = entry["name"].split(";")[0]
+            # Merged exons can come from several genes, in which
+            # case their names are comma delimited
+            gene_id = entry["name"].split(",")[0]
             merged_exons_by_gene[gene_id].append(entry)
         return merged_exons_by_gene
 
@@ -919,63 +1160,90 @@ class GeneTable:
             return
         print " - Output file (BED): %s" %(bed_output_fname)
         print " - Output file (GFF): %s" %(gff_output_fname)
+        merged_exons_filename = os.path.join(self.exons_dir,
+                                             "ensGene.merged_exons.bed")
+        merged_exons = interval_utils.load_bed_intervals(merged_exons_filename)
+        # Merged exons can come from several genes, in which case
+        # their names are comma delimited; assign each merged exon
+        # to the first of its genes
+        exon_genes = [name.split(",")[0] \
+                      for name in merged_exons["names"].tolist()]
+        gene_ids, exon_gene_nums = \
+            np.unique(np.array(exon_genes, dtype="S"),
+                      return_inverse=True)
+        exon_starts = merged_exons["starts"]
+        exon_ends = merged_exons["ends"]
+        # Introns are the complement of the merged exons of each
+        # gene within the gene's bounds
+        bound_starts = np.empty(len(gene_ids), dtype=np.int64)
+        bound_starts[:] = np.iinfo(np.int64).max
+        np.minimum.at(bound_starts, exon_gene_nums, exon_starts)
+        bound_ends = np.zeros(len(gene_ids), dtype=np.int64)
+        np.maximum.at(bound_ends, exon_gene_nums, exon_ends)
+        intron_genes, intron_starts, intron_ends = \
+            interval_utils.complement_intervals(exon_gene_nums,
+                                                exon_starts,
+                                                exon_ends,
+                                                bound_starts,
+                                                bound_ends)
+        # Intron start coordinate is the coordinate right after
+        # the end of the first exon, intron end coordinate is the
+        # coordinate just before the beginning of the second exon
+        intron_starts = intron_starts + 1
+        intron_ends = intron_ends - 1
+        # Filter on intron size (in 0-based coordinates)
+        keep = (intron_starts < intron_ends) & \
+               (intron_ends - intron_starts >= min_intron_size)
+        intron_genes = intron_genes[keep]
+        intron_starts = intron_starts[keep]
+        intron_ends = intron_ends[keep]
+        # Number introns within each gene (1-based), in order
+        # of their coordinates
+        gene_first_introns = np.unique(intron_genes, return_index=True)[1]
+        intron_nums = np.arange(len(intron_genes)) - \
+            np.repeat(gene_first_introns,
+                      np.diff(np.append(gene_first_introns,
+                                        len(intron_genes)))) + 1
+        # Chromosome and strand of each gene, from one of its exons
+        gene_exons = np.zeros(len(gene_ids), dtype=np.int64)
+        gene_exons[exon_gene_nums] = np.arange(len(exon_genes))
+        intron_chroms = merged_exons["chroms"][gene_exons][intron_genes]
+        intron_strands = merged_exons["strands"][gene_exons][intron_genes]
+        intron_order = interval_utils.sort_intervals(intron_chroms,
+                                                     intron_starts,
+                                                     intron_ends)
         bed_introns_file = open(bed_output_fname, "w")
         gff_introns_file = open(gff_output_fname, "w")
-        # Load ensGene exons
-        merged_exons_by_gene = self.load_merged_exons_by_gene()
-        for gene_id, merged_exons in merged_exons_by_gene.iteritems():
-            chrom = merged_exons[0]["chrom"]
-            strand = merged_exons[0]["strand"]
-            # For each gene, get its list of introns and serialize them
-            exon_coords = [(int(exon["start"]), int(exon["end"])) \
-                           for exon in merged_exons]
-            intron_coords = []
-            for first_exon, second_exon in zip(exon_coords,
-                                               exon_coords[1::1]):
-                # Intron start coordinate is the coordinate right after
-                # the end of the first exon, intron end coordinate is the
-                # coordinate just before the beginning of the second exon
-                intron_start = first_exon[1] + 1
-                intron_end = second_exon[0] - 1
-                if intron_start >= intron_end:
-                    continue
-                # Filter on intron size (in 0-based coordinates)
-                intron_size = intron_end - intron_start
-                if intron_size < min_intron_size:
-                    continue
-                intron_coords.append((intron_start, intron_end))
-            # Output introns as BED
+        for intron_ind in intron_order:
+            chrom = intron_chroms[intron_ind]
+            strand = intron_strands[intron_ind]
+            gene_id = gene_ids[intron_genes[intron_ind]]
+            intron_start = intron_starts[intron_ind]
+            intron_end = intron_ends[intron_ind]
+            # Output intron as BED
             bedtools_utils.output_intervals_as_bed(bed_introns_file,
                                                    chrom,
-                                                   intron_coords,
+                                                   [(intron_start,
+                                                     intron_end)],
                                                    strand,
                                                    name=gene_id)
-            # Output introns as GFF: add 1 to start
-            gff_intron_coords = [(s + 1, e) for s, e in intron_coords]
-            for intron_num, curr_intron in enumerate(gff_intron_coords):
-                start_coord, end_coord = curr_intron
-                if start_coord > end_coord:
-                    # Ensure start is less than end for GFF
-                    start_coord, end_coord = end_coord, start_coord
-                # 1-based intron numbering
-                intron_id = "%s.intron%d" %(gene_id, intron_num + 1)
-                curr_gff_interval = [chrom,
-                                     "ensGene",
-                                     "intron",
-                                     str(start_coord),
-                                     str(end_coord),
-                                     ".",
-                                     strand,
-                                     ".",
-                                     "Name=%s;Parent=%s;ID=%s" %(intron_id,
-                                                                 gene_id,
-                                                                 intron_id)]
-                gff_line = "%s\n" %("\t".join(curr_gff_interval))
-                gff_introns_file.write(gff_line)
+            # Output intron as GFF: add 1 to start
+            intron_id = "%s.intron%d" %(gene_id, intron_nums[intron_ind])
+            curr_gff_interval = [chrom,
+                                 "ensGene",
+                                 "intron",
+                                 str(intron_start + 1),
+                                 str(intron_end),
+                                 ".",
+                                 strand,
+                                 ".",
+                                 "Name=%s;Parent=%s;ID=%s" %(intron_id,
+                                                             gene_id,
+                                                             intron_id)]
+            gff_line = "%s\n" %("\t".join(curr_gff_interval))
+            gff_introns_file.write(gff_line)
         bed_introns_file.close()
         gff_introns_file.close()
-        # Sort introns
-        bedtools_utils.sort_bedfile_inplace(bed_output_fname)
                                                    
 
     def parse_string_int_list(self, int_list_as_str,
@@ -997,11 +1265,15 @@ class ConstExons:
 
     Consists of a GFF filename specifying the exons
     and a text file mapping genes to their constitutive exons.
+    If 'annotation_index' is given and indexes the exons, the
+    mapping is taken from the index instead of the text file.
     """
     def __init__(self, table_name,
-                 from_dir=None):
+                 from_dir=None,
+                 annotation_index=None):
         self.table_name = table_name
         self.from_dir = from_dir
+        self.annotation_index = annotation_index
         self.gff_filename = None
         self.na_val = "NA"
         self.genes_to_exons_filename = None
@@ -1026,6 +1298,14 @@ class ConstExons:
             print "WARNING: Cannot find constitutive exons GFF for %s" \
                 %(self.table_name)
             return
+        # Take the mapping from genes to exons from the annotation
+        # index if it has the exons
+        set_name = "const_exons.%s" %(self.table_name)
+        if (self.annotation_index is not None) and \
+           (set_name in self.annotation_index.intervals):
+            self.load_index_genes_to_exons(set_name)
+            self.found = True
+            return
         # Look for the mapping from genes to exons
         self.genes_to_exons_filename = os.path.join(self.from_dir,
                                                     "%s.const_exons.to_genes.txt" \
@@ -1061,6 +1341,33 @@ class ConstExons:
                 self.exon_lens[exon] = exon_len
                 
 
+    def load_index_genes_to_exons(self, set_name):
+        """
+        Load the mapping from genes to constitutive exons from
+        an interval set of the annotation index.
+
+        Exons of a gene are listed in order of their coordinates.
+        """
+        intervals = self.annotation_index.get_intervals(set_name)
+        gene_ids = self.annotation_index.genes.gene_ids
+        intervals = intervals[intervals["gene"] >= 0]
+        # Group exons by gene, keeping their coordinate order
+        intervals = intervals[np.argsort(intervals["gene"], kind="mergesort")]
+        # Exon IDs are the exon labels prefixed by the record type
+        exons = [exon_id.split(".", 1)[1] \
+                 for exon_id in intervals["id"].tolist()]
+        exon_lens = (intervals["end"] - intervals["start"] + 1).tolist()
+        for exon, exon_len in itertools.izip(exons, exon_lens):
+            self.exon_lens[exon] = exon_len
+        gene_nums, first_inds = np.unique(intervals["gene"], return_index=True)
+        last_inds = np.append(first_inds[1:], len(intervals))
+        for gene_num, first_ind, last_ind in \
+            itertools.izip(gene_nums.tolist(), first_inds.tolist(),
+                           last_inds.tolist()):
+            self.genes_to_exons.append({"gene_id": str(gene_ids[gene_num]),
+                                        "exons": ",".join(exons[first_ind:last_ind])})
+
+
     def __repr__(self):
         return "ConstExons(table=%s, gff=%s, genes_to_exons=%d entries)" \
             %(self.table_name,
@@ -1071,12 +1378,12 @@ class ConstExons:
 ##
 ## Related table utilities
 ##
-def get_ucsc_database(genome):
-    return "%s/%s/database" %(UCSC_GOLDENPATH,
+def get_ucsc_database(genome, ucsc_url=UCSC_GOLDENPATH):
+    return "%s/%s/database" %(ucsc_url,
                               genome)
 
 
-def get_ucsc_tables_urls(genome):
+def get_ucsc_tables_urls(genome, ucsc_url=UCSC_GOLDENPATH):
     """
     Return a list of all UCSC tables URLs to download
     for a particular genome.  Format:
@@ -1084,8 +1391,11 @@ def get_ucsc_tables_urls(genome):
     [[table1_label, table1_url],
      [table2_label, table2_url],
      ...]
+
+    'ucsc_url' is the goldenPath URL to download from (e.g. a
+    mirror).
     """
-    ucsc_database = get_ucsc_database(genome)
+    ucsc_database = get_ucsc_database(genome, ucsc_url=ucsc_url)
     table_labels = []
     for table_label in UCSC_TABLE_LABELS:
         table_url = "%s/%s" %(ucsc_database, table_label)
@@ -1093,7 +1403,8 @@ def get_ucsc_tables_urls(genome):
     return table_labels
 
 
-def download_all_ucsc_headers(genome, ucsc_tables, output_dir):
+def download_all_ucsc_headers(genome, ucsc_tables, output_dir,
+                              ucsc_url=UCSC_GOLDENPATH):
     """
     Download all the necessary table headers for
     a genome and save them to a text file.
@@ -1103,61 +1414,79 @@ def download_all_ucsc_headers(genome, ucsc_tables, output_dir):
     print "  - Output dir: %s" %(headers_outdir)
     utils.make_dir(headers_outdir)
     for table_info in ucsc_tables:
-        table_fname = table_info[0]
-        table_name = table_fname.split(".")[0]
-        # Get header for current table
-        header = download_ucsc_table_header(genome, table_name)
-        header_fname = \
-            os.path.join(headers_outdir, "%s.header.txt" %(table_name))
-        # Write header to file in headers directory
-        with open(header_fname, "w") as header_out:
-            header_str = "\t".join(header)
-            header_out.write("%s\n" %(header_str))
-
-
-def download_ucsc_table_header(genome, table_name):
+        output_ucsc_table_header(genome, table_info[0], headers_outdir,
+                                 ucsc_url=ucsc_url)
+
+
+def output_ucsc_table_header(genome, table_fname, headers_outdir,
+                             ucsc_url=UCSC_GOLDENPATH):
+    """
+    Download the header of a table and save it to a text file
+    in the headers directory.
+    """
+    table_name = table_fname.split(".")[0]
+    # Get header for current table
+    header = download_ucsc_table_header(genome, table_name,
+                                        ucsc_url=ucsc_url)
+    if header is None:
+        return None
+    header_fname = \
+        os.path.join(headers_outdir, "%s.header.txt" %(table_name))
+    # Write header to file in headers directory
+    with open(header_fname, "w") as header_out:
+        header_str = "\t".join(header)
+        header_out.write("%s\n" %(header_str))
+    return header_fname
+
+
+def download_ucsc_table_header(genome, table_name,
+                               ucsc_url=UCSC_GOLDENPATH):
     """
     Get UCSC table headers for a given table.
+
+    The header is read from the table's schema (<table>.sql) in
+    the database directory of 'ucsc_url', so that it comes from
+    the same source as the table.
     """
     print "Downloading header for %s (%s)" %(table_name,
                                              genome)
-    mysql_path = utils.which("mysql")
-    if mysql_path is None:
-        print "WARNING: Could not find \'mysql\' on your system. " \
-              "Not fetching headers for UCSC tables from mysql. " \
-              "Will have to guess headers instead."
+    schema_url = "%s/%s.sql" %(get_ucsc_database(genome,
+                                                 ucsc_url=ucsc_url),
+                               table_name)
+    schema_lines = download_utils.load_url_lines(schema_url)
+    if schema_lines is None:
+        print "WARNING: Failed to get header from %s. " \
+              "Will have to guess headers instead." %(schema_url)
         return None
-    # Query headers as TSV from MySQL database
-    mysql_cmd = \
-        "%s --user=genome --host=genome-mysql.cse.ucsc.edu -A -D %s " \
-        "-e \'desc %s\' -N -B" \
-        %(mysql_path,
-          genome,
-          table_name)
-    p = \
-        subprocess.Popen(mysql_cmd,
-                         shell=True,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    ret_val = p.wait()
-    if ret_val != 0:
-        print "ERROR: Failed to get header."
-        print "Standard output was: "
-        for s in p.stdout:
-            print s.strip()
-        print "Standard error was: "
-        for e in p.stderr:
-            print e.strip()
+    header = parse_ucsc_table_schema(schema_lines)
+    if len(header) == 0:
+        print "WARNING: No columns found in %s. " \
+              "Will have to guess headers instead." %(schema_url)
         return None
-    # Command has not failed, so parse header
+    return header
+
+
+def parse_ucsc_table_schema(schema_lines):
+    """
+    Return the column names of a table from the lines of its
+    'CREATE TABLE' schema (as in UCSC's <table>.sql files), in
+    order (as 'desc <table>' lists them).
+    """
     header = []
-    for line in p.stdout:
+    in_table = False
+    for line in schema_lines:
         line = line.strip()
-        if line.startswith("Field"):
-            # Skip header that describes each header field
+        if line.startswith("CREATE TABLE"):
+            in_table = True
+            continue
+        if not in_table:
             continue
-        fields = line.split("\t")
-        header.append(fields[0])
+        if line.startswith(")"):
+            break
+        # Column definitions start with the quoted column name;
+        # keys and indices do not
+        if line.startswith("`"):
+            header.append(line.split("`")[1])
     return header
 
 
@@ -1192,36 +1521,87 @@ def load_ucsc_table_headers(output_dir):
     return headers
     
 
+def download_ucsc_table(args):
+    """
+    Download a UCSC table and its header, and uncompress it.
+    Takes a (genome, table_label, table_url, output_dir, md5sum,
+    ucsc_url) tuple, for use with a pool of workers. Returns the uncompressed
+    table's filename, or None if the download failed.
+    """
+    genome, table_label, table_url, output_dir, md5sum, ucsc_url = args
+    tables_outdir = os.path.join(output_dir, "ucsc")
+    # Get the table header from the same source as the table
+    output_ucsc_table_header(genome, table_label,
+                             os.path.join(tables_outdir, "headers"),
+                             ucsc_url=ucsc_url)
+    print "Downloading %s" %(table_label)
+    # If the table exists in uncompressed form, don't download it
+    table_filename = os.path.join(tables_outdir, table_label)
+    unzipped_table_fname = table_filename[0:-3]
+    if os.path.isfile(unzipped_table_fname):
+        print "Got %s already. Skipping download.." \
+            %(unzipped_table_fname)
+        return unzipped_table_fname
+    # Download table
+    download_status = download_utils.download_url(table_url,
+                                                  tables_outdir,
+                                                  md5sum=md5sum)
+    if download_status is None:
+        print "Failed to get %s, skipping.." %(table_label)
+        return None
+    # Uncompress table
+    return utils.gunzip_file(table_filename, tables_outdir)
+
+
 def download_ucsc_tables(genome,
-                         output_dir):
+                         output_dir,
+                         num_processors=1,
+                         ucsc_url=None):
     """
     Download all relevant UCSC tables for a given genome.
+
+    Tables are downloaded and uncompressed by a pool of
+    'num_processors' workers. Partial downloads are resumed, and
+    downloads are checked against the checksums of the UCSC
+    database directory (UCSC_MD5SUMS_FILENAME) when it has them.
+    'ucsc_url' is the goldenPath URL to download from (by default
+    UCSC_GOLDENPATH).
+
+    Returns the filenames of the downloaded tables.
     """
+    if ucsc_url is None:
+        ucsc_url = UCSC_GOLDENPATH
     tables_outdir = os.path.join(output_dir, "ucsc")
     utils.make_dir(tables_outdir)
+    headers_outdir = os.path.join(tables_outdir, "headers")
+    utils.make_dir(headers_outdir)
     print "Download UCSC tables..."
+    print "  - Source: %s" %(ucsc_url)
     print "  - Output dir: %s" %(tables_outdir)
-    ucsc_tables = get_ucsc_tables_urls(genome)
-    # Download all the table headers and save them to file
-    download_all_ucsc_headers(genome, ucsc_tables, output_dir)
-    # Download the UCSC tables
-    for table_label, table_url in ucsc_tables:
-        print "Downloading %s" %(table_label)
-        # If the table exists in uncompressed form, don't download it
-        table_filename = os.path.join(tables_outdir, table_label)
-        unzipped_table_fname = table_filename[0:-3]
-        if os.path.isfile(unzipped_table_fname):
-            print "Got %s already. Skipping download.." \
-                %(unzipped_table_fname)
-            continue
-        # Download table
-        download_status = download_utils.download_url(table_url,
-                                                      tables_outdir)
-        if download_status is None:
-            print "Failed to get %s, skipping.." %(table_label)
-            continue
-        # Uncompress table
-        utils.gunzip_file(table_filename, tables_outdir)
+    ucsc_tables = get_ucsc_tables_urls(genome, ucsc_url=ucsc_url)
+    md5sums = \
+        download_utils.load_md5sums("%s/%s" %(get_ucsc_database(genome,
+                                                                ucsc_url=ucsc_url),
+                                              UCSC_MD5SUMS_FILENAME))
+    if len(md5sums) == 0:
+        print "  - No checksums available, checking sizes only"
+    # Download the UCSC tables and their headers
+    t1 = time.time()
+    table_fnames = \
+        download_utils.run_in_pool(download_ucsc_table,
+                                   [(genome, table_label, table_url,
+                                     output_dir, md5sums.get(table_label),
+                                     ucsc_url) \
+                                    for table_label, table_url in ucsc_tables],
+                                   num_processors=num_processors)
+    t2 = time.time()
+    print "Downloading tables took %.2f minutes." %((t2 - t1)/60.)
+    for (table_label, table_url), table_fname in zip(ucsc_tables,
+                                                     table_fnames):
+        if table_fname is None:
+            print "WARNING: Could not download %s" %(table_label)
+    return [table_fname for table_fname in table_fnames \
+            if table_fname is not None]
 
 
 def add_introns_to_gff_files(gff_fnames, output_dir):
@@ -1242,9 +1622,14 @@ def process_ucsc_tables(genome, output_dir,
     """
     tables_outdir = os.path.join(output_dir, "ucsc")
     # Convert the UCSC knownGene format to GTF
-    convert_knowngene_to_gtf(tables_outdir)
+    convert_knowngene_to_gtf(tables_outdir,
+                             num_processors=init_params.get("num_processors",
+                                                            1))
     # Convert the various Ensembl tables to GFF3 format
-    gff_fnames = convert_tables_to_gff(tables_outdir)
+    gff_fnames = \
+        convert_tables_to_gff(tables_outdir,
+                              num_processors=init_params.get("num_processors",
+                                                             1))
     ##
     ## Process misc. tables
     ##
@@ -1326,35 +1711,44 @@ def process_tRNA_table(tables_outdir, tRNA_header,
     bedtools_utils.sort_bedfile_inplace(tRNA_bed_filename)
     
 
-def convert_tables_to_gff(tables_outdir):
+def convert_table_to_gff(args):
     """
-    Convert various UCSC tables to GFF3 using
-    foo.
+    Convert a UCSC table to GFF3 using Biotoolbox's
+    ucsc_table2gff3.pl. Takes a (tables_outdir, table) pair, for
+    use with a pool of workers. Returns the GFF3 filename.
     """
-    print "Converting tables to GFF3 format.."
-    # Use Biotoolbox script for UCSC to GFF3 conversion
+    tables_outdir, table = args
     ucsc2gff = "ucsc_table2gff3.pl"
+    output_filename = os.path.join(tables_outdir,
+                                   "%s.gff3" %(table.replace(".txt", "")))
+    if os.path.isfile(output_filename):
+        print "  - Found %s. Skipping conversion..." \
+            %(output_filename)
+        return output_filename
+    print "  - Converting %s to GFF" %(table)
+    table_to_gff_cmd = "%s --table %s " %(ucsc2gff,
+                                          table)
+    subprocess.call(table_to_gff_cmd, shell=True, cwd=tables_outdir)
+    return output_filename
+
+
+def convert_tables_to_gff(tables_outdir, num_processors=1):
+    """
+    Convert various UCSC tables to GFF3 (see
+    convert_table_to_gff), with up to 'num_processors' tables
+    converted at once.
+    """
+    print "Converting tables to GFF3 format.."
     # Convert knownGene, Ensembl and RefSeq to GFF3
     tables_to_convert = ["knownGene.txt",
                          "ensGene.txt",
                          "refGene.txt"]
     t1 = time.time()
-    gff_fnames = []
-    for table in tables_to_convert:
-        print "  - Converting %s to GFF" %(table)
-        table_filename = os.path.join(tables_outdir,
-                                      table)
-        output_filename = os.path.join(tables_outdir,
-                                       "%s.gff3" %(table.replace(".txt", "")))
-        gff_fnames.append(output_filename)
-        if os.path.isfile(output_filename):
-            print "  - Found %s. Skipping conversion..." \
-                %(output_filename)
-            continue
-        os.chdir(tables_outdir)
-        table_to_gff_cmd = "%s --table %s " %(ucsc2gff,
-                                              table)
-        os.system(table_to_gff_cmd)
+    gff_fnames = \
+        download_utils.run_in_pool(convert_table_to_gff,
+                                   [(tables_outdir, table) \
+                                    for table in tables_to_convert],
+                                   num_processors=num_processors)
     t2 = time.time()
     print "Conversion took %.2f minutes." %((t2 - t1)/60.)
     return gff_fnames
@@ -1373,10 +1767,11 @@ def is_ucsc_random_chr(chrom):
     return False
             
     
-def convert_knowngene_to_gtf(tables_outdir):
+def convert_knowngene_to_gtf(tables_outdir, num_processors=1):
     """
     Convert UCSC to knowngenes from genePred
-    format to GTF.
+    format to GTF, and the GTF to GFF3 (see
+    gtf_utils.gtf_to_gff3).
     """
     knowngene_filename = os.path.join(tables_outdir,
                                       "knownGene.txt")
@@ -1419,18 +1814,112 @@ def convert_knowngene_to_gtf(tables_outdir):
         knowngene_in.close()
         knowngene_out.close()
     # Then convert only the one without random chromosomes to GFF as well
-    gtf2gff_cmd = "gtf2gff3.pl"
-    convert_gff_cmd = "%s %s > %s" %(gtf2gff_cmd,
-                                     knowngene_gtf_filename,
-                                     knowngene_gff_filename)
     if not os.path.isfile(knowngene_gff_filename):
-        os.system(convert_gff_cmd)
+        gtf_utils.gtf_to_gff3(knowngene_gtf_filename,
+                              knowngene_gff_filename,
+                              num_processors=num_processors)
     return knowngene_gtf_filename, knowngene_gff_filename
 
 
 ##
 ## Random table utilities
 ##
+def parse_int_lists(int_lists, delimiter=","):
+    """
+    Parse delimited lists of integers (like the exonStarts/exonEnds
+    columns of UCSC tables, e.g. '100,200,') into a flat array of
+    all the integers and an array of offsets, such that the
+    integers of list i are ints[offsets[i]:offsets[i + 1]].
+    """
+    # Make every non-empty list end with a delimiter so that its
+    # number of delimiters is its length
+    int_lists = [l if (l == "" or l.endswith(delimiter)) else l + delimiter \
+                 for l in int_lists]
+    list_lens = np.array([l.count(delimiter) for l in int_lists],
+                         dtype=np.int64)
+    offsets = np.zeros(len(int_lists) + 1, dtype=np.int64)
+    np.cumsum(list_lens, out=offsets[1:])
+    all_ints = "".join(int_lists).rstrip(delimiter)
+    if all_ints == "":
+        return np.zeros(0, dtype=np.int64), offsets
+    ints = np.array(all_ints.split(delimiter), dtype=np.int64)
+    return ints, offsets
+
+
+def parse_ucsc_table_arrays(table_fname, header, delimiter="\t"):
+    """
+    Parse a UCSC genePred-like table (ensGene, refGene, ...) into
+    flat arrays.
+
+    Returns a dictionary with per-transcript arrays 'trans_ids',
+    'gene_ids', 'chroms', 'strands', 'cds_starts' and 'cds_ends',
+    and arrays 'exon_starts' and 'exon_ends' of the exons of all
+    transcripts, where the exons of transcript i are at
+    exon_offsets[i]:exon_offsets[i + 1]. All coordinates
+    are converted to 1-based.
+    """
+    table = pandas.read_table(table_fname,
+                              sep=delimiter,
+                              names=header,
+                              dtype={"chrom": str,
+                                     "name": str,
+                                     "name2": str})
+    exon_starts, exon_offsets = parse_int_lists(table["exonStarts"].values)
+    exon_ends, exon_end_offsets = parse_int_lists(table["exonEnds"].values)
+    if not np.array_equal(exon_offsets, exon_end_offsets):
+        raise Exception, "Mismatched exon starts and ends in %s" \
+            %(table_fname)
+    table_arrays = \
+        {"trans_ids": table["name"].values.astype(str),
+         "gene_ids": table["name2"].values.astype(str),
+         "chroms": table["chrom"].values.astype(str),
+         "strands": table["strand"].values.astype(str),
+         "cds_starts": table["cdsStart"].values.astype(np.int64) + 1,
+         "cds_ends": table["cdsEnd"].values.astype(np.int64),
+         "exon_starts": exon_starts + 1,
+         "exon_ends": exon_ends,
+         "exon_offsets": exon_offsets}
+    return table_arrays
+
+
+def load_table_cache(cache_filename, checksum):
+    """
+    Load a parsed table from a cache file made by
+    output_table_cache.
+
+    Returns None if the cache does not exist or was made from
+    a table with a different checksum.
+    """
+    if not os.path.isfile(cache_filename):
+        return None
+    try:
+        cache = np.load(cache_filename)
+    except IOError:
+        print "WARNING: Cannot read table cache %s" %(cache_filename)
+        return None
+    if str(cache["checksum"]) != checksum:
+        return None
+    table_arrays = dict((key, cache[key]) for key in cache.files \
+                        if key != "checksum")
+    cache.close()
+    return table_arrays
+
+
+def output_table_cache(table_arrays, cache_filename, checksum):
+    """
+    Output a parsed table to a binary cache file, along with the
+    checksum of the table it was parsed from.
+    """
+    print "Outputting parsed table cache..."
+    print "  - Output file: %s" %(cache_filename)
+    # Write to a temporary file first so that an interrupted
+    # write does not leave a truncated cache behind
+    tmp_filename = "%s.tmp.npz" %(cache_filename)
+    np.savez(tmp_filename, checksum=np.array(checksum), **table_arrays)
+    os.rename(tmp_filename, cache_filename)
+    return cache_filename
+
+
 def dictread_groupby_col(file_in, col,
                          delimiter="\t",
                          fieldnames=None):
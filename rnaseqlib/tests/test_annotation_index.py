@@ -0,0 +1,145 @@
+##
+## Unit testing for the annotation index, against GeneModel gene
+## models of the same table
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import misopy.gff_utils as gff_utils
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tables as tables
+import rnaseqlib.genes.GeneModel as GeneModel
+import rnaseqlib.genes.AnnotationIndex as AnnotationIndex
+import rnaseqlib.bam.saturation_utils as saturation_utils
+
+
+class TestAnnotationIndex:
+    """
+    Test annotation index views of genes.
+    """
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_annotation_index.")
+        self.table_dir = os.path.join(self.tmp_dir, "ucsc")
+        self.ensGene_fname, self.gene_table = \
+            test_utils.make_test_gene_table(self.tmp_dir, self.table_dir)
+        self.genes = \
+            self.gene_table.get_ensGene_by_genes(self.ensGene_fname,
+                                                 use_cache=False)
+        self.gene_store = self.gene_table.get_ensGene_store(self.ensGene_fname)
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def test_annotation_index(self):
+        """
+        Test that annotation index interval sets, constitutive
+        exons and gene views match gene models.
+        """
+        print "Testing annotation index"
+        # Constitutive exons of the genes, as output by the gene table
+        const_exons_dir = os.path.join(self.tmp_dir, "const_exons")
+        os.makedirs(const_exons_dir)
+        const_exons_gff_fname = os.path.join(const_exons_dir,
+                                             "ensGene.const_exons.gff")
+        const_exons_by_gene = {}
+        with open(const_exons_gff_fname, "w") as gff_out_file:
+            gff_out = gff_utils.Writer(gff_out_file)
+            for gene_id, gene in self.genes.iteritems():
+                exons = GeneModel.compute_const_exons_by_gene([gene])[0][0]
+                const_exons_by_gene[gene_id] = \
+                    sorted(exon.label for exon in exons)
+                GeneModel.output_parts_as_gff(gff_out, exons,
+                                              gene.chrom, gene.strand,
+                                              gene_id=gene_id)
+        index_dir = os.path.join(self.tmp_dir, "annotation_index")
+        source_fnames = {"ensGene": self.ensGene_fname,
+                         "ensGene.const_exons": const_exons_gff_fname}
+        gene_names = dict((gene_id, "name.%s" %(gene_id)) \
+                          for gene_id in self.genes)
+        AnnotationIndex.build_index(index_dir, self.gene_store, source_fnames,
+                                    gff_interval_sets=\
+                                      {"const_exons.ensGene": \
+                                         (const_exons_gff_fname, "exon")},
+                                    gene_names=gene_names)
+        assert (AnnotationIndex.is_index_current(index_dir, source_fnames))
+        annotation_index = AnnotationIndex.AnnotationIndex(index_dir)
+        # Exon, CDS and UTR interval sets
+        gene_ids = annotation_index.genes.gene_ids
+        for set_name, get_parts in \
+            [("exons", lambda t: t.parts),
+             ("cds", lambda t: t.get_cds_parts()),
+             ("5p_utr", lambda t: t.get_5p_utr_parts()),
+             ("3p_utr", lambda t: t.get_3p_utr_parts())]:
+            intervals = annotation_index.get_intervals(set_name)
+            found = sorted(zip(intervals["id"].tolist(),
+                               intervals["chrom"].tolist(),
+                               intervals["start"].tolist(),
+                               intervals["end"].tolist(),
+                               intervals["strand"].tolist(),
+                               gene_ids[intervals["gene"]].tolist()))
+            expected = sorted((transcript.label, part.chrom, part.start,
+                               part.end, part.strand, gene_id) \
+                              for gene_id, gene in self.genes.iteritems() \
+                              for transcript in gene.transcripts \
+                              for part in get_parts(transcript))
+            assert (found == expected)
+        # Constitutive exons loaded from the index
+        const_exons = tables.ConstExons("ensGene",
+                                        from_dir=const_exons_dir,
+                                        annotation_index=annotation_index)
+        assert (const_exons.found)
+        found_by_gene = dict((entry["gene_id"],
+                              sorted(entry["exons"].split(","))) \
+                             for entry in const_exons.genes_to_exons)
+        assert (found_by_gene == const_exons_by_gene)
+        for gene_id, gene in self.genes.iteritems():
+            for exon in GeneModel.compute_const_exons_by_gene([gene])[0][0]:
+                assert (const_exons.exon_lens[exon.label] == \
+                        exon.end - exon.start + 1)
+        # Gene table loaded from the index
+        index_table = tables.GeneTable(self.table_dir, "ensGene",
+                                       annotation_index=annotation_index)
+        assert (sorted(index_table.genes_list) == sorted(self.genes.keys()))
+        for gene_id in self.genes:
+            assert (index_table.genes_to_names[gene_id] == gene_names[gene_id])
+            assert (index_table.genes_to_desc[gene_id] == "NA")
+        rep_transcripts = \
+            dict((rep_transcript[0], rep_transcript) \
+                 for rep_transcript in \
+                 index_table.get_representative_transcripts())
+        for gene in self.genes.itervalues():
+            trans_lens = [sum(part.end - part.start + 1 \
+                              for part in transcript.parts) \
+                          for transcript in gene.transcripts]
+            rep_transcript = \
+                gene.transcripts[trans_lens.index(max(trans_lens))]
+            assert (rep_transcripts[rep_transcript.label] == \
+                    (rep_transcript.label, rep_transcript.chrom,
+                     rep_transcript.strand,
+                     [part.start for part in rep_transcript.parts],
+                     [part.end for part in rep_transcript.parts]))
+        for gene_id, chrom, exon_starts, exon_ends in \
+            saturation_utils.get_gene_exons(index_table):
+            gene = self.genes[gene_id]
+            assert (chrom == gene.chrom)
+            assert (exon_starts == [part.start for transcript in gene.transcripts \
+                                    for part in transcript.parts])
+            assert (exon_ends == [part.end for transcript in gene.transcripts \
+                                  for part in transcript.parts])
+        # Rewriting a source within the same second, keeping its
+        # size, makes the index stale
+        test_utils.touch_within_second(self.ensGene_fname,
+                                       os.stat(self.ensGene_fname).st_mtime)
+        assert (not AnnotationIndex.is_index_current(index_dir, source_fnames))
+        # Changing a source makes the index stale
+        with open(self.ensGene_fname, "a") as ensGene_out:
+            ensGene_out.write("\n")
+        assert (not AnnotationIndex.is_index_current(index_dir, source_fnames))
@@ -0,0 +1,158 @@
+##
+## Unit testing for counting reads aligned to junction libraries,
+## against counting in a dense array
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.mapping.bowtie_utils as bowtie_utils
+
+
+def output_jxn_sam(sam_filename, refs, reads):
+    """
+    Output a SAM file of single-end reads. 'refs' is a list of
+    (name, length) pairs and 'reads' a list of (reference number,
+    0-based position) pairs, with -1 for unmapped reads.
+    """
+    with open(sam_filename, "w") as sam_out:
+        sam_out.write("@HD\tVN:1.0\tSO:unsorted\n")
+        for ref_name, ref_len in refs:
+            sam_out.write("@SQ\tSN:%s\tLN:%d\n" %(ref_name, ref_len))
+        for read_num, (ref_num, pos) in enumerate(reads):
+            if ref_num < 0:
+                fields = ["read%d" %(read_num), "4", "*", "0", "0", "*"]
+            else:
+                fields = ["read%d" %(read_num), "0", refs[ref_num][0],
+                          str(pos + 1), "255", "10M"]
+            fields.extend(["*", "0", "0", "ACGTACGTAC", "IIIIIIIIII"])
+            sam_out.write("\t".join(fields) + "\n")
+
+
+class TestBowtieUtils:
+    """
+    Test counting junction reads from SAM files.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_bowtie_utils.")
+        self.num_jxns = 20
+        self.jxnmod = 50
+        self.jxns = ["jxn%d" %(jxn_num) for jxn_num in xrange(self.num_jxns)]
+        self.refs = [("chr1", 5000), ("chr1Jxn", 2000)]
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def make_shard(self, shard_num, num_reads):
+        """
+        Output a SAM shard of random reads, some unmapped or off the
+        junction library. Returns its filename and its junction by
+        position counts, counted in a dense array.
+        """
+        ref_nums = self.rand.randint(-1, len(self.refs), num_reads)
+        # Some reads fall past the last junction
+        positions = self.rand.randint(0, self.num_jxns * self.jxnmod + 100,
+                                      num_reads)
+        sam_filename = os.path.join(self.tmp_dir, "shard%d.sam" %(shard_num))
+        output_jxn_sam(sam_filename, self.refs, zip(ref_nums, positions))
+        expected = np.zeros((self.num_jxns + 10, self.jxnmod), dtype=np.uint32)
+        for ref_num, pos in zip(ref_nums, positions):
+            if ref_num >= 0 and "Jxn" in self.refs[ref_num][0]:
+                expected[(pos + 1) // self.jxnmod, (pos + 1) % self.jxnmod] += 1
+        return sam_filename, expected[0:self.num_jxns]
+
+
+    def test_count_jxns(self):
+        """
+        Test counting junction reads in one SAM file.
+        """
+        print "Testing counting of junction reads"
+        sam_filename, expected = self.make_shard(0, 3000)
+        for chunk_size in [1, 7, 1000000]:
+            counts = bowtie_utils.count_bowtie_jxns(sam_filename,
+                                                    self.num_jxns,
+                                                    self.jxnmod,
+                                                    chunk_size=chunk_size)
+            assert (counts.shape == expected.shape)
+            assert ((counts.toarray() == expected).all())
+        # Junctions numbered from an offset
+        counts = bowtie_utils.count_bowtie_jxns(sam_filename,
+                                                self.num_jxns, self.jxnmod,
+                                                ref_offsets={"chr1Jxn": 2})
+        assert ((counts.toarray()[2:] == expected[0:-2]).all())
+        assert (counts.toarray()[0:2].sum() == 0)
+
+
+    def test_count_jxns_parallel(self):
+        """
+        Test summing junction read counts across shards.
+        """
+        print "Testing counting of junction reads across shards"
+        shards = [self.make_shard(shard_num, 1000) for shard_num in xrange(4)]
+        shard_filenames = [shard[0] for shard in shards]
+        expected = sum(shard[1] for shard in shards)
+        for num_processors in [1, 2]:
+            counts = \
+                bowtie_utils.count_bowtie_jxns_parallel(shard_filenames,
+                                                        self.num_jxns,
+                                                        self.jxnmod,
+                                                        num_processors=\
+                                                          num_processors)
+            assert ((counts.toarray() == expected).all())
+
+
+    def test_several_jxn_refs(self):
+        """
+        Test that several junction references need offsets.
+        """
+        print "Testing several junction references"
+        self.refs.append(("chr2Jxn", 2000))
+        sam_filename, expected = self.make_shard(0, 100)
+        try:
+            bowtie_utils.count_bowtie_jxns(sam_filename, self.num_jxns,
+                                           self.jxnmod)
+        except Exception:
+            pass
+        else:
+            assert False, "Expected several junction references to fail."
+        counts = bowtie_utils.count_bowtie_jxns(sam_filename,
+                                                self.num_jxns, self.jxnmod,
+                                                ref_offsets={"chr1Jxn": 0,
+                                                             "chr2Jxn": 0})
+        assert ((counts.toarray() == expected).all())
+
+
+    def test_jxn_count_output(self):
+        """
+        Test saving, loading and writing junction counts.
+        """
+        print "Testing output of junction counts"
+        sam_filename, expected = self.make_shard(0, 500)
+        text_filename = os.path.join(self.tmp_dir, "jxns.txt")
+        matrix_filename = os.path.join(self.tmp_dir, "jxns.npz")
+        counts = bowtie_utils.convertBowtieToJxns(sam_filename, text_filename,
+                                                  self.jxns, self.jxnmod,
+                                                  matrix_outpath=matrix_filename)
+        jxns, loaded_counts = \
+            bowtie_utils.load_jxn_count_matrix(matrix_filename)
+        assert (jxns == self.jxns)
+        assert ((loaded_counts.toarray() == expected).all())
+        expected_lines = []
+        for jxn_num in xrange(self.num_jxns):
+            positions = np.nonzero(expected[jxn_num])[0]
+            if len(positions) == 0:
+                continue
+            expected_lines.append(self.jxns[jxn_num] + "\t" + \
+                                  ";".join(["%d:%d" %(pos,
+                                                      expected[jxn_num, pos]) \
+                                            for pos in positions]) + "\n")
+        assert (open(text_filename).readlines() == expected_lines)
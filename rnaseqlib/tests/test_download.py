@@ -0,0 +1,226 @@
+##
+## Unit testing for downloading files and UCSC tables, against a
+## local HTTP server
+##
+import os
+import sys
+import time
+import gzip
+import shutil
+import hashlib
+import tempfile
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.utils as utils
+import rnaseqlib.tables as tables
+import rnaseqlib.init.download_utils as download_utils
+
+
+class RangeRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serve files from serve_dir, supporting 'Range: bytes=N-'
+    requests. Records the requested ranges.
+    """
+    serve_dir = None
+    requested_ranges = []
+
+    def translate_path(self, path):
+        return os.path.join(RangeRequestHandler.serve_dir,
+                            path.split("?")[0].lstrip("/"))
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+        data = open(path, "rb").read()
+        range_header = self.headers.getheader("Range")
+        RangeRequestHandler.requested_ranges.append(range_header)
+        if range_header is None:
+            self.send_response(200)
+        else:
+            offset = int(range_header.split("=")[1].split("-")[0])
+            if offset >= len(data):
+                self.send_error(416, "Requested range not satisfiable")
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" \
+                             %(offset, len(data) - 1, len(data)))
+            data = data[offset:]
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_table_schema(table_name, header):
+    """
+    Return a 'CREATE TABLE' schema of a table with the given
+    columns, as in UCSC's <table>.sql files.
+    """
+    schema_lines = ["-- MySQL dump 10.13\n",
+                    "DROP TABLE IF EXISTS `%s`;\n" %(table_name),
+                    "CREATE TABLE `%s` (\n" %(table_name)]
+    for col in header:
+        schema_lines.append("  `%s` varchar(255) NOT NULL,\n" %(col))
+    schema_lines.extend(["  KEY `%s` (`%s`(16))\n" %(header[0], header[0]),
+                         ") ENGINE=MyISAM DEFAULT CHARSET=latin1;\n"])
+    return "".join(schema_lines)
+
+
+class TestDownload:
+    """
+    Test resumable, checked and parallel downloads.
+    """
+    def setup(self):
+        self.serve_dir = tempfile.mkdtemp(prefix="test_download.serve.")
+        self.output_dir = tempfile.mkdtemp(prefix="test_download.out.")
+        RangeRequestHandler.serve_dir = self.serve_dir
+        RangeRequestHandler.requested_ranges = []
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                RangeRequestHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.base_url = "http://127.0.0.1:%d" %(self.server.server_port)
+        self.data = "".join(["line %d\n" %(n) for n in xrange(10000)])
+        with open(os.path.join(self.serve_dir, "data.txt"), "wb") as data_out:
+            data_out.write(self.data)
+
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.serve_dir, ignore_errors=True)
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+
+    def test_download_url(self):
+        """
+        Test downloading a file.
+        """
+        print "Testing download"
+        output_fname = \
+            download_utils.download_url("%s/data.txt" %(self.base_url),
+                                        self.output_dir)
+        assert (output_fname == os.path.join(self.output_dir, "data.txt"))
+        assert (open(output_fname, "rb").read() == self.data)
+        assert (not os.path.isfile("%s%s" %(output_fname,
+                                            download_utils.PARTIAL_EXT)))
+        # Missing files cannot be downloaded
+        assert (download_utils.download_url("%s/missing.txt" %(self.base_url),
+                                            self.output_dir) is None)
+
+
+    def test_resume_download(self):
+        """
+        Test resuming a partial download.
+        """
+        print "Testing resumed download"
+        partial_fname = os.path.join(self.output_dir,
+                                     "data.txt%s" %(download_utils.PARTIAL_EXT))
+        with open(partial_fname, "wb") as partial_out:
+            partial_out.write(self.data[0:1000])
+        output_fname = \
+            download_utils.download_url("%s/data.txt" %(self.base_url),
+                                        self.output_dir)
+        assert (RangeRequestHandler.requested_ranges == ["bytes=1000-"])
+        assert (open(output_fname, "rb").read() == self.data)
+
+
+    def test_download_checksum(self):
+        """
+        Test checking downloads against checksums.
+        """
+        print "Testing download checksums"
+        url = "%s/data.txt" %(self.base_url)
+        assert (download_utils.download_url(url, self.output_dir,
+                                            md5sum="0" * 32) is None)
+        assert (os.listdir(self.output_dir) == [])
+        md5sum = hashlib.md5(self.data).hexdigest()
+        assert (download_utils.download_url(url, self.output_dir,
+                                            md5sum=md5sum) is not None)
+
+
+    def test_download_ucsc_tables(self):
+        """
+        Test downloading UCSC tables in parallel from a mirror.
+        """
+        print "Testing UCSC tables download"
+        database_dir = os.path.join(self.serve_dir, "testGenome", "database")
+        os.makedirs(database_dir)
+        md5sums = []
+        for table_label in tables.UCSC_TABLE_LABELS:
+            table_fname = os.path.join(database_dir, table_label)
+            table_out = gzip.open(table_fname, "wb")
+            table_out.write(self.data)
+            table_out.close()
+            md5sums.append("%s  %s\n" \
+                           %(hashlib.md5(open(table_fname, "rb").read()).hexdigest(),
+                             table_label))
+        with open(os.path.join(database_dir,
+                               tables.UCSC_MD5SUMS_FILENAME), "w") as md5_out:
+            md5_out.writelines(md5sums)
+        # Table schemas, from which headers are read; one table has
+        # no schema
+        ensGene_header = tables.UCSC_ENSGENE_HEADER
+        with open(os.path.join(database_dir, "ensGene.sql"), "w") as sql_out:
+            sql_out.write(make_table_schema("ensGene", ensGene_header))
+        table_fnames = tables.download_ucsc_tables("testGenome",
+                                                   self.output_dir,
+                                                   num_processors=4,
+                                                   ucsc_url=self.base_url)
+        assert (len(table_fnames) == len(tables.UCSC_TABLE_LABELS))
+        for table_fname in table_fnames:
+            assert (open(table_fname, "rb").read() == self.data)
+        headers_dir = os.path.join(self.output_dir, "ucsc", "headers")
+        assert (os.listdir(headers_dir) == ["ensGene.header.txt"])
+        assert (tables.load_ucsc_table_headers(self.output_dir)["ensGene"] == \
+                list(ensGene_header))
+
+
+    def test_gunzip_file(self):
+        """
+        Test uncompressing files into an output directory.
+        """
+        print "Testing gunzip"
+        unzipped_dir = os.path.join(self.output_dir, "unzipped")
+        os.makedirs(unzipped_dir)
+        for gz_basename, unzipped_basename in [("data.txt.gz", "data.txt"),
+                                               ("data", "data.txt")]:
+            gz_fname = os.path.join(self.output_dir, gz_basename)
+            gz_out = gzip.open(gz_fname, "wb")
+            gz_out.write(self.data)
+            gz_out.close()
+            # Relative filenames are relative to the current directory
+            cwd = os.getcwd()
+            os.chdir(self.output_dir)
+            try:
+                unzipped_fname = utils.gunzip_file(gz_basename, unzipped_dir)
+            finally:
+                os.chdir(cwd)
+            assert (unzipped_fname == os.path.join(unzipped_dir,
+                                                   unzipped_basename))
+            assert (open(unzipped_fname, "rb").read() == self.data)
+            assert (not os.path.isfile(gz_fname))
+            os.remove(unzipped_fname)
+
+
+    def test_parse_table_schema(self):
+        """
+        Test reading table headers from table schemas.
+        """
+        print "Testing table schemas"
+        for header in [tables.UCSC_ENSGENE_HEADER,
+                       tables.UCSC_KGXREF_HEADER]:
+            schema = make_table_schema("test", header)
+            assert (tables.parse_ucsc_table_schema(schema.splitlines(True)) == \
+                    list(header))
+        assert (tables.parse_ucsc_table_schema([]) == [])
@@ -0,0 +1,187 @@
+##
+## Unit testing for constitutive exons and CDS/UTR parts of gene
+## models, against brute force
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.genes.GeneModel as GeneModel
+
+
+def get_parts_coords(parts):
+    return [(part.start, part.end) for part in parts]
+
+
+def get_bases(coords):
+    return set(base for start, end in coords \
+               for base in xrange(start, end + 1))
+
+
+class TestGeneModel:
+    """
+    Test constitutive exons and derived parts of transcripts.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+
+
+    def make_gene(self, gene_num):
+        """
+        Return a random gene whose transcripts share exons, some
+        with slightly shifted ends.
+        """
+        chrom = "chr1"
+        strand = self.rand.choice(["+", "-"])
+        exon_pool = []
+        pos = 1000
+        for exon_num in xrange(self.rand.randint(1, 6)):
+            pos += self.rand.randint(50, 200)
+            exon_len = self.rand.randint(12, 100)
+            exon_pool.append((pos, pos + exon_len - 1))
+            pos += exon_len
+        transcripts = []
+        for trans_num in xrange(self.rand.randint(1, 5)):
+            exons = [exon for exon in exon_pool if self.rand.rand() < 0.7]
+            if len(exons) == 0:
+                exons = exon_pool[0:1]
+            exons = [(start + self.rand.choice([0, 0, 0, 3, -8]), end) \
+                     for start, end in exons]
+            label = "gene%d.trans%d" %(gene_num, trans_num)
+            parts = [GeneModel.Part(start, end, chrom, strand, parent=label) \
+                     for start, end in exons]
+            cds_start, cds_end = None, None
+            if self.rand.rand() < 0.8:
+                bases = sorted(get_bases(exons))
+                cds_start, cds_end = \
+                    sorted(self.rand.choice(bases, 2, replace=False))
+            transcripts.append(GeneModel.Transcript(parts, chrom, strand,
+                                                    label=label,
+                                                    cds_start=cds_start,
+                                                    cds_end=cds_end,
+                                                    parent="gene%d" %(gene_num)))
+        return GeneModel.Gene(transcripts, chrom, strand,
+                              label="gene%d" %(gene_num))
+
+
+    def get_expected_const_exons(self, gene, base_diff, min_exon_space):
+        """
+        Return the constitutive exons of a gene by checking each
+        distinct exon against each transcript.
+        """
+        transcripts = gene.transcripts
+        exons = []
+        for transcript in transcripts:
+            for part in transcript.parts:
+                if (part.start, part.end) not in exons:
+                    exons.append((part.start, part.end))
+        if len(transcripts) == 1:
+            return exons, ",".join(len(exons) * ["1"])
+        fracs = []
+        for start, end in exons:
+            num_in = len([transcript for transcript in transcripts \
+                          if any(abs(part.start - start) <= base_diff and \
+                                 abs(part.end - end) <= base_diff \
+                                 for part in transcript.parts)])
+            fracs.append(num_in / float(len(transcripts)))
+        max_frac = max(fracs)
+        selected = [exon_num for exon_num in xrange(len(exons)) \
+                    if fracs[exon_num] == max_frac]
+        sum_lens = sum(exons[n][1] - exons[n][0] + 1 for n in selected)
+        others = [n for n in xrange(len(exons)) if fracs[n] != max_frac]
+        if sum_lens < min_exon_space and len(others) > 0:
+            selected.append(max(others, key=lambda n: (fracs[n], -n)))
+        return [exons[n] for n in selected], \
+               ",".join(["%.2f" %(fracs[n]) for n in selected])
+
+
+    def test_const_exons(self):
+        """
+        Test computing constitutive exons of many genes at once
+        against checking each exon.
+        """
+        print "Testing constitutive exons"
+        genes = [self.make_gene(gene_num) for gene_num in xrange(300)]
+        for base_diff, min_exon_space in [(6, 40), (0, 150)]:
+            results = \
+                GeneModel.compute_const_exons_by_gene(genes,
+                                                      base_diff=base_diff,
+                                                      min_exon_space=min_exon_space)
+            for gene, (const_exons, frac_str) in zip(genes, results):
+                expected = self.get_expected_const_exons(gene, base_diff,
+                                                         min_exon_space)
+                assert ((get_parts_coords(const_exons), frac_str) == expected)
+                assert (gene.const_exons == const_exons)
+                if len(gene.transcripts) > 1:
+                    # One gene at a time gives the same exons
+                    single_exons, single_frac_str = \
+                        gene.compute_const_exons(base_diff=base_diff,
+                                                 min_exon_space=min_exon_space)
+                    assert (get_parts_coords(single_exons) == \
+                            expected[0])
+
+
+    def test_derived_parts(self):
+        """
+        Test CDS and UTR parts against the bases of the exons
+        before, in and after the CDS, their memoization and the
+        bulk CDS/UTR intervals.
+        """
+        print "Testing CDS and UTR parts"
+        genes = [self.make_gene(gene_num) for gene_num in xrange(300)]
+        transcripts = [transcript for gene in genes \
+                       for transcript in gene.transcripts]
+        for transcript in transcripts:
+            cds_parts = transcript.get_cds_parts()
+            utr_5p_parts = transcript.get_5p_utr_parts()
+            utr_3p_parts = transcript.get_3p_utr_parts()
+            # Parts are memoized
+            assert (transcript.get_cds_parts() is cds_parts)
+            assert (transcript.get_5p_utr_parts() is utr_5p_parts)
+            if transcript.cds_start is None or \
+               transcript.cds_end - transcript.cds_start + 1 < 10:
+                assert (len(cds_parts) == len(utr_5p_parts) == \
+                        len(utr_3p_parts) == 0)
+                continue
+            exon_bases = get_bases(get_parts_coords(transcript.parts))
+            left_bases = set(base for base in exon_bases \
+                             if base < transcript.cds_start)
+            right_bases = set(base for base in exon_bases \
+                              if base > transcript.cds_end)
+            if transcript.strand == "-":
+                left_bases, right_bases = right_bases, left_bases
+            assert (get_bases(get_parts_coords(utr_5p_parts)) == left_bases)
+            assert (get_bases(get_parts_coords(utr_3p_parts)) == right_bases)
+            assert (get_bases(get_parts_coords(cds_parts)) <= \
+                    set(base for base in exon_bases \
+                        if transcript.cds_start <= base <= transcript.cds_end))
+        # Bulk intervals match the parts of each transcript
+        regions = \
+            GeneModel.get_transcript_regions(*GeneModel.get_transcripts_exon_arrays(transcripts))
+        for region, get_parts in [("cds", lambda t: t.get_cds_parts()),
+                                  ("5p_utr", lambda t: t.get_5p_utr_parts()),
+                                  ("3p_utr", lambda t: t.get_3p_utr_parts())]:
+            trans_inds, starts, ends = regions[region]
+            found = zip(trans_inds.tolist(), starts.tolist(), ends.tolist())
+            expected = [(trans_num, start, end) \
+                        for trans_num, transcript in enumerate(transcripts) \
+                        for start, end in \
+                        get_parts_coords(get_parts(transcript))]
+            assert (found == expected)
+        # Changing the CDS clears the memoized parts
+        transcript = [t for t in transcripts if len(t.get_cds_parts()) > 0][0]
+        cds_parts = transcript.get_cds_parts()
+        transcript.cds_end = transcript.cds_start + 9
+        new_cds_parts = transcript.get_cds_parts()
+        assert (new_cds_parts is not cds_parts)
+        assert (sum(part.end - part.start + 1 for part in new_cds_parts) <= 10)
+        transcript.parts = transcript.parts[0:1]
+        utr_parts = transcript.get_5p_utr_parts() + \
+                    transcript.get_3p_utr_parts()
+        assert (get_bases(get_parts_coords(utr_parts)) == \
+                get_bases(get_parts_coords(transcript.parts)) - \
+                get_bases([(transcript.cds_start, transcript.cds_end)]))
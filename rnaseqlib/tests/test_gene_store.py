@@ -0,0 +1,94 @@
+##
+## Unit testing for array-backed gene stores, against GeneModel
+## gene models of the same table
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.genes.GeneModel as GeneModel
+
+
+def get_parts_info(parts):
+    return [(part.start, part.end, part.chrom, part.strand, part.label) \
+            for part in parts]
+
+
+def get_transcript_info(transcript):
+    """
+    Return the attributes of a transcript (or transcript view)
+    and its parts, for comparison.
+    """
+    return (transcript.label,
+            transcript.parent,
+            transcript.chrom,
+            transcript.strand,
+            transcript.cds_start,
+            transcript.cds_end,
+            get_parts_info(transcript.parts),
+            get_parts_info(transcript.get_cds_parts()),
+            get_parts_info(transcript.get_5p_utr_parts()),
+            get_parts_info(transcript.get_3p_utr_parts()))
+
+
+class TestGeneStore:
+    """
+    Test gene store views of genes.
+    """
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_gene_store.")
+        self.table_dir = os.path.join(self.tmp_dir, "ucsc")
+        self.ensGene_fname, self.gene_table = \
+            test_utils.make_test_gene_table(self.tmp_dir, self.table_dir)
+        self.genes = \
+            self.gene_table.get_ensGene_by_genes(self.ensGene_fname,
+                                                 use_cache=False)
+        self.gene_store = self.gene_table.get_ensGene_store(self.ensGene_fname)
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def test_gene_store(self):
+        """
+        Test that gene store views match gene models.
+        """
+        print "Testing gene store"
+        assert (len(self.genes) > 0)
+        assert (sorted(self.gene_store.keys()) == sorted(self.genes.keys()))
+        for gene_id, gene in self.genes.iteritems():
+            gene_view = self.gene_store[gene_id]
+            assert (gene_view.label == gene.label)
+            assert (gene_view.chrom == gene.chrom)
+            assert (gene_view.strand == gene.strand)
+            assert (gene_view.gene_symbol == gene.gene_symbol)
+            assert (map(get_transcript_info, gene_view.transcripts) == \
+                    map(get_transcript_info, gene.transcripts))
+            for cds_only in [False, True]:
+                assert (get_parts_info(gene_view.get_parts(cds_only=cds_only)) == \
+                        get_parts_info(gene.get_parts(cds_only=cds_only)))
+            assert (list(gene_view.get_inclusive_trans_coords()) == \
+                    list(gene.get_inclusive_trans_coords()))
+            for cds_only in [False, True]:
+                view_exons, view_fracs = \
+                    GeneModel.compute_const_exons_by_gene([gene_view],
+                                                          cds_only=cds_only)[0]
+                exons, fracs = \
+                    GeneModel.compute_const_exons_by_gene([gene],
+                                                          cds_only=cds_only)[0]
+                assert (get_parts_info(view_exons) == get_parts_info(exons))
+                assert (view_fracs == fracs)
+            assert (map(get_transcript_info, gene_view.to_gene().transcripts) == \
+                    map(get_transcript_info, gene.transcripts))
+        # The saved store is reused while the tables are unchanged
+        store_checksum_fname = os.path.join(self.table_dir, "ensGene.store",
+                                            "checksum.txt")
+        store_checksum = open(store_checksum_fname).read()
+        self.gene_table.get_ensGene_store(self.ensGene_fname)
+        assert (open(store_checksum_fname).read() == store_checksum)
@@ -0,0 +1,163 @@
+##
+## Unit testing for annotating events GFFs with gene information,
+## against containment of event genes in table genes by brute force
+##
+import os
+import sys
+import time
+import shutil
+import random
+import tempfile
+import argparse
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.utils as utils
+import rnaseqlib.gff.gff_annotate_events as gff_annotate_events
+
+TABLE_HEADER = ["chrom", "txStart", "txEnd", "strand", "name2",
+                "refseq", "geneSymbol"]
+
+
+def output_table(table_fname, table_rows):
+    """
+    Output a combined kgXref table with the given rows.
+    """
+    with open(table_fname, "w") as table_out:
+        table_out.write("%s\n" %("\t".join(TABLE_HEADER)))
+        for row in table_rows:
+            table_out.write("%s\n" %("\t".join(map(str, row))))
+
+
+def output_events_gff(gff_fname, event_rows):
+    """
+    Output an events GFF: a gene record, with the given extra
+    attributes, and an mRNA record per event.
+    """
+    with open(gff_fname, "w") as gff_out:
+        for chrom, strand, start, end, event_id, extra_attrs in event_rows:
+            gff_out.write("\t".join([chrom, "SE", "gene", str(start),
+                                     str(end), ".", strand, ".",
+                                     "ID=%s;Name=%s%s" %(event_id, event_id,
+                                                         extra_attrs)]) + "\n")
+            gff_out.write("\t".join([chrom, "SE", "mRNA", str(start),
+                                     str(end), ".", strand, ".",
+                                     "ID=%s.A;Parent=%s" %(event_id,
+                                                           event_id)]) + "\n")
+
+
+def load_annotated_genes(gff_fname):
+    """
+    Return the attributes of the gene records of a GFF, by ID.
+    """
+    genes = {}
+    with open(gff_fname) as gff_in:
+        for line in gff_in:
+            fields = line.rstrip("\n").split("\t")
+            if fields[2] == "gene":
+                attributes = utils.parse_attributes(fields[8])
+                genes[attributes["ID"]] = attributes
+    return genes
+
+
+class TestGFFAnnotateEvents:
+    """
+    Test annotating events with the genes that contain them.
+    """
+    def setup(self):
+        self.rand = random.Random(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_gff_annotate_events.")
+        self.table_fname = os.path.join(self.tmp_dir,
+                                        "ensGene.kgXref.combined.txt")
+        self.gff_fname = os.path.join(self.tmp_dir, "SE.gff3")
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def annotate(self):
+        args = argparse.Namespace(gff_filename=self.gff_fname,
+                                  table_filename=self.table_fname)
+        gff_annotate_events.annotate_gff_with_genes(args)
+        return load_annotated_genes(self.gff_fname)
+
+
+    def test_annotate_events(self):
+        """
+        Test gene information of events against containment by
+        brute force.
+        """
+        print "Testing annotation of events"
+        table_rows = []
+        for gene_num in xrange(200):
+            # Table starts are 0-based
+            tx_start = self.rand.randint(0, 20000)
+            tx_end = tx_start + self.rand.randint(1, 3000)
+            table_rows.append([self.rand.choice(["chr1", "chr2"]),
+                               tx_start, tx_end,
+                               self.rand.choice("+-"),
+                               self.rand.choice(["ENSG%d" %(gene_num), ""]),
+                               self.rand.choice(["NM_%d" %(gene_num % 50),
+                                                 ""]),
+                               "G%d" %(gene_num % 30)])
+        output_table(self.table_fname, table_rows)
+        event_rows = []
+        for event_num in xrange(300):
+            start = self.rand.randint(1, 22000)
+            end = start + self.rand.randint(0, 500)
+            event_rows.append((self.rand.choice(["chr1", "chr2", "chr3"]),
+                               self.rand.choice("+-"), start, end,
+                               "event%d" %(event_num), ""))
+        output_events_gff(self.gff_fname, event_rows)
+        genes = self.annotate()
+        assert (len(genes) == len(event_rows))
+        for chrom, strand, start, end, event_id, extra_attrs in event_rows:
+            containing = [row for row in table_rows \
+                          if row[0] == chrom and row[3] == strand and \
+                          row[1] + 1 <= start and end <= row[2]]
+            for attr_name, col in (("ensg_id", 4), ("refseq_id", 5),
+                                   ("gsymbol", 6)):
+                vals = utils.unique_list([str(row[col]) for row in containing \
+                                          if row[col] != ""])
+                expected = "NA"
+                if len(vals) > 0:
+                    expected = ",".join(vals)
+                assert (genes[event_id][attr_name] == expected)
+
+
+    def test_existing_attributes(self):
+        """
+        Test that existing gene information attributes are kept
+        unless a table gene contains the event.
+        """
+        print "Testing existing gene information attributes"
+        output_table(self.table_fname,
+                     [["chr1", 99, 1000, "+", "ENSG1", "NM_1", "G1"]])
+        existing_attrs = ";ensg_id=ENSG0;refseq_id=NM_0;gsymbol=G0"
+        output_events_gff(self.gff_fname,
+                          [("chr1", "+", 200, 300, "contained",
+                            existing_attrs),
+                           ("chr1", "-", 200, 300, "other_strand",
+                            existing_attrs),
+                           ("chr1", "+", 900, 1100, "not_contained", ""),
+                           ("chr1", "+", 100, 1000, "same_coords", "")])
+        genes = self.annotate()
+        assert ([genes["contained"][attr_name] for attr_name in \
+                 gff_annotate_events.GENE_INFO_ATTRIBUTES] == \
+                ["ENSG1", "NM_1", "G1"])
+        assert ([genes["other_strand"][attr_name] for attr_name in \
+                 gff_annotate_events.GENE_INFO_ATTRIBUTES] == \
+                ["ENSG0", "NM_0", "G0"])
+        assert ([genes["not_contained"][attr_name] for attr_name in \
+                 gff_annotate_events.GENE_INFO_ATTRIBUTES] == \
+                ["NA", "NA", "NA"])
+        assert ([genes["same_coords"][attr_name] for attr_name in \
+                 gff_annotate_events.GENE_INFO_ATTRIBUTES] == \
+                ["ENSG1", "NM_1", "G1"])
+        # Existing attributes keep their position in the record
+        with open(self.gff_fname) as gff_in:
+            gene_lines = [line for line in gff_in if "\tgene\t" in line]
+        assert (gene_lines[0].rstrip("\n").split("\t")[8] == \
+                "ID=contained;Name=contained;ensg_id=ENSG1;" \
+                "refseq_id=NM_1;gsymbol=G1")
@@ -0,0 +1,111 @@
+##
+## Unit testing for GTF to GFF3 conversion, against the output
+## of gtf2gff3.pl
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.gff.gtf_utils as gtf_utils
+
+# Transcripts as output by genePredToGtf: a plus strand transcript,
+# a minus strand transcript and a transcript whose CDS is incomplete
+# at its 5' end (no start codon, first CDS frame of 2)
+TEST_GTF = """\
+chr1\ttest\texon\t101\t200\t.\t+\t.\tgene_id "gp"; transcript_id "tp";
+chr1\ttest\texon\t301\t400\t.\t+\t.\tgene_id "gp"; transcript_id "tp";
+chr1\ttest\texon\t501\t600\t.\t+\t.\tgene_id "gp"; transcript_id "tp";
+chr1\ttest\tCDS\t151\t200\t.\t+\t0\tgene_id "gp"; transcript_id "tp";
+chr1\ttest\tCDS\t301\t400\t.\t+\t1\tgene_id "gp"; transcript_id "tp";
+chr1\ttest\tCDS\t501\t548\t.\t+\t0\tgene_id "gp"; transcript_id "tp";
+chr1\ttest\tstart_codon\t151\t153\t.\t+\t0\tgene_id "gp"; transcript_id "tp";
+chr1\ttest\tstop_codon\t549\t551\t.\t+\t0\tgene_id "gp"; transcript_id "tp";
+chr1\ttest\texon\t1101\t1200\t.\t-\t.\tgene_id "gm"; transcript_id "tm";
+chr1\ttest\texon\t1301\t1400\t.\t-\t.\tgene_id "gm"; transcript_id "tm";
+chr1\ttest\texon\t1501\t1600\t.\t-\t.\tgene_id "gm"; transcript_id "tm";
+chr1\ttest\tCDS\t1501\t1550\t.\t-\t0\tgene_id "gm"; transcript_id "tm";
+chr1\ttest\tCDS\t1301\t1400\t.\t-\t1\tgene_id "gm"; transcript_id "tm";
+chr1\ttest\tCDS\t1153\t1200\t.\t-\t0\tgene_id "gm"; transcript_id "tm";
+chr1\ttest\tstart_codon\t1548\t1550\t.\t-\t0\tgene_id "gm"; transcript_id "tm";
+chr1\ttest\tstop_codon\t1150\t1152\t.\t-\t0\tgene_id "gm"; transcript_id "tm";
+chr1\ttest\texon\t2101\t2200\t.\t+\t.\tgene_id "gi"; transcript_id "ti";
+chr1\ttest\texon\t2301\t2400\t.\t+\t.\tgene_id "gi"; transcript_id "ti";
+chr1\ttest\tCDS\t2101\t2200\t.\t+\t2\tgene_id "gi"; transcript_id "ti";
+chr1\ttest\tCDS\t2301\t2360\t.\t+\t1\tgene_id "gi"; transcript_id "ti";
+chr1\ttest\tstop_codon\t2361\t2363\t.\t+\t0\tgene_id "gi"; transcript_id "ti";
+"""
+
+# CDS records (start, end, strand, phase) that gtf2gff3.pl outputs
+# for each transcript of TEST_GTF, in 5' to 3' order
+GTF2GFF3_CDS = {"tp": [(151, 200, "+", 0),
+                       (301, 400, "+", 1),
+                       (501, 551, "+", 0)],
+                "tm": [(1501, 1550, "-", 0),
+                       (1301, 1400, "-", 1),
+                       (1150, 1200, "-", 0)],
+                "ti": [(2101, 2200, "+", 2),
+                       (2301, 2363, "+", 1)]}
+
+
+class TestGTFUtils:
+    """
+    Test converting GTF to GFF3.
+    """
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_gtf_utils.")
+        self.gtf_filename = os.path.join(self.tmp_dir, "genes.gtf")
+        with open(self.gtf_filename, "w") as gtf_out:
+            gtf_out.write(TEST_GTF)
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def test_cds_phases(self):
+        """
+        Test that CDS records and their phases match gtf2gff3.pl.
+        """
+        print "Testing CDS phases"
+        for num_processors in [1, 2]:
+            gff3_filename = os.path.join(self.tmp_dir,
+                                         "genes.%d.gff3" %(num_processors))
+            gtf_utils.gtf_to_gff3(self.gtf_filename, gff3_filename,
+                                  num_processors=num_processors)
+            cds_recs = {}
+            with open(gff3_filename) as gff3_in:
+                for line in gff3_in:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) < 9 or fields[2] != "CDS":
+                        continue
+                    attributes = dict(attr.split("=") \
+                                      for attr in fields[8].split(";"))
+                    parent = attributes["Parent"]
+                    if parent not in cds_recs:
+                        cds_recs[parent] = []
+                    cds_recs[parent].append((int(fields[3]), int(fields[4]),
+                                             fields[6], int(fields[7])))
+            assert (cds_recs == GTF2GFF3_CDS)
+
+
+    def test_first_cds_frame(self):
+        """
+        Test phases of CDS parts starting from a first frame.
+        """
+        print "Testing phases from a first CDS frame"
+        cds_parts = [(1, 10), (21, 25), (31, 32), (41, 50)]
+        assert (gtf_utils.get_cds_phases(cds_parts) == [0, 2, 0, 1])
+        # A CDS that is incomplete at its 5' end starts mid-codon:
+        # skipping the first frame bases gives a complete CDS
+        for first_frame in xrange(3):
+            phases = gtf_utils.get_cds_phases(cds_parts,
+                                              first_frame=first_frame)
+            assert (phases[0] == first_frame)
+            cds_len = 0
+            for (start, end), phase in zip(cds_parts, phases):
+                assert ((cds_len + phase - first_frame) % 3 == 0)
+                cds_len += end - start + 1
@@ -0,0 +1,214 @@
+##
+## Unit testing for indexed GFF files: region, batch region and
+## record queries against a linear scan of the records
+##
+import os
+import sys
+import time
+import shutil
+import random
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.gff.IndexedGFF as IndexedGFF
+import rnaseqlib.miso.intersect_events as intersect_events
+
+
+def output_random_gff(gff_filename, num_genes, rand):
+    """
+    Output a GFF of random genes, each with two mRNAs of two
+    exons.
+    """
+    with open(gff_filename, "w") as gff_out:
+        gff_out.write("##gff-version 3\n")
+        for gene_num in xrange(num_genes):
+            chrom = "chr%d" %(rand.randint(1, 3))
+            start = rand.randint(1, 100000)
+            end = start + rand.randint(0, 5000)
+            strand = rand.choice("+-")
+            gene_id = "gene%d" %(gene_num)
+            recs = [("gene", start, end, "ID=%s;Name=%s" %(gene_id, gene_id))]
+            for trans_num in xrange(2):
+                trans_id = "%s.mRNA%d" %(gene_id, trans_num)
+                recs.append(("mRNA", start, end,
+                             "ID=%s;Parent=%s" %(trans_id, gene_id)))
+                for exon_num in xrange(2):
+                    exon_start = rand.randint(start, end)
+                    exon_end = min(exon_start + rand.randint(0, 200), end)
+                    recs.append(("exon", exon_start, exon_end,
+                                 "ID=%s.exon%d;Parent=%s" %(trans_id, exon_num,
+                                                            trans_id)))
+            for rec_type, rec_start, rec_end, attributes in recs:
+                gff_out.write("\t".join([chrom, "test", rec_type,
+                                         str(rec_start), str(rec_end),
+                                         ".", strand, ".",
+                                         attributes]) + "\n")
+
+
+def load_gff_records(gff_filename):
+    """
+    Return all records of a GFF file, by a linear scan.
+    """
+    with open(gff_filename) as gff_in:
+        return [IndexedGFF.parse_gff_line(line) for line in gff_in \
+                if line.strip() != "" and not line.startswith("#")]
+
+
+def get_overlapping_records(recs, chrom, start, end,
+                            strand=None,
+                            record_types=None):
+    """
+    Return the records that overlap a region, by a linear scan.
+    """
+    return [rec for rec in recs \
+            if rec.seqid == chrom and rec.start <= end and rec.end >= start \
+            and (strand is None or rec.strand == strand) \
+            and (record_types is None or rec.type in record_types)]
+
+
+class TestIndexedGFF:
+    """
+    Test querying indexed GFF files.
+    """
+    def setup(self):
+        self.rand = random.Random(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_indexed_gff.")
+        self.gff_filename = os.path.join(self.tmp_dir, "genes.gff3")
+        output_random_gff(self.gff_filename, 300, self.rand)
+        self.ri_gff_filename = os.path.join(self.tmp_dir, "RI.gff3")
+        shutil.copy(test_utils.load_test_data(os.path.join("ri-test",
+                                                           "RI.gff3")),
+                    self.ri_gff_filename)
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def get_random_regions(self, recs, num_regions):
+        """
+        Return random regions (chrom, start, end, strand) near
+        records, and some on chromosomes without records.
+        """
+        regions = []
+        for region_num in xrange(num_regions):
+            rec = self.rand.choice(recs)
+            chrom = rec.seqid
+            if self.rand.random() < 0.05:
+                chrom = "chrNone"
+            start = self.rand.randint(max(1, rec.start - 3000), rec.end)
+            end = start + self.rand.randint(0, 3000)
+            strand = self.rand.choice([None, "+", "-"])
+            regions.append((chrom, start, end, strand))
+        return regions
+
+
+    def test_region_queries(self):
+        """
+        Test querying records in a region.
+        """
+        print "Testing region queries"
+        for gff_filename in [self.gff_filename, self.ri_gff_filename]:
+            recs = load_gff_records(gff_filename)
+            # Query both a newly built and a saved index
+            for indexed_gff in [IndexedGFF.IndexedGFF(gff_filename),
+                                IndexedGFF.IndexedGFF(gff_filename)]:
+                assert (os.path.isfile(gff_filename + IndexedGFF.INDEX_EXT))
+                for record_types in [None, ["gene"], ["mRNA", "exon"]]:
+                    for chrom, start, end, strand in \
+                        self.get_random_regions(recs, 100):
+                        expected = \
+                            get_overlapping_records(recs, chrom, start, end,
+                                                    strand=strand,
+                                                    record_types=record_types)
+                        found = \
+                            indexed_gff.get_records_in_region(chrom, start, end,
+                                                              strand=strand,
+                                                              record_types=record_types)
+                        assert (sorted(map(str, found)) == \
+                                sorted(map(str, expected)))
+                        assert ([rec.start for rec in found] == \
+                                sorted(rec.start for rec in found))
+                indexed_gff.close()
+
+
+    def test_index_stamp(self):
+        """
+        Test that an index is rebuilt when its GFF changes.
+        """
+        print "Testing index stamps"
+        IndexedGFF.IndexedGFF(self.gff_filename).close()
+        gff_mtime = os.stat(self.gff_filename).st_mtime
+        # Rewrite the GFF within the same second, keeping its size
+        with open(self.gff_filename) as gff_in:
+            gff_lines = gff_in.readlines()
+        gff_lines[1] = gff_lines[1].replace("chr", "CHR", 1)
+        chrom = gff_lines[1].split("\t")[0]
+        with open(self.gff_filename, "w") as gff_out:
+            gff_out.writelines(gff_lines)
+        test_utils.touch_within_second(self.gff_filename, gff_mtime)
+        indexed_gff = IndexedGFF.IndexedGFF(self.gff_filename)
+        found = indexed_gff.get_records_in_region(chrom, 1, 200000)
+        assert (len(found) == 1)
+        assert (map(str, found) == \
+                map(str, get_overlapping_records(\
+                    load_gff_records(self.gff_filename), chrom, 1, 200000)))
+        indexed_gff.close()
+
+
+    def test_batch_region_queries(self):
+        """
+        Test querying records in many regions at once.
+        """
+        print "Testing batch region queries"
+        recs = load_gff_records(self.gff_filename)
+        indexed_gff = IndexedGFF.IndexedGFF(self.gff_filename)
+        regions = self.get_random_regions(recs, 1000)
+        chroms, starts, ends, strands = zip(*regions)
+        for record_types in [None, ["gene"], ["mRNA", "exon"]]:
+            found = indexed_gff.get_records_in_regions(chroms, starts, ends,
+                                                       strands=strands,
+                                                       record_types=record_types)
+            assert (len(found) == len(regions))
+            for (chrom, start, end, strand), region_recs in \
+                zip(regions, found):
+                expected = \
+                    get_overlapping_records(recs, chrom, start, end,
+                                            strand=strand,
+                                            record_types=record_types)
+                assert (sorted(map(str, region_recs)) == \
+                        sorted(map(str, expected)))
+        assert (indexed_gff.get_records_in_regions([], [], []) == [])
+        indexed_gff.close()
+        # Events in regions match querying the regions one by one
+        region_strs = ["%s:%d-%d" %(chrom, start, end) \
+                       for chrom, start, end, strand in regions[0:100]]
+        events = intersect_events.get_events_in_regions(self.gff_filename,
+                                                        region_strs)
+        for region_str, region_events in zip(region_strs, events):
+            assert (map(str, region_events) == \
+                    map(str, intersect_events.get_events_in_region(self.gff_filename,
+                                                                   region_str)))
+
+
+    def test_record_lookup(self):
+        """
+        Test looking up records and record trees by ID.
+        """
+        print "Testing record lookup"
+        recs = load_gff_records(self.gff_filename)
+        indexed_gff = IndexedGFF.IndexedGFF(self.gff_filename)
+        for rec in recs:
+            assert (str(indexed_gff.get_record(rec.get_id())) == str(rec))
+        assert (indexed_gff.get_record("missing") is None)
+        # Record trees cover all records
+        num_tree_recs = 0
+        for top_rec, child_recs in indexed_gff.iter_record_trees():
+            assert (top_rec.type == "gene")
+            assert (all(child_rec.seqid == top_rec.seqid \
+                        for child_rec in child_recs))
+            num_tree_recs += 1 + len(child_recs)
+        assert (num_tree_recs == len(recs))
+        indexed_gff.close()
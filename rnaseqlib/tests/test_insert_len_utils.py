@@ -0,0 +1,134 @@
+##
+## Unit testing for insert length estimation from paired-end
+## alignments, against the insert lengths of simulated pairs
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.bam.insert_len_utils as insert_len_utils
+
+
+class FakeConstExons:
+    """
+    Constitutive exons with only exon lengths, as used by
+    get_const_exon_regions.
+    """
+    def __init__(self, exon_lens):
+        self.exon_lens = exon_lens
+
+
+class TestInsertLenUtils:
+    """
+    Test estimating insert lengths in constitutive exon regions.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_insert_len_utils.")
+        self.refs = [("chr1", 20000), ("chr2", 20000)]
+        # Disjoint regions, 1-based inclusive
+        self.regions = [("chr1", 1001, 3000), ("chr1", 5001, 6000),
+                        ("chr2", 2001, 4000), ("chrNone", 1, 1000)]
+        self.read_len = 20
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def make_pairs(self, num_pairs):
+        """
+        Return SAM lines of random read pairs in and around the
+        regions, and the insert lengths of the pairs that should
+        be counted.
+        """
+        read_lines = []
+        expected_lens = []
+        for pair_num in xrange(num_pairs):
+            chrom, start, end = \
+                self.regions[self.rand.randint(0, len(self.regions) - 1)]
+            insert_len = int(self.rand.normal(200, 30))
+            if self.rand.rand() < 0.02:
+                # Outlying insert length
+                insert_len = 900
+            left_start = self.rand.randint(start - 100, end)
+            right_start = left_start + insert_len - self.read_len
+            is_proper = (self.rand.rand() < 0.9)
+            left_cigar = "%dM" %(self.read_len)
+            if self.rand.rand() < 0.1:
+                left_cigar = "10M50N10M"
+                right_start += 50
+            left_flag = 99 if is_proper else 97
+            right_flag = 147 if is_proper else 145
+            read_name = "pair%d" %(pair_num)
+            seq = "A" * self.read_len
+            qual = "I" * self.read_len
+            tlen = right_start + self.read_len - left_start
+            read_lines.append([read_name, left_flag, chrom, left_start, 255,
+                               left_cigar, "=", right_start, tlen,
+                               seq, qual])
+            read_lines.append([read_name, right_flag, chrom, right_start, 255,
+                               "%dM" %(self.read_len), "=", left_start,
+                               -tlen, seq, qual])
+            if is_proper and left_cigar == "%dM" %(self.read_len) and \
+               left_start >= start and left_start + tlen - 1 <= end:
+                expected_lens.append(tlen)
+        return read_lines, expected_lens
+
+
+    def test_compute_insert_lens(self):
+        """
+        Test insert length distribution against simulated pairs.
+        """
+        print "Testing insert length estimation"
+        read_lines, expected_lens = self.make_pairs(2000)
+        bam_filename = test_utils.make_test_bam(os.path.join(self.tmp_dir,
+                                                             "pairs.bam"),
+                                                self.refs, read_lines)
+        insert_len_dist = \
+            insert_len_utils.compute_insert_lens(bam_filename, self.regions)
+        expected_lens = np.array(expected_lens)
+        mu, sdev = expected_lens.mean(), expected_lens.std()
+        expected_lens = expected_lens[(expected_lens >= mu - 2 * sdev) & \
+                                      (expected_lens <= mu + 2 * sdev)]
+        assert (insert_len_dist["num_pairs"] == len(expected_lens))
+        assert (np.allclose(insert_len_dist["mean"], expected_lens.mean()))
+        assert (np.allclose(insert_len_dist["sdev"], expected_lens.std()))
+        assert ((insert_len_dist["hist"] == np.bincount(expected_lens)).all())
+        assert (900 not in insert_len_dist["hist"].nonzero()[0])
+        # Sampling is bounded
+        insert_len_dist = \
+            insert_len_utils.compute_insert_lens(bam_filename, self.regions,
+                                                 max_pairs=100)
+        assert (0 < insert_len_dist["num_pairs"] <= 100)
+        # Regions without pairs
+        assert (insert_len_utils.compute_insert_lens(bam_filename,
+                                                     self.regions[-1:]) \
+                is None)
+        # Output and load the distribution
+        insert_len_filename = os.path.join(self.tmp_dir, "pairs.insert_len")
+        insert_len_utils.output_insert_lens(insert_len_dist,
+                                            insert_len_filename)
+        assert (np.allclose(insert_len_utils.load_insert_len_mean(insert_len_filename),
+                            insert_len_dist["mean"], atol=0.05))
+
+
+    def test_const_exon_regions(self):
+        """
+        Test getting long constitutive exon regions.
+        """
+        print "Testing constitutive exon regions"
+        const_exons = \
+            FakeConstExons({"chr1:100-700:+": 601,
+                            "chr1:1000-1200:-": 201,
+                            "chr2:50-1049:-": 1000,
+                            "bad_label": 1000})
+        assert (insert_len_utils.get_const_exon_regions(const_exons) == \
+                [("chr1", 100, 700), ("chr2", 50, 1049)])
@@ -0,0 +1,156 @@
+##
+## Unit testing for operations on interval arrays, against
+## brute force
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.interval_utils as interval_utils
+
+
+def get_runs(bases):
+    """
+    Return the maximal runs of consecutive bases in a set,
+    as sorted (start, end) half-open intervals.
+    """
+    runs = []
+    for base in sorted(bases):
+        if len(runs) > 0 and runs[-1][1] == base:
+            runs[-1][1] = base + 1
+        else:
+            runs.append([base, base + 1])
+    return [tuple(run) for run in runs]
+
+
+def get_covered_bases(starts, ends):
+    covered = set()
+    for start, end in zip(starts, ends):
+        covered.update(xrange(start, end))
+    return covered
+
+
+class TestIntervals:
+    """
+    Test merging, subtracting and complementing intervals.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+
+
+    def make_intervals(self, num_intervals, chrom_names=["chr1", "chr2"]):
+        """
+        Return random intervals: chroms, strands, starts and ends.
+        """
+        chroms = np.array(self.rand.choice(chrom_names, num_intervals),
+                          dtype="S")
+        strands = np.array(self.rand.choice(["+", "-"], num_intervals),
+                           dtype="S")
+        starts = self.rand.randint(0, 200, num_intervals).astype(np.int64)
+        ends = starts + self.rand.randint(1, 30, num_intervals)
+        return chroms, strands, starts, ends
+
+
+    def test_merge_intervals(self):
+        """
+        Test merging intervals against connected components of
+        overlapping intervals.
+        """
+        print "Testing merging of intervals"
+        for trial in xrange(100):
+            num_intervals = self.rand.randint(1, 40)
+            chroms, strands, starts, ends = self.make_intervals(num_intervals)
+            distance = self.rand.randint(0, 3)
+            use_strands = (trial % 2 == 0)
+            keys = zip(chroms, strands) if use_strands else zip(chroms)
+            # Brute force: merge components of intervals with the
+            # same key that are at most 'distance' apart
+            components = range(num_intervals)
+            def find(i):
+                while components[i] != i:
+                    i = components[i]
+                return i
+            for i in xrange(num_intervals):
+                for j in xrange(num_intervals):
+                    if keys[i] == keys[j] and \
+                       starts[j] <= ends[i] + distance and \
+                       starts[i] <= ends[j] + distance:
+                        components[find(i)] = find(j)
+            expected = {}
+            for i in xrange(num_intervals):
+                comp = find(i)
+                if comp not in expected:
+                    expected[comp] = [chroms[i], starts[i], ends[i]]
+                expected[comp][1] = min(expected[comp][1], starts[i])
+                expected[comp][2] = max(expected[comp][2], ends[i])
+            first_inds, merged_starts, merged_ends, interval_merged = \
+                interval_utils.merge_intervals(chroms, starts, ends,
+                                               strands=strands if use_strands \
+                                               else None,
+                                               distance=distance)
+            merged = zip(chroms[first_inds].tolist(), merged_starts.tolist(),
+                         merged_ends.tolist())
+            assert (sorted(merged) == \
+                    sorted(tuple(interval) for interval in expected.values()))
+            # Merged intervals are sorted by chromosome and start
+            assert ([interval[0:2] for interval in merged] == \
+                    sorted([interval[0:2] for interval in merged]))
+            for i in xrange(num_intervals):
+                assert (merged[interval_merged[i]] == \
+                        tuple(expected[find(i)]))
+
+
+    def test_subtract_intervals(self):
+        """
+        Test subtracting intervals against sets of bases.
+        """
+        print "Testing subtraction of intervals"
+        for trial in xrange(100):
+            chroms, strands, starts, ends = \
+                self.make_intervals(self.rand.randint(0, 30))
+            sub_chroms, sub_strands, sub_starts, sub_ends = \
+                self.make_intervals(self.rand.randint(0, 30),
+                                    chrom_names=["chr1", "chr3"])
+            interval_inds, piece_starts, piece_ends = \
+                interval_utils.subtract_intervals(chroms, starts, ends,
+                                                  sub_chroms,
+                                                  sub_starts,
+                                                  sub_ends)
+            for i in xrange(len(starts)):
+                on_chrom = (sub_chroms == chroms[i])
+                remaining = set(xrange(starts[i], ends[i])) - \
+                    get_covered_bases(sub_starts[on_chrom], sub_ends[on_chrom])
+                pieces = zip(piece_starts[interval_inds == i].tolist(),
+                             piece_ends[interval_inds == i].tolist())
+                assert (pieces == get_runs(remaining))
+
+
+    def test_complement_intervals(self):
+        """
+        Test complementing intervals within group bounds against
+        sets of bases.
+        """
+        print "Testing complement of intervals"
+        num_groups = 4
+        for trial in xrange(100):
+            chroms, strands, starts, ends = \
+                self.make_intervals(self.rand.randint(1, 30))
+            groups = self.rand.randint(0, num_groups, len(starts))
+            bound_starts = self.rand.randint(0, 100, num_groups)
+            bound_ends = bound_starts + self.rand.randint(0, 200, num_groups)
+            comp_groups, comp_starts, comp_ends = \
+                interval_utils.complement_intervals(groups, starts, ends,
+                                                    bound_starts,
+                                                    bound_ends)
+            for group in xrange(num_groups):
+                remaining = \
+                    set(xrange(bound_starts[group], bound_ends[group])) - \
+                    get_covered_bases(starts[groups == group],
+                                      ends[groups == group])
+                pieces = zip(comp_starts[comp_groups == group].tolist(),
+                             comp_ends[comp_groups == group].tolist())
+                assert (pieces == get_runs(remaining))
@@ -0,0 +1,166 @@
+##
+## Unit testing for intron retention metrics, against coverage
+## computed base by base
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.bam.intron_retention_utils as intron_retention_utils
+
+
+class TestIntronRetention:
+    """
+    Test computing intron retention metrics from BAM files.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_intron_retention.")
+        self.refs = [("chr1", 3000), ("chr2", 3000)]
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def make_reads(self, num_reads, chrom_len):
+        """
+        Return random SAM lines and, per chromosome, the base by
+        base coverage and junction read counts of the reads.
+        """
+        read_lines = []
+        coverage = dict((chrom, np.zeros(chrom_len + 1, dtype=np.int64)) \
+                        for chrom, ref_len in self.refs)
+        jxn_counts = dict((chrom, {}) for chrom, ref_len in self.refs)
+        for read_num in xrange(num_reads):
+            chrom = self.refs[self.rand.randint(0, len(self.refs))][0]
+            pos = self.rand.randint(1, chrom_len - 600)
+            jxns = []
+            if self.rand.rand() < 0.3:
+                intron_len = self.rand.choice([100, 200, 300])
+                cigar = "15M%dN15M" %(intron_len)
+                blocks = [(pos, pos + 14),
+                          (pos + 15 + intron_len, pos + 29 + intron_len)]
+                jxns.append((pos + 15, pos + 14 + intron_len))
+            else:
+                cigar = "10M2D20M"
+                blocks = [(pos, pos + 31)]
+            flag = 0
+            if self.rand.rand() < 0.05:
+                # Secondary alignments are not counted
+                flag = 256
+            else:
+                for start, end in blocks:
+                    coverage[chrom][start:end + 1] += 1
+                for jxn in jxns:
+                    jxn_counts[chrom][jxn] = jxn_counts[chrom].get(jxn, 0) + 1
+            read_lines.append(["read%d" %(read_num), flag, chrom, pos, 255,
+                               cigar, "*", 0, 0, "A" * 30, "I" * 30])
+        return read_lines, coverage, jxn_counts
+
+
+    def make_introns(self, jxn_counts, num_introns, chrom_len):
+        """
+        Return random introns, including ones at junctions of reads
+        and ones on chromosomes without reads.
+        """
+        introns = []
+        for intron_num in xrange(num_introns):
+            chrom = str(self.rand.choice(["chr1", "chr2", "chrNone"]))
+            if chrom in jxn_counts and self.rand.rand() < 0.5:
+                start, end = \
+                    sorted(jxn_counts[chrom].keys())[self.rand.randint(0, 10)]
+            else:
+                start = self.rand.randint(100, chrom_len - 600)
+                end = start + self.rand.randint(0, 300)
+            flank_len = self.rand.randint(1, 50)
+            introns.append(("intron%d" %(intron_num), chrom, "+", start, end,
+                            max(start - flank_len, 1), start - 1,
+                            end + 1, end + self.rand.randint(1, 50)))
+        return introns
+
+
+    def test_compute_intron_retention(self):
+        """
+        Test intron and flanking exon median coverage and junction
+        reads against base by base coverage.
+        """
+        print "Testing intron retention"
+        chrom_len = 3000
+        read_lines, coverage, jxn_counts = self.make_reads(1500, chrom_len)
+        bam_filename = test_utils.make_test_bam(os.path.join(self.tmp_dir,
+                                                             "reads.bam"),
+                                                self.refs, read_lines)
+        introns = self.make_introns(jxn_counts, 200, chrom_len)
+        for max_batch_bases in [10000000, 500]:
+            ir = \
+                intron_retention_utils.compute_intron_retention(bam_filename,
+                                                                introns,
+                                                                max_batch_bases=\
+                                                                  max_batch_bases)
+            for intron_num, intron in enumerate(introns):
+                intron_id, chrom, strand, start, end, up_start, up_end, \
+                    dn_start, dn_end = intron
+                if chrom not in coverage:
+                    assert (np.isnan(ir["intron_median_cov"][intron_num]))
+                    assert (np.isnan(ir["cov_ratio"][intron_num]))
+                    assert (ir["jxn_reads"][intron_num] == 0)
+                    continue
+                chrom_cov = coverage[chrom]
+                intron_cov = np.median(chrom_cov[start:end + 1])
+                flank_cov = \
+                    np.median(np.concatenate([chrom_cov[up_start:up_end + 1],
+                                              chrom_cov[dn_start:dn_end + 1]]))
+                assert (ir["intron_median_cov"][intron_num] == intron_cov)
+                assert (ir["flank_median_cov"][intron_num] == flank_cov)
+                if flank_cov > 0:
+                    assert (np.allclose(ir["cov_ratio"][intron_num],
+                                        intron_cov / flank_cov))
+                else:
+                    assert (np.isnan(ir["cov_ratio"][intron_num]))
+                assert (ir["jxn_reads"][intron_num] == \
+                        jxn_counts[chrom].get((start, end), 0))
+        assert (ir["jxn_reads"].sum() > 0)
+        ir_filename = os.path.join(self.tmp_dir, "introns.ir.txt")
+        intron_retention_utils.output_intron_retention(introns, ir,
+                                                       ir_filename)
+        lines = open(ir_filename).readlines()
+        assert (lines[0].strip().split("\t") == \
+                intron_retention_utils.IR_TABLE_HEADER)
+        assert (len(lines) == len(introns) + 1)
+
+
+    def test_load_introns(self):
+        """
+        Test loading introns of RI events and of intron GFFs.
+        """
+        print "Testing loading of introns"
+        ri_introns = \
+            intron_retention_utils.load_ri_introns(test_utils.load_test_data(os.path.join("ri-test",
+                                                                                          "RI.gff3")))
+        assert (len(ri_introns) > 0)
+        intron_id, chrom, strand, start, end, up_start, up_end, \
+            dn_start, dn_end = ri_introns[0]
+        assert (intron_id == "chr7:128533529:128533513:-@" \
+                             "chr7:128533510:128533445:-")
+        assert ((chrom, strand) == ("chr7", "-"))
+        assert ((up_start, up_end, start, end, dn_start, dn_end) == \
+                (128533445, 128533510, 128533511, 128533512,
+                 128533513, 128533529))
+        gff_filename = os.path.join(self.tmp_dir, "introns.gff")
+        with open(gff_filename, "w") as gff_out:
+            gff_out.write("##gff-version 3\n")
+            gff_out.write("chr1\tensGene\tintron\t30\t100\t.\t+\t.\t" \
+                          "ID=intron1;Parent=gene1\n")
+            gff_out.write("chr1\tensGene\texon\t101\t200\t.\t+\t.\t" \
+                          "ID=exon1;Parent=gene1\n")
+        assert (intron_retention_utils.load_gff_introns(gff_filename,
+                                                        flank_len=50) == \
+                [("intron1", "chr1", "+", 30, 100, 1, 29, 101, 150)])
@@ -0,0 +1,172 @@
+##
+## Unit testing for counting splice junctions from spliced
+## alignments, against parsing the CIGAR strings directly
+##
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.bam.jxn_utils as jxn_utils
+
+
+def get_cigar_jxns(pos, cigar):
+    """
+    Return the junctions of a CIGAR string aligned at a 1-based
+    position, as (start, end, overhang) tuples.
+    """
+    ops = [(int(op_len), op) for op_len, op in \
+           re.findall(r"(\d+)([MIDNSHP=X])", cigar)]
+    aligned_len = sum(op_len for op_len, op in ops if op in "M=X")
+    jxns = []
+    ref_pos = pos
+    left_len = 0
+    for op_len, op in ops:
+        if op == "N":
+            jxns.append((ref_pos, ref_pos + op_len - 1,
+                         min(left_len, aligned_len - left_len)))
+        if op in "M=X":
+            left_len += op_len
+        if op in "M=XDN":
+            ref_pos += op_len
+    return jxns
+
+
+class TestJxnUtils:
+    """
+    Test counting junctions in BAM files.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_jxn_utils.")
+        self.refs = [("chr1", 10000), ("chr2", 10000), ("chr3", 10000)]
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def make_reads(self, num_reads):
+        """
+        Return random SAM lines of spliced and unspliced reads,
+        some multi-mapping or without a strand.
+        """
+        read_lines = []
+        cigars = ["30M", "10M200N20M", "5M1I4M50N20M", "12M300N6M2D12M",
+                  "8M100N8M100N14M", "3S10M500N17M", "10M5=15X"]
+        for read_num in xrange(num_reads):
+            chrom = self.refs[self.rand.randint(0, len(self.refs))][0]
+            pos = self.rand.randint(1, 5) * 100 + 1
+            cigar = cigars[self.rand.randint(0, len(cigars))]
+            tags = []
+            strand = self.rand.choice(["+", "-", None])
+            if strand is not None:
+                tags.append("XS:A:%s" %(strand))
+            tags.append("NH:i:%d" %(self.rand.randint(1, 3)))
+            read_len = sum(int(op_len) for op_len, op in \
+                           re.findall(r"(\d+)([MIDNSHP=X])", cigar) \
+                           if op in "MIS=X")
+            read_lines.append(["read%d" %(read_num), 0, chrom, pos, 255,
+                               cigar, "*", 0, 0, "A" * read_len,
+                               "I" * read_len] + tags)
+        # An unmapped read
+        read_lines.append(["unmapped", 4, "*", 0, 0, "*", "*", 0, 0,
+                           "ACGT", "IIII"])
+        return read_lines
+
+
+    def get_expected_records(self, read_lines):
+        """
+        Count junctions of SAM lines by their CIGAR strings.
+        """
+        jxn_counts = {}
+        for fields in read_lines:
+            if fields[2] == "*":
+                continue
+            tags = dict((tag.split(":")[0], tag.split(":")[2]) \
+                        for tag in fields[11:])
+            strand = tags.get("XS", ".")
+            is_unique = (int(tags["NH"]) == 1)
+            for start, end, overhang in get_cigar_jxns(fields[3], fields[5]):
+                jxn = (fields[2], start, end, strand)
+                counts = jxn_counts.setdefault(jxn, [0, 0, 0, []])
+                counts[0 if is_unique else 1] += 1
+                counts[2] = max(counts[2], overhang)
+                counts[3].append(overhang)
+        chrom_order = [ref[0] for ref in self.refs]
+        return [jxn + (counts[0], counts[1], counts[2], np.mean(counts[3])) \
+                for jxn, counts in \
+                sorted(jxn_counts.items(),
+                       key=lambda item: (chrom_order.index(item[0][0]),
+                                         item[0][1:]))]
+
+
+    def test_count_bam_jxns(self):
+        """
+        Test counting junctions per chromosome, serially and in
+        parallel.
+        """
+        print "Testing counting of junctions"
+        read_lines = self.make_reads(500)
+        bam_filename = test_utils.make_test_bam(os.path.join(self.tmp_dir,
+                                                             "reads.bam"),
+                                                self.refs, read_lines)
+        expected = self.get_expected_records(read_lines)
+        assert (len(expected) > 0)
+        for num_processors in [1, 2]:
+            jxn_records = \
+                jxn_utils.count_bam_jxns(bam_filename,
+                                         num_processors=num_processors)
+            assert ([record[0:7] for record in jxn_records] == \
+                    [record[0:7] for record in expected])
+            assert (np.allclose([record[7] for record in jxn_records],
+                                [record[7] for record in expected]))
+
+
+    def test_jxn_output(self):
+        """
+        Test outputting and loading junction tables and outputting
+        junction by sample matrices.
+        """
+        print "Testing output of junctions"
+        sample_records = []
+        for sample_num in xrange(2):
+            read_lines = self.make_reads(200)
+            bam_filename = \
+                test_utils.make_test_bam(os.path.join(self.tmp_dir,
+                                                      "reads%d.bam" %(sample_num)),
+                                         self.refs, read_lines)
+            sample_records.append(jxn_utils.count_bam_jxns(bam_filename))
+        table_filename = os.path.join(self.tmp_dir, "jxns.txt")
+        jxn_utils.output_jxn_table(sample_records[0], table_filename)
+        loaded_records = jxn_utils.load_jxn_table(table_filename)
+        assert ([record[0:7] for record in loaded_records] == \
+                [record[0:7] for record in sample_records[0]])
+        output_prefix = os.path.join(self.tmp_dir, "jxns")
+        jxn_utils.output_jxn_matrix(["s1", "s2"], sample_records,
+                                    output_prefix, count_type="total")
+        jxn_ids = open("%s.jxns.txt" %(output_prefix)).read().split()
+        matrix_lines = open("%s.mtx" %(output_prefix)).readlines()
+        num_rows, num_cols, num_entries = map(int, matrix_lines[1].split())
+        assert ((num_rows, num_cols) == (len(jxn_ids), 2))
+        assert (num_entries == len(matrix_lines) - 2)
+        found = {}
+        for line in matrix_lines[2:]:
+            row, col, count = map(int, line.split())
+            found[(jxn_ids[row - 1], col - 1)] = count
+        expected = {}
+        for col, records in enumerate(sample_records):
+            for record in records:
+                if record[4] + record[5] > 0:
+                    expected[(jxn_utils.jxn_to_str(*record[0:4]), col)] = \
+                        record[4] + record[5]
+        assert (found == expected)
+        assert (open("%s.samples.txt" %(output_prefix)).read().split() == \
+                ["s1", "s2"])
@@ -0,0 +1,249 @@
+##
+## Unit testing for screening events by junction and body read
+## counts, against brute force read placements
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.miso.psi_screen_utils as psi_screen_utils
+
+# Skipped exon events: inclusion and exclusion isoform exons
+SE_EVENTS = [("se1", "chr1", "+", [(101, 200), (301, 350), (501, 600)],
+              [(101, 200), (501, 600)]),
+             ("se2", "chr1", "-", [(1001, 1100), (1201, 1300), (1401, 1500)],
+              [(1001, 1100), (1401, 1500)]),
+             ("se3", "chr2", "+", [(101, 150), (201, 260), (301, 400)],
+              [(101, 150), (301, 400)])]
+
+
+def output_events_gff(gff_filename):
+    """
+    Output the skipped exon events, and an event with three
+    isoforms, as an events GFF3 file.
+    """
+    with open(gff_filename, "w") as gff_out:
+        gff_out.write("##gff-version 3\n")
+        events = SE_EVENTS + \
+            [("three_isoforms", "chr2", "+", [(1001, 1100)], [(1201, 1300)],
+              [(1401, 1500)])]
+        for event in events:
+            event_id, chrom, strand = event[0:3]
+            isoforms = event[3:]
+            gff_out.write("\t".join([chrom, "SE", "gene",
+                                     str(isoforms[0][0][0]),
+                                     str(isoforms[0][-1][1]), ".", strand,
+                                     ".", "ID=%s;Name=%s" %(event_id,
+                                                            event_id)]) + "\n")
+            for iso_num, exons in enumerate(isoforms):
+                mRNA_id = "%s.%s" %(event_id, "AB"[iso_num % 2] + \
+                                    str(iso_num))
+                gff_out.write("\t".join([chrom, "SE", "mRNA",
+                                         str(exons[0][0]), str(exons[-1][1]),
+                                         ".", strand, ".",
+                                         "ID=%s;Parent=%s" %(mRNA_id,
+                                                             event_id)]) + "\n")
+                for exon_num, (start, end) in enumerate(exons):
+                    gff_out.write("\t".join([chrom, "SE", "exon", str(start),
+                                             str(end), ".", strand, ".",
+                                             "ID=%s.%d;Parent=%s" \
+                                             %(mRNA_id, exon_num,
+                                               mRNA_id)]) + "\n")
+
+
+def get_positions(exons):
+    return [pos for start, end in sorted(exons) \
+            for pos in xrange(start, end + 1)]
+
+
+def get_placements(exons, read_len):
+    """
+    Return the genomic positions covered by each placement of a
+    read on an isoform.
+    """
+    positions = get_positions(exons)
+    return [tuple(positions[pos:pos + read_len]) \
+            for pos in xrange(len(positions) - read_len + 1)]
+
+
+def get_blocks(placement):
+    """
+    Return the (start, end) blocks of consecutive positions.
+    """
+    blocks = [[placement[0], placement[0]]]
+    for pos in placement[1:]:
+        if pos == blocks[-1][1] + 1:
+            blocks[-1][1] = pos
+        else:
+            blocks.append([pos, pos])
+    return [tuple(block) for block in blocks]
+
+
+class TestPsiScreen:
+    """
+    Test counting event reads and screening events by Psi.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_psi_screen.")
+        self.gff_filename = os.path.join(self.tmp_dir, "SE.gff3")
+        output_events_gff(self.gff_filename)
+        self.events = \
+            psi_screen_utils.load_two_isoform_events(self.gff_filename)
+        self.refs = [("chr1", 5000), ("chr2", 5000)]
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def test_load_events(self):
+        """
+        Test loading two-isoform events.
+        """
+        print "Testing loading of events"
+        assert ([event["event_id"] for event in self.events] == \
+                [event[0] for event in SE_EVENTS])
+        for event, se_event in zip(self.events, SE_EVENTS):
+            assert ((event["chrom"], event["strand"]) == se_event[1:3])
+            assert (event["exons"] == list(se_event[3:5]))
+            assert (event["mRNA_starts"] == [se_event[3][0][0],
+                                             se_event[4][0][0]])
+            assert (event["mRNA_ends"] == [se_event[3][-1][1],
+                                           se_event[4][-1][1]])
+
+
+    def test_unique_placements(self):
+        """
+        Test counting read placements unique to each isoform
+        against enumerating placements.
+        """
+        print "Testing unique read placements"
+        for read_len in [1, 10, 36, 60, 1000]:
+            inc_lens, exc_lens = \
+                psi_screen_utils.get_events_unique_lens(self.events, read_len)
+            for event_num, event in enumerate(self.events):
+                inc_placements = get_placements(event["exons"][0], read_len)
+                exc_placements = get_placements(event["exons"][1], read_len)
+                assert (inc_lens[event_num] == \
+                        len(set(inc_placements) - set(exc_placements)))
+                assert (exc_lens[event_num] == \
+                        len(set(exc_placements) - set(inc_placements)))
+
+
+    def test_count_event_reads(self):
+        """
+        Test counting inclusion, exclusion and shared reads.
+        """
+        print "Testing counting of event reads"
+        read_len = 30
+        read_lines = []
+        expected = np.zeros((len(self.events), 3), dtype=np.int64)
+        for read_num in xrange(1000):
+            event_num = self.rand.randint(0, len(self.events))
+            event = self.events[event_num]
+            iso_num = self.rand.randint(0, 2)
+            placements = get_placements(event["exons"][iso_num], read_len)
+            placement = placements[self.rand.randint(0, len(placements))]
+            in_inc = placement in \
+                set(get_placements(event["exons"][0], read_len))
+            in_exc = placement in \
+                set(get_placements(event["exons"][1], read_len))
+            expected[event_num, (in_inc + 2 * in_exc) - 1] += 1
+            blocks = get_blocks(placement)
+            cigar = "%dM" %(blocks[0][1] - blocks[0][0] + 1)
+            for block_num in xrange(1, len(blocks)):
+                cigar += "%dN%dM" %(blocks[block_num][0] - \
+                                    blocks[block_num - 1][1] - 1,
+                                    blocks[block_num][1] - \
+                                    blocks[block_num][0] + 1)
+            read_lines.append(["read%d" %(read_num), 0, event["chrom"],
+                               blocks[0][0], 255, cigar, "*", 0, 0,
+                               "A" * read_len, "I" * read_len])
+        bam_filename = test_utils.make_test_bam(os.path.join(self.tmp_dir,
+                                                             "reads.bam"),
+                                                self.refs, read_lines)
+        event_counts = psi_screen_utils.count_event_reads(bam_filename,
+                                                          self.events)
+        assert ((event_counts == expected).all())
+        # Summary in MISO's format
+        event_psis = psi_screen_utils.screen_events(bam_filename,
+                                                    self.events, read_len)
+        summary_filename = os.path.join(self.tmp_dir, "SE.miso_summary")
+        psi_screen_utils.output_screen_summary(self.events, event_psis,
+                                               summary_filename)
+        lines = [line.strip("\n").split("\t") \
+                 for line in open(summary_filename)]
+        assert (lines[0] == psi_screen_utils.SUMMARY_HEADER)
+        for event_num, fields in enumerate(lines[1:]):
+            inc_count, exc_count, both_count = expected[event_num]
+            assert (fields[0] == self.events[event_num]["event_id"])
+            assert (fields[5] == "(0,1):%d,(1,0):%d,(1,1):%d" \
+                    %(exc_count, inc_count, both_count))
+            assert (fields[6] == "0:%d,1:%d" %(inc_count, exc_count))
+            assert (float(fields[2]) <= float(fields[1]) <= float(fields[3]))
+
+
+    def test_compute_psi(self):
+        """
+        Test Psi estimates and confidence intervals.
+        """
+        print "Testing Psi estimates"
+        psi, ci_low, ci_high = \
+            psi_screen_utils.compute_psi([10, 0, 5, 0, 50],
+                                         [10, 10, 0, 0, 50],
+                                         [200, 100, 100, 100, 0],
+                                         [100, 100, 100, 100, 100])
+        # Equal counts, inclusion isoform twice as long
+        assert (np.allclose(psi[0], 1 / 3.))
+        assert (ci_low[0] < psi[0] < ci_high[0])
+        assert (np.allclose(psi[1:3], [0., 1.]))
+        assert (ci_high[1] > 0 and ci_low[2] < 1)
+        # No reads, or no unique inclusion placements
+        assert (np.isnan(psi[3:]).all() and np.isnan(ci_low[3:]).all())
+        # Intervals narrow with more reads
+        psi, ci_low, ci_high = \
+            psi_screen_utils.compute_psi([10, 1000], [30, 3000],
+                                         [100, 100], [100, 100])
+        assert (np.allclose(psi, [0.25, 0.25]))
+        assert ((ci_high[1] - ci_low[1]) < (ci_high[0] - ci_low[0]))
+
+
+    def test_screened_events(self):
+        """
+        Test selecting events by coverage and Psi variability, and
+        outputting their records.
+        """
+        print "Testing screening of events"
+        samples_event_psis = \
+            [{"counts": np.array([[30, 30, 0], [5, 5, 0], [30, 30, 0]]),
+              "psi": np.array([0.5, 0.5, 0.5])},
+             {"counts": np.array([[30, 30, 0], [30, 30, 0], [0, 0, 0]]),
+              "psi": np.array([0.55, 0.9, np.nan])}]
+        # se1 does not vary enough, and se2 and se3 are covered in
+        # only one sample each
+        assert (psi_screen_utils.get_screened_events(self.events,
+                                                     samples_event_psis) == \
+                [])
+        assert (psi_screen_utils.get_screened_events(self.events,
+                                                     samples_event_psis[0:1]) == \
+                ["se1", "se3"])
+        assert (psi_screen_utils.get_screened_events(self.events,
+                                                     samples_event_psis,
+                                                     min_counts=10,
+                                                     min_delta_psi=0.05) == \
+                ["se1", "se2"])
+        screened_filename = os.path.join(self.tmp_dir, "SE.screened.gff3")
+        psi_screen_utils.output_events_gff(self.gff_filename, ["se2"],
+                                           screened_filename)
+        screened_events = \
+            psi_screen_utils.load_two_isoform_events(screened_filename)
+        assert ([event["event_id"] for event in screened_events] == ["se2"])
+        assert (screened_events[0]["exons"] == self.events[1]["exons"])
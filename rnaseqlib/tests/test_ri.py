@@ -20,12 +20,10 @@ def test_ri():
         [data_filename("ri-test/ensGene.txt")]
 #         data_filename("ri-test/knownGene.txt"),
 #         data_filename("ri-test/refGene.txt")]
-    DtoA_F, AtoD_F, DtoA_R, AtoD_R = \
-        def_events.prepareSplicegraph(*table_fnames)
+    sg = def_events.prepareSplicegraph(*table_fnames)
     ri_fname = data_filename("ri-test/RI.gff3")
     print "Making RI..."
-    def_events.RI(DtoA_F, AtoD_F, DtoA_R, AtoD_R, ri_fname,
-                  multi_iso=False)
+    def_events.RI(sg, ri_fname, multi_iso=False)
             
 
 def main():
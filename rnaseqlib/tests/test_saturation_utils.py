@@ -0,0 +1,126 @@
+##
+## Unit testing for saturation curves, against subsampling
+## reads at each level separately
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.bam.saturation_utils as saturation_utils
+
+
+class TestSaturationUtils:
+    """
+    Test computing saturation curves of genes and junctions.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_saturation_utils.")
+        self.refs = [("chr1", 10000), ("chr2", 10000)]
+        # Genes with overlapping exons: gene2 overlaps gene1
+        self.gene_exons = [("gene1", "chr1", [101, 501], [300, 700]),
+                           ("gene2", "chr1", [601, 1001], [900, 1200]),
+                           ("gene3", "chr2", [101, 151, 2001], [200, 400, 2300]),
+                           ("gene4", "chrNone", [1], [100])]
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def make_reads(self, num_reads):
+        """
+        Return random SAM lines and their (read name, chrom, 1-based
+        position, junction) info, where junction is None for
+        unspliced reads.
+        """
+        read_lines = []
+        reads = []
+        for read_num in xrange(num_reads):
+            chrom = self.refs[self.rand.randint(0, len(self.refs))][0]
+            pos = self.rand.randint(1, 2500)
+            read_name = "read%d" %(read_num)
+            if self.rand.rand() < 0.3:
+                intron_len = self.rand.choice([100, 200])
+                cigar = "10M%dN10M" %(intron_len)
+                jxn = (chrom, pos + 10, pos + 10 + intron_len - 1)
+            else:
+                cigar = "20M"
+                jxn = None
+            read_lines.append([read_name, 0, chrom, pos, 255, cigar,
+                               "*", 0, 0, "A" * 20, "I" * 20])
+            reads.append((read_name, chrom, pos, jxn))
+        return read_lines, reads
+
+
+    def get_read_gene(self, chrom, pos):
+        """
+        Return the one gene whose exons cover a position, or None.
+        """
+        genes = set(gene_id for gene_id, gene_chrom, starts, ends \
+                    in self.gene_exons if gene_chrom == chrom \
+                    for start, end in zip(starts, ends) \
+                    if start <= pos <= end)
+        if len(genes) != 1:
+            return None
+        return genes.pop()
+
+
+    def test_compute_saturation(self):
+        """
+        Test saturation curves against subsampling reads at each
+        level.
+        """
+        print "Testing saturation curves"
+        read_lines, reads = self.make_reads(2000)
+        bam_filename = test_utils.make_test_bam(os.path.join(self.tmp_dir,
+                                                             "reads.bam"),
+                                                self.refs, read_lines)
+        num_levels = 10
+        for min_reads, chunk_size in [(1, 500000), (3, 7)]:
+            saturation = \
+                saturation_utils.compute_saturation(bam_filename,
+                                                    self.gene_exons,
+                                                    num_levels=num_levels,
+                                                    min_reads=min_reads,
+                                                    chunk_size=chunk_size)
+            assert (len(saturation) == num_levels)
+            for level in xrange(num_levels):
+                subsample = \
+                    [read for read in reads \
+                     if saturation_utils.get_read_subsample_bin(read[0],
+                                                                num_levels) \
+                     <= level]
+                gene_counts = {}
+                jxn_counts = {}
+                for read_name, chrom, pos, jxn in subsample:
+                    gene_id = self.get_read_gene(chrom, pos)
+                    if gene_id is not None:
+                        gene_counts[gene_id] = gene_counts.get(gene_id, 0) + 1
+                    if jxn is not None:
+                        jxn_counts[jxn] = jxn_counts.get(jxn, 0) + 1
+                assert (saturation[level]["fraction"] == \
+                        (level + 1) / float(num_levels))
+                assert (saturation[level]["num_reads"] == len(subsample))
+                assert (saturation[level]["num_genes"] == \
+                        len([count for count in gene_counts.values() \
+                             if count >= min_reads]))
+                assert (saturation[level]["num_jxns"] == \
+                        len([count for count in jxn_counts.values() \
+                             if count >= min_reads]))
+        # Full sample detects at least as much as any subsample
+        assert (all(saturation[level]["num_genes"] <= \
+                    saturation[level + 1]["num_genes"] \
+                    for level in xrange(num_levels - 1)))
+        saturation_filename = os.path.join(self.tmp_dir, "saturation.txt")
+        saturation_utils.output_saturation(saturation, saturation_filename)
+        lines = open(saturation_filename).readlines()
+        assert (len(lines) == num_levels + 1)
+        assert (lines[-1].split("\t")[1] == str(len(reads)))
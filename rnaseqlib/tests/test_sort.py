@@ -0,0 +1,74 @@
+##
+## Unit testing for external sorting of interval files, against
+## sorting in memory
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.sort_utils as sort_utils
+
+
+class TestSort:
+    """
+    Test sorting interval files.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_sort.")
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def check_sort_file(self, file_format, start_col, max_mem_mb):
+        """
+        Sort a random file and compare it to sorting its lines
+        in memory.
+        """
+        header_lines = ["track name=test\n", "# comment\n"]
+        lines = []
+        for line_num in xrange(2000):
+            fields = ["chr%d" %(self.rand.randint(1, 4)),
+                      "x", "exon", "1", "1", ".", "+", ".",
+                      "ID=line%d" %(line_num)]
+            fields[start_col] = str(self.rand.randint(1, 500))
+            lines.append("\t".join(fields) + "\n")
+        input_fname = os.path.join(self.tmp_dir,
+                                   "input.%s" %(file_format))
+        with open(input_fname, "w") as input_file:
+            input_file.write(header_lines[0])
+            input_file.writelines(lines[0:1000])
+            input_file.write(header_lines[1])
+            input_file.write("\n")
+            input_file.writelines(lines[1000:])
+        output_fname = os.path.join(self.tmp_dir,
+                                    "output.%s" %(file_format))
+        sort_utils.sort_file(input_fname, output_fname,
+                             max_mem_mb=max_mem_mb)
+        expected_lines = \
+            header_lines + \
+            sorted(lines, key=lambda line: (line.split("\t")[0],
+                                            int(line.split("\t")[start_col])))
+        assert (open(output_fname).readlines() == expected_lines)
+        # Spilled chunks are removed
+        assert (not any(fname.startswith("sort_chunk.") \
+                        for fname in os.listdir(self.tmp_dir)))
+
+
+    def test_sort_file(self):
+        """
+        Test sorting BED and GFF files in memory and with chunks
+        spilled to disk.
+        """
+        print "Testing sorting of interval files"
+        for max_mem_mb in [sort_utils.DEFAULT_MAX_MEM_MB, 0.01]:
+            self.check_sort_file("bed", 1, max_mem_mb)
+            self.check_sort_file("gff", 3, max_mem_mb)
@@ -0,0 +1,133 @@
+##
+## Unit testing for parsing UCSC tables into arrays and caching
+## the parsed tables, against parsing the table line by line
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tables as tables
+
+
+def get_gene_info(gene):
+    """
+    Return the attributes of a gene and its transcripts, for
+    comparison.
+    """
+    return (gene.label, gene.chrom, gene.strand, gene.gene_symbol,
+            [(transcript.label, transcript.parent, transcript.cds_start,
+              transcript.cds_end,
+              [(part.start, part.end, part.chrom, part.strand) \
+               for part in transcript.parts]) \
+             for transcript in gene.transcripts])
+
+
+class TestTables:
+    """
+    Test parsing and caching gene tables.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_tables.")
+        self.table_dir = os.path.join(self.tmp_dir, "ucsc")
+        self.ensGene_fname, self.gene_table = \
+            test_utils.make_test_gene_table(self.tmp_dir, self.table_dir)
+        self.cache_fname = self.gene_table.get_table_cache_filename("ensGene")
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def test_parse_int_lists(self):
+        """
+        Test parsing delimited lists of integers.
+        """
+        print "Testing parsing of integer lists"
+        for trial in xrange(50):
+            int_lists = [list(self.rand.randint(0, 10**9,
+                                                self.rand.randint(0, 5))) \
+                         for list_num in xrange(self.rand.randint(0, 10))]
+            # Lists with and without a trailing delimiter, and
+            # empty lists
+            list_strs = [",".join(map(str, l)) + \
+                         ("," if len(l) > 0 and self.rand.rand() < 0.5 \
+                          else "") \
+                         for l in int_lists]
+            ints, offsets = tables.parse_int_lists(list_strs)
+            assert (len(offsets) == len(int_lists) + 1)
+            for list_num, l in enumerate(int_lists):
+                assert (ints[offsets[list_num]:offsets[list_num + 1]].tolist() == \
+                        l)
+
+
+    def test_parse_table_arrays(self):
+        """
+        Test parsing a table into arrays against parsing it line
+        by line.
+        """
+        print "Testing parsing of table into arrays"
+        table_arrays = \
+            tables.parse_ucsc_table_arrays(self.ensGene_fname,
+                                           tables.UCSC_ENSGENE_HEADER)
+        lines = [line.strip("\n").split("\t") \
+                 for line in open(self.ensGene_fname)]
+        header = tables.UCSC_ENSGENE_HEADER
+        for trans_num, fields in enumerate(lines):
+            entry = dict(zip(header, fields))
+            assert (table_arrays["trans_ids"][trans_num] == entry["name"])
+            assert (table_arrays["gene_ids"][trans_num] == entry["name2"])
+            assert (table_arrays["chroms"][trans_num] == entry["chrom"])
+            assert (table_arrays["strands"][trans_num] == entry["strand"])
+            assert (table_arrays["cds_starts"][trans_num] == \
+                    int(entry["cdsStart"]) + 1)
+            assert (table_arrays["cds_ends"][trans_num] == \
+                    int(entry["cdsEnd"]))
+            first_exon = table_arrays["exon_offsets"][trans_num]
+            last_exon = table_arrays["exon_offsets"][trans_num + 1]
+            assert (table_arrays["exon_starts"][first_exon:last_exon].tolist() == \
+                    [int(start) + 1 \
+                     for start in entry["exonStarts"].rstrip(",").split(",")])
+            assert (table_arrays["exon_ends"][first_exon:last_exon].tolist() == \
+                    [int(end) for end in entry["exonEnds"].rstrip(",").split(",")])
+
+
+    def test_table_cache(self):
+        """
+        Test that genes loaded from the parsed table cache match
+        genes parsed from the table, and that changing the table
+        invalidates the cache.
+        """
+        print "Testing parsed table cache"
+        genes = self.gene_table.get_ensGene_by_genes(self.ensGene_fname,
+                                                     use_cache=False)
+        expected = sorted(map(get_gene_info, genes.values()))
+        assert (not os.path.isfile(self.cache_fname))
+        for load_num in xrange(2):
+            # The first load makes the cache, the second reads it
+            gene_table = tables.GeneTable(self.table_dir, "ensGene")
+            genes = gene_table.get_ensGene_by_genes(self.ensGene_fname)
+            assert (os.path.isfile(self.cache_fname))
+            assert (sorted(map(get_gene_info, genes.values())) == expected)
+        table_checksum = \
+            tables.utils.get_file_checksum(self.ensGene_fname)
+        assert (tables.load_table_cache(self.cache_fname,
+                                        table_checksum) is not None)
+        assert (tables.load_table_cache(self.cache_fname, "other") is None)
+        # Drop the last gene from the table
+        lines = open(self.ensGene_fname).readlines()
+        last_gene = lines[-1].split("\t")[12]
+        with open(self.ensGene_fname, "w") as ensGene_out:
+            ensGene_out.writelines([line for line in lines \
+                                    if line.split("\t")[12] != last_gene])
+        gene_table = tables.GeneTable(self.table_dir, "ensGene")
+        genes = gene_table.get_ensGene_by_genes(self.ensGene_fname)
+        assert (sorted(map(get_gene_info, genes.values())) == \
+                [info for info in expected if info[0] != last_gene])
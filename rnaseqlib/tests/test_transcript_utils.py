@@ -0,0 +1,228 @@
+##
+## Unit testing for transcript quantification by EM over
+## equivalence classes, against brute force compatibility
+## and the EM fixed point
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.rpkm.transcript_utils as transcript_utils
+
+
+def is_compatible(exon_coords, read_blocks):
+    """
+    Return True if read blocks are compatible with a transcript's
+    sorted exons, by checking each block against each exon.
+    """
+    block_exons = []
+    for start, end in read_blocks:
+        containing = [exon_num for exon_num, (exon_start, exon_end) \
+                      in enumerate(exon_coords) \
+                      if exon_start <= start and end <= exon_end]
+        if len(containing) == 0:
+            return False
+        block_exons.append(containing[0])
+    for block_num in xrange(len(read_blocks) - 1):
+        exon_num = block_exons[block_num]
+        if block_exons[block_num + 1] != exon_num + 1 or \
+           exon_coords[exon_num][1] != read_blocks[block_num][1] or \
+           exon_coords[exon_num + 1][0] != read_blocks[block_num + 1][0]:
+            return False
+    return True
+
+
+def get_trans_read_blocks(exon_coords, trans_start, read_len):
+    """
+    Return the genomic blocks of a read starting at a 0-based
+    transcript position.
+    """
+    blocks = []
+    exon_offset = 0
+    remaining = read_len
+    for exon_start, exon_end in exon_coords:
+        exon_len = exon_end - exon_start + 1
+        if trans_start < exon_offset + exon_len and remaining > 0:
+            start = exon_start + max(0, trans_start - exon_offset)
+            end = min(exon_end, start + remaining - 1)
+            blocks.append((start, end))
+            remaining -= end - start + 1
+        exon_offset += exon_len
+    return blocks
+
+
+def get_blocks_cigar(read_blocks):
+    """
+    Return the CIGAR string of read blocks separated by junctions.
+    """
+    cigar = "%dM" %(read_blocks[0][1] - read_blocks[0][0] + 1)
+    for block_num in xrange(1, len(read_blocks)):
+        prev_end = read_blocks[block_num - 1][1]
+        start, end = read_blocks[block_num]
+        cigar += "%dN%dM" %(start - prev_end - 1, end - start + 1)
+    return cigar
+
+
+class TestTranscriptUtils:
+    """
+    Test finding compatible transcripts, counting equivalence
+    classes and EM.
+    """
+    def setup(self):
+        self.rand = np.random.RandomState(1)
+        self.tmp_dir = tempfile.mkdtemp(prefix="test_transcript_utils.")
+        self.refs = [("chr1", 5000), ("chr2", 5000)]
+        self.trans_records = \
+            [("gene1", "T0", "chr1", [(101, 200), (301, 400), (501, 600)]),
+             ("gene1", "T1", "chr1", [(501, 600), (101, 200)]),
+             ("gene2", "T2", "chr1", [(151, 250), (301, 450)]),
+             ("gene3", "T3", "chr2", [(101, 300)]),
+             ("gene3", "T4", "chr2", [(101, 200), (251, 300)])]
+        self.trans_index = transcript_utils.TranscriptIndex(self.trans_records)
+
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+    def get_random_read(self, read_len):
+        """
+        Return the chrom and blocks of a random read, from a
+        transcript or from random positions.
+        """
+        gene_id, trans_id, chrom, exon_coords = \
+            self.trans_records[self.rand.randint(0, len(self.trans_records))]
+        exon_coords = sorted(exon_coords)
+        if self.rand.rand() < 0.8:
+            trans_len = sum(end - start + 1 for start, end in exon_coords)
+            trans_start = self.rand.randint(0, trans_len - read_len + 1)
+            return chrom, get_trans_read_blocks(exon_coords, trans_start,
+                                                read_len)
+        start = self.rand.randint(50, 600)
+        if self.rand.rand() < 0.5:
+            return chrom, [(start, start + read_len - 1)]
+        intron_len = self.rand.randint(1, 150)
+        return chrom, [(start, start + 9),
+                       (start + 10 + intron_len,
+                        start + intron_len + read_len - 1)]
+
+
+    def get_expected_transcripts(self, chrom, read_blocks):
+        return [trans_num for trans_num, record in \
+                enumerate(self.trans_records) \
+                if record[2] == chrom and \
+                is_compatible(sorted(record[3]), read_blocks)]
+
+
+    def test_compatible_transcripts(self):
+        """
+        Test finding transcripts compatible with reads.
+        """
+        print "Testing compatible transcripts"
+        assert (self.trans_index.trans_lens.tolist() == \
+                [300, 200, 250, 200, 150])
+        for read_num in xrange(2000):
+            chrom, read_blocks = self.get_random_read(30)
+            trans_inds = \
+                self.trans_index.get_compatible_transcripts(chrom, read_blocks)
+            assert (sorted(trans_inds.tolist()) == \
+                    self.get_expected_transcripts(chrom, read_blocks))
+
+
+    def test_count_equiv_classes(self):
+        """
+        Test counting equivalence classes of single and paired
+        reads in a BAM file.
+        """
+        print "Testing counting of equivalence classes"
+        read_len = 30
+        read_lines = []
+        expected_counts = {}
+        expected_unassigned = 0
+        for read_num in xrange(1000):
+            read_name = "read%d" %(read_num)
+            chrom, read_blocks = self.get_random_read(read_len)
+            trans_inds = set(self.get_expected_transcripts(chrom, read_blocks))
+            is_paired = (self.rand.rand() < 0.5)
+            if is_paired:
+                # A random mate on the same chromosome
+                mate_chrom, mate_blocks = self.get_random_read(read_len)
+                if mate_chrom != chrom:
+                    mate_chrom, mate_blocks = chrom, read_blocks
+                trans_inds &= \
+                    set(self.get_expected_transcripts(mate_chrom, mate_blocks))
+                for flag, blocks, other_blocks in \
+                    [(99, read_blocks, mate_blocks),
+                     (147, mate_blocks, read_blocks)]:
+                    read_lines.append([read_name, flag, chrom, blocks[0][0],
+                                       255, get_blocks_cigar(blocks), "=",
+                                       other_blocks[0][0], 0,
+                                       "A" * read_len, "I" * read_len])
+            else:
+                read_lines.append([read_name, 0, chrom, read_blocks[0][0],
+                                   255, get_blocks_cigar(read_blocks),
+                                   "*", 0, 0, "A" * read_len, "I" * read_len])
+            if len(trans_inds) == 0:
+                expected_unassigned += 1
+            else:
+                equiv_class = tuple(sorted(trans_inds))
+                expected_counts[equiv_class] = \
+                    expected_counts.get(equiv_class, 0) + 1
+        # Secondary and unmapped reads are skipped
+        read_lines.append(["secondary", 256, "chr1", 101, 255, "30M", "*",
+                           0, 0, "A" * read_len, "I" * read_len])
+        read_lines.append(["unmapped", 4, "*", 0, 0, "*", "*", 0, 0,
+                           "A" * read_len, "I" * read_len])
+        bam_filename = test_utils.make_test_bam(os.path.join(self.tmp_dir,
+                                                             "reads.bam"),
+                                                self.refs, read_lines)
+        equiv_counts, num_unassigned = \
+            transcript_utils.count_equiv_classes(bam_filename,
+                                                 self.trans_index)
+        assert (equiv_counts == expected_counts)
+        assert (num_unassigned == expected_unassigned)
+
+
+    def test_run_em(self):
+        """
+        Test that EM estimates are a fixed point of the EM update
+        and sum to the number of reads.
+        """
+        print "Testing EM"
+        eff_lens = self.trans_index.get_eff_lens(50)
+        assert (eff_lens.tolist() == [251, 151, 201, 151, 101])
+        assert (self.trans_index.get_eff_lens(1000).tolist() == [1] * 5)
+        for trial in xrange(20):
+            equiv_counts = {}
+            for equiv_class in [(0,), (0, 1), (0, 1, 2), (2,), (3, 4), (4,)]:
+                if self.rand.rand() < 0.8:
+                    equiv_counts[equiv_class] = self.rand.randint(1, 100)
+            trans_counts = transcript_utils.run_em(equiv_counts, eff_lens,
+                                                   tol=1e-12)
+            total_counts = sum(equiv_counts.values())
+            assert (np.allclose(trans_counts.sum(), total_counts))
+            # Transcripts without compatible reads get no reads
+            seen = set(trans_num for equiv_class in equiv_counts \
+                       for trans_num in equiv_class)
+            for trans_num in xrange(len(eff_lens)):
+                if trans_num not in seen:
+                    assert (trans_counts[trans_num] == 0)
+            # One more EM update leaves the estimates unchanged
+            updated = np.zeros(len(eff_lens))
+            for equiv_class, count in equiv_counts.iteritems():
+                probs = np.array([trans_counts[t] / eff_lens[t] \
+                                  for t in equiv_class])
+                for t, prob in zip(equiv_class, probs):
+                    updated[t] += count * prob / probs.sum()
+            assert (np.allclose(updated, trans_counts, atol=1e-4))
+            tpms = transcript_utils.compute_tpms(trans_counts, eff_lens)
+            assert (np.allclose(tpms.sum(), 1e6))
+        assert ((transcript_utils.run_em({}, eff_lens) == 0).all())
+        assert ((transcript_utils.compute_tpms(np.zeros(5), eff_lens) == 0).all())
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import glob
 
 TESTDIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -12,7 +13,70 @@ def load_test_data(name):
     if not os.path.isfile(test_fname):
         raise Exception, "Cannot find %s" %(test_fname)
     return test_fname
-    
-    
-    
-    
+
+
+def touch_within_second(filename, mtime):
+    """
+    Set the modification time of a file to a different time
+    within the same second as 'mtime'.
+    """
+    new_mtime = int(mtime) + 0.25
+    if new_mtime == mtime:
+        new_mtime = int(mtime) + 0.75
+    os.utime(filename, (new_mtime, new_mtime))
+
+
+def make_test_gene_table(output_dir, table_dir):
+    """
+    Combine the test ensGene tables into one table in output_dir,
+    and make a gene table in table_dir (with a minimal kgXref
+    table, which gene tables need) to load it with.
+
+    Returns the combined table filename and the gene table.
+    """
+    import rnaseqlib.tables as tables
+    ensGene_fname = os.path.join(output_dir, "ensGene.txt")
+    table_fnames = \
+        sorted(glob.glob(os.path.join(TESTDIR, "test_data", "hg19",
+                                      "ensGene.hg19.*.txt")))
+    with open(ensGene_fname, "w") as ensGene_out:
+        for table_fname in table_fnames:
+            ensGene_out.write(open(table_fname).read())
+    if not os.path.isdir(table_dir):
+        os.makedirs(table_dir)
+    with open(os.path.join(table_dir, "kgXref.txt"), "w") as kgXref_out:
+        kgXref_out.write("\t".join(["uc001aaa.1", "mRNA", "spID",
+                                    "spDisplayID", "geneSymbol",
+                                    "refseq", "protAcc",
+                                    "description"]) + "\n")
+    gene_table = tables.GeneTable(table_dir, "ensGene")
+    return ensGene_fname, gene_table
+
+
+def make_test_bam(bam_filename, refs, read_lines):
+    """
+    Output a sorted and indexed BAM file of alignments.
+
+    'refs' is a list of (name, length) pairs and 'read_lines' a
+    list of SAM alignment lines, each a list of fields.
+    """
+    import pysam
+    sam_filename = "%s.sam" %(bam_filename)
+    with open(sam_filename, "w") as sam_out:
+        sam_out.write("@HD\tVN:1.0\tSO:unsorted\n")
+        for ref_name, ref_len in refs:
+            sam_out.write("@SQ\tSN:%s\tLN:%d\n" %(ref_name, ref_len))
+        for fields in read_lines:
+            sam_out.write("\t".join(map(str, fields)) + "\n")
+    sam_file = pysam.Samfile(sam_filename, "r")
+    unsorted_filename = "%s.unsorted.bam" %(bam_filename)
+    bam_out = pysam.Samfile(unsorted_filename, "wb", template=sam_file)
+    for read in sam_file:
+        bam_out.write(read)
+    bam_out.close()
+    sam_file.close()
+    pysam.sort("-o", bam_filename, unsorted_filename)
+    pysam.index(bam_filename)
+    os.remove(sam_filename)
+    os.remove(unsorted_filename)
+    return bam_filename
@@ -8,6 +8,9 @@ import datetime
 from time import gmtime, strftime
 import glob
 import re
+import gzip
+import shutil
+import hashlib
 
 import operator
 
@@ -145,32 +148,42 @@ def make_dir(dirpath):
     
 def gunzip_file(filename, output_dir,
                 ext=".txt",
-                force=True,
                 unless_exists=True):
     """
     Unzip the file into the given output directory.
 
     If file ends with .gz, strip the .gz. Otherwise,
     add a .txt at the end.
+
+    'filename' is a path as given (relative paths are relative
+    to the current directory, not to output_dir). The file is
+    uncompressed to a temporary file that is moved into place
+    once complete, overwriting any existing file unless
+    'unless_exists' is set, and the compressed file is then
+    removed (as gunzip does).
     """
     print "Unzipping: %s into directory %s" %(filename,
                                               output_dir)
-    if filename.endswith(".gz"):
-        unzipped_filename = filename[0:-3]
+    unzipped_basename = os.path.basename(filename)
+    if unzipped_basename.endswith(".gz"):
+        unzipped_basename = unzipped_basename[0:-3]
     else:
-        unzipped_filename = "%s.%s" %(filename,
-                                      ext)
+        unzipped_basename = "%s%s" %(unzipped_basename,
+                                     ext)
+    unzipped_filename = os.path.join(output_dir, unzipped_basename)
     print "  - Unzipped filename: %s" %(unzipped_filename)
     if unless_exists and os.path.isfile(unzipped_filename):
         print "  - File exists, skipping.."
         return unzipped_filename
-    os.chdir(output_dir)
-    gunzip = "gunzip "
-    if force:
-        gunzip += "--force"
-    os.system("%s %s > %s" %(gunzip,
-                             filename,
-                             unzipped_filename))
+    tmp_unzipped_filename = "%s.tmp" %(unzipped_filename)
+    gzip_in = gzip.open(filename, "rb")
+    try:
+        with open(tmp_unzipped_filename, "wb") as unzipped_out:
+            shutil.copyfileobj(gzip_in, unzipped_out)
+    finally:
+        gzip_in.close()
+    os.rename(tmp_unzipped_filename, unzipped_filename)
+    os.remove(filename)
     return unzipped_filename
     
     
@@ -223,6 +236,20 @@ def count_lines(fname, skipstart="#"):
         num_lines += 1
     return num_lines
 
+
+def get_file_checksum(fname, block_size=2**20):
+    """
+    Return the MD5 checksum of a file (as a hex string).
+    """
+    checksum = hashlib.md5()
+    with open(fname, "rb") as file_in:
+        while True:
+            data = file_in.read(block_size)
+            if not data:
+                break
+            checksum.update(data)
+    return checksum.hexdigest()
+
 ##
 ## Misc. utilities for manipulating strings/lists
 ##